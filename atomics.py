@@ -0,0 +1,47 @@
+"""Instructions for the atomic read-modify-write built-ins (nodes.ATOMICS).
+
+Each operation reads a qword, computes the new value and writes it back
+as one indivisible step, so threads updating the same variable or array
+element never lose each other's updates. Every operation returns the
+value the qword held before; atomic_compare_exchange only writes when
+that value was the expected one.
+
+On x86-64 the operations are single locked instructions (xchg locks
+itself), which are also full memory barriers. ARM64 uses load-acquire /
+store-release exclusive loops that retry until no other core wrote the
+qword in between; these assemble for any ARMv8 core, unlike the LSE
+instructions.
+"""
+
+# x86-64: the value (the expected value for atomic_compare_exchange) is in
+# rax and the new value in rcx; the old value is left in rax.
+X86 = {
+    'atomic_add': ['lock xadd {target}, rax'],
+    'atomic_sub': ['neg rax', 'lock xadd {target}, rax'],
+    'atomic_exchange': ['xchg {target}, rax'],
+    'atomic_compare_exchange': ['lock cmpxchg {target}, rcx'],
+}
+
+# ARM64: the address is in x1, the value (or expected value) in x2 and the
+# new value in x3; the old value is left in x0. x4 and w5 are scratch.
+ARM64 = {
+    'atomic_add': ['add x4, x0, x2', 'stlxr w5, x4, [x1]'],
+    'atomic_sub': ['sub x4, x0, x2', 'stlxr w5, x4, [x1]'],
+    'atomic_exchange': ['stlxr w5, x2, [x1]'],
+    'atomic_compare_exchange': ['cmp x0, x2', 'b.ne {label}_done', 'stlxr w5, x3, [x1]'],
+}
+
+
+def x86(name, target):
+    """Lines performing atomic operation name on the qword memory operand target."""
+    return [f'    {line.format(target=target)}' for line in X86[name]]
+
+
+def arm64(name, label):
+    """Lines performing atomic operation name on the qword x1 points to; label must be unique."""
+    lines = [f'{label}:', '    ldaxr x0, [x1]']
+    lines += [f'    {line.format(label=label)}' for line in ARM64[name]]
+    lines.append(f'    cbnz w5, {label}')
+    if name == 'atomic_compare_exchange':
+        lines += [f'{label}_done:', '    clrex']
+    return lines
@@ -0,0 +1,890 @@
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import tracing
+from compile_cache import CompilationCache
+from code_generator import LinuxCodeGenerator
+from compiler import compile_to_asm
+from data_layout import CACHE_LINE, thread_writers
+from dead_code import DeadCodeEliminator
+from lexer import Lexer, RegexLexer
+from loop_optimizer import LoopUnroller
+from nodes import global_variables, iter_child_nodes
+from parser import Parser, RecursiveDescentParser
+from peephole import PEEPHOLE_RULES, PeepholeOptimizer
+from x86_simulator import X86Simulator
+
+SAMPLE_PROGRAM = """
+li = new[9]
+i = 10
+
+while i < 18
+ li[i-11] = i   # store into the heap array
+ print i
+ print li[i-11]
+ i = i+1
+end
+delete li
+
+function add(a, b)
+    return a + b
+end
+
+if i >= 18
+    print add(i, 2) * -3
+else
+    print i != 4
+end
+"""
+
+
+def generated_source(copies):
+    """Builds a large machine-generated style program from SAMPLE_PROGRAM."""
+    return SAMPLE_PROGRAM * copies
+
+
+def best_time(func, repeat):
+    """Runs func repeat times with stdout discarded and returns the fastest run."""
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def bench_lexer(copies, repeat):
+    source = generated_source(copies)
+    print(f"Lexer benchmark: {len(source.splitlines())} lines, {len(source)} chars")
+    baseline = None
+    for name, lexer_class in (('Lexer', Lexer), ('RegexLexer', RegexLexer)):
+        elapsed, tokens = best_time(lambda: lexer_class(source).tokenize(), repeat)
+        rate = len(tokens) / elapsed
+        if baseline is None:
+            baseline = elapsed
+        print(f"  {name:<12} {len(tokens):>9} tokens  {elapsed * 1000:9.2f} ms  "
+              f"{rate:14,.0f} tokens/s  x{baseline / elapsed:.2f}")
+
+
+PEAK_RSS_SCRIPT = """
+import sys
+from lexer import RegexLexer
+from parser import Parser, RecursiveDescentParser
+from peephole import PEEPHOLE_RULES, PeepholeOptimizer
+import benchmark
+source = benchmark.generated_source(int(sys.argv[1]))
+lexer = RegexLexer(source)
+tokens = lexer.tokenize() if sys.argv[2] == 'list' else lexer.iter_tokens()
+Parser(tokens).parse()
+with open('/proc/self/status') as status:
+    print([line.split()[1] for line in status if line.startswith('VmHWM:')][0])
+"""
+
+
+def peak_rss_kib(copies, mode):
+    """Peak RSS of a fresh interpreter that parses the generated source.
+
+    A subprocess is used because tracemalloc imports the standard library
+    'token' module, which this repository's token.py shadows. The peak is
+    read from /proc (VmHWM), so this is only available on Linux.
+    """
+    if not os.path.exists('/proc/self/status'):
+        return None
+    result = subprocess.run([sys.executable, '-c', PEAK_RSS_SCRIPT, str(copies), mode],
+                            capture_output=True, text=True, check=True)
+    return int(result.stdout.split()[-1])
+
+
+def bench_stream(copies, repeat):
+    source = generated_source(copies)
+    print(f"Front end benchmark: {len(source.splitlines())} lines")
+    runs = (
+        ('token list', 'list', lambda: Parser(RegexLexer(source).tokenize()).parse()),
+        ('token stream', 'stream', lambda: Parser(RegexLexer(source).iter_tokens()).parse()),
+    )
+    for name, mode, func in runs:
+        elapsed, _ = best_time(func, repeat)
+        peak = peak_rss_kib(copies, mode)
+        peak_text = 'n/a' if peak is None else f'{peak:,} KiB'
+        print(f"  {name:<12} {elapsed * 1000:9.2f} ms  peak RSS {peak_text}")
+
+
+class DictToken:
+    """The token layout before __slots__: a per-instance __dict__ and no span."""
+    def __init__(self, type_, value=None):
+        self.type = type_
+        self.value = value
+
+
+def object_bytes(obj):
+    """Bytes owned by a single token or node, not counting shared children."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    span = getattr(obj, 'span', 0)
+    if span > 256:  # small ints are shared by the interpreter
+        size += sys.getsizeof(span)
+    return size
+
+
+DICT_NODE_CLASSES = {}
+
+
+def dict_node_bytes(node):
+    """Size of the same node as a plain dict-backed object."""
+    name = type(node).__name__
+    legacy_class = DICT_NODE_CLASSES.get(name)
+    if legacy_class is None:
+        legacy_class = DICT_NODE_CLASSES[name] = type('Dict' + name, (), {})
+    legacy = legacy_class()
+    for field in node.__slots__:
+        setattr(legacy, field, getattr(node, field))
+    if name == 'VarAssignNode':
+        legacy.var_name_token = node.left_node   # stored twice before
+        legacy.value = node.value_node
+    return object_bytes(legacy)
+
+
+def bench_memory(copies, repeat):
+    source = generated_source(copies)
+    tokens = RegexLexer(source).tokenize()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ast = Parser(tokens).parse()
+    nodes = []
+    pending = list(ast)
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending.extend(iter_child_nodes(node))
+    token_before = sum(object_bytes(DictToken(t.type, t.value)) for t in tokens) / len(tokens)
+    token_after = sum(object_bytes(t) for t in tokens) / len(tokens)
+    node_before = sum(dict_node_bytes(n) for n in nodes) / len(nodes)
+    node_after = sum(object_bytes(n) for n in nodes) / len(nodes)
+    print(f"Memory benchmark: {len(tokens)} tokens, {len(nodes)} nodes")
+    print(f"  bytes/token  dict {token_before:7.1f}  slots {token_after:7.1f}")
+    print(f"  bytes/node   dict {node_before:7.1f}  slots {node_after:7.1f}")
+
+
+def bench_trace(copies, repeat):
+    source = generated_source(copies)
+    print(f"Tracing benchmark: compile {len(source.splitlines())} lines for linux-x86_64")
+    with tempfile.TemporaryDirectory() as tmp:
+        asm_path = os.path.join(tmp, 'bench.asm')
+        for spec in ('', 'all=info', 'all=trace'):
+            sink = io.StringIO()
+            tracing.configure(spec, output=sink)
+            try:
+                elapsed, _ = best_time(lambda: compile_to_asm(source, asm_path, target='linux'), repeat)
+            finally:
+                tracing.configure('')
+            print(f"  trace {spec or 'off':<10} {elapsed * 1000:9.2f} ms  {sink.tell() / repeat / 1024:10.1f} KiB traced per run")
+
+
+def bench_expr(copies, repeat):
+    terms = max(copies, 10)
+    cases = (
+        ('sum', ' + '.join(f'a{i % 7}' for i in range(terms))),
+        ('mixed', ' + '.join(f'(a{i % 7} - {i}) * b < c' for i in range(terms // 4))),
+        ('deep', '(' * 100 + '1' + ' + b)' * 100),
+        ('very deep', '(' * terms + '1' + ' + b)' * terms),
+    )
+    print(f"Expression parser benchmark ({terms} terms)")
+    for case, source in cases:
+        tokens = RegexLexer(source).tokenize()
+        baseline = None
+        for name, parser_class in (('recursive', RecursiveDescentParser), ('precedence', Parser)):
+            try:
+                elapsed, _ = best_time(lambda: parser_class(tokens).expression(), repeat)
+            except RecursionError:
+                print(f"  {case:<10} {name:<11}  RecursionError")
+                continue
+            speedup = f"x{baseline / elapsed:.2f}" if baseline else ""
+            baseline = baseline or elapsed
+            print(f"  {case:<10} {name:<11} {elapsed * 1000:9.2f} ms  {speedup}")
+
+
+def bench_cache(copies, repeat):
+    source = generated_source(copies)
+    print(f"Compilation cache benchmark: {len(source.splitlines())} lines for linux-x86_64")
+    with tempfile.TemporaryDirectory() as tmp:
+        asm_path = os.path.join(tmp, 'bench.asm')
+        cache = CompilationCache(os.path.join(tmp, 'cache'))
+        uncached, _ = best_time(lambda: compile_to_asm(source, asm_path, target='linux'), repeat)
+        cold, _ = best_time(lambda: (cache.clear(), compile_to_asm(source, asm_path, target='linux', cache=cache)), repeat)
+        warm, _ = best_time(lambda: compile_to_asm(source, asm_path, target='linux', cache=cache), repeat)
+        print(f"  no cache   {uncached * 1000:9.2f} ms")
+        print(f"  cold cache {cold * 1000:9.2f} ms")
+        print(f"  warm cache {warm * 1000:9.2f} ms  x{uncached / warm:.1f}")
+        print(f"  {cache.format_stats()}")
+
+
+def function_heavy_source(copies):
+    """A program made mostly of distinct top-level functions."""
+    parts = []
+    for i in range(copies):
+        parts.append(f"""
+function f{i}(a, b)
+    total = 0
+    while a < b
+        if a * {i % 7 + 2} > b - 1
+            total = total + a * (b - {i}) / 3
+        else
+            total = total - (a + {i}) * 2
+        end
+        a = a + 1
+    end
+    return total
+end
+""")
+    parts.append("print f0(1, 10)\n")
+    return ''.join(parts)
+
+
+def bench_parallel(copies, repeat):
+    source = function_heavy_source(copies)
+    print(f"Parallel compilation benchmark: {copies} functions, {len(source.splitlines())} lines")
+    with tempfile.TemporaryDirectory() as tmp:
+        asm_path = os.path.join(tmp, 'bench.asm')
+        serial = None
+        for jobs in sorted({1, 2, 4, os.cpu_count() or 1}):
+            elapsed, _ = best_time(lambda: compile_to_asm(source, asm_path, target='linux', jobs=jobs), repeat)
+            speedup = f"x{serial / elapsed:.2f}" if serial else ""
+            serial = serial or elapsed
+            print(f"  jobs {jobs:<3} {elapsed * 1000:9.2f} ms  {speedup}")
+
+
+KERNELS = {
+    'sum of squares': """
+s = 0
+i = 0
+while i < 20000000
+    s = s + i * i - (i - 3) * 2
+    i = i + 1
+end
+print s
+""",
+    'nested loops': """
+total = 0
+i = 0
+while i < 4000
+    j = 0
+    while j < 4000
+        if (i + j) / 2 > j
+            total = total + i - j
+        else
+            total = total + 1
+        end
+        j = j + 1
+    end
+    i = i + 1
+end
+print total
+""",
+    'array walk': """
+n = 1000
+a = new[1000]
+k = 0
+while k < n
+    a[k] = k * 7
+    k = k + 1
+end
+round = 0
+acc = 0
+while round < 5000
+    k = 0
+    while k < n
+        acc = acc + a[k] - round
+        k = k + 1
+    end
+    round = round + 1
+end
+print acc
+""",
+}
+
+
+def instruction_counts(asm_code):
+    """(instructions, stack operations, memory operands) in the generated code."""
+    instructions = [line for line in asm_code.splitlines() if line.startswith('    ')]
+    stack = sum(1 for line in instructions if line.split()[0] in ('push', 'pop'))
+    memory = sum(1 for line in instructions if '[' in line)
+    return len(instructions), stack, memory
+
+
+def native_runtime(asm_code, tmp, repeat):
+    """Best wall time of the program built with nasm and gcc, or None without the toolchain."""
+    nasm, gcc = shutil.which('nasm'), shutil.which('gcc')
+    if not nasm or not gcc or not sys.platform.startswith('linux'):
+        return None
+    asm_path, obj_path, exe_path = (os.path.join(tmp, 'kernel' + ext) for ext in ('.asm', '.o', ''))
+    with open(asm_path, 'w') as f:
+        f.write(asm_code)
+    subprocess.run([nasm, '-f', 'elf64', '-o', obj_path, asm_path], check=True)
+    subprocess.run([gcc, '-no-pie', '-o', exe_path, obj_path], check=True)
+    elapsed, _ = best_time(lambda: subprocess.run([exe_path], check=True, capture_output=True), repeat)
+    return elapsed
+
+
+def bench_regalloc(copies, repeat):
+    print("Register allocation benchmark (linux-x86_64): instructions / push+pop / memory operands, runtime")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, source in KERNELS.items():
+            ast = Parser(RegexLexer(source).iter_tokens()).parse()
+            baseline = None
+            for label, enabled in (('stack', False), ('registers', True)):
+                asm_code = LinuxCodeGenerator(register_allocation=enabled).generate(ast)
+                counts = '{:5d} / {:4d} / {:4d}'.format(*instruction_counts(asm_code))
+                elapsed = native_runtime(asm_code, tmp, repeat)
+                if elapsed is None:
+                    runtime = 'runtime n/a (needs nasm and gcc on Linux)'
+                else:
+                    runtime = f"{elapsed * 1000:9.2f} ms" + (f"  x{baseline / elapsed:.2f}" if baseline else "")
+                    baseline = baseline or elapsed
+                print(f"  {name:<15} {label:<10} {counts}  {runtime}")
+
+
+def operator_kernel(statement):
+    """A loop running statement, which reads x, 10 million times."""
+    return f"""
+acc = 0
+a = new[16]
+x = 1
+while x < 10000000
+    {statement}
+    x = x + 1
+end
+print acc
+"""
+
+
+OPERATOR_KERNELS = {
+    'x * 8': operator_kernel("acc = acc + x * 8"),
+    'x * 10': operator_kernel("acc = acc + x * 10"),
+    'x / 8': operator_kernel("acc = acc + x / 8"),
+    'x / 7': operator_kernel("acc = acc + x / 7"),
+    'a[x / 1000000 + 1]': operator_kernel("acc = acc + a[x / 1000000 + 1]"),
+}
+
+
+def bench_strength(copies, repeat):
+    print("Strength reduction benchmark (linux-x86_64): instructions, runtime with imul/idiv vs reduced")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, source in OPERATOR_KERNELS.items():
+            ast = Parser(RegexLexer(source).iter_tokens()).parse()
+            baseline = None
+            for label, enabled in (('imul/idiv', False), ('reduced', True)):
+                asm_code = LinuxCodeGenerator(strength_reduction=enabled).generate(ast)
+                count = instruction_counts(asm_code)[0]
+                elapsed = native_runtime(asm_code, tmp, repeat)
+                if elapsed is None:
+                    runtime = 'runtime n/a (needs nasm and gcc on Linux)'
+                else:
+                    runtime = f"{elapsed * 1000:9.2f} ms" + (f"  x{baseline / elapsed:.2f}" if baseline else "")
+                    baseline = baseline or elapsed
+                print(f"  {name:<20} {label:<10} {count:4d}  {runtime}")
+
+
+def loop_kernel(setup, body, result):
+    """A counting loop like the README's, as a function of its trip count."""
+    return lambda trips: f"""
+{setup}
+i = 0
+while i < {trips}
+    {body}
+    i = i + 1
+end
+print {result}
+"""
+
+
+LOOP_KERNELS = {
+    'count': loop_kernel("j = 1", "j = j + 1", "j"),
+    'invariant': loop_kernel("k = 12\ns = 0", "s = s + i * (k + 3) - k * k", "s"),
+    'array sum': loop_kernel("a = new[16]\na[3] = 5\ns = 0", "s = s + a[3] + i", "s"),
+}
+LOOP_CONFIGURATIONS = (('top-tested', False, 1), ('rotated', True, 1), ('unrolled x4', True, 4))
+
+
+def bench_loops(copies, repeat):
+    print("Loop optimization benchmark (linux-x86_64): instructions, instructions executed for 1000 trips "
+          "(simulated), runtime for 20 million trips")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, kernel in LOOP_KERNELS.items():
+            baseline = None
+            for label, enabled, factor in LOOP_CONFIGURATIONS:
+                def generate(trips):
+                    ast = LoopUnroller(factor).unroll(Parser(RegexLexer(kernel(trips)).iter_tokens()).parse())
+                    return LinuxCodeGenerator(loop_optimization=enabled).generate(ast)
+                simulator = X86Simulator(generate(1000), 'linux')
+                simulator.run()
+                asm_code = generate(20000000)
+                count = instruction_counts(asm_code)[0]
+                elapsed = native_runtime(asm_code, tmp, repeat)
+                if elapsed is None:
+                    runtime = 'runtime n/a (needs nasm and gcc on Linux)'
+                else:
+                    runtime = f"{elapsed * 1000:9.2f} ms" + (f"  x{baseline / elapsed:.2f}" if baseline else "")
+                    baseline = baseline or elapsed
+                print(f"  {name:<10} {label:<12} {count:4d} {simulator.steps:7d}  {runtime}")
+
+
+def frame_kernel(functions, main, globals_prelude=None):
+    """A program calling functions, as a function of its size and of where their variables live.
+
+    With as_globals the top level first runs globals_prelude, which mentions
+    the functions' variables and so makes them .bss globals, as all variables
+    were before functions had stack frames. Kernels without a prelude need
+    frames (recursion).
+    """
+    def source(size, as_globals):
+        prelude = globals_prelude if as_globals else ''
+        return f"{prelude}\n{functions}\n{main}".replace('{size}', str(size))
+    source.has_globals_variant = globals_prelude is not None
+    return source
+
+
+FRAME_KERNELS = {
+    'recursive fib': (frame_kernel("""
+function fib(n)
+    if n < 2
+        return n
+    end
+    a = fib(n - 1)
+    b = fib(n - 2)
+    return a + b
+end
+""", "print fib({size})"), 15, 30),
+    'call in loop': (frame_kernel("""
+function sq(x)
+    return x * x
+end
+function sum_squares(limit)
+    k = 0
+    s = 0
+    while k < limit
+        s = s + sq(k)
+        k = k + 1
+    end
+    return s
+end
+""", "print sum_squares({size})", "k = 0\ns = 0"), 1000, 20000000),
+    # The main program spins until the thread publishes its result, so the runtime includes the thread.
+    'threaded': (frame_kernel("""
+threaded function worker()
+    k = 0
+    s = 0
+    while k < {size}
+        s = s + k * 3
+        k = k + 1
+    end
+    total = s + 1
+end
+""", """
+total = 0
+spins = 0
+worker()
+while total == 0
+    spins = spins + 1
+end
+print total
+""", "k = 0\ns = 0"), 1000, 100000000),
+}
+
+
+def bench_frames(copies, repeat):
+    print("Stack frame benchmark (linux-x86_64): instructions / memory operands, instructions executed "
+          "(simulated, small size), runtime (large size)")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (kernel, simulated, native) in FRAME_KERNELS.items():
+            baseline = None
+            for label, as_globals in (('globals', True), ('frame', False)):
+                if as_globals and not kernel.has_globals_variant:
+                    continue
+                def generate(size):
+                    source = kernel(size, as_globals)
+                    return LinuxCodeGenerator().generate(Parser(RegexLexer(source).iter_tokens()).parse())
+                simulator = X86Simulator(generate(simulated), 'linux')
+                simulator.run()
+                asm_code = generate(native)
+                count, _, memory = instruction_counts(asm_code)
+                elapsed = native_runtime(asm_code, tmp, repeat)
+                if elapsed is None:
+                    runtime = 'runtime n/a (needs nasm and gcc on Linux)'
+                else:
+                    runtime = f"{elapsed * 1000:9.2f} ms" + (f"  x{baseline / elapsed:.2f}" if baseline else "")
+                    baseline = baseline or elapsed
+                print(f"  {name:<14} {label:<8} {count:4d} / {memory:3d} {simulator.steps:8d}  {runtime}")
+
+
+
+# Recursive kernels: {depth} calls deep, run {reps} times. The native depth
+# stays within the default 8 MB stack even when every call takes a frame.
+TAIL_CALL_KERNELS = {
+    'accumulate': """
+function sum_to(n, acc)
+    if n == 0
+        return acc
+    end
+    return sum_to(n - 1, acc + n)
+end
+r = 0
+t = 0
+while r < {reps}
+    t = t + sum_to({depth}, r)
+    r = r + 1
+end
+print t
+""",
+    'mutual': """
+function is_even(n)
+    if n == 0
+        return 1
+    end
+    return is_odd(n - 1)
+end
+function is_odd(n)
+    if n == 0
+        return 0
+    end
+    return is_even(n - 1)
+end
+r = 0
+t = 0
+while r < {reps}
+    t = t + is_even({depth} + r)
+    r = r + 1
+end
+print t
+""",
+}
+
+
+def bench_tail_calls(copies, repeat):
+    print("Tail call benchmark (linux-x86_64): instructions executed and deepest stack "
+          "(simulated, 1000 deep), runtime (100000 deep, 200 times)")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, kernel in TAIL_CALL_KERNELS.items():
+            baseline = None
+            for label, enabled in (('call', False), ('jump', True)):
+                def generate(depth, reps):
+                    source = kernel.replace('{depth}', str(depth)).replace('{reps}', str(reps))
+                    ast = Parser(RegexLexer(source).iter_tokens()).parse()
+                    return LinuxCodeGenerator(tail_calls=enabled).generate(ast)
+                simulator = X86Simulator(generate(1000, 1), 'linux')
+                simulator.run()
+                elapsed = native_runtime(generate(100000, 200), tmp, repeat)
+                if elapsed is None:
+                    runtime = 'runtime n/a (needs nasm and gcc on Linux)'
+                else:
+                    runtime = f"{elapsed * 1000:9.2f} ms" + (f"  x{baseline / elapsed:.2f}" if baseline else "")
+                    baseline = baseline or elapsed
+                print(f"  {name:<11} {label:<5} {simulator.steps:7d} {simulator.stack_bytes:7d} B  {runtime}")
+
+
+def library_source(functions):
+    """A program using 3 of a library of helper functions, a few scratch variables each."""
+    helpers = ''.join(f"""
+function helper{n}(x)
+    scratch{n} = x * {n}
+    unused{n} = scratch{n} + 1
+    return scratch{n} + x
+end
+""" for n in range(functions))
+    return helpers + "total = 0\nlog = 0\ntotal = helper0(1) + helper1(2) + helper2(3)\nprint total\n"
+
+
+def bench_dead_code(copies, repeat):
+    print("Dead code benchmark (linux-x86_64): instructions / .bss slots without and with the pass, pass time")
+    for functions in (10, 100, max(copies // 4, 100)):
+        source = library_source(functions)
+        counts = []
+        for eliminate in (False, True):
+            ast = Parser(RegexLexer(source).iter_tokens()).parse()
+            if eliminate:
+                fresh = [Parser(RegexLexer(source).iter_tokens()).parse() for _ in range(repeat)]
+                elapsed, _ = best_time(lambda: DeadCodeEliminator().eliminate(fresh.pop()), repeat)
+                eliminator = DeadCodeEliminator()
+                ast = eliminator.eliminate(ast)
+            asm_code = LinuxCodeGenerator().generate(ast)
+            counts.append(f"{instruction_counts(asm_code)[0]:6d} / {asm_code.count('resq'):3d}")
+        print(f"  {functions:5d} functions  {counts[0]}  ->  {counts[1]}  {elapsed * 1000:8.2f} ms"
+              f"  ({eliminator.format_stats()})")
+
+SPAWN_KERNEL = """
+threaded function task()
+    work = work + 1
+end
+work = 0
+n = 0
+while n < {spawns}
+    task()
+    n = n + 1
+end
+print n
+"""
+
+
+def bench_thread_pool(copies, repeat):
+    print("Thread pool benchmark (linux-x86_64): per threaded call, instructions executed and the "
+          "threads created and system calls made that they do not count (simulated), then spawn "
+          "latency and throughput of the whole program")
+    with tempfile.TemporaryDirectory() as tmp:
+        for spawns in (1000, max(copies * 5, 10000)):
+            baseline = None
+            for label, enabled in (('thread', False), ('pool', True)):
+                def generate(count):
+                    ast = Parser(RegexLexer(SPAWN_KERNEL.replace('{spawns}', str(count))).iter_tokens()).parse()
+                    return LinuxCodeGenerator(thread_pool=enabled).generate(ast)
+                simulator = X86Simulator(generate(100), 'linux')
+                simulator.run()
+                # The pool's workers are created once; a thread per call pays for one each time.
+                threads = simulator.library_calls.get('pthread_create', 0) / 100
+                system_calls = simulator.library_calls.get('syscall', 0) / 100
+                elapsed = native_runtime(generate(spawns), tmp, repeat)
+                if elapsed is None:
+                    runtime = 'runtime n/a (needs nasm and gcc on Linux)'
+                else:
+                    runtime = (f"{elapsed / spawns * 1e6:8.2f} us/call  {spawns / elapsed:12,.0f} calls/s"
+                               + (f"  x{baseline / elapsed:.2f}" if baseline else ""))
+                    baseline = baseline or elapsed
+                print(f"  {spawns:6d} calls  {label:<7} {simulator.steps / 100:6.1f} instructions"
+                      f"  {threads:4.2f} threads created  {system_calls:4.2f} system calls  {runtime}")
+
+
+CHUNK_KERNEL = """
+threaded function chunk(start, stop)
+    s = 0
+    i = start
+    while i < stop
+        s = s + data[i] * data[i]
+        i = i + 1
+    end
+    return s
+end
+data = new[{size}]
+k = 0
+while k < {size}
+    data[k] = k
+    k = k + 1
+end
+handles = new[{chunks}]
+c = 0
+while c < {chunks}
+    handles[c] = chunk(c * {step}, c * {step} + {step})
+    c = c + 1
+end
+total = 0
+c = 0
+while c < {chunks}
+    total = total + join(handles[c])
+    c = c + 1
+end
+print total
+"""
+
+
+def bench_join(copies, repeat):
+    print("Join benchmark (linux-x86_64): an array's sum of squares in 1..8 joined chunks, "
+          "instructions executed for 800 elements (simulated, all threads) and runtime")
+    size = max(copies * 50, 100000) // 8 * 8
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = None
+        for chunks in (1, 2, 4, 8):
+            def generate(length):
+                source = CHUNK_KERNEL
+                for name, value in (('size', length), ('chunks', chunks), ('step', length // chunks)):
+                    source = source.replace('{' + name + '}', str(value))
+                return compile_to_asm(source, os.path.join(tmp, 'join.asm'), 'linux')
+            simulator = X86Simulator(generate(800), 'linux')
+            simulator.run()
+            elapsed = native_runtime(generate(size), tmp, repeat)
+            if elapsed is None:
+                runtime = 'runtime n/a (needs nasm and gcc on Linux)'
+            else:
+                runtime = f"{elapsed * 1000:8.2f} ms" + (f"  x{baseline / elapsed:.2f}" if baseline else "")
+                baseline = baseline or elapsed
+            print(f"  {size:7d} elements  {chunks} chunks  {simulator.steps:8d}  {runtime}")
+
+
+COUNTER_KERNEL = """
+threaded function count(n)
+    i = 0
+    while i < n
+        {increment}
+        i = i + 1
+    end
+end
+counter = 0
+handles = new[{threads}]
+t = 0
+while t < {threads}
+    handles[t] = count({share})
+    t = t + 1
+end
+t = 0
+while t < {threads}
+    join(handles[t])
+    t = t + 1
+end
+print counter
+"""
+
+
+def bench_atomics(copies, repeat):
+    print("Atomics benchmark (linux-x86_64): one counter incremented from 1..8 threads, plain (loses "
+          "updates) vs atomic_add; instructions per increment (simulated) and increments/s")
+    increments = max(copies * 500, 1000000) // 8 * 8
+    with tempfile.TemporaryDirectory() as tmp:
+        for threads in (1, 2, 4, 8):
+            for label, increment in (('plain', 'counter = counter + 1'), ('atomic', 'atomic_add(counter, 1)')):
+                def generate(total):
+                    source = COUNTER_KERNEL.replace('{increment}', increment)
+                    source = source.replace('{threads}', str(threads)).replace('{share}', str(total // threads))
+                    return compile_to_asm(source, os.path.join(tmp, 'counter.asm'), 'linux')
+                simulator = X86Simulator(generate(800), 'linux')
+                simulator.run()
+                elapsed = native_runtime(generate(increments), tmp, repeat)
+                if elapsed is None:
+                    runtime = 'runtime n/a (needs nasm and gcc on Linux)'
+                else:
+                    runtime = f"{increments / elapsed:14,.0f} increments/s"
+                print(f"  {threads} threads  {label:<7} {simulator.steps / 800:6.2f}  {runtime}")
+
+
+def bench_locks(copies, repeat):
+    print("Locks benchmark (linux-x86_64): one counter incremented from 1..8 threads with atomic_add vs "
+          "a lock block, and a lock block with --lock-stats; instructions per increment (simulated) and "
+          "increments/s")
+    increments = max(copies * 500, 1000000) // 8 * 8
+    variants = (('atomic', 'atomic_add(counter, 1)', False),
+                ('lock', 'lock counter_lock\n counter = counter + 1\n end', False),
+                ('stats', 'lock counter_lock\n counter = counter + 1\n end', True))
+    with tempfile.TemporaryDirectory() as tmp:
+        for threads in (1, 2, 4, 8):
+            for label, increment, lock_stats in variants:
+                def generate(total):
+                    source = COUNTER_KERNEL.replace('{increment}', increment)
+                    source = source.replace('{threads}', str(threads)).replace('{share}', str(total // threads))
+                    return compile_to_asm(source, os.path.join(tmp, 'counter.asm'), 'linux', lock_stats=lock_stats)
+                simulator = X86Simulator(generate(800), 'linux')
+                simulator.run()
+                elapsed = native_runtime(generate(increments), tmp, repeat)
+                if elapsed is None:
+                    runtime = 'runtime n/a (needs nasm and gcc on Linux)'
+                else:
+                    runtime = f"{increments / elapsed:14,.0f} increments/s"
+                print(f"  {threads} threads  {label:<7} {simulator.steps / 800:6.2f}  {runtime}")
+
+
+def layout_source(threads, share):
+    """threads threaded functions, each adding to a counter of its own, with main's variables around them."""
+    lines = []
+    for k in range(threads):
+        lines += [f"threaded function count{k}(n)", "    i = 0", "    while i < n",
+                  f"        c{k} = c{k} + 1", "        i = i + 1", "    end", "end"]
+    lines += ["step = 1"] + [f"c{k} = 0" for k in range(threads)]
+    lines += [f"h{k} = count{k}({share})" for k in range(threads)]
+    lines += ["total = 0"] + [f"total = total + join(h{k}) + c{k}" for k in range(threads)]
+    lines.append("print total")
+    return '\n'.join(lines) + '\n'
+
+
+def program_globals(simulator, ast):
+    """Name -> address of the globals of the program in ast, runtime symbols left out."""
+    return {name: address for name, address in simulator.symbols.items() if name in global_variables(ast)}
+
+
+def falsely_shared_lines(addresses, writers):
+    """Cache lines holding a global one thread writes and a global it does not."""
+    owners = {}
+    for name, address in addresses.items():
+        owners.setdefault(address // CACHE_LINE, set()).add(frozenset(writers.get(name, ())))
+    return sum(1 for sets in owners.values() if len(sets) > 1 and any(sets))
+
+
+def bench_layout(copies, repeat):
+    print("Cache-line layout benchmark (linux-x86_64): 1..8 threads each incrementing a counter of its own, "
+          "globals packed vs laid out by thread; falsely shared lines, .bss bytes and runtime")
+    increments = max(copies * 500, 1000000)
+    with tempfile.TemporaryDirectory() as tmp:
+        for threads in (1, 2, 4, 8):
+            for label, layout in (('packed', False), ('layout', True)):
+                def generate(share):
+                    ast = Parser(RegexLexer(layout_source(threads, share)).iter_tokens()).parse()
+                    return LinuxCodeGenerator(register_allocation=True, cache_line_layout=layout).generate(ast)
+                simulator = X86Simulator(generate(100), 'linux')
+                simulator.run()
+                ast = Parser(RegexLexer(layout_source(threads, 100)).iter_tokens()).parse()
+                addresses = program_globals(simulator, ast)
+                shared = falsely_shared_lines(addresses, thread_writers(ast))
+                size = max(addresses.values()) + 8 - min(addresses.values())
+                elapsed = native_runtime(generate(increments // threads), tmp, repeat)
+                if elapsed is None:
+                    runtime = 'runtime n/a (needs nasm and gcc on Linux)'
+                else:
+                    runtime = f"{increments / elapsed:14,.0f} increments/s"
+                print(f"  {threads} threads  {label:<7} {shared:2d} falsely shared lines  {size:5d} bytes  {runtime}")
+
+
+def bench_peephole(copies, repeat):
+    print("Peephole benchmark (linux-x86_64): instructions without / with peephole rules, rewrite time")
+    programs = dict(KERNELS, sample=generated_source(max(copies // 20, 1)))
+    for name, source in programs.items():
+        ast = Parser(RegexLexer(source).iter_tokens()).parse()
+        for label, enabled in (('stack', False), ('registers', True)):
+            lines = LinuxCodeGenerator(register_allocation=enabled, peephole=False).generate(ast).splitlines()
+            optimizer = PeepholeOptimizer(PEEPHOLE_RULES['x86_64'])
+            elapsed, optimized = best_time(lambda: optimizer.optimize(lines), repeat)
+            before = instruction_counts('\n'.join(lines))[0]
+            after = instruction_counts('\n'.join(optimized))[0]
+            print(f"  {name:<15} {label:<10} {before:6d} -> {after:6d}  {elapsed * 1000:8.2f} ms")
+            optimizer.stats.clear()
+            optimizer.optimize(lines)
+            print(f"    {optimizer.format_stats()}")
+
+
+SUITES = {
+    'lexer': bench_lexer,
+    'stream': bench_stream,
+    'memory': bench_memory,
+    'trace': bench_trace,
+    'expr': bench_expr,
+    'cache': bench_cache,
+    'parallel': bench_parallel,
+    'regalloc': bench_regalloc,
+    'peephole': bench_peephole,
+    'strength': bench_strength,
+    'loops': bench_loops,
+    'frames': bench_frames,
+    'tailcalls': bench_tail_calls,
+    'deadcode': bench_dead_code,
+    'threadpool': bench_thread_pool,
+    'join': bench_join,
+    'atomics': bench_atomics,
+    'locks': bench_locks,
+    'layout': bench_layout,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HiVe compiler benchmarks")
+    parser.add_argument("suites", nargs="*", default=list(SUITES), help=", ".join(SUITES))
+    parser.add_argument("--copies", type=int, default=2000, help="copies of the sample program")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    for suite in args.suites:
+        SUITES[suite](args.copies, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
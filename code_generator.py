@@ -5,16 +5,87 @@ from token_types import (
 import itertools
 from nodes import *
 import platform
+import tracing
+from peephole import PEEPHOLE_RULES, PeepholeOptimizer
+import thread_pool
+import atomics
+import data_layout
+import locks
+from strength_reduction import (
+    arm64_divide_by_constant, arm64_multiply_by_constant, constant_offset, divide_by_constant,
+    constant_value, displacement, is_power_of_two, multiply_by_constant, reducible_divisor, scaled_index,
+)
+from loop_optimizer import invariant_arrays, invariant_expressions, is_self_contained
+from register_allocator import (
+    ARGUMENT_REGISTERS, BYTE_REGISTERS, CALLER_SAVED_REGISTERS, RegisterAllocator, contains_call,
+)
+from value_numbering import base_key, is_straight_line, repeated_values, straight_line_run, value_key, value_names
+
+# setcc mnemonic for each comparison operator.
+SETCC = {TT_EE: 'sete', TT_NE: 'setne', TT_LT: 'setl', TT_GT: 'setg', TT_LTE: 'setle', TT_GTE: 'setge'}
+# Jumps taken when a comparison is false, for if and while conditions.
+JCC_FALSE = {TT_EE: 'jne', TT_NE: 'je', TT_LT: 'jge', TT_GT: 'jle', TT_LTE: 'jg', TT_GTE: 'jl'}
+JCC_TRUE = {TT_EE: 'je', TT_NE: 'jne', TT_LT: 'jl', TT_GT: 'jg', TT_LTE: 'jle', TT_GTE: 'jge'}
+ARM64_CONDITIONS = {TT_EE: 'eq', TT_NE: 'ne', TT_LT: 'lt', TT_GT: 'gt', TT_LTE: 'le', TT_GTE: 'ge'}
+ARM64_CONDITIONS_FALSE = {TT_EE: 'ne', TT_NE: 'eq', TT_LT: 'ge', TT_GT: 'le', TT_LTE: 'gt', TT_GTE: 'lt'}
+ARITHMETIC = {TT_PLUS: 'add', TT_MINUS: 'sub', TT_MUL: 'imul'}
 
 class CodeGenerator:
-    def __init__(self):
+    abi = 'windows'
+    architecture = 'x86_64'
+    jump = 'jmp'
+
+    def __init__(self, register_allocation=True, peephole=True, strength_reduction=True,
+                 loop_optimization=True, value_numbering=True, tail_calls=True, thread_pool=True,
+                 lock_stats=False, cache_line_layout=True):
         self.asm_code = []
+        self.function_code = []  # the code of each function generated, in order
         self.functions = {}
         self.labels = 0
         self.variables = {}
         self.string_constants = []
         self.current_function_end_label = None
+        self.current_function = None  # the FunctionDefNode being generated
         self.variable_scopes = [{}]
+        # Names the top-level statements use; only these are .bss globals. The
+        # parameters and other variables of a function live in its frame, which
+        # maps them to their rbp-relative operands while it is generated.
+        self.global_names = set()
+        self.frame = {}
+        # Prepended to generated control-flow labels so separately generated
+        # functions can be merged without clashes.
+        self.label_prefix = ''
+        # With register_allocation=False expressions use the original
+        # push/pop stack machine.
+        self.allocator = RegisterAllocator(self.abi) if register_allocation else None
+        # Rewrites the finished instruction list with the target's peephole rules.
+        self.peephole = PeepholeOptimizer(PEEPHOLE_RULES[self.architecture]) if peephole else None
+        # Multiplication and division by constants use shifts, lea and magic numbers.
+        self.strength_reduction = strength_reduction
+        # While loops are bottom-tested, and with register allocation their
+        # invariant expressions and array bases are kept in registers.
+        self.loop_optimization = loop_optimization
+        # With register allocation, straight-line statements reuse expressions
+        # and array bases computed by earlier ones (value_numbering.py).
+        self.value_numbering = value_numbering
+        # With register allocation, return f(...) jumps to f instead of calling
+        # it, reusing the frame (see emit_tail_call).
+        self.tail_calls = tail_calls
+        # Threaded calls queue work for a pool of worker threads started with
+        # the program (thread_pool.py) instead of creating a thread each.
+        self.thread_pool = thread_pool
+        self.uses_threads = False
+        self.statement = None  # the statement being visited; a call that is one is detached
+        # Lock blocks count acquisitions and contention, and main prints the
+        # counts before exiting (locks.py).
+        self.lock_stats = lock_stats
+        self.held_locks = []  # (FunctionDefNode or None, name) of the lock blocks being generated
+        # Globals are grouped onto cache lines by the threads that use them
+        # (data_layout.py): thread_writers maps a global to the threaded
+        # functions writing it, thread_readers holds every global a thread uses.
+        self.cache_line_layout = cache_line_layout
+        self.thread_writers = {}
+        self.thread_readers = set()
 
     def setup(self):
         """Set up the initial assembly code."""
@@ -42,41 +113,279 @@ class CodeGenerator:
         self.asm_code.append('    mov [heap_handle], rax')
 
     def cleanup(self):
+        self.report_locks()
         self.asm_code.append('    mov ecx, 0')
         self.asm_code.append('    call ExitProcess')
 
-    def generate(self, nodes):
-        """Generate assembly code for the AST."""
+    def generate(self, nodes, compiled_functions=()):
+        """Generate assembly code for the AST.
+
+        compiled_functions holds (asm_lines, variables) pairs from
+        generate_function(), produced separately (e.g. in worker processes)
+        and merged in order as if their definitions had been visited here.
+        """
         self.setup()
+        self.start_thread_pool(nodes)
 
         # Initialize symbol tables
         self.variables = {}
         self.variable_scopes = [{}]
+        self.global_names = global_variables(nodes)
+        if self.allocator is not None:
+            self.allocator.shared_variables |= threaded_function_variables(nodes)
+        self.find_thread_globals(nodes)
+        for asm_lines, variables in compiled_functions:
+            self.merge_function(asm_lines, variables)
 
         # Visit each node in the AST
-        for node in nodes:
-            self.visit(node)
+        self.visit_statements(nodes)
 
         # Add cleanup code
         self.cleanup()
+        self.place_functions()
 
-        bss_vars = []
-        for var_name, var_info in self.variables.items():
-            if var_info['type'] == 'scalar':
-                bss_vars.append(f'{var_name}: resq 1')
-            elif var_info['type'] == 'array':
-                total_size = var_info.get('size', 1)
-                bss_vars.append(f'{var_name}: resq {total_size}')
-            elif var_info['type'] == 'dynamic_array':
-                bss_vars.append(f'{var_name}: resq 1')
+        bss_vars = self.bss_section()
         if bss_vars:
             text_idx = self.asm_code.index('section .text')
             self.asm_code = self.asm_code[:text_idx] + bss_vars + self.asm_code[text_idx:]
+        self.add_thread_pool()
+        self.add_locks()
+        self.run_peephole()
 
         # Join all assembly code
         return '\n'.join(self.asm_code)
 
 
+    def start_thread_pool(self, nodes):
+        """Starts the workers in main's prologue if the program has threaded functions."""
+        self.uses_threads = thread_pool.uses_threads(nodes, self.functions)
+        if self.uses_threads and self.thread_pool:
+            self.asm_code.extend(thread_pool.start())
+
+    def add_thread_pool(self):
+        if self.uses_threads:
+            self.asm_code.extend(thread_pool.runtime(self.abi, self.thread_pool))
+
+    def find_thread_globals(self, nodes):
+        """Adds the globals the threaded functions among nodes write and use to thread_writers/readers."""
+        for name, writers in data_layout.thread_writers(nodes).items():
+            self.thread_writers.setdefault(name, set()).update(writers)
+        self.thread_readers |= threaded_function_variables(nodes)
+
+    def bss_section(self):
+        """Declarations of the globals; with cache_line_layout grouped onto cache lines (data_layout.py)."""
+        declarations = []
+        for var_name, var_info in self.variables.items():
+            if var_name not in self.global_names:
+                continue  # a local, in the frame of the functions using it
+            if var_info['type'] == 'scalar':
+                declarations.append((var_name, f'{var_name}: resq 1'))
+            elif var_info['type'] == 'array':
+                total_size = var_info.get('size', 1)
+                declarations.append((var_name, f'{var_name}: resq {total_size}'))
+            elif var_info['type'] == 'dynamic_array':
+                declarations.append((var_name, f'{var_name}: resq 1'))
+        if not self.cache_line_layout:
+            return [line for _, line in declarations]
+        return data_layout.arrange(declarations, self.thread_writers, self.thread_readers,
+                                   f'alignb {data_layout.CACHE_LINE}')
+
+    def lock_names(self):
+        """Names of the locks the program's lock blocks take, merged functions included."""
+        return [info['name'] for info in self.variables.values() if info['type'] == 'lock']
+
+    def report_locks(self):
+        if self.lock_stats:
+            self.asm_code.extend(locks.report(self.abi, self.lock_names()))
+
+    def add_locks(self):
+        names = self.lock_names()
+        if names:
+            self.asm_code.extend(locks.runtime(self.abi, names, self.lock_stats))
+
+    def is_threaded(self, func_name):
+        return self.functions.get(func_name, {}).get('threaded', False)
+
+    def is_builtin_call(self, func_name):
+        """True for calls the generator expands itself: threaded calls, join and the atomic operations."""
+        return func_name in BUILTINS or self.is_threaded(func_name)
+
+    def evaluate(self, node):
+        """Leaves node's value in rax, with or without the register allocator."""
+        if self.allocator is not None:
+            self.expression(node)
+        else:
+            self.visit(node)
+
+    def emit_spawn(self, node):
+        """Starts a threaded call with its arguments; rax is the handle join takes.
+
+        The arguments are pushed first to last for hive_spawn to copy into
+        the task. A call that is a statement of its own is detached.
+        """
+        func_name = node.func_name_token.value
+        registers = ARGUMENT_REGISTERS[self.abi]
+        if len(node.arg_nodes) > len(registers):
+            raise Exception(f"More than {len(registers)} arguments to a threaded function not yet supported")
+        for arg in node.arg_nodes:
+            self.evaluate(arg)
+            self.asm_code.append('    push rax')
+            if self.allocator is not None:
+                self.allocator.stack_bytes += 8
+        self.asm_code.extend(thread_pool.spawn(self.abi, f'FUNC_{func_name}', len(node.arg_nodes),
+                                               node is self.statement))
+        if node.arg_nodes:
+            self.asm_code.append(f'    add rsp, {8 * len(node.arg_nodes)}')
+            if self.allocator is not None:
+                self.allocator.stack_bytes -= 8 * len(node.arg_nodes)
+
+    def emit_join(self, node):
+        """join(handle): waits for the threaded call and leaves its value in rax."""
+        if len(node.arg_nodes) != 1:
+            raise Exception(f"{JOIN} takes one handle")
+        self.evaluate(node.arg_nodes[0])
+        self.asm_code.extend(thread_pool.join(self.abi))
+
+    def emit_atomic(self, node):
+        """An atomic operation (atomics.py) on a variable or array element; leaves the old value in rax.
+
+        The array index and the values are evaluated in order, all but the
+        last one kept on the stack, then moved to the registers the
+        instruction takes.
+        """
+        func_name = node.func_name_token.value
+        target = atomic_target(node)
+        var_name = target.var_name_token.value
+        operands = node.arg_nodes[1:]
+        registers = ['rax', 'rcx'][:len(operands)]
+        if isinstance(target, ArrayAccessNode):
+            self.variables[var_name] = {'type': 'dynamic_array'}
+            operands = [target.indexes[0]] + operands
+            registers = ['rdx'] + registers
+        elif var_name not in self.variables:
+            self.variables[var_name] = {'type': 'scalar'}
+        for operand in operands[:-1]:
+            self.evaluate(operand)
+            self.asm_code.append('    push rax')
+            if self.allocator is not None:
+                self.allocator.stack_bytes += 8
+        self.evaluate(operands[-1])
+        if registers[-1] != 'rax':
+            self.asm_code.append(f'    mov {registers[-1]}, rax')
+        for register in reversed(registers[:-1]):
+            self.asm_code.append(f'    pop {register}')
+            if self.allocator is not None:
+                self.allocator.stack_bytes -= 8
+        if isinstance(target, ArrayAccessNode):
+            self.asm_code.append(f'    mov r8, {self.variable(var_name)}')
+            memory = 'qword [r8 + rdx*8]'
+        else:
+            memory = self.variable(var_name)
+        self.asm_code.extend(atomics.x86(func_name, memory))
+
+    def run_peephole(self):
+        if self.peephole is None:
+            return
+        self.asm_code = self.peephole.optimize(self.asm_code)
+        if tracing.enabled('codegen', tracing.DEBUG):
+            tracing.emit('codegen', f"peephole: {self.peephole.format_stats()}")
+
+    def generate_function(self, node):
+        """Generates a single FunctionDefNode in isolation.
+
+        self.functions should already describe every function the body may
+        call. Returns (asm_lines, variables) for merge_function().
+        """
+        self.asm_code = []
+        self.visit(node)
+        self.place_functions()
+        return self.asm_code, self.variables
+
+    def merge_function(self, asm_lines, variables):
+        """Adds separately generated function code, like visit_FunctionDefNode does."""
+        self.function_code.append(asm_lines)
+        for var_name, var_info in variables.items():
+            self.variables.setdefault(var_name, var_info)
+
+    def place_functions(self):
+        """Puts the code of the functions generated so far before the rest, the last one first."""
+        self.asm_code = [line for code in reversed(self.function_code) for line in code] + self.asm_code
+        self.function_code = []
+
+    def variable(self, var_name):
+        """Memory operand of a variable: its frame slot for a local, its .bss symbol for a global."""
+        return self.frame.get(var_name, f'qword [{var_name}]')
+
+    def function_frame(self, node):
+        """(operands of a function's parameters and locals, bytes of its frame below rbp).
+
+        Parameters passed in registers and the other locals get slots below
+        rbp; parameters the caller pushed are used where they are, above the
+        return address. The size keeps rsp 16-byte aligned.
+        """
+        registers = ARGUMENT_REGISTERS[self.abi]
+        params = len(node.param_tokens)
+        frame, slots = {}, 0
+        for index, var_name in enumerate(local_variables(node, self.global_names)):
+            if len(registers) <= index < params:
+                frame[var_name] = f'qword [rbp + {16 + 8 * (index - len(registers))}]'
+            else:
+                slots += 1
+                frame[var_name] = f'qword [rbp - {8 * slots}]'
+        return frame, -(-8 * slots // 16) * 16
+
+    def enter_frame(self, node):
+        """Reserves the frame of a function after its push rbp / mov rbp, rsp and stores the register parameters.
+
+        The parameters are stored after the FUNC_<name>_BODY label, where
+        self tail calls enter.
+        """
+        frame, size = self.function_frame(node)
+        if size:
+            self.asm_code.append(f'    sub rsp, {size}')
+        # Self tail calls jump here with the new arguments in the argument registers.
+        self.asm_code.append(f'FUNC_{node.func_name_token.value}_BODY:')
+        for param_token, register in zip(node.param_tokens, ARGUMENT_REGISTERS[self.abi]):
+            self.asm_code.append(f'    mov {frame[param_token.value]}, {register}')
+        if tracing.enabled('codegen', tracing.TRACE):
+            tracing.emit('codegen', f"frame {frame}")
+        self.frame = frame
+        if self.allocator is not None:
+            self.allocator.frame = frame
+
+    def leave_frame(self):
+        self.frame = {}
+        if self.allocator is not None:
+            self.allocator.frame = {}
+
+    def visit_statements(self, nodes):
+        """Visits a statement list, numbering the values of each straight-line run."""
+        allocator = self.allocator
+        if allocator is None or not self.value_numbering:
+            for node in nodes:
+                self.statement = node
+                self.visit(node)
+            return
+        allocator.forget_values()
+        run_end = 0
+        for index, node in enumerate(nodes):
+            if not is_straight_line(node):
+                # Control flow and calls: nothing is known before or after.
+                allocator.forget_values()
+                self.statement = node
+                self.visit(node)
+                allocator.forget_values()
+                continue
+            if index >= run_end:
+                run_end = straight_line_run(nodes, index)
+                allocator.forget_values()
+                allocator.reusable = repeated_values(nodes[index:run_end], allocator.shared_variables)
+            self.statement = node
+            self.visit(node)
+            if isinstance(node, PrintNode):
+                allocator.forget_values()  # printf may clobber every scratch register
+        allocator.forget_values()
+
     def visit(self, node):
         method_name = f'visit_{type(node).__name__}'
         visitor = getattr(self, method_name, self.no_visit_method)
@@ -85,7 +394,312 @@ class CodeGenerator:
     def no_visit_method(self, node):
         raise Exception(f"No visit_{type(node).__name__} method defined")
 
+    def expression(self, node, target='rax'):
+        """Evaluates an expression into target with the register allocator."""
+        allocator = self.allocator
+        if not allocator.in_use:
+            allocator.reset_needs()
+        allocator.in_use.add(target)
+        self.emit_value(node, target)
+        allocator.in_use.discard(target)
+        return target
+
+    def emit_value(self, node, target):
+        """Emits code leaving node's value in target, which the caller has reserved.
+
+        Values an earlier statement of the run left in a register are copied
+        from there, and reusable values are remembered for later ones.
+        """
+        allocator = self.allocator
+        key = value_key(node) if allocator.reusable else None
+        if key not in allocator.reusable or id(node) in allocator.hoisted:
+            allocator.forget_register(target)
+            self.compute_value(node, target)
+            return
+        register = allocator.recall(key)
+        allocator.forget_register(target)
+        if register is not None:
+            if register != target:
+                self.asm_code.append(f'    mov {target}, {register}')
+            return
+        self.compute_value(node, target)
+        spare = allocator.spare()
+        if spare is not None:
+            self.asm_code.append(f'    mov {spare}, {target}')
+            allocator.remember(key, spare, *value_names(node))
+
+    def compute_value(self, node, target):
+        hoisted = self.allocator.hoisted.get(id(node))
+        if hoisted is not None:
+            if hoisted != target:
+                self.asm_code.append(f'    mov {target}, {hoisted}')
+        elif isinstance(node, NumberNode):
+            self.asm_code.append(f'    mov {target}, {node.token.value}')
+        elif isinstance(node, VarAccessNode):
+            var_name = node.var_name_token.value
+            if var_name not in self.variables:
+                self.variables[var_name] = {'type': 'scalar'}
+            source = self.allocator.operand(node)
+            if source != target:
+                self.asm_code.append(f'    mov {target}, {source}')
+        elif isinstance(node, UnaryOpNode):
+            if node.op_token.type not in (TT_PLUS, TT_MINUS):
+                raise Exception(f"Unknown unary operator {node.op_token.type}")
+            self.emit_value(node.node, target)
+            if node.op_token.type == TT_MINUS:
+                self.asm_code.append(f'    neg {target}')
+        elif isinstance(node, BinOpNode):
+            self.emit_binary_operation(node, target)
+        elif isinstance(node, ArrayAccessNode):
+            var_name = node.var_name_token.value
+            self.variables[var_name] = {'type': 'dynamic_array'}
+            index, offset = self.array_index(node)
+            self.emit_value(index, target)
+            base = self.array_base(var_name)
+            if base is not None:
+                self.asm_code.append(f'    mov {target}, qword [{scaled_index(base, target, offset)}]')
+                return
+            base = self.allocator.allocate()
+            if base is not None:
+                self.asm_code.append(f'    mov {base}, {self.variable(var_name)}')
+                self.asm_code.append(f'    mov {target}, qword [{scaled_index(base, target, offset)}]')
+                self.remember_base(var_name, base)
+                self.allocator.release(base)
+            else:
+                self.asm_code.append(f'    shl {target}, 3')
+                self.asm_code.append(f'    add {target}, {self.variable(var_name)}')
+                self.asm_code.append(f'    mov {target}, qword [{target}{displacement(offset)}]')
+        elif isinstance(node, FunctionCallNode):
+            self.emit_call(node, target)
+        else:
+            raise Exception(f"Cannot evaluate {type(node).__name__} as an expression")
+
+    def array_base(self, var_name):
+        """Register already holding the base pointer of var_name, or None."""
+        allocator = self.allocator
+        base = allocator.array_bases.get(var_name)
+        if base is None and base_key(var_name) in allocator.reusable:
+            base = allocator.recall(base_key(var_name))
+        return base
+
+    def remember_base(self, var_name, register):
+        if base_key(var_name) in self.allocator.reusable:
+            self.allocator.remember(base_key(var_name), register, {var_name})
+
+    def emit_binary_operation(self, node, target, compare_only=False):
+        """target = left op right; with compare_only a comparison only sets the flags."""
+        op = node.op_token.type
+        if op not in ARITHMETIC and op not in SETCC and op != TT_DIV:
+            raise Exception(f"Unknown binary operator {op}")
+        allocator = self.allocator
+        left, right = node.left_node, node.right_node
+        if op == TT_MUL and constant_value(left) is not None and constant_value(right) is None:
+            # Constant factor on the right, where it is an immediate.
+            left, right = right, left
+        if self.strength_reduction and self.emit_constant_operation(op, left, constant_value(right), target):
+            return
+        operand = allocator.operand(right)
+        if operand is not None and not (op == TT_DIV and isinstance(right, NumberNode)):
+            # Leaf on the right: use it directly as a memory, register or immediate operand.
+            self.emit_value(left, target)
+            self.apply_operator(op, target, operand, compare_only)
+            return
+        if allocator.free_count() == 0:
+            # Out of registers: keep the left value on the stack.
+            self.emit_value(left, target)
+            self.asm_code.append(f'    push {target}')
+            allocator.stack_bytes += 8
+            self.emit_value(right, target)
+            self.asm_code.append(f'    xchg {target}, qword [rsp]')
+            self.apply_operator(op, target, 'qword [rsp]', compare_only)
+            # lea leaves the flags of a comparison intact.
+            self.asm_code.append('    lea rsp, [rsp + 8]' if compare_only else '    add rsp, 8')
+            allocator.stack_bytes -= 8
+            return
+        if (allocator.register_need(right) > allocator.register_need(left)
+                and not allocator.has_call(left) and not allocator.has_call(right)):
+            # Sethi-Ullman order: the needier side first. Safe because neither side has side effects.
+            reg = allocator.allocate()
+            self.emit_value(right, reg)
+            self.emit_value(left, target)
+        else:
+            self.emit_value(left, target)
+            reg = allocator.allocate()
+            self.emit_value(right, reg)
+        self.apply_operator(op, target, reg, compare_only)
+        allocator.release(reg)
+
+    def apply_operator(self, op, target, source, compare_only=False):
+        if op in ARITHMETIC:
+            if op == TT_MUL and source[0] in '-0123456789':
+                self.asm_code.append(f'    imul {target}, {target}, {source}')
+            else:
+                self.asm_code.append(f'    {ARITHMETIC[op]} {target}, {source}')
+        elif op == TT_DIV:
+            self.emit_divide(target, source)
+        else:
+            byte = BYTE_REGISTERS[target]
+            self.asm_code.append(f'    cmp {target}, {source}')
+            if compare_only:
+                return
+            self.asm_code.append(f'    {SETCC[op]} {byte}')
+            self.asm_code.append(f'    movzx {target}, {byte}')
+
+    def emit_constant_operation(self, op, left, value, target):
+        """Emits left * value or left / value without imul/idiv; False if that is not cheaper."""
+        allocator = self.allocator
+        if value is None:
+            return False
+        if op == TT_MUL:
+            code = multiply_by_constant(target, value)
+            if code is None:
+                return False
+            self.emit_value(left, target)
+            self.asm_code.extend(code)
+            return True
+        if op != TT_DIV or not reducible_divisor(value) or allocator.free_count() == 0:
+            return False
+        self.emit_value(left, target)
+        scratch = allocator.allocate()
+        saved = []
+        if not is_power_of_two(abs(value)):
+            # The magic-number multiply clobbers rax and rdx.
+            saved = [reg for reg in ('rax', 'rdx') if reg != target and reg in allocator.in_use]
+        for reg in saved:
+            self.asm_code.append(f'    push {reg}')
+        self.asm_code.extend(divide_by_constant(target, value, scratch))
+        for reg in reversed(saved):
+            self.asm_code.append(f'    pop {reg}')
+        allocator.release(scratch)
+        return True
+
+    def array_index(self, node):
+        """(index node, constant element offset) for a one-dimensional array access."""
+        if self.strength_reduction:
+            return constant_offset(node.indexes[0])
+        return node.indexes[0], 0
+
+    def emit_divide(self, target, source):
+        """target = target / source; idiv needs the dividend in rax and clobbers rdx."""
+        saved = [reg for reg in ('rax', 'rdx') if reg != target and reg in self.allocator.in_use]
+        for reg in saved:
+            self.asm_code.append(f'    push {reg}')
+        if saved and '[rsp]' in source:
+            source = source.replace('[rsp]', f'[rsp + {8 * len(saved)}]')
+        if target != 'rax':
+            self.asm_code.append(f'    mov rax, {target}')
+        self.asm_code.append('    cqo')
+        self.asm_code.append(f'    idiv {source}')
+        if target != 'rax':
+            self.asm_code.append(f'    mov {target}, rax')
+        for reg in reversed(saved):
+            self.asm_code.append(f'    pop {reg}')
+
+    def emit_call(self, node, target):
+        """Calls a HiVe function from expression code, preserving live caller-saved registers."""
+        allocator = self.allocator
+        func_name = node.func_name_token.value
+        saved = [reg for reg in CALLER_SAVED_REGISTERS if reg in allocator.in_use and reg != target]
+        for reg in saved:
+            self.asm_code.append(f'    push {reg}')
+        allocator.stack_bytes += 8 * len(saved)
+        live, allocator.in_use = allocator.in_use, set()
+        if self.is_builtin_call(func_name):
+            self.visit_FunctionCallNode(node)
+        else:
+            self.emit_call_arguments(node)
+        allocator.in_use = live
+        if target != 'rax':
+            self.asm_code.append(f'    mov {target}, rax')
+        for reg in reversed(saved):
+            self.asm_code.append(f'    pop {reg}')
+        allocator.stack_bytes -= 8 * len(saved)
+
+    def emit_call_arguments(self, node):
+        """Evaluates arguments into the ABI's argument registers and calls the function."""
+        allocator = self.allocator
+        stack_args = node.arg_nodes[len(allocator.argument_registers):]
+        padding = (allocator.stack_bytes + 8 * len(stack_args)) % 16
+        if padding:
+            self.asm_code.append('    sub rsp, 8')
+            allocator.stack_bytes += 8
+        self.load_arguments(node)
+        self.asm_code.append(f'    call FUNC_{node.func_name_token.value}')
+        cleanup = 8 * len(stack_args) + (8 if padding else 0)
+        if cleanup:
+            self.asm_code.append(f'    add rsp, {cleanup}')
+            allocator.stack_bytes -= cleanup
+
+    def load_arguments(self, node):
+        """Pushes the stack arguments of a call, last first, and loads the register arguments."""
+        allocator = self.allocator
+        registers = allocator.argument_registers
+        arg_nodes = node.arg_nodes
+        if len(arg_nodes) > len(registers) and self.abi == 'windows':
+            raise Exception("More than 4 arguments not yet supported")
+        register_args, stack_args = arg_nodes[:len(registers)], arg_nodes[len(registers):]
+        for arg in reversed(stack_args):
+            self.expression(arg)
+            self.asm_code.append('    push rax')
+            allocator.stack_bytes += 8
+        if any(allocator.has_call(arg) for arg in register_args):
+            # A nested call would clobber argument registers already loaded.
+            for arg in register_args:
+                self.expression(arg)
+                self.asm_code.append('    push rax')
+                allocator.stack_bytes += 8
+            for reg in reversed(registers[:len(register_args)]):
+                self.asm_code.append(f'    pop {reg}')
+                allocator.stack_bytes -= 8
+        else:
+            for reg, arg in zip(registers, register_args):
+                allocator.in_use.add(reg)
+                self.emit_value(arg, reg)
+            allocator.in_use.clear()
+
+    def emit_tail_call(self, node):
+        """Emits return node as a jump if node is a call with nothing left to do after it.
+
+        A self call passes its arguments like a call and jumps back to
+        FUNC_<name>_BODY, reusing the frame; a call to another function tears
+        the frame down first, so the callee returns straight to our caller.
+        Stack arguments overwrite this function's own, so a callee may take
+        no more of them than this function was passed. Returns False, having
+        emitted nothing, for anything else.
+        """
+        function = self.current_function
+        if (not self.tail_calls or self.allocator is None or function is None
+                or not isinstance(node, FunctionCallNode)):
+            return False
+        func_name = node.func_name_token.value
+        if self.is_builtin_call(func_name):
+            return False  # a threaded call, join or an atomic operation
+        if any(held is function for held, _ in self.held_locks):
+            return False  # inside a lock block, which is released after the call
+        allocator = self.allocator
+        registers = allocator.argument_registers
+        params = len(function.param_tokens)
+        stack_args = max(len(node.arg_nodes) - len(registers), 0)
+        if stack_args > max(params - len(registers), 0):
+            return False
+        if tracing.enabled('codegen', tracing.DEBUG):
+            tracing.emit('codegen', f"tail call {func_name} from {function.func_name_token.value}")
+        self.load_arguments(node)
+        for index in range(stack_args):
+            self.asm_code.append('    pop rax')
+            self.asm_code.append(f'    mov qword [rbp + {16 + 8 * index}], rax')
+            allocator.stack_bytes -= 8
+        if func_name == function.func_name_token.value:
+            self.asm_code.append(f'    jmp FUNC_{func_name}_BODY')
+        else:
+            self.asm_code.append('    mov rsp, rbp')
+            self.asm_code.append('    pop rbp')
+            self.asm_code.append(f'    jmp FUNC_{func_name}')
+        return True
+
     def visit_NumberNode(self, node):
+        if self.allocator is not None:
+            return self.expression(node)
         self.asm_code.append(f'    mov rax, {node.token.value}')
         return 'rax'
 
@@ -99,18 +713,60 @@ class CodeGenerator:
                    break
 
                # Variable not found; declare it in current scope
-               print("declaring scalar")
+               if tracing.enabled('codegen', tracing.TRACE):
+                   tracing.emit('codegen', f"declaring scalar {var_name}")
                self.variable_scopes[-1][var_name] = {'type': 'scalar'}
                self.variables[var_name] = {'type': 'scalar'}
+           if self.allocator is not None:
+               self.assign_scalar(var_name, node.value_node)
+               return
            self.visit(node.value_node)
-           self.asm_code.append(f'    mov qword [{var_name}], rax')  # Use qword for 64-bit
+           self.asm_code.append(f'    mov {self.variable(var_name)}, rax')  # Use qword for 64-bit
        elif isinstance(node.left_node, ArrayAccessNode):
            # Assignment to array element
            self.visit_ArrayAssignNode(node.left_node, node.value_node)
        else:
            raise Exception(f"Invalid left-hand side in assignment")
 
+    def assign_scalar(self, var_name, value_node):
+        allocator = self.allocator
+        if var_name not in self.variables:
+            self.variables[var_name] = {'type': 'scalar'}
+        register = allocator.promoted.get(var_name)
+        if register is None:
+            source = allocator.operand(value_node)
+            if isinstance(value_node, NumberNode) and source is not None:
+                self.asm_code.append(f'    mov {self.variable(var_name)}, {source}')
+            else:
+                self.asm_code.append(f'    mov {self.variable(var_name)}, {self.expression(value_node)}')
+        elif self.reads_only_first(value_node, var_name):
+            # The old value is loaded first, so the result can be built in place.
+            self.expression(value_node, register)
+        else:
+            self.asm_code.append(f'    mov {register}, {self.expression(value_node)}')
+        allocator.forget(var_name)
+
+    def reads_only_first(self, node, var_name):
+        """True if var_name is not read by node, or only as the first value it loads."""
+        uses = [n for n in walk(node) if isinstance(n, VarAccessNode) and n.var_name_token.value == var_name]
+        if not uses:
+            return True
+        if len(uses) > 1 or contains_call(node):
+            return False
+        while not isinstance(node, (VarAccessNode, NumberNode, FunctionCallNode)):
+            if isinstance(node, BinOpNode):
+                node = node.left_node
+            elif isinstance(node, UnaryOpNode):
+                node = node.node
+            elif isinstance(node, ArrayAccessNode):
+                node = node.indexes[0]
+            else:
+                return False
+        return node is uses[0]
+
     def visit_VarAccessNode(self, node):
+       if self.allocator is not None:
+           return self.expression(node)
        var_name = node.var_name_token.value
        for scope in reversed(self.variable_scopes):
            if var_name in scope:
@@ -119,29 +775,169 @@ class CodeGenerator:
                self.variables[var_name] = {'type': 'scalar'}
        var_info = self.variables[var_name]
        if var_info['type'] == 'scalar':
-           self.asm_code.append(f'    mov rax, qword [{var_name}]')
+           self.asm_code.append(f'    mov rax, {self.variable(var_name)}')
        elif var_info['type'] == 'dynamic_array':
-           self.asm_code.append(f'    mov rax, [{var_name}]')
+           self.asm_code.append(f'    mov rax, {self.variable(var_name)}')
        else:
            raise Exception(f"Cannot access variable of type '{var_info['type']}'")
        return 'rax'
     def visit_WhileNode(self, node):
-        label_start = f'WHILE_START_{self.labels}'
-        label_end = f'WHILE_END_{self.labels}'
+        label_start = f'{self.label_prefix}WHILE_START_{self.labels}'
+        label_end = f'{self.label_prefix}WHILE_END_{self.labels}'
         self.labels += 1
 
-        self.asm_code.append(f'{label_start}:')
-        self.visit(node.condition_node)
-        self.asm_code.append('    cmp rax, 0')
-        self.asm_code.append(f'    je {label_end}')
-        for stmt in node.body_node:
-            self.visit(stmt)
-        self.asm_code.append(f'    jmp {label_start}')
+        promoted, bases, hoisted = [], [], []
+        if self.allocator is not None:
+            promoted = self.allocator.loop_candidates(node, self.variables)
+            if self.loop_optimization:
+                bases, hoisted = self.loop_invariants(node, promoted)
+        saved = [register for _, register in promoted + bases + hoisted]
+        self.save_registers(saved)
+        self.promote_variables(promoted)
+        if self.loop_optimization:
+            # Rotated: the condition is tested once in front of the loop and then at
+            # the bottom, so an iteration costs one conditional branch and no jmp.
+            self.emit_branch(node.condition_node, label_end)
+            self.hoist_invariants(bases, hoisted)
+            self.asm_code.append(f'{label_start}:')
+            self.visit_statements(node.body_node)
+            self.emit_branch(node.condition_node, label_start, when=True)
+        else:
+            self.asm_code.append(f'{label_start}:')
+            self.emit_branch(node.condition_node, label_end)
+            self.visit_statements(node.body_node)
+            self.asm_code.append(f'    {self.jump} {label_start}')
         self.asm_code.append(f'{label_end}:')
+        self.drop_invariants(bases, hoisted)
+        self.demote_variables(promoted)
+        self.restore_registers(saved)
+
+    def loop_invariants(self, node, promoted):
+        """Callee-saved registers for a loop's invariant array bases and expressions.
+
+        Returns ([(array name, register)], [(expressions, register)]), where
+        expressions are structurally equal nodes sharing one register.
+        Promoted loop variables get their registers first.
+        """
+        allocator = self.allocator
+        if not is_self_contained(node):
+            return [], []
+        taken = {register for _, register in promoted}
+        free = [register for register in allocator.free_callee_saved() if register not in taken]
+        arrays = [name for name in invariant_arrays(node, allocator.shared_variables)
+                  if name not in allocator.array_bases]
+        bases = list(zip(arrays, free))
+        groups = [group for group in invariant_expressions(node, allocator.shared_variables)
+                  if id(group[0]) not in allocator.hoisted]
+        hoisted = list(zip(groups, free[len(bases):]))
+        if tracing.enabled('codegen', tracing.DEBUG) and (bases or hoisted):
+            tracing.emit('codegen', f"loop invariants: bases {bases}, "
+                                    f"{len(hoisted)} expressions in {[register for _, register in hoisted]}")
+        return bases, hoisted
+
+    def hoist_invariants(self, bases, hoisted):
+        allocator = self.allocator
+        for var_name, register in bases:
+            self.asm_code.append(f'    mov {register}, {self.variable(var_name)}')
+            allocator.array_bases[var_name] = register
+        for group, register in hoisted:
+            self.expression(group[0], register)
+            for node in group:
+                allocator.hoisted[id(node)] = register
+
+    def drop_invariants(self, bases, hoisted):
+        allocator = self.allocator
+        for var_name, _ in bases:
+            del allocator.array_bases[var_name]
+        for group, _ in hoisted:
+            for node in group:
+                del allocator.hoisted[id(node)]
+
+    def emit_branch(self, condition, label, when=False):
+        """Jumps to label when condition is true (when=True) or false.
+
+        A comparison goes straight to cmp + jcc; its 0/1 value is only
+        materialised (setcc) where it is used as a value.
+        """
+        if not (isinstance(condition, BinOpNode) and condition.op_token.type in JCC_FALSE):
+            self.visit(condition)
+            self.asm_code.append('    test rax, rax')
+            self.asm_code.append(f"    {'jnz' if when else 'jz'} {label}")
+            return
+        if self.allocator is not None:
+            self.emit_comparison(condition)
+        else:
+            self.visit(condition.left_node)
+            self.asm_code.append('    push rax')
+            self.visit(condition.right_node)
+            self.asm_code.append('    pop rbx')
+            self.asm_code.append('    cmp rbx, rax')
+        self.asm_code.append(f'    {(JCC_TRUE if when else JCC_FALSE)[condition.op_token.type]} {label}')
+
+    def emit_comparison(self, node):
+        """Sets the flags for comparison node, comparing leaf operands in place when possible."""
+        allocator = self.allocator
+        left = allocator.operand(node.left_node)
+        right = allocator.operand(node.right_node)
+        for operand in (node.left_node, node.right_node):
+            if isinstance(operand, VarAccessNode) and operand.var_name_token.value not in self.variables:
+                self.variables[operand.var_name_token.value] = {'type': 'scalar'}
+        if (left is not None and right is not None and left[0] not in '-0123456789'
+                and not (left.startswith('qword') and right.startswith('qword'))):
+            # e.g. cmp qword [j], 1000 or, for a loop variable, cmp rbx, 1000
+            self.asm_code.append(f'    cmp {left}, {right}')
+            return
+        if not allocator.in_use:
+            allocator.reset_needs()
+        allocator.in_use.add('rax')
+        self.emit_binary_operation(node, 'rax', compare_only=True)
+        allocator.in_use.discard('rax')
+
+    def save_registers(self, registers):
+        for register in registers:
+            self.asm_code.append(f'    push {register}')
+        if len(registers) % 2:
+            self.asm_code.append('    sub rsp, 8')  # keep rsp 16-byte aligned for calls in the loop
+
+    def restore_registers(self, registers):
+        if len(registers) % 2:
+            self.asm_code.append('    add rsp, 8')
+        for register in reversed(registers):
+            self.asm_code.append(f'    pop {register}')
+
+    def promote_variables(self, promoted):
+        """Moves loop variables into their callee-saved registers, saved by save_registers."""
+        for var_name, register in promoted:
+            if var_name not in self.variables:
+                self.variables[var_name] = {'type': 'scalar'}
+            self.asm_code.append(f'    mov {register}, {self.variable(var_name)}')
+            self.allocator.promoted[var_name] = register
+        if promoted and tracing.enabled('codegen', tracing.DEBUG):
+            tracing.emit('codegen', f"loop registers {promoted}")
+
+    def demote_variables(self, promoted):
+        for var_name, register in promoted:
+            self.asm_code.append(f'    mov {self.variable(var_name)}, {register}')
+            del self.allocator.promoted[var_name]
 
 
 
     def visit_BinOpNode(self, node):
+        if self.allocator is not None:
+            return self.expression(node)
+        operand, constant = node.left_node, constant_value(node.right_node)
+        if node.op_token.type == TT_MUL and constant is None:
+            operand, constant = node.right_node, constant_value(node.left_node)
+        if self.strength_reduction and constant is not None:
+            code = None
+            if node.op_token.type == TT_MUL:
+                code = multiply_by_constant('rax', constant)
+            elif node.op_token.type == TT_DIV:
+                code = divide_by_constant('rax', constant, 'rbx')
+            if code is not None:
+                self.visit(operand)
+                self.asm_code.extend(code)
+                return
         if node.op_token.type in (TT_PLUS, TT_MINUS, TT_MUL, TT_DIV):
             self.visit(node.left_node)
             self.asm_code.append('    push rax')  # Save left operand
@@ -182,42 +978,72 @@ class CodeGenerator:
             raise Exception(f"Unknown binary operator {node.op_token.type}")
 
     def visit_PrintNode(self, node):
-        value_reg = self.visit(node.value_node)
+        if self.allocator is not None:
+            self.expression(node.value_node, 'rdx')
+            self.asm_code.append('    sub rsp, 32')
+            self.asm_code.append('    lea rcx, [rel format]')
+            self.asm_code.append('    call printf')
+            self.asm_code.append('    add rsp, 32')
+            return None
+        self.visit(node.value_node)  # every expression leaves its value in rax
         self.asm_code.append('    sub rsp, 32')
         self.asm_code.append('    lea rcx, [rel format]')
-        self.asm_code.append(f'    mov rdx, {value_reg}')
+        self.asm_code.append('    mov rdx, rax')
         self.asm_code.append('    call printf')
         self.asm_code.append('    add rsp, 32')
         return None
 
     def visit_IfNode(self, node):
-        label_else = f"ELSE_{self.labels}"
-        label_end = f"ENDIF_{self.labels}"
+        label_else = f"{self.label_prefix}ELSE_{self.labels}"
+        label_end = f"{self.label_prefix}ENDIF_{self.labels}"
         self.labels += 1
 
         # Evaluate condition
-        self.visit(node.condition_node)
-        self.asm_code.append('    cmp rax, 0')
-        if node.false_statements is not None:
-            self.asm_code.append(f'    je {label_else}')
-        else:
-            self.asm_code.append(f'    je {label_end}')
+        self.emit_branch(node.condition_node, label_else if node.false_statements is not None else label_end)
 
         # True branch
-        for stmt in node.true_statements:
-            self.visit(stmt)
-        self.asm_code.append(f'    jmp {label_end}')
+        self.visit_statements(node.true_statements)
+        self.asm_code.append(f'    {self.jump} {label_end}')
 
         if node.false_statements is not None:
             # Else label
             self.asm_code.append(f'{label_else}:')
             # False branch
-            for stmt in node.false_statements:
-                self.visit(stmt)
+            self.visit_statements(node.false_statements)
 
         # End if label
         self.asm_code.append(f'{label_end}:')
+
+    def visit_LockNode(self, node):
+        """lock name ... end: takes the lock, runs the body and releases it (locks.py).
+
+        The lock is a variable of its own kind, so functions generated
+        separately report theirs through merge_function.
+        """
+        name = node.lock_name_token.value
+        self.variables[locks.symbol(name)] = {'type': 'lock', 'name': name}
+        self.asm_code.extend(locks.acquire(self.abi, name))
+        self.held_locks.append((self.current_function, name))
+        self.visit_statements(node.body_nodes)
+        self.held_locks.pop()
+        self.asm_code.extend(locks.release(self.abi, name))
+
+    def release_held_locks(self):
+        """Releases the locks a return leaves, innermost first, keeping the value in rax."""
+        held = [name for function, name in self.held_locks if function is self.current_function]
+        if not held:
+            return
+        self.asm_code.append('    push rax')
+        if self.allocator is not None:
+            self.allocator.stack_bytes += 8
+        for name in reversed(held):
+            self.asm_code.extend(locks.release(self.abi, name))
+        self.asm_code.append('    pop rax')
+        if self.allocator is not None:
+            self.allocator.stack_bytes -= 8
     def visit_UnaryOpNode(self, node):
+        if self.allocator is not None:
+            return self.expression(node)
         self.visit(node.node)
         if node.op_token.type == TT_MINUS:
             self.asm_code.append('    neg rax')
@@ -237,9 +1063,13 @@ class CodeGenerator:
         var_name = node.var_name_token.value
         if var_name == '[':
             return
+        if self.allocator is not None and value_node is not None:
+            self.store_array_element(var_name, node, value_node)
+            return
         for scope in reversed(self.variable_scopes):
             if var_name in scope:
-                print(var_name)
+                if tracing.enabled('codegen', tracing.TRACE):
+                    tracing.emit('codegen', f"array store {var_name}")
 
                 break
             else:
@@ -259,24 +1089,62 @@ class CodeGenerator:
                 self.visit(value_node)
                 self.asm_code.append('    mov rcx, rax')      # Value to assign
                 self.asm_code.append('    pop rdx')           # Restore index
-                self.asm_code.append(f'    mov r8, [{var_name}]')  # Base address of array
+                self.asm_code.append(f'    mov r8, {self.variable(var_name)}')  # Base address of array
                 self.asm_code.append('    mov [r8 + rdx*8], rcx')  # Store value at address
             else:
             # Reading from array (though assign node typically doesn't read)
                 self.asm_code.append('    pop rdx')           # Restore index
-                self.asm_code.append(f'    mov r8, [{var_name}]')  # Base address of array
+                self.asm_code.append(f'    mov r8, {self.variable(var_name)}')  # Base address of array
                 self.asm_code.append('    mov rax, [r8 + rdx*8]')  # Load value at index into rax
         else:
             raise Exception(f"Unsupported array type '{var_info['type']}'")
 
+    def store_array_element(self, var_name, node, value_node):
+        if len(node.indexes) != 1:
+            raise Exception("Dynamic arrays are one-dimensional")
+        self.variables[var_name] = {'type': 'dynamic_array'}
+        allocator = self.allocator
+        allocator.reset_needs()
+        index = allocator.allocate()
+        index_node, offset = self.array_index(node)
+        self.emit_value(index_node, index)
+        source = allocator.operand(value_node)
+        value = None
+        if not isinstance(value_node, NumberNode) or source is None:
+            value = allocator.allocate()
+            self.emit_value(value_node, value)
+            source = value
+        base = self.array_base(var_name)
+        if base is None:
+            base = allocator.allocate()
+            if base is not None:
+                self.asm_code.append(f'    mov {base}, {self.variable(var_name)}')
+                self.remember_base(var_name, base)
+        if base is not None:
+            self.asm_code.append(f'    mov qword [{scaled_index(base, index, offset)}], {source}')
+        else:
+            self.asm_code.append(f'    shl {index}, 3')
+            self.asm_code.append(f'    add {index}, {self.variable(var_name)}')
+            self.asm_code.append(f'    mov qword [{index}{displacement(offset)}], {source}')
+        # The store may change any element an earlier load read, through another array name.
+        allocator.forget(elements=True)
+        key = value_key(node)
+        if value is not None and key in allocator.reusable:
+            # Later loads of this element get the stored value.
+            allocator.remember(key, value, *value_names(node))
+        allocator.in_use.clear()
+
     def visit_ArrayAccessNode(self, node):
         var_name = node.var_name_token.value
         if var_name == '[':
             return
+        if self.allocator is not None:
+            return self.expression(node)
 
         for scope in reversed(self.variable_scopes):
             if var_name in scope:
-                print(var_name)
+                if tracing.enabled('codegen', tracing.TRACE):
+                    tracing.emit('codegen', f"array load {var_name}")
                 break
 
 
@@ -286,7 +1154,7 @@ class CodeGenerator:
             # Compute index
             self.visit(node.indexes[0])
             self.asm_code.append('    push rax')  # Save index on stack
-            self.asm_code.append(f'    mov rax, [{var_name}]')  # Base address of array
+            self.asm_code.append(f'    mov rax, {self.variable(var_name)}')  # Base address of array
             self.asm_code.append('    pop rdx')   # Restore index
             self.asm_code.append('    mov rax, [rax + rdx*8]')  # Load value at index into rax
         else:
@@ -322,92 +1190,31 @@ class CodeGenerator:
         self.visit(node.size_expr)
         self.asm_code.append('    mov rcx, [heap_handle]')  # Heap handle
         self.asm_code.append('    mov rdx, HEAP_ZERO_MEMORY')  # Heap allocation flags
-        self.asm_code.append('    imul rax, 8')
-        self.asm_code.append('    mov r8, rax')  # Size of allocation
+        if self.strength_reduction:
+            self.asm_code.append('    lea r8, [rax*8]')  # Size of allocation
+        else:
+            self.asm_code.append('    imul rax, 8')
+            self.asm_code.append('    mov r8, rax')  # Size of allocation
+        self.asm_code.append('    sub rsp, 32')  # shadow space, which HeapAlloc may overwrite
         self.asm_code.append('    call HeapAlloc')
-        self.asm_code.append(f'    mov [{var_name}], rax')  # Store pointer in variable
+        self.asm_code.append('    add rsp, 32')
+        self.asm_code.append(f'    mov {self.variable(var_name)}, rax')  # Store pointer in variable
     def visit_DeleteNode(self, node):
         var_name = node.var_name_token.value
         if var_name not in self.variables or self.variables[var_name]['type'] != 'dynamic_array':
             raise Exception(f"Variable '{var_name}' is not a dynamic array")
         self.asm_code.append('    mov rcx, [heap_handle]')   # Heap handle
-        self.asm_code.append(f'    mov rdx, [{var_name}]')   # Pointer to free
+        self.asm_code.append(f'    mov rdx, {self.variable(var_name)}')   # Pointer to free
         self.asm_code.append('    mov r8, 0')                # HeapFree flags
+        self.asm_code.append('    sub rsp, 32')
         self.asm_code.append('    call HeapFree')
+        self.asm_code.append('    add rsp, 32')
         # Optionally, remove the variable
         #del self.variables[var_name]
-    def visit_FunctionDefNode(self, node):
-        print(self.functions)
-        try:
-
-            func_name = node.func_name_token.value
-        except:
-            return
-        print(func_name)
-
-        self.functions[func_name] = {'threaded': node.threaded}
-        label_func_start = f"FUNC_{func_name}"
-        label_func_end = f"FUNC_{func_name}_END"
-
-
-        # Store the current asm_code to restore after function definition
-        main_asm_code = self.asm_code
-        self.asm_code = []
-
-        # Function label
-        self.asm_code.append(f'{label_func_start}:')
-        self.current_function_end_label = label_func_end
-
-        # Threaded functions need a different prologue
-        if node.threaded:
-            self.asm_code.append('    mov rdx, rcx')  # Thread parameter is in rcx
-            self.asm_code.append('    push rbp')
-            self.asm_code.append('    mov rbp, rsp')
-            # Handle parameters if needed
-            # ... (similar to normal functions) ...
-        else:
-            # Prologue
-            self.asm_code.append('    push rbp')
-            self.asm_code.append('    mov rbp, rsp')
-            # Handle parameters
-            num_params = len(node.param_tokens)
-            param_registers = ['rcx', 'rdx', 'r8', 'r9']
-            for i, param_token in enumerate(node.param_tokens):
-                self.variables[param_token.value] = {'type': 'scalar'}
-                print(param_token.value)
-                if i < 4:
-                    reg = param_registers[i]
-                    self.asm_code.append(f'    mov qword [{param_token.value}], {reg}')
-                else:
-                    offset = (i - 4) * 8 + 16
-                    self.asm_code.append(f'    mov rax, qword [rbp + {offset}]')
-                    self.asm_code.append(f'    mov qword [{param_token.value}], rax')
-                if param_token.value not in self.variables:
-                    self.variables[param_token.value] = {'type': 'scalar'}
-
-    # Function body
-        for stmt in node.body_nodes:
-            self.visit(stmt)
-
-    # Epilogue
-        self.asm_code.append(f'{label_func_end}:')
-        self.asm_code.append('    mov rsp, rbp')
-        self.asm_code.append('    pop rbp')
-        if node.threaded:
-            self.asm_code.append('    ret')  # Return to thread exit
-        else:
-            self.asm_code.append('    ret')
-
-        # Save the function code
-        func_code = self.asm_code
-
-        # Restore the main asm_code
-        self.asm_code = main_asm_code
-        # Insert the function code at the beginning (or appropriate place)
-        self.asm_code = func_code + self.asm_code
-        self.current_function_end_label = label_func_end
     def visit_FunctionDefNode(self, node):
        func_name = node.func_name_token.value
+       if tracing.enabled('codegen', tracing.DEBUG):
+           tracing.emit('codegen', f"function {func_name}")
        self.functions[func_name] = {'threaded': node.threaded}
        label_func_start = f"FUNC_{func_name}"
        label_func_end = f"FUNC_{func_name}_END"
@@ -419,30 +1226,21 @@ class CodeGenerator:
        # Function label
        self.asm_code.append(f'{label_func_start}:')
        self.current_function_end_label = label_func_end
+       self.current_function = node
 
        # Push a new variable scope for the function
        self.variable_scopes.append({})
 
-       # Prologue
+       # Prologue; parameters and locals live in the function's frame
        self.asm_code.append('    push rbp')
        self.asm_code.append('    mov rbp, rsp')
-       # Handle parameters
-       num_params = len(node.param_tokens)
-       param_registers = ['rcx', 'rdx', 'r8', 'r9']
-       for i, param_token in enumerate(node.param_tokens):
-           if i < 4:
-               reg = param_registers[i]
-               self.asm_code.append(f'    mov qword [{param_token.value}], {reg}')
-           else:
-               offset = (i - 4) * 8 + 16
-               self.asm_code.append(f'    mov rax, qword [rbp + {offset}]')
-               self.asm_code.append(f'    mov qword [{param_token.value}], rax')
+       self.enter_frame(node)
+       for param_token in node.param_tokens:
            # Declare parameter in the function's scope
            self.variable_scopes[-1][param_token.value] = {'type': 'scalar'}
            self.variables[param_token.value] = {'type': 'scalar'}
        # Function body
-       for stmt in node.body_nodes:
-           self.visit(stmt)
+       self.visit_statements(node.body_nodes)
 
        # Epilogue
        self.asm_code.append(f'{label_func_end}:')
@@ -452,26 +1250,30 @@ class CodeGenerator:
 
        # Pop the function's scope
        self.variable_scopes.pop()
+       self.leave_frame()
+       self.current_function = None
 
        # Save the function code
        func_code = self.asm_code
 
-       # Restore the main asm_code
+       # Restore the main asm_code; generate() puts the function code before it
        self.asm_code = main_asm_code
-       # Insert the function code at the beginning (or appropriate place)
-       self.asm_code = func_code + self.asm_code
+       self.function_code.append(func_code)
        self.current_function_end_label = label_func_end
 
     def visit_FunctionCallNode(self, node):
         func_name = node.func_name_token.value
-        # Check if the function is threaded
-        is_threaded = self.functions.get(func_name, {}).get('threaded', False)
-        # You might need to keep track of function definitions and whether they are threaded
-        print(is_threaded)
-        # Evaluate arguments
-
-
-        if not is_threaded:
+        if self.allocator is not None and not self.is_builtin_call(func_name):
+            return self.expression(node)
+        if tracing.enabled('codegen', tracing.DEBUG):
+            tracing.emit('codegen', f"call {func_name} threaded={self.is_threaded(func_name)}")
+        if func_name == JOIN:
+            self.emit_join(node)
+        elif func_name in ATOMICS:
+            self.emit_atomic(node)
+        elif self.is_threaded(func_name):
+            self.emit_spawn(node)
+        else:
             arg_registers = ['rcx', 'rdx', 'r8', 'r9']
             num_args = len(node.arg_nodes)
             # Normal function call
@@ -481,41 +1283,23 @@ class CodeGenerator:
                 self.visit(node.arg_nodes[i])
                 self.asm_code.append(f'    mov {arg_registers[i]}, rax')
             self.asm_code.append(f'    call FUNC_{func_name}')
-        else:
-            # Threaded function call
-            # For simplicity, we won't pass arguments to threaded functions in this example
-            # Alternatively, you can pass parameters via a structure allocated on the heap
-
-            # Create the thread
-            self.asm_code.append('    sub rsp, 40')  # Allocate 40 bytes (32 for shadow space + 8 for alignment)
-
-        # Set stack parameters (dwCreationFlags and lpThreadId)
-            self.asm_code.append('    mov dword [rsp + 32], 0')    # dwCreationFlags = 0
-            self.asm_code.append('    mov qword [rsp + 40], 0')    # lpThreadId = NULL
-
-        # Set register parameters
-            self.asm_code.append('    mov rcx, 0')                 # lpThreadAttributes = NULL
-            self.asm_code.append('    mov rdx, 0')                 # dwStackSize = 0 (default size)
-            self.asm_code.append(f'    lea r8, [rel FUNC_{func_name}]')  # lpStartAddress (function address)
-            self.asm_code.append('    mov r9, 0')                  # lpParameter = NULL
-
-        # Call CreateThread
-            self.asm_code.append('    call CreateThread')
 
-        # Clean up the stack
-            self.asm_code.append('    add rsp, 40')                # Restore stack pointer
-
-        # Close the thread handle
-            self.asm_code.append('    mov rcx, rax')               # Thread handle returned in rax
-            self.asm_code.append('    call CloseHandle')  # Close the thread handle
     def visit_ReturnNode(self, node):
+        if self.emit_tail_call(node.value_node):
+            return
         self.visit(node.value_node)
         # RAX already contains the return value
+        self.release_held_locks()
         self.asm_code.append('    jmp ' + self.current_function_end_label)
 
 class LinuxCodeGenerator(CodeGenerator):
-    def __init__(self):
-        super().__init__()
+    abi = 'linux'
+
+    def __init__(self, register_allocation=True, peephole=True, strength_reduction=True,
+                 loop_optimization=True, value_numbering=True, tail_calls=True, thread_pool=True,
+                 lock_stats=False, cache_line_layout=True):
+        super().__init__(register_allocation, peephole, strength_reduction, loop_optimization, value_numbering,
+                         tail_calls, thread_pool, lock_stats, cache_line_layout)
 
     def setup(self):
         """Linux-specific setup"""
@@ -539,6 +1323,7 @@ class LinuxCodeGenerator(CodeGenerator):
 
     def cleanup(self):
         """Linux-specific cleanup"""
+        self.report_locks()
         self.asm_code.append('    mov rsp, rbp')
         self.asm_code.append('    pop rbp')
         self.asm_code.append('    xor eax, eax')
@@ -549,37 +1334,44 @@ class LinuxCodeGenerator(CodeGenerator):
         self.asm_code.append('    mov eax, 1')
         self.asm_code.append('    ret')
 
-    def generate(self, nodes):
+    def generate(self, nodes, compiled_functions=()):
         """Override generate to use Linux cleanup"""
         self.asm_code = []
         self.setup()
+        self.start_thread_pool(nodes)
+        self.global_names = global_variables(nodes)
+        if self.allocator is not None:
+            self.allocator.shared_variables |= threaded_function_variables(nodes)
+        self.find_thread_globals(nodes)
+        for asm_lines, variables in compiled_functions:
+            self.merge_function(asm_lines, variables)
 
         for node in nodes:
             if isinstance(node, FunctionDefNode):
                 self.visit(node)
-        for node in nodes:
-            if not isinstance(node, FunctionDefNode):
-                self.visit(node)
+        self.visit_statements([node for node in nodes if not isinstance(node, FunctionDefNode)])
 
         self.cleanup()
+        self.place_functions()
 
-        bss_section = []
-        for var_name, var_info in self.variables.items():
-            if var_info['type'] == 'scalar':
-                bss_section.append(f'{var_name}: resq 1')
-            elif var_info['type'] == 'array':
-                total_size = var_info['size']
-                bss_section.append(f'{var_name}: resq {total_size}')
-            elif var_info['type'] == 'dynamic_array':
-                bss_section.append(f'{var_name}: resq 1')
+        bss_section = self.bss_section()
 
         data_section_end = self.asm_code.index('section .text')
         self.asm_code = self.asm_code[:data_section_end] + bss_section + self.asm_code[data_section_end:]
+        self.add_thread_pool()
+        self.add_locks()
+        self.run_peephole()
 
         return '\n'.join(self.asm_code)
 
     def visit_PrintNode(self, node):
         """Linux x64 calling convention for printf"""
+        if self.allocator is not None:
+            self.expression(node.value_node, 'rsi')
+            self.asm_code.append('    lea rdi, [rel format]')
+            self.asm_code.append('    xor eax, eax')
+            self.asm_code.append('    call printf')
+            return
         self.visit(node.value_node)
         self.asm_code.append('    mov rsi, rax')        # Second argument (value)
         self.asm_code.append('    lea rdi, [rel format]')  # First argument (format string)
@@ -600,12 +1392,15 @@ class LinuxCodeGenerator(CodeGenerator):
 
         # Evaluate size expression and allocate memory
         self.visit(node.size_expr)
-        self.asm_code.append('    imul rax, 8')         # Multiply by 8 for 64-bit integers
-        self.asm_code.append('    mov rdi, rax')        # Size argument for malloc
+        if self.strength_reduction:
+            self.asm_code.append('    lea rdi, [rax*8]')    # Size argument for malloc
+        else:
+            self.asm_code.append('    imul rax, 8')         # Multiply by 8 for 64-bit integers
+            self.asm_code.append('    mov rdi, rax')        # Size argument for malloc
         self.asm_code.append('    call malloc')         # Call malloc
         self.asm_code.append('    test rax, rax')       # Check if allocation failed
         self.asm_code.append('    jz allocation_failed')
-        self.asm_code.append(f'    mov [{var_name}], rax')  # Store pointer in variable
+        self.asm_code.append(f'    mov {self.variable(var_name)}, rax')  # Store pointer in variable
 
     def visit_DeleteNode(self, node):
         """Linux implementation of memory deallocation using free"""
@@ -614,7 +1409,7 @@ class LinuxCodeGenerator(CodeGenerator):
             raise Exception(f"Variable '{var_name}' is not a dynamic array")
 
 
-        self.asm_code.append(f'    mov rdi, [{var_name}]')   # Pointer argument for free
+        self.asm_code.append(f'    mov rdi, {self.variable(var_name)}')   # Pointer argument for free
         self.asm_code.append('    call free')                # Call free
 
     def visit_FunctionDefNode(self, node):
@@ -635,27 +1430,17 @@ class LinuxCodeGenerator(CodeGenerator):
         # Function label
         self.asm_code.append(f'{label_func_start}:')
         self.current_function_end_label = label_func_end
+        self.current_function = node
 
-        if node.threaded:
-            # Thread function receives a single void* parameter in rdi
-            self.asm_code.append('    push rbp')
-            self.asm_code.append('    mov rbp, rsp')
-            self.asm_code.append('    push rdi')  # Save thread parameter
-        else:
-            # Regular function prologue
-            self.asm_code.append('    push rbp')
-            self.asm_code.append('    mov rbp, rsp')
-            # Handle parameters using Linux calling convention
-            param_registers = ['rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9']
-            for i, param_token in enumerate(node.param_tokens):
-                self.variables[param_token.value] = {'type': 'scalar'}
-                if i < 6:
-                    reg = param_registers[i]
-                    self.asm_code.append(f'    mov qword [{param_token.value}], {reg}')
+        # Prologue; parameters and locals live in the function's frame
+        self.asm_code.append('    push rbp')
+        self.asm_code.append('    mov rbp, rsp')
+        self.enter_frame(node)
+        for param_token in node.param_tokens:
+            self.variables[param_token.value] = {'type': 'scalar'}
 
         # Function body
-        for stmt in node.body_nodes:
-            self.visit(stmt)
+        self.visit_statements(node.body_nodes)
 
         # Epilogue
         self.asm_code.append(f'{label_func_end}:')
@@ -665,35 +1450,28 @@ class LinuxCodeGenerator(CodeGenerator):
             self.asm_code.append('    ret')  # Return to thread exit
         else:
             self.asm_code.append('    ret')
+        self.leave_frame()
+        self.current_function = None
 
         # Save the function code
         func_code = self.asm_code
 
-        # Restore the main asm_code
+        # Restore the main asm_code; generate() puts the function code before it
         self.asm_code = main_asm_code
-        # Insert the function code at the beginning (or appropriate place)
-        self.asm_code = func_code + self.asm_code
+        self.function_code.append(func_code)
         self.current_function_end_label = label_func_end
 
     def visit_FunctionCallNode(self, node):
         func_name = node.func_name_token.value
-
-        if func_name in self.functions and self.functions[func_name]['threaded']:
-            thread_var = f'thread_{self.labels}'
-            self.labels += 1
-            self.asm_code.append('    sub rsp, 8')
-            self.asm_code.append('    mov [rsp], rsp')
-
-            self.asm_code.append('    mov rdi, rsp')
-            self.asm_code.append('    xor rsi, rsi')
-            self.asm_code.append(f'    lea rdx, [rel FUNC_{func_name}]')
-            self.asm_code.append('    xor rcx, rcx')
-
-            self.asm_code.append('    call pthread_create')
-            self.asm_code.append('    test rax, rax')
-            self.asm_code.append('    jnz thread_error')
-
-            self.asm_code.append('    add rsp, 8')
+        if self.allocator is not None and not self.is_builtin_call(func_name):
+            return self.expression(node)
+
+        if func_name == JOIN:
+            self.emit_join(node)
+        elif func_name in ATOMICS:
+            self.emit_atomic(node)
+        elif self.is_threaded(func_name):
+            self.emit_spawn(node)
         else:
             registers = ['rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9']
             stack_args = []
@@ -705,14 +1483,15 @@ class LinuxCodeGenerator(CodeGenerator):
                 else:
                     stack_args.append(arg)
 
+            # Pad before pushing, so the stack arguments sit right above the return address.
+            if len(stack_args) % 2 != 0:
+                self.asm_code.append('    sub rsp, 8')
+
             if stack_args:
                 for arg in reversed(stack_args):
                     self.visit(arg)
                     self.asm_code.append('    push rax')
 
-            if len(stack_args) % 2 != 0:
-                self.asm_code.append('    sub rsp, 8')
-
             self.asm_code.append(f'    call FUNC_{func_name}')
 
             if stack_args:
@@ -726,8 +1505,12 @@ class LinuxCodeGenerator(CodeGenerator):
         self.asm_code.append('    mov rax, -1')
 
 class RISCCodeGenerator(CodeGenerator):
-    def __init__(self):
-        super().__init__()
+    architecture = 'arm64'
+    jump = 'b'
+
+    def __init__(self, peephole=True, strength_reduction=True, loop_optimization=True):
+        super().__init__(register_allocation=False, peephole=peephole, strength_reduction=strength_reduction,
+                         loop_optimization=loop_optimization, thread_pool=False)
         # ARM64 register mapping
         self.register_map = {
             'x0': 'return value/first argument',
@@ -807,11 +1590,63 @@ class RISCCodeGenerator(CodeGenerator):
         self.asm_code.append('    mov x8, #93')               # exit syscall number
         self.asm_code.append('    svc #0')                    # Make syscall
 
+    def bss_section(self):
+        """Nothing to add: visit_VarAssignNode declares each global in .bss when it is first assigned."""
+        return []
+
+    def emit_branch(self, condition, label, when=False):
+        """Jumps to label when condition is when: cmp + b.cond for comparisons, cbz/cbnz otherwise."""
+        if isinstance(condition, BinOpNode) and condition.op_token.type in ARM64_CONDITIONS_FALSE:
+            conditions = ARM64_CONDITIONS if when else ARM64_CONDITIONS_FALSE
+            self.load_operands(condition)
+            self.asm_code.append('    cmp x2, x3')
+            self.asm_code.append(f'    b.{conditions[condition.op_token.type]} {label}')
+            return
+        value_reg = self.visit(condition)
+        self.asm_code.append(f"    {'cbnz' if when else 'cbz'} {value_reg}, {label}")
+
+    def emit_atomic(self, node):
+        raise Exception("Atomic operations on ARM64 need the IR backend (--backend ir)")
+
+    def visit_FunctionDefNode(self, node):
+        raise Exception("Functions on ARM64 need the IR backend (--backend ir)")
+
+    def visit_NumberNode(self, node):
+        """Loads an integer literal into x0."""
+        self.asm_code.append(f'    ldr x0, ={node.token.value}')
+        return 'x0'
+
+    def visit_LockNode(self, node):
+        raise Exception("Lock blocks not yet supported on ARM64")
+
+    def load_operands(self, node):
+        """Evaluates the operands of a binary operation into x2 and x3."""
+        left_reg = self.visit(node.left_node)
+        self.asm_code.append(f'    mov x2, {left_reg}')  # Save left value
+        right_reg = self.visit(node.right_node)
+        self.asm_code.append(f'    mov x3, {right_reg}')  # Save right value
+
     def visit_BinOpNode(self, node):
         """Generate ARM64 assembly for binary operations."""
+        if node.op_token.type in ARM64_CONDITIONS:
+            # A comparison used as a value; if and while branch on the flags instead.
+            self.load_operands(node)
+            self.asm_code.append('    cmp x2, x3')
+            self.asm_code.append(f'    cset x0, {ARM64_CONDITIONS[node.op_token.type]}')
+            return 'x0'
         # Visit left and right nodes to get their values in registers
         left_reg = self.visit(node.left_node)
         self.asm_code.append(f'    mov x2, {left_reg}')  # Save left value
+        value = constant_value(node.right_node)
+        if self.strength_reduction and value is not None:
+            code = None
+            if node.op_token.type == TT_MUL:
+                code = arm64_multiply_by_constant('x0', 'x2', value)
+            elif node.op_token.type == TT_DIV:
+                code = arm64_divide_by_constant('x0', 'x2', value, 'x3')
+            if code is not None:
+                self.asm_code.extend(code)
+                return 'x0'
         right_reg = self.visit(node.right_node)
         self.asm_code.append(f'    mov x3, {right_reg}')  # Save right value
 
@@ -841,8 +1676,8 @@ class RISCCodeGenerator(CodeGenerator):
         var_name = node.left_node.var_name_token.value
 
         # If this is a new variable, declare it in BSS
-        if var_name not in self.variables[0]:
-            self.variables[0][var_name] = {'type': 'scalar'}
+        if var_name not in self.variables:
+            self.variables[var_name] = {'type': 'scalar'}
             # Find BSS section and add variable declaration
             bss_index = self.asm_code.index('.bss') + 2  # Skip .bss and .align
             self.asm_code.insert(bss_index, f'{var_name}: .skip 8')
@@ -856,7 +1691,7 @@ class RISCCodeGenerator(CodeGenerator):
 
     def visit_VarAccessNode(self, node):
         """Generate ARM64 assembly for variable access."""
-        if node.var_name_token.value not in self.variables[0]:
+        if node.var_name_token.value not in self.variables:
             raise Exception(f"Variable '{node.var_name_token.value}' not defined")
 
         # Load the value from memory into a register
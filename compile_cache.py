@@ -0,0 +1,129 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+ENTRY_SUFFIX = '.hivecache'
+
+
+class CompilationCache:
+    """Content-addressed on-disk cache of parsed ASTs and generated assembly.
+
+    Entries are keyed by a hash of the source, the target, the compiler
+    version and any code generation options. Each entry is one file holding
+    two pickles, the assembly first, so a hit only unpickles the AST when
+    asked to. The file's modification time doubles as the LRU timestamp and
+    is refreshed on every hit. When the directory grows past max_bytes the
+    least recently used entries are removed.
+    """
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(source_code, target, version, options=()):
+        digest = hashlib.sha256()
+        for part in (version, target, repr(tuple(options)), source_code):
+            digest.update(str(part).encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def get(self, key, with_ast=False):
+        """Returns (ast, asm_code) for key, or None on a miss; ast is None unless with_ast."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                asm_code = pickle.load(f)
+                ast = pickle.load(f) if with_ast else None
+            os.utime(path)  # mark as most recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # Truncated or stale entry: drop it and recompile.
+            self.misses += 1
+            self._remove(path)
+            return None
+        self.hits += 1
+        return ast, asm_code
+
+    def put(self, key, ast, asm_code):
+        """Stores an entry, then evicts old entries if the cache is over budget."""
+        try:
+            ast_payload = pickle.dumps(ast, pickle.HIGHEST_PROTOCOL)
+        except RecursionError:
+            # Extremely deep expression trees cannot be pickled; the asm alone still saves the work.
+            ast_payload = pickle.dumps(None, pickle.HIGHEST_PROTOCOL)
+        payload = pickle.dumps(asm_code, pickle.HIGHEST_PROTOCOL) + ast_payload
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            self._remove(tmp_path)
+            raise
+        self.stores += 1
+        self.evict()
+
+    def entries(self):
+        """(mtime, size, path) for every entry, least recently used first."""
+        result = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            result.append((st.st_mtime, st.st_size, path))
+        result.sort()
+        return result
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        for _, _, path in self.entries():
+            self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
+
+    def format_stats(self):
+        s = self.stats()
+        return (f"cache: {s['hits']} hits, {s['misses']} misses ({s['hit_rate']:.0%} hit rate), "
+                f"{s['stores']} stores, {s['evictions']} evictions, "
+                f"{s['entries']} entries / {s['bytes'] / 1024:.1f} KiB of {self.max_bytes / 1024:.0f} KiB")
@@ -1,6 +1,6 @@
 import token
 import platform
-from lexer import Lexer
+from lexer import RegexLexer, TOKEN_REGEX
 import token_types
 from parser import Parser
 from code_generator import CodeGenerator, LinuxCodeGenerator, RISCCodeGenerator
@@ -8,6 +8,25 @@ import subprocess
 import argparse
 import shutil
 import os
+import time
+import hashlib
+# Not concurrent.futures/multiprocessing.pool: they import traceback -> tokenize,
+# which needs the stdlib token module that token.py shadows here.
+import multiprocessing
+import data_layout
+import tracing
+from compile_cache import CompilationCache
+from ir import lower
+from nodes import FunctionDefNode, check_locals_assigned, global_variables
+from pass_manager import PassContext, default_pass_manager
+from instruction_selection import get_selector
+
+COMPILER_VERSION = '0.1'
+# -O0: original stack-machine code; -O1: register allocation, strength
+# reduction and peephole rules; -O2: also constant folding and propagation on
+# the AST. The passes of each level are registered in pass_manager.
+DEFAULT_OPT_LEVEL = 1
+_fingerprint = None
 
 def _norm_target(t):
     if not t:
@@ -21,7 +40,8 @@ def _norm_target(t):
         return "arm64"
     return None
 
-def get_code_generator(target: str | None = None):
+def resolve_target(target: str | None = None):
+    """Normalizes target, falling back to the host OS (Windows when unknown)."""
     system_target = _norm_target(target)
     if system_target is None:
         system = platform.system()
@@ -31,35 +51,294 @@ def get_code_generator(target: str | None = None):
             system_target = "linux-x86_64"
         else:
             system_target = "windows-x86_64"
+    return system_target
+
+def default_backend(target):
+    """The backend compile_to_asm uses for a resolved target when none is given.
+
+    The AST generators are the main backend: x86-64's register allocation,
+    strength reduction and loop optimizations only exist there. ARM64 goes
+    through the IR, since the AST generator for it (RISCCodeGenerator) only
+    handles straight-line code and loops without functions.
+    """
+    return 'ir' if target == 'arm64' else 'ast'
+
+def compiler_version():
+    """COMPILER_VERSION plus a hash of the compiler sources, so edits invalidate cached output."""
+    global _fingerprint
+    if _fingerprint is None:
+        digest = hashlib.sha256()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(here)):
+            if name.endswith('.py') and not name.startswith('test_') and name != 'benchmark.py':
+                with open(os.path.join(here, name), 'rb') as f:
+                    digest.update(f.read())
+        _fingerprint = f'{COMPILER_VERSION}+{digest.hexdigest()[:16]}'
+    return _fingerprint
+
+def get_code_generator(target: str | None = None, opt_level=DEFAULT_OPT_LEVEL, lock_stats=False):
+    """Generator for target; the peephole rules run afterwards as an asm pass."""
+    system_target = resolve_target(target)
+    enabled = opt_level >= 1
     if system_target == "windows-x86_64":
-        return CodeGenerator()
+        return CodeGenerator(register_allocation=enabled, peephole=False, strength_reduction=enabled,
+                             loop_optimization=enabled, value_numbering=enabled, tail_calls=enabled,
+                             lock_stats=lock_stats)
     if system_target == "linux-x86_64":
-        return LinuxCodeGenerator()
-    return RISCCodeGenerator()
+        return LinuxCodeGenerator(register_allocation=enabled, peephole=False, strength_reduction=enabled,
+                                  loop_optimization=enabled, value_numbering=enabled, tail_calls=enabled,
+                                  lock_stats=lock_stats)
+    return RISCCodeGenerator(peephole=False, strength_reduction=enabled, loop_optimization=enabled)
+
+def generate_through_ir(ast, target, passes, context, dump_ir=False, lock_stats=False):
+    """Lowers ast to the IR, runs the IR passes and selects instructions for target."""
+    module = passes.run('ir', lower(ast), context)
+    if dump_ir:
+        print(module.dump(), end='')
+    if tracing.enabled('codegen', tracing.DEBUG):
+        tracing.emit('codegen', f"IR:\n{module.dump()}")
+    return get_selector(resolve_target(target), peephole=False, lock_stats=lock_stats).select(module)
+
+def split_top_level_functions(source_code):
+    """Cuts top-level function definitions out of the source.
+
+    Returns (main_source, units) where units is a list of
+    (func_name, threaded, unit_source) in source order. Every piece keeps
+    the line and column numbers of the original text: a unit is padded to
+    its original position and its span in main_source is blanked out.
+    """
+    units = []
+    pieces = []
+    depth = 0
+    start = None
+    threaded = False
+    func_name = None
+    expect_name = False
+    last = 0          # end of the text already copied to pieces
+    line = 1          # line of 'start', counted incrementally
+    line_pos = 0
+    for m in TOKEN_REGEX.finditer(source_code):
+        if m.lastgroup != 'NAME':
+            continue
+        word = m.group()
+        if expect_name:
+            func_name = word
+            expect_name = False
+        if word == 'threaded':
+            if depth == 0:
+                start, threaded = m.start(), True
+        elif word == 'function':
+            if depth == 0 and start is None:
+                start, threaded = m.start(), False
+            depth += 1
+            expect_name = depth == 1
+        elif word in ('if', 'while', 'lock'):
+            depth += 1
+        elif word == 'end' and depth > 0:
+            depth -= 1
+            if depth == 0 and start is not None:
+                end = m.end()
+                line += source_code.count('\n', line_pos, start)
+                line_pos = start
+                col = start - (source_code.rfind('\n', 0, start) + 1)
+                span = source_code[start:end]
+                units.append((func_name, threaded, '\n' * (line - 1) + ' ' * col + span))
+                newlines = span.count('\n')
+                tail = len(span) - span.rfind('\n') - 1 if newlines else len(span)
+                pieces.append(source_code[last:start])
+                pieces.append('\n' * newlines + ' ' * tail)
+                last = end
+                start = None
+    pieces.append(source_code[last:])
+    return ''.join(pieces), units
+
+def _compile_function_unit(args):
+    """Worker: lexes, parses and generates one function unit.
+
+    Returns (asm_lines, variables, summaries); summaries maps the unit's
+    functions to their data_layout.summary().
+    """
+    unit_source, target, functions, global_names, shared_variables, label_prefix, opt_level, unroll = args
+    nodes = Parser(RegexLexer(unit_source).iter_tokens()).parse()
+    check_locals_assigned(nodes, global_names)
+    nodes = default_pass_manager(opt_level, unroll).run('ast', nodes, PassContext(target, shared_variables, False))
+    generator = get_code_generator(target, opt_level)
+    generator.functions = dict(functions)
+    generator.global_names = set(global_names)
+    generator.label_prefix = label_prefix
+    if generator.allocator is not None:
+        generator.allocator.shared_variables |= shared_variables
+    asm_lines = []
+    variables = {}
+    summaries = {}
+    for node in nodes:
+        lines, node_variables = generator.generate_function(node)
+        asm_lines = lines + asm_lines
+        variables.update(node_variables)
+        if isinstance(node, FunctionDefNode):
+            summaries[node.func_name_token.value] = data_layout.summary(node, global_names)
+    return asm_lines, variables, summaries
+
+def _function_worker(tasks, conn):
+    try:
+        conn.send([_compile_function_unit(task) for task in tasks])
+    except Exception as e:
+        conn.send(e)
+    conn.close()
 
-def compile_to_asm(source_code, output_filename='outputtest.asm', target: str | None = None):
-    lexer = Lexer(source_code)
-    tokens = lexer.tokenize()
-    print("Tokens:", tokens)
+def compile_parallel(source_code, target, jobs, opt_level=DEFAULT_OPT_LEVEL, passes=None, unroll=1,
+                     lock_stats=False):
+    """Compiles top-level functions in worker processes and the rest in this process.
+
+    Each worker gets a contiguous slice of the function units, and results
+    are merged in source order with labels prefixed per unit, so the output
+    does not depend on which worker finishes first. Returns (ast, asm_code);
+    ast is None because the function ASTs stay in the workers.
+
+    Workers run the AST passes of opt_level themselves; passes (a
+    PassManager) runs them on the main program and records only those.
+    The lock runtime and its counters are emitted with the main program.
+    """
+    if passes is None:
+        passes = default_pass_manager(opt_level, unroll)
+    main_source, units = split_top_level_functions(source_code)
+    # Every unit sees every function, as if all definitions had been visited first.
+    functions = {name: {'threaded': threaded} for name, threaded, _ in units}
+    # Only variables the main program mentions are globals; the rest are locals of the units.
+    tokens = list(RegexLexer(main_source).iter_tokens())
+    global_names = {token.value for token, following in zip(tokens, tokens[1:] + [None])
+                    if token.type == token_types.TT_IDENTIFIER
+                    and (following is None or following.type != token_types.TT_LPAREN)}
+    # Globals a threaded function mentions must stay in memory in every unit's loops.
+    shared_variables = {token.value for _, threaded, unit_source in units if threaded
+                        for token in RegexLexer(unit_source).iter_tokens()
+                        if token.type == token_types.TT_IDENTIFIER and token.value in global_names}
+    tasks = [(unit_source, target, functions, global_names, shared_variables, f'F{index}_', opt_level, unroll)
+             for index, (_, _, unit_source) in enumerate(units)]
+    size = -(-len(tasks) // jobs) or 1
+    workers = []
+    for first in range(0, len(tasks), size):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_function_worker, args=(tasks[first:first + size], sender))
+        process.start()
+        sender.close()
+        workers.append((process, receiver))
+    try:
+        # The main program is parsed while the workers run.
+        main_nodes = Parser(RegexLexer(main_source).iter_tokens()).parse()
+        main_nodes = passes.run('ast', main_nodes, PassContext(target, shared_variables, False))
+        compiled_functions = []
+        summaries = {}
+        for process, receiver in workers:
+            result = receiver.recv()
+            if isinstance(result, Exception):
+                raise result
+            for asm_lines, variables, unit_summaries in result:
+                compiled_functions.append((asm_lines, variables))
+                summaries.update(unit_summaries)
+    finally:
+        for process, receiver in workers:
+            receiver.close()
+            process.join()
+    generator = get_code_generator(target, opt_level, lock_stats)
+    generator.functions.update(functions)
+    if generator.allocator is not None:
+        generator.allocator.shared_variables |= shared_variables
+    generator.thread_writers.update(data_layout.resolve_writers(
+        summaries, {name for name, threaded, _ in units if threaded}))
+    generator.thread_readers |= shared_variables
+    return None, generator.generate(main_nodes, compiled_functions)
+
+def compile_to_asm(source_code, output_filename='outputtest.asm', target: str | None = None,
+                   cache: CompilationCache | None = None, jobs=1, opt_level=DEFAULT_OPT_LEVEL,
+                   backend=None, dump_ir=False, passes=None, unroll=1, lock_stats=False):
+    """Compiles source_code to assembly for target and writes it to output_filename.
+
+    passes is the PassManager to run, by default the passes of opt_level
+    (unrolling loops by unroll); pass one in to read its records afterwards.
+    With lock_stats the program prints how often each lock was taken and
+    found held before it exits. backend is 'ast' or 'ir', by default
+    default_backend(target).
+    """
+    if passes is None:
+        passes = default_pass_manager(opt_level, unroll)
+    timed = tracing.enabled('compiler', tracing.INFO)
+    if timed:
+        start = time.perf_counter()
+    target = resolve_target(target)
+    if backend is None:
+        backend = default_backend(target)
+    if backend == 'ir':
+        # Functions are lowered into one module, so the IR backend compiles serially.
+        jobs = 1
+    if dump_ir:
+        cache = None  # a cache hit would skip lowering
+    if cache is not None:
+        options = ((f'O{opt_level}', backend, f'unroll{unroll}') + (('parallel',) if jobs > 1 else ())
+                   + (('lock-stats',) if lock_stats else ()))
+        cache_key = cache.key(source_code, target, compiler_version(), options)
+        cached = cache.get(cache_key, with_ast=tracing.enabled('parser', tracing.INFO))
+        if cached is not None:
+            # Hit: lexing, parsing and code generation are skipped entirely.
+            ast, asm_code = cached
+            if tracing.enabled('parser', tracing.INFO):
+                tracing.emit('parser', f"AST: {ast}")
+            with open(output_filename, 'w') as f:
+                f.write(asm_code)
+            if tracing.enabled('codegen', tracing.INFO):
+                tracing.emit('codegen', f"Assembly:\n{asm_code}")
+            if timed:
+                tracing.emit('compiler', f"cache hit {cache_key[:12]} "
+                                         f"{(time.perf_counter() - start) * 1000:.2f} ms")
+            return asm_code
+    if jobs > 1:
+        ast, asm_code = compile_parallel(source_code, target, jobs, opt_level, passes, unroll, lock_stats)
+        asm_code = '\n'.join(passes.run('asm', asm_code.split('\n'), PassContext(target)))
+        if timed:
+            tracing.emit('compiler', f"parallel compile ({jobs} jobs) "
+                                     f"{(time.perf_counter() - start) * 1000:.2f} ms")
+        if cache is not None:
+            cache.put(cache_key, ast, asm_code)
+        with open(output_filename, 'w') as f:
+            f.write(asm_code)
+        if tracing.enabled('codegen', tracing.INFO):
+            tracing.emit('codegen', f"Assembly:\n{asm_code}")
+        return asm_code
+    lexer = RegexLexer(source_code)
+    if tracing.enabled('lexer', tracing.INFO):
+        tokens = lexer.tokenize()
+        tracing.emit('lexer', f"Tokens: {tokens}")
+    else:
+        # Tokens are streamed into the parser, so lexing and parsing overlap.
+        tokens = lexer.iter_tokens()
     parser = Parser(tokens)
+    context = PassContext(target)
     ast = parser.parse()
-    print("AST:", ast)
-    generator = get_code_generator(target)
-    asm_code = generator.generate(ast)
+    check_locals_assigned(ast, global_variables(ast))
+    ast = passes.run('ast', ast, context)
+    if tracing.enabled('parser', tracing.INFO):
+        tracing.emit('parser', f"AST: {ast}")
+    if timed:
+        parsed = time.perf_counter()
+    if backend == 'ir':
+        asm_code = generate_through_ir(ast, target, passes, context, dump_ir, lock_stats)
+    else:
+        asm_code = get_code_generator(target, opt_level, lock_stats).generate(ast)
+    asm_code = '\n'.join(passes.run('asm', asm_code.split('\n'), context))
+    if timed:
+        done = time.perf_counter()
+        tracing.emit('compiler', f"lex+parse {(parsed - start) * 1000:.2f} ms, "
+                                 f"codegen {(done - parsed) * 1000:.2f} ms")
+    if cache is not None:
+        cache.put(cache_key, ast, asm_code)
     with open(output_filename, 'w') as f:
         f.write(asm_code)
-    print(asm_code)
+    if tracing.enabled('codegen', tracing.INFO):
+        tracing.emit('codegen', f"Assembly:\n{asm_code}")
+    return asm_code
 
 def assemble_and_link(asm_filename='outputtest.asm', obj_filename='outputtest.o', exe_filename='outputtest', target: str | None = None):
-    system_target = _norm_target(target)
-    if system_target is None:
-        sysname = platform.system()
-        if sysname == "Windows":
-            system_target = "windows-x86_64"
-        elif sysname == "Linux":
-            system_target = "linux-x86_64"
-        else:
-            system_target = "windows-x86_64"
+    system_target = resolve_target(target)
     try:
         if system_target == "windows-x86_64":
             asm = shutil.which("nasm")
@@ -74,12 +353,12 @@ def assemble_and_link(asm_filename='outputtest.asm', obj_filename='outputtest.o'
             mingw = shutil.which("x86_64-w64-mingw32-gcc")
             if mingw:
                 exe_filename = os.path.splitext(exe_filename)[0] + ".exe"
-                subprocess.run([mingw, "-o", exe_filename, obj_filename], check=True)
+                subprocess.run([mingw, "-o", exe_filename, obj_filename, "-lsynchronization"], check=True)
             else:
                 gcc = shutil.which("gcc")
                 if platform.system() == "Windows" and gcc:
                     exe_filename = os.path.splitext(exe_filename)[0] + ".exe"
-                    subprocess.run([gcc, "-o", exe_filename, obj_filename], check=True)
+                    subprocess.run([gcc, "-o", exe_filename, obj_filename, "-lsynchronization"], check=True)
                 else:
                     print("Skipping link: no MinGW (x86_64-w64-mingw32-gcc) or Windows gcc found.")
         elif system_target == "linux-x86_64":
@@ -117,15 +396,53 @@ def assemble_and_link(asm_filename='outputtest.asm', obj_filename='outputtest.o'
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--target", default=None, help="windows-x86_64|linux-x86_64|arm64")
+    parser.add_argument("--trace", default="", metavar="SPEC",
+                        help="trace phases, e.g. 'all', 'lexer=debug,codegen' (categories: "
+                             + ", ".join(tracing.CATEGORIES) + "; levels: " + ", ".join(tracing.LEVELS) + ")")
+    parser.add_argument("--cache-dir", default=None,
+                        help="reuse ASTs and assembly from this directory when source and target are unchanged")
+    parser.add_argument("--cache-max-mb", type=float, default=64, help="size limit of the cache directory")
+    parser.add_argument("--cache-stats", action="store_true", help="print cache hit/miss statistics")
+    parser.add_argument("-O", dest="opt_level", type=int, choices=(0, 1, 2), default=DEFAULT_OPT_LEVEL,
+                        help="optimization level: 0 stack machine, 1 register allocation and peephole, "
+                             "2 also constant folding (default %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="compile top-level functions in this many worker processes")
+    parser.add_argument("--unroll", type=int, default=1, metavar="FACTOR",
+                        help="unroll counted while loops by FACTOR from -O1 (default 1: no unrolling)")
+    parser.add_argument("--pass-stats", action="store_true",
+                        help="print the wall time and instructions removed of every optimization pass")
+    parser.add_argument("--backend", choices=("ast", "ir"),
+                        help="generate assembly from the AST directly or through the three-address IR "
+                             "(default: ir for arm64, ast otherwise)")
+    parser.add_argument("--dump-ir", action="store_true", help="print the IR (implies --backend ir)")
+    parser.add_argument("--lock-stats", action="store_true",
+                        help="count acquisitions and contention of every lock and print them at exit")
     args = parser.parse_args()
+    if args.dump_ir:
+        args.backend = "ir"
+    try:
+        tracing.configure(args.trace)
+    except Exception as e:
+        parser.error(str(e))
+    cache = None
+    if args.cache_dir:
+        cache = CompilationCache(args.cache_dir, int(args.cache_max_mb * 1024 * 1024))
     source_code = """
 a = 5
 b = 3
 c = a + b
 print c
     """
-    compile_to_asm(source_code, target=args.target)
+    passes = default_pass_manager(args.opt_level, args.unroll)
+    compile_to_asm(source_code, target=args.target, cache=cache, jobs=args.jobs, opt_level=args.opt_level,
+                  backend=args.backend, dump_ir=args.dump_ir, passes=passes, unroll=args.unroll,
+                  lock_stats=args.lock_stats)
+    if args.pass_stats:
+        print(passes.format_report())
+    if cache is not None and args.cache_stats:
+        print(cache.format_stats())
     assemble_and_link(target=args.target)
 
 if __name__ == '__main__':
-    main()
+    main()
@@ -0,0 +1,236 @@
+from nodes import *
+from token import Token
+from token_types import (
+    TT_INT, TT_PLUS, TT_MINUS, TT_MUL, TT_DIV,
+    TT_EE, TT_NE, TT_LT, TT_GT, TT_LTE, TT_GTE
+)
+
+INT64_MIN = -2**63
+
+
+def wrap64(value):
+    """Wraps value to a signed 64-bit integer, as the generated code would."""
+    value &= 2**64 - 1
+    return value - 2**64 if value >= 2**63 else value
+
+
+def truncating_division(left, right):
+    quotient = abs(left) // abs(right)
+    return quotient if (left < 0) == (right < 0) else -quotient
+
+
+OPERATIONS = {
+    TT_PLUS: lambda a, b: wrap64(a + b),
+    TT_MINUS: lambda a, b: wrap64(a - b),
+    TT_MUL: lambda a, b: wrap64(a * b),
+    TT_DIV: truncating_division,
+    TT_EE: lambda a, b: int(a == b),
+    TT_NE: lambda a, b: int(a != b),
+    TT_LT: lambda a, b: int(a < b),
+    TT_GT: lambda a, b: int(a > b),
+    TT_LTE: lambda a, b: int(a <= b),
+    TT_GTE: lambda a, b: int(a >= b),
+}
+
+
+def assigned_variables(nodes):
+    """Names a statement list may assign, including parameters of functions it defines
+    and variables changed by atomic operations."""
+    names = set()
+    for statement in nodes:
+        for node in walk(statement):
+            if isinstance(node, VarAssignNode) and isinstance(node.left_node, VarAccessNode):
+                names.add(node.left_node.var_name_token.value)
+            elif isinstance(atomic_target(node), VarAccessNode):
+                names.add(node.arg_nodes[0].var_name_token.value)
+            elif isinstance(node, (DynamicArrayAllocNode, DeleteNode)):
+                names.add(node.var_name_token.value)
+            elif isinstance(node, FunctionDefNode):
+                names.update(token.value for token in node.param_tokens)
+    return names
+
+
+class ConstantFolder:
+    """Folds constant expressions and propagates constants through assignments.
+
+    The pass tracks one environment of variables known to hold a constant
+    and forgets entries whenever control flow or a call could change them:
+
+    - a while loop forgets everything its body assigns, before and after the loop;
+    - an if merges the environments of both branches;
+    - a call forgets every global a function assigns, or everything when
+      whole_program is False and other units may define the callee; the
+      caller's locals are in its own frame and survive the call;
+    - variables a threaded function uses are never propagated, and threaded
+      function bodies only fold literal expressions.
+
+    Assignments are kept, so the variables still hold the same values in memory.
+    """
+    def __init__(self, shared_variables=(), whole_program=True):
+        self.shared_variables = set(shared_variables)
+        self.whole_program = whole_program
+        self.function_writes = None  # None: unknown, a call may change anything
+        self.constants = {}
+        self.propagate = True
+        self.folded = 0
+
+    def fold(self, nodes):
+        """Optimizes a program in place and returns it."""
+        self.shared_variables |= threaded_function_variables(nodes)
+        if self.whole_program:
+            self.function_writes = assigned_variables(
+                [node for node in nodes if isinstance(node, FunctionDefNode)]) & global_variables(nodes)
+        self.statements(nodes)
+        return nodes
+
+    def statements(self, nodes):
+        for index, node in enumerate(nodes):
+            nodes[index] = self.statement(node)
+
+    def statement(self, node):
+        method = getattr(self, f'statement_{type(node).__name__}', None)
+        if method is None:
+            return self.expression(node)
+        return method(node)
+
+    # Statements
+
+    def statement_VarAssignNode(self, node):
+        if isinstance(node.left_node, ArrayAccessNode):
+            self.array_indexes(node.left_node)
+            node.value_node = self.expression(node.value_node)
+            return node
+        node.value_node = self.expression(node.value_node)
+        var_name = node.left_node.var_name_token.value
+        if (self.propagate and isinstance(node.value_node, NumberNode)
+                and var_name not in self.shared_variables):
+            self.constants[var_name] = wrap64(node.value_node.token.value)
+        else:
+            self.constants.pop(var_name, None)
+        return node
+
+    def statement_PrintNode(self, node):
+        node.value_node = self.expression(node.value_node)
+        return node
+
+    def statement_ReturnNode(self, node):
+        node.value_node = self.expression(node.value_node)
+        return node
+
+    def statement_DynamicArrayAllocNode(self, node):
+        node.size_expr = self.expression(node.size_expr)
+        self.constants.pop(node.var_name_token.value, None)
+        return node
+
+    def statement_DeleteNode(self, node):
+        self.constants.pop(node.var_name_token.value, None)
+        return node
+
+    def statement_IfNode(self, node):
+        node.condition_node = self.expression(node.condition_node)
+        before = dict(self.constants)
+        self.statements(node.true_statements)
+        after_true = self.constants
+        self.constants = before
+        if node.false_statements is not None:
+            self.statements(node.false_statements)
+        if isinstance(node.condition_node, NumberNode):
+            # Only one branch can run.
+            if node.condition_node.token.value != 0:
+                self.constants = after_true
+        else:
+            self.constants = {name: value for name, value in after_true.items()
+                              if name in self.constants and self.constants[name] == value}
+        return node
+
+    def statement_WhileNode(self, node):
+        # Values assigned anywhere in the loop are unknown at the condition and after the loop.
+        changed = assigned_variables(node.body_node)
+        if any(isinstance(child, FunctionCallNode) for child in walk(node)):
+            self.forget_call_effects()
+        for name in changed:
+            self.constants.pop(name, None)
+        node.condition_node = self.expression(node.condition_node)
+        self.statements(node.body_node)
+        for name in changed:
+            self.constants.pop(name, None)
+        if any(isinstance(child, FunctionCallNode) for child in walk(node)):
+            self.forget_call_effects()
+        return node
+
+    def statement_LockNode(self, node):
+        # Only variables no thread shares are propagated, so taking the lock changes none of them.
+        self.statements(node.body_nodes)
+        return node
+
+    def statement_FunctionDefNode(self, node):
+        # The body runs when called, with unknown globals; the definition itself changes nothing.
+        outer, outer_propagate = self.constants, self.propagate
+        self.constants = {}
+        self.propagate = not node.threaded
+        self.statements(node.body_nodes)
+        self.constants, self.propagate = outer, outer_propagate
+        return node
+
+    # Expressions
+
+    def expression(self, node):
+        method = getattr(self, f'expression_{type(node).__name__}', None)
+        return method(node) if method is not None else node
+
+    def expression_VarAccessNode(self, node):
+        value = self.constants.get(node.var_name_token.value) if self.propagate else None
+        if value is None:
+            return node
+        self.folded += 1
+        token = node.var_name_token
+        return NumberNode(Token(TT_INT, value, token.line, token.col))
+
+    def expression_UnaryOpNode(self, node):
+        node.node = self.expression(node.node)
+        if isinstance(node.node, NumberNode) and node.op_token.type in (TT_PLUS, TT_MINUS):
+            value = wrap64(node.node.token.value)
+            return self.number(-value if node.op_token.type == TT_MINUS else value, node.op_token)
+        return node
+
+    def expression_BinOpNode(self, node):
+        node.left_node = self.expression(node.left_node)
+        node.right_node = self.expression(node.right_node)
+        op = node.op_token.type
+        if not (isinstance(node.left_node, NumberNode) and isinstance(node.right_node, NumberNode)
+                and op in OPERATIONS):
+            return node
+        left = wrap64(node.left_node.token.value)
+        right = wrap64(node.right_node.token.value)
+        if op == TT_DIV and (right == 0 or (left == INT64_MIN and right == -1)):
+            return node  # traps at run time; leave it to do so
+        return self.number(OPERATIONS[op](left, right), node.op_token)
+
+    def expression_ArrayAccessNode(self, node):
+        self.array_indexes(node)
+        return node
+
+    def expression_FunctionCallNode(self, node):
+        target = atomic_target(node)
+        if isinstance(target, VarAccessNode):
+            # The variable is changed in place, not read: keep it and forget its value.
+            node.arg_nodes[1:] = [self.expression(arg) for arg in node.arg_nodes[1:]]
+            self.constants.pop(target.var_name_token.value, None)
+        else:
+            node.arg_nodes = [self.expression(arg) for arg in node.arg_nodes]
+        self.forget_call_effects()
+        return node
+
+    def array_indexes(self, node):
+        node.indexes = [self.expression(index) for index in node.indexes]
+
+    def forget_call_effects(self):
+        if self.function_writes is None:
+            self.constants.clear()
+        else:
+            for name in self.function_writes:
+                self.constants.pop(name, None)
+
+    def number(self, value, token):
+        self.folded += 1
+        return NumberNode(Token(TT_INT, wrap64(value), token.line, token.col))
@@ -0,0 +1,110 @@
+"""Cache-line-aware layout of the .bss globals.
+
+Cores keep memory in 64-byte cache lines, and a line written on one core
+is taken away from every other core that holds it. Globals declared one
+after another share lines. If a threaded function writes one of them
+while main or another thread uses its neighbours, the line moves between
+cores on every write even though no variable is actually shared (false
+sharing).
+
+The globals are therefore arranged in three kinds of groups, each
+starting on a line of its own:
+
+- globals no thread uses: main's own variables, such as its loop
+  counters and handles, packed together;
+- globals threads only read: read-mostly data, packed together;
+- globals threads write: one group per set of threaded functions
+  writing them, so counters of different workers never share a line.
+
+What a threaded function writes includes what the functions it calls
+write, since they run on its thread. The analysis works on per-function
+summaries, so the parallel compile can have its workers summarise the
+functions they compile. Lock records and the thread pool's counters get
+lines of their own in their runtimes.
+"""
+from nodes import *
+
+CACHE_LINE = 64
+
+
+def written_globals(node, global_names):
+    """Globals a FunctionDefNode stores to, array elements included; parameters hide globals."""
+    params = {token.value for token in node.param_tokens}
+    names = set()
+    for statement in node.body_nodes:
+        for child in walk(statement):
+            if isinstance(child, VarAssignNode):
+                names.add(child.left_node.var_name_token.value)
+            elif isinstance(child, (ArrayAssignNode, DynamicArrayAllocNode, DeleteNode)):
+                names.add(child.var_name_token.value)
+            elif atomic_target(child) is not None:
+                names.add(child.arg_nodes[0].var_name_token.value)
+    return {name for name in names if name in global_names and name not in params}
+
+
+def called_functions(node):
+    """Names of the functions a FunctionDefNode calls, built-ins left out."""
+    return {child.func_name_token.value for child in walk(node)
+            if isinstance(child, FunctionCallNode) and child.func_name_token.value not in BUILTINS}
+
+
+def summary(node, global_names):
+    """(globals a FunctionDefNode writes, functions it calls), what resolve_writers needs of it."""
+    return written_globals(node, global_names), called_functions(node)
+
+
+def resolve_writers(summaries, threaded):
+    """Global name -> names of the threaded functions that may write it.
+
+    summaries maps each function name to its summary(); threaded holds the
+    names of the threaded functions. A threaded function writes what its
+    body stores to and what the plain functions it calls, directly or not,
+    store to. Threaded functions it calls are threads of their own.
+    """
+    writers = {}
+    for name in threaded:
+        if name not in summaries:
+            continue
+        reached, stack = {name}, [name]
+        while stack:
+            written, called = summaries[stack.pop()]
+            for name_written in written:
+                writers.setdefault(name_written, set()).add(name)
+            for callee in called:
+                if callee in summaries and callee not in reached and callee not in threaded:
+                    reached.add(callee)
+                    stack.append(callee)
+    return writers
+
+
+def thread_writers(nodes):
+    """resolve_writers() for the function definitions among nodes."""
+    global_names = global_variables(nodes)
+    functions = [node for node in nodes if isinstance(node, FunctionDefNode)]
+    return resolve_writers({node.func_name_token.value: summary(node, global_names) for node in functions},
+                           {node.func_name_token.value for node in functions if node.threaded})
+
+
+def arrange(declarations, writers, readers, align):
+    """Orders (name, line) declarations into cache-line groups; align is the target's alignment line.
+
+    Within a group the declarations keep their order. A closing align
+    keeps whatever is declared next off the last group's line.
+    """
+    private, read_mostly, written = [], [], {}
+    for name, line in declarations:
+        if writers.get(name):
+            written.setdefault(frozenset(writers[name]), []).append(line)
+        elif name in readers:
+            read_mostly.append(line)
+        else:
+            private.append(line)
+    groups = [group for group in [read_mostly, *written.values()] if group]
+    if not groups:
+        return private
+    lines = list(private)
+    for group in groups:
+        lines.append(align)
+        lines.extend(group)
+    lines.append(align)
+    return lines
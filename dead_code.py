@@ -0,0 +1,122 @@
+"""Removal of code that cannot run or whose results are never used.
+
+Functions are live if the top-level statements call them, directly or
+through other live functions; this includes threaded functions, whose
+calls start the threads. Everything else is removed, along with
+statements after a return, the branch an if with a constant condition
+never takes, while loops whose constant condition is 0 and assignments to
+variables that nothing reads (their calls still run). Removing one piece
+can make others dead, so the pass repeats until nothing changes.
+"""
+from inliner import discard
+from nodes import *
+
+
+def called_names(nodes):
+    return {node.func_name_token.value for statement in nodes for node in walk(statement)
+            if isinstance(node, FunctionCallNode)}
+
+
+def live_functions(nodes):
+    """Names of the functions reachable from the top-level statements."""
+    bodies = {}
+    for node in nodes:
+        if isinstance(node, FunctionDefNode):
+            bodies.setdefault(node.func_name_token.value, []).extend(node.body_nodes)
+    live = set()
+    pending = called_names([node for node in nodes if not isinstance(node, FunctionDefNode)])
+    while pending:
+        name = pending.pop()
+        if name not in live:
+            live.add(name)
+            pending |= called_names(bodies.get(name, ()))
+    return live
+
+
+def read_variables(nodes):
+    """Names a program reads; every use of an array counts as a read.
+
+    Reading a variable only to assign it again, as in s = s + k, does not
+    count.
+    """
+    ignored, names = set(), set()
+    for statement in nodes:
+        for node in walk(statement):
+            # walk yields an assignment before its target and value.
+            if isinstance(node, VarAssignNode) and isinstance(node.left_node, VarAccessNode):
+                var_name = node.left_node.var_name_token.value
+                ignored.add(id(node.left_node))
+                ignored.update(id(child) for child in walk(node.value_node)
+                               if isinstance(child, VarAccessNode) and child.var_name_token.value == var_name)
+            elif isinstance(node, VARIABLE_NODES) and id(node) not in ignored:
+                names.add(node.var_name_token.value)
+    return names
+
+
+class DeadCodeEliminator:
+    """Removes dead functions, statements and stores from a whole program, in place."""
+    def __init__(self):
+        self.removed_functions = 0
+        self.removed_statements = 0
+        self.removed_stores = 0
+        self.read = set()
+
+    def eliminate(self, nodes):
+        while True:
+            before = (self.removed_functions, self.removed_statements, self.removed_stores)
+            live = live_functions(nodes)
+            kept = [node for node in nodes
+                    if not isinstance(node, FunctionDefNode) or node.func_name_token.value in live]
+            self.removed_functions += len(nodes) - len(kept)
+            nodes[:] = kept
+            self.read = read_variables(nodes)
+            self.block(nodes)
+            if (self.removed_functions, self.removed_statements, self.removed_stores) == before:
+                return nodes
+
+    def block(self, nodes):
+        """Removes the dead statements of a statement list and of the lists nested in it."""
+        index = 0
+        while index < len(nodes):
+            node = nodes[index]
+            replacement = self.replacement(node)
+            if replacement is not None:
+                nodes[index:index + 1] = replacement
+                continue  # the replacement may be dead too
+            if isinstance(node, ReturnNode):
+                self.removed_statements += len(nodes) - index - 1
+                del nodes[index + 1:]
+            elif isinstance(node, WhileNode):
+                self.block(node.body_node)
+            elif isinstance(node, IfNode):
+                self.block(node.true_statements)
+                if node.false_statements is not None:
+                    self.block(node.false_statements)
+            elif isinstance(node, (FunctionDefNode, LockNode)):
+                self.block(node.body_nodes)
+            index += 1
+
+    def replacement(self, node):
+        """The statements replacing a dead statement or store, or None if node stays."""
+        if (isinstance(node, VarAssignNode) and isinstance(node.left_node, VarAccessNode)
+                and node.left_node.var_name_token.value not in self.read):
+            self.removed_stores += 1
+            return discard(node.value_node)
+        if isinstance(node, IfNode) and isinstance(node.condition_node, NumberNode):
+            taken, untaken = node.true_statements, node.false_statements or []
+            if node.condition_node.token.value == 0:
+                taken, untaken = untaken, taken
+            self.removed_statements += len(untaken)
+            return taken
+        if isinstance(node, IfNode) and not node.true_statements and not node.false_statements:
+            self.removed_statements += 1
+            return discard(node.condition_node)
+        if (isinstance(node, WhileNode) and isinstance(node.condition_node, NumberNode)
+                and node.condition_node.token.value == 0):
+            self.removed_statements += 1
+            return []
+        return None
+
+    def format_stats(self):
+        return (f"{self.removed_functions} functions, {self.removed_statements} unreachable statements "
+                f"and {self.removed_stores} stores removed")
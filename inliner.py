@@ -0,0 +1,174 @@
+"""Inlining of small non-threaded functions at their call sites.
+
+A call f(x, y) behaves like the assignments of x and y to f's parameters
+followed by f's body; the inliner substitutes exactly that, with f's
+parameters and locals renamed to names of their own at each call site
+(f.<site>.<name>, which no HiVe identifier can clash with). A return is
+only supported as the last
+thing on every path through the body (directly, or at the end of both
+branches of a final if/else): there it becomes the statement that used the
+call's value, e.g. x = f(n) with a body ending in return n * 2 becomes
+x = n * 2. Functions returning from anywhere else, recursive functions
+and threaded functions are never inlined.
+"""
+import copy
+
+from nodes import *
+
+# Bodies up to this many AST nodes are inlined; twice as many inside loops,
+# where the saved call, prologue and epilogue count on every iteration.
+INLINE_MAX_NODES = 32
+
+
+def body_size(node):
+    return sum(1 for statement in node.body_nodes for _ in walk(statement))
+
+
+def called_functions(node):
+    return {child.func_name_token.value for child in walk(node) if isinstance(child, FunctionCallNode)}
+
+
+def recursive_functions(definitions):
+    """Names of the functions that can reach themselves through calls."""
+    calls = {name: called_functions(node) for name, node in definitions.items()}
+    recursive = set()
+    for name in definitions:
+        seen, stack = set(), list(calls[name])
+        while stack:
+            callee = stack.pop()
+            if callee == name:
+                recursive.add(name)
+                break
+            if callee not in seen and callee in calls:
+                seen.add(callee)
+                stack.extend(calls[callee])
+    return recursive
+
+
+def contains_return(statements):
+    return any(isinstance(node, ReturnNode) for statement in statements for node in walk(statement))
+
+
+def returns_at_end(statements):
+    """True if every path through statements ends in a return and no return is anywhere else."""
+    if not statements or contains_return(statements[:-1]):
+        return False
+    last = statements[-1]
+    if isinstance(last, ReturnNode):
+        return True
+    if isinstance(last, IfNode) and last.false_statements is not None:
+        return (not contains_return([last.condition_node]) and returns_at_end(last.true_statements)
+                and returns_at_end(last.false_statements))
+    return False
+
+
+def replace_returns(statements, use):
+    """statements with each final return value replaced by the statements use(value) returns."""
+    last = statements[-1]
+    if isinstance(last, ReturnNode):
+        return statements[:-1] + use(last.value_node)
+    last.true_statements = replace_returns(last.true_statements, use)
+    last.false_statements = replace_returns(last.false_statements, use)
+    return statements
+
+
+def discard(value):
+    """Statements evaluating value for its side effects only."""
+    return [value] if any(isinstance(node, FunctionCallNode) for node in walk(value)) else []
+
+
+class Inliner:
+    """Inlines calls to small non-recursive, non-threaded functions of a program, in place.
+
+    Only calls that are a whole statement, the value of an assignment to
+    a variable, of a print or of a return are inlined; other calls (in
+    conditions, inside larger expressions) keep the call.
+    """
+    def __init__(self, max_nodes=INLINE_MAX_NODES):
+        self.max_nodes = max_nodes
+        self.definitions = {}
+        self.global_names = set()
+        self.inlined = 0
+
+    def inline(self, nodes):
+        self.global_names = global_variables(nodes)
+        definitions, seen = {}, set()
+        for node in nodes:
+            if isinstance(node, FunctionDefNode):
+                name = node.func_name_token.value
+                if name in seen:
+                    definitions.pop(name, None)  # redefined: which body a call runs depends on order
+                elif not node.threaded:
+                    definitions[name] = node
+                seen.add(name)
+        recursive = recursive_functions(definitions)
+        self.definitions = {name: node for name, node in definitions.items() if name not in recursive
+                            and (returns_at_end(node.body_nodes) or not contains_return(node.body_nodes))}
+        self.statements(nodes, 0)
+        return nodes
+
+    def statements(self, nodes, loop_depth):
+        index = 0
+        while index < len(nodes):
+            node = nodes[index]
+            replacement = self.expand(node, loop_depth)
+            if replacement is not None:
+                # The inlined statements may hold further calls, so they are looked at again.
+                nodes[index:index + 1] = replacement
+                self.inlined += 1
+                continue
+            if isinstance(node, WhileNode):
+                self.statements(node.body_node, loop_depth + 1)
+            elif isinstance(node, IfNode):
+                self.statements(node.true_statements, loop_depth)
+                if node.false_statements is not None:
+                    self.statements(node.false_statements, loop_depth)
+            elif isinstance(node, FunctionDefNode):
+                self.statements(node.body_nodes, 0)
+            elif isinstance(node, LockNode):
+                self.statements(node.body_nodes, loop_depth)
+            index += 1
+
+    def expand(self, node, loop_depth):
+        """The statements replacing node, or None if node has no call worth inlining."""
+        if isinstance(node, FunctionCallNode):
+            call, use = node, discard
+        elif isinstance(node, VarAssignNode) and isinstance(node.left_node, VarAccessNode):
+            call, use = node.value_node, lambda value: [VarAssignNode(copy.deepcopy(node.left_node), value)]
+        elif isinstance(node, PrintNode):
+            call, use = node.value_node, lambda value: [PrintNode(value)]
+        elif isinstance(node, ReturnNode):
+            call, use = node.value_node, lambda value: [ReturnNode(value)]
+        else:
+            return None
+        if not isinstance(call, FunctionCallNode):
+            return None
+        definition = self.definitions.get(call.func_name_token.value)
+        if definition is None or not self.worth_inlining(definition, call, loop_depth):
+            return None
+        if use is not discard and not returns_at_end(definition.body_nodes):
+            return None  # the value of a function without a return is undefined
+        names = self.site_names(definition)
+        parameters = []
+        for token, arg in zip(definition.param_tokens, call.arg_nodes):
+            token = copy.copy(token)
+            token.value = names[token.value]
+            parameters.append(VarAssignNode(VarAccessNode(token), arg))
+        body = copy.deepcopy(definition.body_nodes)
+        for child in (child for statement in body for child in walk(statement)):
+            if isinstance(child, VARIABLE_NODES) and child.var_name_token.value in names:
+                child.var_name_token.value = names[child.var_name_token.value]
+        if returns_at_end(body):
+            body = replace_returns(body, use)
+        return parameters + body
+
+    def site_names(self, definition):
+        """Names of the parameters and locals of definition at the next inlined call site."""
+        prefix = f'{definition.func_name_token.value}.{self.inlined}.'
+        return {name: prefix + name for name in local_variables(definition, self.global_names)}
+
+    def worth_inlining(self, definition, call, loop_depth):
+        if len(call.arg_nodes) != len(definition.param_tokens):
+            return False
+        limit = self.max_nodes * (2 if loop_depth else 1)
+        return body_size(definition) <= limit
@@ -0,0 +1,624 @@
+"""Instruction selectors from the IR (ir.py) to assembly text.
+
+Each selector is a thin, per-target translation of IR instructions;
+optimization happens on the IR before selection and in the peephole
+stage after it. Temporaries and then locals live in stack slots of the
+function's frame, and globals in .bss, as in the AST code generators.
+"""
+import atomics
+import data_layout
+import locks
+import thread_pool
+from ir import COMPARISONS, Global, Local, Temp
+from nodes import JOIN
+from peephole import PEEPHOLE_RULES, PeepholeOptimizer
+from register_allocator import ARGUMENT_REGISTERS, is_imm32
+
+X86_SETCC = {'eq': 'sete', 'ne': 'setne', 'lt': 'setl', 'gt': 'setg', 'le': 'setle', 'ge': 'setge'}
+X86_JCC_FALSE = {'eq': 'jne', 'ne': 'je', 'lt': 'jge', 'gt': 'jle', 'le': 'jg', 'ge': 'jl'}
+X86_ARITHMETIC = {'add': 'add', 'sub': 'sub', 'mul': 'imul'}
+ARM64_CONDITIONS = {'eq': 'eq', 'ne': 'ne', 'lt': 'lt', 'gt': 'gt', 'le': 'le', 'ge': 'ge'}
+ARM64_CONDITIONS_FALSE = {'eq': 'ne', 'ne': 'eq', 'lt': 'ge', 'gt': 'le', 'le': 'gt', 'ge': 'lt'}
+ARM64_ARITHMETIC = {'add': 'add', 'sub': 'sub', 'mul': 'mul', 'div': 'sdiv'}
+ARM64_ARGUMENT_REGISTERS = [f'x{n}' for n in range(8)]
+
+
+def function_label(name):
+    return 'main' if name == 'main' else f'FUNC_{name}'
+
+
+def frame_slot(function, value):
+    """Index of the frame slot of a temporary or local; locals follow the temporaries."""
+    if isinstance(value, Temp):
+        return value.index
+    return function.temps + list(function.locals).index(value.name)
+
+
+def frame_slots(function):
+    return function.temps + len(function.locals)
+
+
+def use_counts(function):
+    """How many instructions read each temporary, by index."""
+    counts = {}
+    for block in function.blocks:
+        for instruction in block.instructions:
+            for arg in instruction.args:
+                if isinstance(arg, Temp):
+                    counts[arg.index] = counts.get(arg.index, 0) + 1
+    return counts
+
+
+def fused_branch(instructions, i, uses):
+    """True if instructions[i] is a comparison only read by the branch right after it."""
+    compare = instructions[i]
+    if compare.op not in COMPARISONS or i + 1 == len(instructions):
+        return False
+    branch = instructions[i + 1]
+    return (branch.op == 'branch' and isinstance(branch.args[0], Temp)
+            and branch.args[0].index == compare.dest.index and uses.get(compare.dest.index) == 1)
+
+
+class InstructionSelector:
+    """Walks an IRModule and calls select_<op> for every instruction.
+
+    Subclasses provide the target's prologue, epilogue and instructions.
+    """
+    architecture = None
+
+    def __init__(self, peephole=True):
+        self.asm_code = []
+        self.function = None
+        self.peephole = PeepholeOptimizer(PEEPHOLE_RULES[self.architecture]) if peephole else None
+
+    def select(self, module):
+        self.asm_code = []
+        self.header(module)
+        for function in module.functions.values():
+            self.function = function
+            self.asm_code.append(f'{function_label(function.name)}:')
+            self.prologue(function)
+            uses = use_counts(function)
+            for block in function.blocks:
+                self.asm_code.append(f'{self.block_label(block.label)}:')
+                instructions = block.instructions
+                i = 0
+                while i < len(instructions):
+                    instruction = instructions[i]
+                    if fused_branch(instructions, i, uses):
+                        # cmp + conditional jump; the 0/1 value is never needed.
+                        self.select_compare_branch(instruction.op, *instruction.args, *instructions[i + 1].args[1:])
+                        i += 2
+                        continue
+                    getattr(self, f'select_{instruction.op}')(instruction.dest, *instruction.args)
+                    i += 1
+        self.footer(module)
+        if self.peephole is not None:
+            self.asm_code = self.peephole.optimize(self.asm_code)
+        return '\n'.join(self.asm_code)
+
+    def footer(self, module):
+        """Code following the functions; the targets emit their runtime support here."""
+
+    def block_label(self, label):
+        # Block labels are only unique within a function.
+        return f'IR_{self.function.name}_{label}'
+
+    def emit(self, line):
+        self.asm_code.append(f'    {line}')
+
+
+class X86Selector(InstructionSelector):
+    """NASM x86-64 for the 'windows' or 'linux' ABI.
+
+    Operations go through rax and rcx; temporaries and locals are qwords below rbp.
+    """
+    architecture = 'x86_64'
+
+    def __init__(self, abi, peephole=True, thread_pool=True, lock_stats=False):
+        super().__init__(peephole)
+        self.abi = abi
+        self.argument_registers = ARGUMENT_REGISTERS[abi]
+        # Spawns queue work for thread_pool.py's workers instead of creating threads.
+        self.thread_pool = thread_pool
+        self.uses_threads = False
+        # Locks count acquisitions and contention, printed before main exits (locks.py).
+        self.lock_stats = lock_stats
+        self.locks = []
+
+    def header(self, module):
+        if self.abi == 'windows':
+            externs = ('printf', 'ExitProcess', 'GetProcessHeap', 'HeapAlloc', 'HeapFree',
+                       'CreateThread', 'CloseHandle')
+        else:
+            externs = ('printf', 'malloc', 'free', 'pthread_create')
+        self.asm_code.append('global main')
+        self.asm_code.extend(f'extern {name}' for name in externs)
+        self.asm_code.append('section .data')
+        self.asm_code.append('format: db "%lld", 10, 0')
+        if self.abi == 'windows':
+            self.asm_code.append('HEAP_ZERO_MEMORY equ 0x00000008')
+        self.asm_code.append('section .bss')
+        if self.abi == 'windows':
+            self.asm_code.append('heap_handle: resq 1')
+        self.asm_code.extend(data_layout.arrange([(name, f'{name}: resq 1') for name in module.globals],
+                                                 module.thread_writers, module.thread_readers,
+                                                 f'alignb {data_layout.CACHE_LINE}'))
+        self.asm_code.append('section .text')
+        self.uses_threads = any(function.threaded for function in module.functions.values())
+        self.locks = list(module.locks)
+
+    def footer(self, module):
+        if self.uses_threads:
+            self.asm_code.extend(thread_pool.runtime(self.abi, self.thread_pool))
+        if self.locks:
+            self.asm_code.extend(locks.runtime(self.abi, self.locks, self.lock_stats))
+
+    def prologue(self, function):
+        # Windows callees may use 32 bytes of shadow space above the return address.
+        shadow = 32 if self.abi == 'windows' else 0
+        frame = -(-(8 * frame_slots(function) + shadow) // 16) * 16
+        self.emit('push rbp')
+        self.emit('mov rbp, rsp')
+        if frame:
+            self.emit(f'sub rsp, {frame}')
+        if function.name == 'main' and self.abi == 'windows':
+            self.emit('call GetProcessHeap')
+            self.emit('mov [heap_handle], rax')
+        if function.name == 'main' and self.uses_threads and self.thread_pool:
+            self.asm_code.extend(thread_pool.start())
+
+    def operand(self, value):
+        if isinstance(value, (Temp, Local)):
+            return f'qword [rbp - {8 * (frame_slot(self.function, value) + 1)}]'
+        if isinstance(value, Global):
+            return f'qword [{value.name}]'
+        return str(value)
+
+    def load(self, register, value):
+        self.emit(f'mov {register}, {self.operand(value)}')
+
+    def store(self, temp, register='rax'):
+        self.emit(f'mov {self.operand(temp)}, {register}')
+
+    def select_param(self, dest, index):
+        registers = self.argument_registers
+        if index < len(registers):
+            self.store(dest, registers[index])
+        else:
+            self.emit(f'mov rax, qword [rbp + {16 + 8 * (index - len(registers))}]')
+            self.store(dest)
+
+    def select_copy(self, dest, value):
+        self.load('rax', value)
+        self.store(dest)
+
+    def select_binary(self, op, dest, left, right):
+        self.load('rax', left)
+        self.load('rcx', right)
+        if op in X86_ARITHMETIC:
+            self.emit(f'{X86_ARITHMETIC[op]} rax, rcx')
+        elif op == 'div':
+            self.emit('cqo')
+            self.emit('idiv rcx')
+        else:
+            self.emit('cmp rax, rcx')
+            self.emit(f'{X86_SETCC[op]} al')
+            self.emit('movzx rax, al')
+        self.store(dest)
+
+    def select_neg(self, dest, value):
+        self.load('rax', value)
+        self.emit('neg rax')
+        self.store(dest)
+
+    def select_load(self, dest, variable):
+        self.load('rax', variable)
+        self.store(dest)
+
+    def select_store(self, dest, variable, value):
+        if isinstance(value, int) and is_imm32(value):
+            self.emit(f'mov {self.operand(variable)}, {value}')
+            return
+        self.load('rax', value)
+        self.emit(f'mov {self.operand(variable)}, rax')
+
+    def select_aload(self, dest, array, index):
+        self.load('rax', index)
+        self.load('rcx', array)
+        self.emit('mov rax, qword [rcx + rax*8]')
+        self.store(dest)
+
+    def select_astore(self, dest, array, index, value):
+        self.load('rax', index)
+        self.load('rdx', value)
+        self.load('rcx', array)
+        self.emit('mov qword [rcx + rax*8], rdx')
+
+    def select_alloc(self, dest, array, size):
+        self.load('rax', size)
+        if self.abi == 'windows':
+            self.emit('mov rcx, [heap_handle]')
+            self.emit('mov rdx, HEAP_ZERO_MEMORY')
+            self.emit('lea r8, [rax*8]')
+            self.emit('call HeapAlloc')
+        else:
+            self.emit('lea rdi, [rax*8]')
+            self.emit('call malloc')
+        self.emit(f'mov {self.operand(array)}, rax')
+
+    def select_free(self, dest, array):
+        if self.abi == 'windows':
+            self.emit('mov rcx, [heap_handle]')
+            self.load('rdx', array)
+            self.emit('mov r8, 0')
+            self.emit('call HeapFree')
+        else:
+            self.load('rdi', array)
+            self.emit('call free')
+
+    def select_print(self, dest, value):
+        first, second = self.argument_registers[:2]
+        self.load(second, value)
+        self.emit(f'lea {first}, [rel format]')
+        if self.abi == 'linux':
+            self.emit('xor eax, eax')
+        self.emit('call printf')
+
+    def select_call(self, dest, name, *args):
+        self.call(name, args)
+        self.store(dest)
+
+    def call(self, name, args):
+        registers = self.argument_registers
+        if len(args) > len(registers) and self.abi == 'windows':
+            raise Exception("More than 4 arguments not yet supported")
+        stack_args = args[len(registers):]
+        padding = 8 * (len(stack_args) % 2)
+        if padding:
+            self.emit('sub rsp, 8')
+        for arg in reversed(stack_args):
+            self.load('rax', arg)
+            self.emit('push rax')
+        for register, arg in zip(registers, args):
+            self.load(register, arg)
+        self.emit(f'call {function_label(name)}')
+        if stack_args:
+            self.emit(f'add rsp, {8 * len(stack_args) + padding}')
+
+    def select_tailcall(self, dest, name, *args):
+        """Passes the arguments like a call and jumps: back to the entry block for a self call,
+        to the callee after releasing the frame otherwise, so it returns to our caller.
+
+        Stack arguments overwrite the function's own; a callee taking more of
+        them than the function was passed is called as usual.
+        """
+        registers = self.argument_registers
+        params = len(self.function.params)
+        stack_args = args[len(registers):]
+        if len(stack_args) > max(params - len(registers), 0):
+            self.call(name, args)
+            self.release_frame()
+            self.emit('ret')
+            return
+        for index, arg in enumerate(stack_args):
+            self.load('rax', arg)
+            self.emit(f'mov qword [rbp + {16 + 8 * index}], rax')
+        for register, arg in zip(registers, args):
+            self.load(register, arg)
+        if name == self.function.name:
+            self.emit(f'jmp {self.block_label(self.function.blocks[0].label)}')
+        else:
+            self.release_frame()
+            self.emit(f'jmp {function_label(name)}')
+
+    def select_spawn(self, dest, name, detached, *args):
+        """Pushes the arguments for hive_spawn; dest gets the handle unless the call is detached."""
+        if len(args) > len(self.argument_registers):
+            raise Exception(f"More than {len(self.argument_registers)} arguments to a threaded function "
+                            "not yet supported")
+        for arg in args:
+            self.load('rax', arg)
+            self.emit('push rax')
+        self.asm_code.extend(thread_pool.spawn(self.abi, function_label(name), len(args), detached))
+        if args:
+            self.emit(f'add rsp, {8 * len(args)}')
+        if dest is not None:
+            self.store(dest)
+
+    def select_join(self, dest, handle):
+        self.load('rax', handle)
+        self.asm_code.extend(thread_pool.join(self.abi))
+        self.store(dest)
+
+    def select_atomic(self, dest, name, variable, *values):
+        for register, value in zip(('rax', 'rcx'), values):
+            self.load(register, value)
+        self.asm_code.extend(atomics.x86(name, self.operand(variable)))
+        self.store(dest)
+
+    def select_aatomic(self, dest, name, array, index, *values):
+        self.load('rdx', index)
+        self.load('r8', array)
+        for register, value in zip(('rax', 'rcx'), values):
+            self.load(register, value)
+        self.asm_code.extend(atomics.x86(name, 'qword [r8 + rdx*8]'))
+        self.store(dest)
+
+    def select_lock(self, dest, name):
+        self.asm_code.extend(locks.acquire(self.abi, name))
+
+    def select_unlock(self, dest, name):
+        self.asm_code.extend(locks.release(self.abi, name))
+
+    def select_jump(self, dest, label):
+        self.emit(f'jmp {self.block_label(label)}')
+
+    def select_branch(self, dest, condition, if_true, if_false):
+        self.load('rax', condition)
+        self.emit('test rax, rax')
+        self.emit(f'jz {self.block_label(if_false)}')
+        self.emit(f'jmp {self.block_label(if_true)}')
+
+    def select_compare_branch(self, op, left, right, if_true, if_false):
+        self.load('rax', left)
+        if isinstance(right, int) and is_imm32(right):
+            self.emit(f'cmp rax, {right}')
+        else:
+            self.load('rcx', right)
+            self.emit('cmp rax, rcx')
+        self.emit(f'{X86_JCC_FALSE[op]} {self.block_label(if_false)}')
+        self.emit(f'jmp {self.block_label(if_true)}')
+
+    def select_ret(self, dest, value):
+        if self.function.name == 'main':
+            if self.lock_stats:
+                self.asm_code.extend(locks.report(self.abi, self.locks))
+            if self.abi == 'windows':
+                self.emit('xor ecx, ecx')
+                self.emit('call ExitProcess')
+                return
+            value = 0
+        self.load('rax', value)
+        self.release_frame()
+        self.emit('ret')
+
+    def release_frame(self):
+        self.emit('mov rsp, rbp')
+        self.emit('pop rbp')
+
+    def __getattr__(self, name):
+        # add, sub, ..., ge share one selector.
+        op = name[len('select_'):]
+        if name.startswith('select_') and (op in X86_ARITHMETIC or op == 'div' or op in COMPARISONS):
+            return lambda dest, left, right: self.select_binary(op, dest, left, right)
+        raise AttributeError(name)
+
+
+class ARM64Selector(InstructionSelector):
+    """GNU as AArch64 for Linux.
+
+    Operations go through x0 and x1, with x9 for addresses; temporaries
+    and locals are qwords above sp.
+    """
+    architecture = 'arm64'
+
+    def __init__(self, peephole=True):
+        super().__init__(peephole)
+        self.atomics = 0  # numbers the labels of atomic operations' retry loops
+
+    def header(self, module):
+        self.asm_code.append('.data')
+        self.asm_code.append('format_int: .string "%ld\\n"')
+        self.asm_code.append('.bss')
+        self.asm_code.append('.align 3')
+        self.asm_code.extend(data_layout.arrange([(name, f'{name}: .skip 8') for name in module.globals],
+                                                 module.thread_writers, module.thread_readers,
+                                                 f'.balign {data_layout.CACHE_LINE}'))
+        self.asm_code.append('.text')
+        self.asm_code.append('.align 2')
+        self.asm_code.append('.global main')
+        self.asm_code.append('.type main, %function')
+
+    def prologue(self, function):
+        frame = -(-8 * frame_slots(function) // 16) * 16
+        if frame > 32760:
+            raise Exception(f"Function '{function.name}' has too many temporaries for ARM64")
+        self.emit('stp x29, x30, [sp, #-16]!')
+        self.emit('mov x29, sp')
+        if frame >= 4096:
+            self.emit(f'mov x16, #{frame}')
+            self.emit('sub sp, sp, x16')
+        elif frame:
+            self.emit(f'sub sp, sp, #{frame}')
+
+    def address(self, name, register='x9'):
+        self.emit(f'adrp {register}, {name}')
+        self.emit(f'add {register}, {register}, :lo12:{name}')
+
+    def load(self, register, value):
+        if isinstance(value, (Temp, Local)):
+            self.emit(f'ldr {register}, [sp, #{8 * frame_slot(self.function, value)}]')
+        elif isinstance(value, Global):
+            self.address(value.name)
+            self.emit(f'ldr {register}, [x9]')
+        elif -65536 < value < 65536:
+            self.emit(f'mov {register}, #{value}')
+        else:
+            self.emit(f'ldr {register}, ={value}')
+
+    def store(self, temp, register='x0'):
+        self.emit(f'str {register}, [sp, #{8 * frame_slot(self.function, temp)}]')
+
+    def store_variable(self, variable, register='x0'):
+        if isinstance(variable, Local):
+            self.store(variable, register)
+            return
+        self.address(variable.name)
+        self.emit(f'str {register}, [x9]')
+
+    def select_param(self, dest, index):
+        if index >= len(ARM64_ARGUMENT_REGISTERS):
+            raise Exception("More than 8 arguments not yet supported on ARM64")
+        self.store(dest, ARM64_ARGUMENT_REGISTERS[index])
+
+    def select_copy(self, dest, value):
+        self.load('x0', value)
+        self.store(dest)
+
+    def select_binary(self, op, dest, left, right):
+        self.load('x0', left)
+        self.load('x1', right)
+        if op in ARM64_ARITHMETIC:
+            self.emit(f'{ARM64_ARITHMETIC[op]} x0, x0, x1')
+        else:
+            self.emit('cmp x0, x1')
+            self.emit(f'cset x0, {ARM64_CONDITIONS[op]}')
+        self.store(dest)
+
+    def select_neg(self, dest, value):
+        self.load('x0', value)
+        self.emit('neg x0, x0')
+        self.store(dest)
+
+    def select_load(self, dest, variable):
+        self.load('x0', variable)
+        self.store(dest)
+
+    def select_store(self, dest, variable, value):
+        self.load('x0', value)
+        self.store_variable(variable)
+
+    def select_aload(self, dest, array, index):
+        self.load('x0', index)
+        self.load('x9', array)
+        self.emit('ldr x0, [x9, x0, lsl #3]')
+        self.store(dest)
+
+    def select_astore(self, dest, array, index, value):
+        self.load('x0', index)
+        self.load('x1', value)
+        self.load('x9', array)
+        self.emit('str x1, [x9, x0, lsl #3]')
+
+    def select_alloc(self, dest, array, size):
+        self.load('x0', size)
+        self.emit('lsl x0, x0, #3')
+        self.emit('bl malloc')
+        self.store_variable(array)
+
+    def select_free(self, dest, array):
+        self.load('x0', array)
+        self.emit('bl free')
+
+    def select_print(self, dest, value):
+        self.load('x1', value)
+        self.address('format_int', 'x0')
+        self.emit('bl printf')
+
+    def select_call(self, dest, name, *args):
+        if len(args) > len(ARM64_ARGUMENT_REGISTERS):
+            raise Exception("More than 8 arguments not yet supported on ARM64")
+        for register, arg in zip(ARM64_ARGUMENT_REGISTERS, args):
+            self.load(register, arg)
+        self.emit(f'bl {function_label(name)}')
+        self.store(dest)
+
+    def select_tailcall(self, dest, name, *args):
+        """Like the x86 selector's: the arguments go in x0-x7, then b instead of bl."""
+        if len(args) > len(ARM64_ARGUMENT_REGISTERS):
+            raise Exception("More than 8 arguments not yet supported on ARM64")
+        for register, arg in zip(ARM64_ARGUMENT_REGISTERS, args):
+            self.load(register, arg)
+        if name == self.function.name:
+            self.emit(f'b {self.block_label(self.function.blocks[0].label)}')
+        else:
+            self.release_frame()
+            self.emit(f'b {function_label(name)}')
+
+    def select_spawn(self, dest, name, detached, *args):
+        if args or not detached:
+            raise Exception("Threaded calls with arguments or handles not yet supported on ARM64")
+        self.emit('sub sp, sp, #16')               # pthread_t
+        self.emit('mov x0, sp')
+        self.emit('mov x1, #0')
+        self.address(function_label(name), 'x2')
+        self.emit('mov x3, #0')
+        self.emit('bl pthread_create')
+        self.emit('add sp, sp, #16')
+
+    def select_join(self, dest, handle):
+        raise Exception(f"{JOIN} not yet supported on ARM64")
+
+    def select_atomic(self, dest, name, variable, *values):
+        if isinstance(variable, Local):
+            offset = 8 * frame_slot(self.function, variable)
+            if offset < 4096:
+                self.emit(f'add x1, sp, #{offset}')
+            else:
+                self.emit(f'mov x16, #{offset}')
+                self.emit('add x1, sp, x16')
+        else:
+            self.address(variable.name, 'x1')
+        self.atomic(dest, name, values)
+
+    def select_aatomic(self, dest, name, array, index, *values):
+        self.load('x0', index)
+        self.load('x9', array)
+        self.emit('add x1, x9, x0, lsl #3')
+        self.atomic(dest, name, values)
+
+    def atomic(self, dest, name, values):
+        for register, value in zip(('x2', 'x3'), values):
+            self.load(register, value)
+        self.atomics += 1
+        self.asm_code.extend(atomics.arm64(name, self.block_label(f'atomic{self.atomics}')))
+        self.store(dest)
+
+    def select_lock(self, dest, name):
+        raise Exception("Lock blocks not yet supported on ARM64")
+
+    select_unlock = select_lock
+
+    def select_jump(self, dest, label):
+        self.emit(f'b {self.block_label(label)}')
+
+    def select_branch(self, dest, condition, if_true, if_false):
+        self.load('x0', condition)
+        self.emit(f'cbz x0, {self.block_label(if_false)}')
+        self.emit(f'b {self.block_label(if_true)}')
+
+    def select_compare_branch(self, op, left, right, if_true, if_false):
+        self.load('x0', left)
+        if isinstance(right, int) and 0 <= right < 4096:
+            self.emit(f'cmp x0, #{right}')
+        else:
+            self.load('x1', right)
+            self.emit('cmp x0, x1')
+        self.emit(f'b.{ARM64_CONDITIONS_FALSE[op]} {self.block_label(if_false)}')
+        self.emit(f'b {self.block_label(if_true)}')
+
+    def select_ret(self, dest, value):
+        self.load('x0', 0 if self.function.name == 'main' else value)
+        self.release_frame()
+        self.emit('ret')
+
+    def release_frame(self):
+        # Restores the caller's frame pointer and link register.
+        self.emit('mov sp, x29')
+        self.emit('ldp x29, x30, [sp], #16')
+
+    def __getattr__(self, name):
+        op = name[len('select_'):]
+        if name.startswith('select_') and (op in ARM64_ARITHMETIC or op in COMPARISONS):
+            return lambda dest, left, right: self.select_binary(op, dest, left, right)
+        raise AttributeError(name)
+
+
+def get_selector(target, peephole=True, lock_stats=False):
+    """Selector for a resolved target name (see compiler.resolve_target)."""
+    if target == 'windows-x86_64':
+        return X86Selector('windows', peephole, lock_stats=lock_stats)
+    if target == 'linux-x86_64':
+        return X86Selector('linux', peephole, lock_stats=lock_stats)
+    return ARM64Selector(peephole)
@@ -0,0 +1,561 @@
+"""Target-independent three-address IR.
+
+The AST is lowered into one IRFunction per HiVe function plus 'main' for
+the top-level statements. A function is a list of basic blocks; every
+block ends in exactly one terminator (jump, branch, ret or tailcall, a
+call whose value is returned), so block successors form the control-flow
+graph.
+
+An instruction produces at most one temporary (%n) and reads temporaries
+or integer constants. Variables are only touched by load/store and the
+array instructions, so passes can see every memory access. As in the AST
+code generators, the names the top-level statements use are globals
+(@name); the parameters and other variables of a function are locals
+(%name) in its stack frame.
+"""
+import data_layout
+from nodes import *
+from token_types import (
+    TT_PLUS, TT_MINUS, TT_MUL, TT_DIV,
+    TT_EE, TT_NE, TT_LT, TT_GT, TT_LTE, TT_GTE
+)
+
+BINARY_OPS = {
+    TT_PLUS: 'add', TT_MINUS: 'sub', TT_MUL: 'mul', TT_DIV: 'div',
+    TT_EE: 'eq', TT_NE: 'ne', TT_LT: 'lt', TT_GT: 'gt', TT_LTE: 'le', TT_GTE: 'ge',
+}
+COMPARISONS = ('eq', 'ne', 'lt', 'gt', 'le', 'ge')
+TERMINATORS = ('jump', 'branch', 'ret', 'tailcall')
+
+
+class Temp:
+    __slots__ = ('index',)
+    def __init__(self, index):
+        self.index = index
+    def __repr__(self):
+        return f'%{self.index}'
+
+
+class Global:
+    __slots__ = ('name',)
+    def __init__(self, name):
+        self.name = name
+    def __eq__(self, other):
+        return isinstance(other, Global) and other.name == self.name
+    def __hash__(self):
+        return hash(self.name)
+    def __repr__(self):
+        return f'@{self.name}'
+
+
+class Local:
+    __slots__ = ('name',)
+    def __init__(self, name):
+        self.name = name
+    def __eq__(self, other):
+        return isinstance(other, Local) and other.name == self.name
+    def __hash__(self):
+        return hash(('local', self.name))
+    def __repr__(self):
+        return f'%{self.name}'
+
+
+class Instruction:
+    """op with an optional result temporary and operands.
+
+    Operands are Temps, ints, Globals, Locals, function names (call/spawn),
+    atomic operation names (atomic/aatomic), lock names (lock/unlock) and
+    block labels (jump/branch).
+    """
+    __slots__ = ('op', 'dest', 'args')
+    def __init__(self, op, dest=None, args=()):
+        self.op = op
+        self.dest = dest
+        self.args = tuple(args)
+    def __repr__(self):
+        text = f"{self.op} {', '.join(map(str, self.args))}".rstrip()
+        return f'{self.dest} = {text}' if self.dest is not None else text
+
+
+class BasicBlock:
+    __slots__ = ('label', 'instructions')
+    def __init__(self, label):
+        self.label = label
+        self.instructions = []
+
+    @property
+    def terminator(self):
+        if self.instructions and self.instructions[-1].op in TERMINATORS:
+            return self.instructions[-1]
+        return None
+
+    def successors(self):
+        terminator = self.terminator
+        if terminator is None or terminator.op in ('ret', 'tailcall'):
+            return []
+        if terminator.op == 'jump':
+            return [terminator.args[0]]
+        return [terminator.args[1], terminator.args[2]]
+
+
+class IRFunction:
+    __slots__ = ('name', 'params', 'threaded', 'locals', 'blocks', 'temps', 'labels')
+    def __init__(self, name, params=(), threaded=False):
+        self.name = name
+        self.params = list(params)
+        self.threaded = threaded
+        self.locals = {}  # name -> 'scalar' or 'dynamic_array', parameters first
+        self.blocks = []  # in layout order; the first is the entry
+        self.temps = 0
+        self.labels = 0
+
+    def new_temp(self):
+        self.temps += 1
+        return Temp(self.temps - 1)
+
+    def new_block(self, hint='B'):
+        """A block with a fresh label; it joins the layout when the builder moves to it."""
+        self.labels += 1
+        return BasicBlock(f'{hint}{self.labels - 1}')
+
+    def block_map(self):
+        return {block.label: block for block in self.blocks}
+
+    def predecessors(self):
+        """Label -> labels of the blocks that can jump to it."""
+        preds = {block.label: [] for block in self.blocks}
+        for block in self.blocks:
+            for label in block.successors():
+                preds[label].append(block.label)
+        return preds
+
+    def instruction_count(self):
+        return sum(len(block.instructions) for block in self.blocks)
+
+
+class IRModule:
+    """Functions in definition order, with 'main' last, and the globals and locks they use."""
+    def __init__(self):
+        self.functions = {}
+        self.globals = {}  # name -> 'scalar' or 'dynamic_array'
+        self.locks = {}  # names of the locks of lock blocks, in order of first use
+        # For the cache-line layout (data_layout.py): global -> threaded functions
+        # writing it, and the globals threads use at all.
+        self.thread_writers = {}
+        self.thread_readers = set()
+
+    def dump(self):
+        lines = []
+        for name, kind in self.globals.items():
+            lines.append(f'global @{name} : {kind}')
+        lines.extend(f'lock {name}' for name in self.locks)
+        for function in self.functions.values():
+            header = 'threaded function' if function.threaded else 'function'
+            lines.append(f"\n{header} {function.name}({', '.join(function.params)}):")
+            lines.extend(f'  local %{name} : {kind}' for name, kind in function.locals.items())
+            for block in function.blocks:
+                lines.append(f'  {block.label}:')
+                lines.extend(f'    {instruction}' for instruction in block.instructions)
+        return '\n'.join(lines).lstrip('\n') + '\n'
+
+
+class IRBuilder:
+    """Lowers a parsed program into an IRModule."""
+    def __init__(self):
+        self.module = IRModule()
+        self.function = None
+        self.block = None
+        self.threaded = set()
+        self.global_names = set()
+        self.held_locks = []  # locks of the function's lock blocks being lowered, outermost first
+
+    def lower(self, nodes):
+        self.threaded = {node.func_name_token.value for node in nodes
+                         if isinstance(node, FunctionDefNode) and node.threaded}
+        self.global_names = global_variables(nodes)
+        self.module.thread_writers = data_layout.thread_writers(nodes)
+        self.module.thread_readers = threaded_function_variables(nodes)
+        main = IRFunction('main')
+        self.enter(main)
+        self.statements(nodes)
+        self.finish(0)
+        self.module.functions['main'] = main
+        return self.module
+
+    def enter(self, function):
+        self.function = function
+        self.move_to(function.new_block())
+
+    def move_to(self, block):
+        self.function.blocks.append(block)
+        self.block = block
+
+    def finish(self, value):
+        if self.block.terminator is None:
+            self.emit('ret', None, value)
+
+    def emit(self, op, dest=None, *args):
+        if self.block.terminator is not None:
+            # Code after a return or jump is unreachable; keep it in its own block for passes to drop.
+            self.move_to(self.function.new_block())
+        self.block.instructions.append(Instruction(op, dest, args))
+        return dest
+
+    def value(self, op, *args):
+        return self.emit(op, self.function.new_temp(), *args)
+
+    def jump(self, block):
+        if self.block.terminator is None:
+            self.emit('jump', None, block.label)
+
+    def declare(self, name, kind='scalar'):
+        variables = self.function.locals if name in self.function.locals else self.module.globals
+        if kind == 'dynamic_array' or name not in variables:
+            variables[name] = kind
+        return Local(name) if variables is self.function.locals else Global(name)
+
+    # Statements
+
+    def statements(self, nodes):
+        for node in nodes:
+            self.statement(node)
+
+    def statement(self, node):
+        method = getattr(self, f'statement_{type(node).__name__}', None)
+        if method is None:
+            self.expression(node)
+        else:
+            method(node)
+
+    def statement_VarAssignNode(self, node):
+        if isinstance(node.left_node, ArrayAccessNode):
+            target = node.left_node
+            if len(target.indexes) != 1:
+                raise Exception("Dynamic arrays are one-dimensional")
+            index = self.expression(target.indexes[0])
+            value = self.expression(node.value_node)
+            self.emit('astore', None, self.declare(target.var_name_token.value, 'dynamic_array'), index, value)
+            return
+        value = self.expression(node.value_node)
+        self.emit('store', None, self.declare(node.left_node.var_name_token.value), value)
+
+    def statement_PrintNode(self, node):
+        self.emit('print', None, self.expression(node.value_node))
+
+    def statement_IfNode(self, node):
+        condition = self.expression(node.condition_node)
+        function = self.function
+        then_block = function.new_block('THEN')
+        else_block = function.new_block('ELSE') if node.false_statements is not None else None
+        end_block = function.new_block('ENDIF')
+        self.emit('branch', None, condition, then_block.label, (else_block or end_block).label)
+        self.move_to(then_block)
+        self.statements(node.true_statements)
+        if else_block is not None:
+            self.jump(end_block)
+            self.move_to(else_block)
+            self.statements(node.false_statements)
+        self.jump(end_block)
+        self.move_to(end_block)
+
+    def statement_WhileNode(self, node):
+        function = self.function
+        condition_block = function.new_block('WHILE')
+        body_block = function.new_block('BODY')
+        end_block = function.new_block('ENDWHILE')
+        self.jump(condition_block)
+        self.move_to(condition_block)
+        condition = self.expression(node.condition_node)
+        self.emit('branch', None, condition, body_block.label, end_block.label)
+        self.move_to(body_block)
+        self.statements(node.body_node)
+        self.jump(condition_block)
+        self.move_to(end_block)
+
+    def statement_ReturnNode(self, node):
+        value = self.expression(node.value_node)
+        for name in reversed(self.held_locks):
+            self.emit('unlock', None, name)
+        self.emit('ret', None, value)
+
+    def statement_LockNode(self, node):
+        name = node.lock_name_token.value
+        self.module.locks.setdefault(name, None)
+        self.emit('lock', None, name)
+        self.held_locks.append(name)
+        self.statements(node.body_nodes)
+        self.held_locks.pop()
+        self.emit('unlock', None, name)
+
+    def statement_DynamicArrayAllocNode(self, node):
+        size = self.expression(node.size_expr)
+        self.emit('alloc', None, self.declare(node.var_name_token.value, 'dynamic_array'), size)
+
+    def statement_DeleteNode(self, node):
+        name = node.var_name_token.value
+        variables = self.function.locals if name in self.function.locals else self.module.globals
+        if variables.get(name) != 'dynamic_array':
+            raise Exception(f"Variable '{name}' is not a dynamic array")
+        self.emit('free', None, self.declare(name, 'dynamic_array'))
+
+    def statement_FunctionCallNode(self, node):
+        name = node.func_name_token.value
+        if name in self.threaded:
+            # Nothing can join a call whose handle is dropped: detach it.
+            self.emit('spawn', None, name, 1, *(self.expression(arg) for arg in node.arg_nodes))
+        else:
+            self.expression(node)
+
+    def statement_FunctionDefNode(self, node):
+        outer_function, outer_block, outer_locks = self.function, self.block, self.held_locks
+        self.held_locks = []
+        name = node.func_name_token.value
+        params = [token.value for token in node.param_tokens]
+        function = IRFunction(name, params, node.threaded)
+        function.locals = dict.fromkeys(local_variables(node, self.global_names), 'scalar')
+        self.enter(function)
+        for index, param in enumerate(params):
+            self.emit('store', None, self.declare(param), self.value('param', index))
+        self.statements(node.body_nodes)
+        self.finish(0)
+        self.module.functions[name] = function
+        self.function, self.block, self.held_locks = outer_function, outer_block, outer_locks
+
+    # Expressions
+
+    def expression(self, node):
+        method = getattr(self, f'expression_{type(node).__name__}', None)
+        if method is None:
+            raise Exception(f"Cannot evaluate {type(node).__name__} as an expression")
+        return method(node)
+
+    def expression_NumberNode(self, node):
+        return node.token.value
+
+    def expression_VarAccessNode(self, node):
+        return self.value('load', self.declare(node.var_name_token.value))
+
+    def expression_UnaryOpNode(self, node):
+        operand = self.expression(node.node)
+        if node.op_token.type == TT_PLUS:
+            return operand
+        if node.op_token.type != TT_MINUS:
+            raise Exception(f"Unknown unary operator {node.op_token.type}")
+        return self.value('neg', operand)
+
+    def expression_BinOpNode(self, node):
+        op = BINARY_OPS.get(node.op_token.type)
+        if op is None:
+            raise Exception(f"Unknown binary operator {node.op_token.type}")
+        left = self.expression(node.left_node)
+        right = self.expression(node.right_node)
+        return self.value(op, left, right)
+
+    def expression_ArrayAccessNode(self, node):
+        index = self.expression(node.indexes[0])
+        return self.value('aload', self.declare(node.var_name_token.value, 'dynamic_array'), index)
+
+    def expression_FunctionCallNode(self, node):
+        name = node.func_name_token.value
+        target = atomic_target(node)
+        if target is not None:
+            return self.expression_atomic(node, target)
+        args = [self.expression(arg) for arg in node.arg_nodes]
+        if name in self.threaded:
+            return self.value('spawn', name, 0, *args)
+        if name == JOIN:
+            if len(args) != 1:
+                raise Exception(f"{JOIN} takes one handle")
+            return self.value('join', *args)
+        return self.value('call', name, *args)
+
+    def expression_atomic(self, node, target):
+        name = node.func_name_token.value
+        var_name = target.var_name_token.value
+        if isinstance(target, ArrayAccessNode):
+            array = self.declare(var_name, 'dynamic_array')
+            index = self.expression(target.indexes[0])
+            values = [self.expression(arg) for arg in node.arg_nodes[1:]]
+            return self.value('aatomic', name, array, index, *values)
+        values = [self.expression(arg) for arg in node.arg_nodes[1:]]
+        return self.value('atomic', name, self.declare(var_name), *values)
+
+
+def lower(nodes):
+    """Lowers a parsed program to an IRModule."""
+    return IRBuilder().lower(nodes)
+
+
+# Passes. Each takes an IRFunction, changes it in place and returns True if it changed anything.
+
+def fold_constant_branches(function):
+    """branch 1, A, B  ->  jump A"""
+    changed = False
+    for block in function.blocks:
+        terminator = block.terminator
+        if terminator is not None and terminator.op == 'branch' and isinstance(terminator.args[0], int):
+            target = terminator.args[1] if terminator.args[0] != 0 else terminator.args[2]
+            block.instructions[-1] = Instruction('jump', None, (target,))
+            changed = True
+    return changed
+
+
+def remove_unreachable_blocks(function):
+    blocks = function.block_map()
+    reachable, stack = set(), [function.blocks[0].label]
+    while stack:
+        label = stack.pop()
+        if label not in reachable:
+            reachable.add(label)
+            stack.extend(blocks[label].successors())
+    before = len(function.blocks)
+    function.blocks = [block for block in function.blocks if block.label in reachable]
+    return len(function.blocks) != before
+
+
+def merge_blocks(function):
+    """Appends a block to its only predecessor when that predecessor only jumps to it."""
+    changed = False
+    preds = function.predecessors()
+    blocks = function.block_map()
+    for block in list(function.blocks):
+        if block.label not in blocks:
+            continue
+        while True:
+            terminator = block.terminator
+            if terminator is None or terminator.op != 'jump':
+                break
+            successor = blocks[terminator.args[0]]
+            if successor is block or preds[successor.label] != [block.label] or successor is function.blocks[0]:
+                break
+            block.instructions[-1:] = successor.instructions
+            for label in successor.successors():
+                preds[label] = [block.label if p == successor.label else p for p in preds[label]]
+            del blocks[successor.label]
+            changed = True
+    function.blocks = [block for block in function.blocks if block.label in blocks]
+    return changed
+
+
+IR_PASSES = (fold_constant_branches, remove_unreachable_blocks, merge_blocks)
+
+PURE_OPS = ('add', 'sub', 'mul', 'div', 'neg') + COMPARISONS
+COMMUTATIVE_OPS = ('add', 'mul', 'eq', 'ne')
+# Instructions after which no global or array element is known any more.
+CLOBBERING_OPS = ('call', 'tailcall', 'spawn', 'join', 'atomic', 'aatomic', 'lock', 'unlock', 'alloc', 'free')
+
+
+def operand_key(value):
+    return ('temp', value.index) if isinstance(value, Temp) else value
+
+
+def is_shared(variable, shared):
+    return isinstance(variable, Global) and variable.name in shared
+
+
+def shared_globals(module):
+    """Globals a threaded function touches; another thread may change them at any time."""
+    names = set()
+    for function in module.functions.values():
+        if function.threaded:
+            names.update(arg.name for block in function.blocks for instruction in block.instructions
+                          for arg in instruction.args if isinstance(arg, Global))
+    if any(instruction.op in ('call', 'tailcall') for function in module.functions.values() if function.threaded
+           for block in function.blocks for instruction in block.instructions):
+        # Functions called from a thread run on that thread too.
+        names.update(module.globals)
+    return names
+
+
+def number_values(function, shared=()):
+    """Local value numbering: an instruction recomputing a value already in a temporary of its block is dropped.
+
+    Loads are numbered like arithmetic until a store to the same variable
+    (or to any array element, for aload) invalidates them, or a call that
+    may change them: any global or array element, but not the function's
+    locals. A store makes the stored value the variable's known value.
+    Globals in shared are always loaded again.
+    """
+    replacements = {}
+    changed = False
+    for block in function.blocks:
+        known = {}
+        kept = []
+        for instruction in block.instructions:
+            instruction.args = tuple(replacements.get(arg.index, arg) if isinstance(arg, Temp) else arg
+                                     for arg in instruction.args)
+            op, args = instruction.op, instruction.args
+            key = None
+            if op in PURE_OPS:
+                operands = [operand_key(arg) for arg in args]
+                if op in COMMUTATIVE_OPS:
+                    operands.sort(key=repr)
+                key = (op, *operands)
+            elif op in ('load', 'aload') and not is_shared(args[0], shared):
+                key = (op, args[0], *(operand_key(arg) for arg in args[1:]))
+            if key is not None:
+                if key in known:
+                    replacements[instruction.dest.index] = known[key]
+                    changed = True
+                    continue
+                known[key] = instruction.dest
+            elif op == 'store':
+                variable = args[0]
+                for stale in [k for k in known if k[0] in ('load', 'aload') and k[1] == variable]:
+                    del known[stale]
+                if not is_shared(variable, shared):
+                    known[('load', variable)] = args[1]
+            elif op == 'astore':
+                for stale in [k for k in known if k[0] == 'aload']:
+                    del known[stale]
+                if not is_shared(args[0], shared):
+                    known[('aload', args[0], operand_key(args[1]))] = args[2]
+            elif op in CLOBBERING_OPS:
+                for stale in [k for k in known if k[0] == 'aload' or (k[0] == 'load' and (
+                        op in ('alloc', 'free', 'atomic') or isinstance(k[1], Global)))]:
+                    del known[stale]
+            kept.append(instruction)
+        block.instructions = kept
+    return changed
+
+
+def mark_tail_calls(function):
+    """%t = call f, args; ret %t  ->  tailcall f, args
+
+    Nothing is left to do after such a call, so selectors may jump to f
+    instead of calling it. main's ret ends the program and is left alone.
+    """
+    if function.name == 'main':
+        return False
+    changed = False
+    for block in function.blocks:
+        instructions = block.instructions
+        if len(instructions) < 2:
+            continue
+        call, ret = instructions[-2:]
+        if (call.op == 'call' and ret.op == 'ret' and isinstance(ret.args[0], Temp)
+                and ret.args[0].index == call.dest.index):
+            instructions[-2:] = [Instruction('tailcall', None, call.args)]
+            changed = True
+    return changed
+
+
+def tail_calls(module):
+    for function in module.functions.values():
+        mark_tail_calls(function)
+    return module
+
+
+def value_numbering(module):
+    shared = shared_globals(module)
+    for function in module.functions.values():
+        number_values(function, shared)
+    return module
+
+
+def simplify(module, passes=IR_PASSES):
+    """Runs passes over every function of module until none changes anything."""
+    for function in module.functions.values():
+        while any([run(function) for run in passes]):
+            pass
+    return module
@@ -1,6 +1,12 @@
 import re
 from token import Token
 from token_types import *
+import tracing
+
+KEYWORDS = frozenset({
+    'print', 'if', 'else', 'end', 'while', 'new', 'delete', 'function', 'threaded', 'return',
+    'lock'
+})
 
 class Lexer:
     def __init__(self, text):
@@ -22,8 +28,10 @@ class Lexer:
         """Tokenizes the entire text."""
         
         tokens = []
+        trace = tracing.enabled('lexer', tracing.TRACE)
         while self.current_char is not None:
-            print("tokening...")
+            if trace:
+                tracing.emit('lexer', f"tokening at {self.pos}: {self.current_char!r}")
             if self.current_char in ' \t':
                 self.advance()
             if self.current_char in ' \t\n':
@@ -108,13 +116,13 @@ class Lexer:
             id_str += self.current_char
             self.advance()
 
-        if id_str in {
-            'print', 'if', 'else', 'end', 'while', 'new', 'delete', 'function', 'threaded', 'return'
-        }:
-            print(f"Tokenizing keyword: {id_str}")
+        if id_str in KEYWORDS:
+            if tracing.enabled('lexer', tracing.DEBUG):
+                tracing.emit('lexer', f"Tokenizing keyword: {id_str}")
             return Token(TT_KEYWORD, id_str)
         else:
-            print(f"Tokenizing identifier: {id_str}")
+            if tracing.enabled('lexer', tracing.DEBUG):
+                tracing.emit('lexer', f"Tokenizing identifier: {id_str}")
             return Token(TT_IDENTIFIER, id_str)
 
     def make_equals(self):
@@ -145,4 +153,70 @@ class Lexer:
             elif char == '>':
                 return Token(TT_GT, '>')
             else:
-                raise Exception(f"Invalid character '{char}'")
\ No newline at end of file
+                raise Exception(f"Invalid character '{char}'")
+
+
+# Single- and double-character operators, keyed by their exact text.
+OPERATOR_TYPES = {
+    '+': TT_PLUS, '-': TT_MINUS, '*': TT_MUL, '/': TT_DIV,
+    '(': TT_LPAREN, ')': TT_RPAREN, '{': TT_LBRACE, '}': TT_RBRACE,
+    '[': TT_LBRACKET, ']': TT_RBRACKET, ',': TT_COMMA, '=': TT_EQ,
+    '==': TT_EE, '!=': TT_NE, '<': TT_LT, '>': TT_GT, '<=': TT_LTE, '>=': TT_GTE,
+}
+
+# One master pattern; the name of the group that matched selects the token kind.
+TOKEN_REGEX = re.compile(r"""
+    (?P<SKIP>(?:[ \t\r\n]+|\#[^\n]*\n?)+)
+  | (?P<INT>\d+)
+  | (?P<NAME>[^\W\d]\w*)
+  | (?P<OP>[=!<>]=|[-+*/(){}\[\],=<>!])
+  | (?P<ILLEGAL>.)
+""", re.VERBOSE | re.DOTALL)
+
+
+class RegexLexer:
+    """Table-driven lexer producing the same token stream as Lexer.
+
+    The source is scanned with a single compiled pattern instead of one
+    advance() per character; keywords and operators are resolved with
+    dictionary lookups.
+    """
+    def __init__(self, text):
+        self.text = text
+
+    def tokenize(self):
+        """Tokenizes the entire text."""
+        return list(self.iter_tokens())
+
+    def iter_tokens(self):
+        """Yields tokens one at a time, ending with an EOF token."""
+        operator_types = OPERATOR_TYPES
+        keywords = KEYWORDS
+        trace = tracing.enabled('lexer', tracing.TRACE)
+        line = 1
+        line_start = 0
+        for m in TOKEN_REGEX.finditer(self.text):
+            kind = m.lastgroup
+            if kind == 'SKIP':
+                newlines = m.group().count('\n')
+                if newlines:
+                    line += newlines
+                    line_start = self.text.rindex('\n', 0, m.end()) + 1
+                continue
+            value = m.group()
+            col = m.start() - line_start + 1
+            if kind == 'NAME':
+                token = Token(TT_KEYWORD if value in keywords else TT_IDENTIFIER, value, line, col)
+            elif kind == 'INT':
+                token = Token(TT_INT, int(value), line, col)
+            elif kind == 'OP':
+                if value == '!':
+                    raise Exception(f"Invalid character '{value}' at line {line}, column {col}")
+                token = Token(operator_types[value], value, line, col)
+            else:
+                # Same as Lexer: stop at the first illegal character.
+                break
+            if trace:
+                tracing.emit('lexer', f"{line}:{col} {token}")
+            yield token
+        yield Token(TT_EOF, None, line, len(self.text) - line_start + 1)
@@ -0,0 +1,220 @@
+"""Mutex runtime for lock blocks.
+
+lock name ... end runs its body while holding the mutex called name. A
+program has one mutex per name, shared by every function and thread;
+hive_lock and hive_unlock take its record, a .bss block holding the
+lock word and two counters.
+
+On Linux the word is a futex: 0 when free, 1 when held and 2 when held
+with threads possibly asleep on it (Drepper's "Futexes Are Tricky",
+mutex 3). hive_lock takes a free lock with one lock cmpxchg. When the
+lock is held it spins for SPINS rounds first, reading the word and
+retrying only once it looks free, since critical sections are usually
+short; then it marks the lock 2 and sleeps in futex(2) until woken.
+hive_unlock stores 0 and only makes the wake-up call if it was 2.
+
+On Windows the word is an SRWLOCK, which spins briefly before blocking
+by itself; SRWLOCK_INIT is zero, so the zeroed .bss needs no setup.
+
+With lock_stats the runtime also counts, per lock, the acquisitions and
+how many of them found the lock held, and main prints both before the
+program exits:
+
+    lock name: <acquisitions> acquisitions, <contended> contended
+
+The acquisition count is updated while the lock is held, so it needs no
+locked instruction; the contention count is bumped with lock add.
+"""
+from data_layout import CACHE_LINE
+from register_allocator import ARGUMENT_REGISTERS
+from thread_pool import wait, wake
+
+# The futex(2) system call on Linux; the SRWLOCK calls on Windows.
+EXTERNS = {
+    'linux': ('syscall',),
+    'windows': ('AcquireSRWLockExclusive', 'TryAcquireSRWLockExclusive', 'ReleaseSRWLockExclusive'),
+}
+SPINS = 100  # rounds hive_lock spins on a held lock before sleeping
+
+# A lock record: the futex word or SRWLOCK, then the counters lock_stats
+# adds, padded to a cache line.
+LOCK_WORD = 0
+LOCK_ACQUISITIONS = 8
+LOCK_CONTENDED = 16
+FREE, HELD, SLEEPERS = 0, 1, 2
+
+
+def symbol(name):
+    """The .bss symbol of lock name's record."""
+    return f'hive_lock_{name}'
+
+
+def acquire(abi, name):
+    """Lines that wait for lock name and take it."""
+    return [f'    lea {ARGUMENT_REGISTERS[abi][0]}, [rel {symbol(name)}]',
+            '    call hive_lock']
+
+
+def release(abi, name):
+    """Lines that release lock name."""
+    return [f'    lea {ARGUMENT_REGISTERS[abi][0]}, [rel {symbol(name)}]',
+            '    call hive_unlock']
+
+
+def report(abi, names):
+    """Lines that print the counters of each lock; they go before the program exits."""
+    registers = ARGUMENT_REGISTERS[abi]
+    lines = []
+    for name in names:
+        lines += [f'    lea {registers[0]}, [rel {symbol(name)}_report]',
+                  f'    mov {registers[1]}, qword [rel {symbol(name)} + {LOCK_ACQUISITIONS}]',
+                  f'    mov {registers[2]}, qword [rel {symbol(name)} + {LOCK_CONTENDED}]']
+        if abi == 'linux':
+            lines.append('    xor eax, eax')
+        lines.append('    call printf')
+    return lines
+
+
+def runtime(abi, names, stats=False):
+    """The records of the locks in names, hive_lock and hive_unlock."""
+    lines = [f'extern {name}' for name in EXTERNS[abi]]
+    if stats:
+        lines.append('section .data')
+        lines += [f'{symbol(name)}_report: db "lock {name}: %lld acquisitions, %lld contended", 10, 0'
+                  for name in names]
+    lines.append('section .bss')
+    for name in names:
+        # A line of its own: every thread taking the lock writes it.
+        lines += [f'alignb {CACHE_LINE}', f'{symbol(name)}: resq {CACHE_LINE // 8}']
+    lines.append('section .text')
+    if abi == 'windows':
+        return lines + windows_lock(stats) + windows_unlock()
+    return lines + futex_lock(stats) + futex_unlock()
+
+
+def futex_lock(stats):
+    """hive_lock(record) for Linux: callable with any stack alignment; keeps rbx and rbp."""
+    lines = [
+        'hive_lock:',
+        '    xor eax, eax',
+        f'    mov ecx, {HELD}',
+        f'    lock cmpxchg qword [rdi + {LOCK_WORD}], rcx',
+        '    jne hive_lock_contended',
+        'hive_lock_acquired:',
+    ]
+    if stats:
+        lines.append(f'    add qword [rdi + {LOCK_ACQUISITIONS}], 1')
+    lines += [
+        '    ret',
+        'hive_lock_contended:',
+    ]
+    if stats:
+        lines.append(f'    lock add qword [rdi + {LOCK_CONTENDED}], 1')
+    lines += [
+        f'    mov edx, {SPINS}',
+        'hive_lock_spin:',
+        '    pause',
+        f'    cmp qword [rdi + {LOCK_WORD}], {FREE}',
+        '    jne hive_lock_spin_next',  # only retry the locked instruction on a free lock
+        '    xor eax, eax',
+        f'    lock cmpxchg qword [rdi + {LOCK_WORD}], rcx',
+        '    je hive_lock_acquired',
+        'hive_lock_spin_next:',
+        '    sub edx, 1',
+        '    jnz hive_lock_spin',
+        # Still held: mark it as having sleepers and sleep until it is released.
+        '    push rbx',
+        '    push rbp',
+        '    mov rbp, rsp',
+        '    and rsp, -16',
+        '    mov rbx, rdi',
+        'hive_lock_sleep:',
+        f'    mov eax, {SLEEPERS}',
+        f'    xchg qword [rbx + {LOCK_WORD}], rax',
+        f'    cmp rax, {FREE}',
+        '    je hive_lock_woken',
+    ]
+    lines += wait('linux', f'rbx + {LOCK_WORD}', SLEEPERS, None)
+    lines += [
+        '    jmp hive_lock_sleep',
+        'hive_lock_woken:',
+        '    mov rdi, rbx',
+        '    mov rsp, rbp',
+        '    pop rbp',
+        '    pop rbx',
+        '    jmp hive_lock_acquired',
+    ]
+    return lines
+
+
+def futex_unlock():
+    """hive_unlock(record) for Linux: wakes one sleeper if the lock may have any."""
+    lines = [
+        'hive_unlock:',
+        f'    mov eax, {FREE}',
+        f'    xchg qword [rdi + {LOCK_WORD}], rax',
+        f'    cmp rax, {SLEEPERS}',
+        '    je hive_unlock_wake',
+        '    ret',
+        'hive_unlock_wake:',
+        '    push rbp',
+        '    mov rbp, rsp',
+        '    and rsp, -16',
+        '    mov r8, rdi',  # wake() replaces rdi with the system call number
+    ]
+    lines += wake('linux', f'r8 + {LOCK_WORD}', everyone=False)
+    lines += [
+        '    mov rsp, rbp',
+        '    pop rbp',
+        '    ret',
+    ]
+    return lines
+
+
+def windows_lock(stats):
+    """hive_lock(record) for Windows: callable with any stack alignment."""
+    lines = [
+        'hive_lock:',
+        '    push rbx',
+        '    push rbp',
+        '    mov rbp, rsp',
+        '    and rsp, -16',
+        '    sub rsp, 32',  # shadow space
+        '    mov rbx, rcx',
+    ]
+    if stats:
+        lines += [
+            '    call TryAcquireSRWLockExclusive',
+            '    test al, al',
+            '    jnz hive_lock_acquired',
+            f'    lock add qword [rbx + {LOCK_CONTENDED}], 1',
+            '    mov rcx, rbx',
+        ]
+    lines.append('    call AcquireSRWLockExclusive')
+    if stats:
+        lines += [
+            'hive_lock_acquired:',
+            f'    add qword [rbx + {LOCK_ACQUISITIONS}], 1',
+        ]
+    lines += [
+        '    mov rsp, rbp',
+        '    pop rbp',
+        '    pop rbx',
+        '    ret',
+    ]
+    return lines
+
+
+def windows_unlock():
+    """hive_unlock(record) for Windows."""
+    return [
+        'hive_unlock:',
+        '    push rbp',
+        '    mov rbp, rsp',
+        '    and rsp, -16',
+        '    sub rsp, 32',
+        '    call ReleaseSRWLockExclusive',
+        '    mov rsp, rbp',
+        '    pop rbp',
+        '    ret',
+    ]
@@ -0,0 +1,184 @@
+"""While-loop analysis and unrolling.
+
+Values only stay put across the iterations of a self-contained loop: one
+that calls no HiVe function (a callee may assign any global), does not
+return and does not allocate.
+Variables used by threaded functions are never treated as invariant.
+"""
+import copy
+
+from constant_folding import assigned_variables
+from nodes import *
+from strength_reduction import constant_value
+from token import Token
+from token_types import TT_PLUS, TT_MINUS, TT_MUL, TT_DIV, TT_INT, TT_LT, TT_LTE
+
+# Operators whose result is worth keeping in a register across iterations.
+# Comparisons are left to the branches that test them.
+HOISTABLE_OPERATORS = (TT_PLUS, TT_MINUS, TT_MUL, TT_DIV)
+# Loops with larger bodies are not unrolled.
+UNROLL_MAX_NODES = 64
+INT64_MIN = -2**63
+
+
+def is_self_contained(loop):
+    return not any(isinstance(node, (FunctionCallNode, ReturnNode, FunctionDefNode, DynamicArrayAllocNode, LockNode))
+                   for node in walk(loop))
+
+
+def expression_key(node):
+    """Hashable key that is equal for structurally equal expressions; None for calls."""
+    if isinstance(node, NumberNode):
+        return node.token.value
+    if isinstance(node, VarAccessNode):
+        return ('var', node.var_name_token.value)
+    if isinstance(node, UnaryOpNode):
+        operand = expression_key(node.node)
+        return None if operand is None else (node.op_token.type, operand)
+    if isinstance(node, BinOpNode):
+        left, right = expression_key(node.left_node), expression_key(node.right_node)
+        if left is None or right is None:
+            return None
+        return (node.op_token.type, left, right)
+    if isinstance(node, ArrayAccessNode) and len(node.indexes) == 1:
+        index = expression_key(node.indexes[0])
+        return None if index is None else ('array', node.var_name_token.value, index)
+    return None
+
+
+def is_invariant(node, changed):
+    """True if node only reads constants and variables outside changed, and cannot trap."""
+    for child in walk(node):
+        if isinstance(child, VarAccessNode):
+            if child.var_name_token.value in changed:
+                return False
+        elif isinstance(child, BinOpNode):
+            if child.op_token.type == TT_DIV and constant_value(child.right_node) in (None, 0, -1):
+                # Hoisting a division could make it trap where the loop never evaluates it.
+                return False
+        elif not isinstance(child, (NumberNode, UnaryOpNode)):
+            return False
+    return True
+
+
+def invariant_expressions(loop, shared_variables=()):
+    """Groups of structurally equal loop-invariant expressions, most frequent first.
+
+    Only the largest invariant expressions are collected, not their parts.
+    """
+    if not is_self_contained(loop):
+        return []
+    changed = assigned_variables([loop]) | set(shared_variables)
+    groups = {}
+    stack = [loop]
+    while stack:
+        node = stack.pop()
+        if (isinstance(node, BinOpNode) and node.op_token.type in HOISTABLE_OPERATORS
+                and is_invariant(node, changed)):
+            groups.setdefault(expression_key(node), []).append(node)
+            continue
+        stack.extend(iter_child_nodes(node))
+    return sorted(groups.values(), key=len, reverse=True)
+
+
+def invariant_arrays(loop, shared_variables=()):
+    """Dynamic arrays a loop indexes whose base pointer it cannot change, most used first."""
+    if not is_self_contained(loop):
+        return []
+    changed = assigned_variables([loop]) | set(shared_variables)
+    counts = {}
+    for node in walk(loop):
+        if isinstance(node, ArrayAccessNode) and node.var_name_token.value not in changed:
+            counts[node.var_name_token.value] = counts.get(node.var_name_token.value, 0) + 1
+    return sorted(counts, key=lambda name: -counts[name])
+
+
+def counted_loop(loop, shared_variables=()):
+    """(counter name, step) for while i < N (or <=) with constant N whose body ends in i = i + step.
+
+    The counter must not be assigned anywhere else in the body, which may
+    not contain loops of its own.
+    """
+    condition = loop.condition_node
+    if not (isinstance(condition, BinOpNode) and condition.op_token.type in (TT_LT, TT_LTE)
+            and isinstance(condition.left_node, VarAccessNode) and isinstance(condition.right_node, NumberNode)):
+        return None
+    counter = condition.left_node.var_name_token.value
+    body = loop.body_node
+    if not body or counter in shared_variables or not is_self_contained(loop):
+        return None
+    increment = body[-1]
+    if not (isinstance(increment, VarAssignNode) and isinstance(increment.left_node, VarAccessNode)
+            and increment.left_node.var_name_token.value == counter):
+        return None
+    value = increment.value_node
+    if not (isinstance(value, BinOpNode) and value.op_token.type == TT_PLUS):
+        return None
+    operands = (value.left_node, value.right_node)
+    if not any(isinstance(node, VarAccessNode) and node.var_name_token.value == counter for node in operands):
+        return None
+    step = [node.token.value for node in operands if isinstance(node, NumberNode)]
+    if len(step) != 1 or step[0] <= 0:
+        return None
+    if counter in assigned_variables(body[:-1]):
+        return None
+    if any(isinstance(node, WhileNode) for statement in body for node in walk(statement)):
+        return None
+    if sum(1 for statement in body for _ in walk(statement)) > UNROLL_MAX_NODES:
+        return None
+    return counter, step[0]
+
+
+def unroll_loop(loop, factor, step):
+    """[unrolled loop, remainder loop] for a counted loop, or None if the bound would wrap.
+
+    The unrolled loop runs factor copies of the body while the last copy's
+    counter still passes the test: i < N becomes i < N - (factor - 1) * step.
+    """
+    condition = loop.condition_node
+    bound = condition.right_node.token
+    limit = bound.value - (factor - 1) * step
+    if limit < INT64_MIN:
+        return None
+    unrolled_condition = BinOpNode(copy.deepcopy(condition.left_node), condition.op_token,
+                                   NumberNode(Token(TT_INT, limit, bound.line, bound.col)))
+    body = [copy.deepcopy(statement) for _ in range(factor) for statement in loop.body_node]
+    return [WhileNode(unrolled_condition, body), loop]
+
+
+class LoopUnroller:
+    """Unrolls counted innermost while loops of a program by factor, in place."""
+    def __init__(self, factor, shared_variables=()):
+        self.factor = factor
+        self.shared_variables = set(shared_variables)
+        self.unrolled = 0
+
+    def unroll(self, nodes):
+        if self.factor > 1:
+            self.shared_variables |= threaded_function_variables(nodes)
+            self.statements(nodes)
+        return nodes
+
+    def statements(self, nodes):
+        index = 0
+        while index < len(nodes):
+            node = nodes[index]
+            replacement = None
+            if isinstance(node, WhileNode):
+                counted = counted_loop(node, self.shared_variables)
+                if counted is not None:
+                    replacement = unroll_loop(node, self.factor, counted[1])
+                if replacement is None:
+                    self.statements(node.body_node)
+            elif isinstance(node, IfNode):
+                self.statements(node.true_statements)
+                if node.false_statements is not None:
+                    self.statements(node.false_statements)
+            elif isinstance(node, (FunctionDefNode, LockNode)):
+                self.statements(node.body_nodes)
+            if replacement is not None:
+                nodes[index:index + 1] = replacement
+                self.unrolled += 1
+                index += len(replacement)
+            else:
+                index += 1
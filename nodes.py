@@ -1,79 +1,268 @@
-class NumberNode:
+class Node:
+    # Nodes declare their fields in __slots__, so no per-instance __dict__ is allocated.
+    __slots__ = ()
+
+def iter_child_nodes(node):
+    """Yields the direct child nodes of node, looking into statement and argument lists."""
+    for name in node.__slots__:
+        value = getattr(node, name)
+        if isinstance(value, Node):
+            yield value
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, Node):
+                    yield item
+
+class NumberNode(Node):
+    __slots__ = ('token',)
     def __init__(self, token):
         self.token = token
 
-class BinOpNode:
+class BinOpNode(Node):
+    __slots__ = ('left_node', 'op_token', 'right_node')
     def __init__(self, left_node, op_token, right_node):
         self.left_node = left_node
         self.op_token = op_token
         self.right_node = right_node
 
-class VarAccessNode:
+class VarAccessNode(Node):
+    __slots__ = ('var_name_token',)
     def __init__(self, var_name_token):
         self.var_name_token = var_name_token
     def __repr__(self):
         return "["+str(self.var_name_token).replace("Token(IDENTIFIER, '","").replace("')","")+']'
 
-class VarAssignNode:
+class VarAssignNode(Node):
+    __slots__ = ('left_node', 'value_node')
     def __init__(self, left_node, value_node):
         self.left_node = left_node  # Can be VarAccessNode or ArrayAccessNode
         self.value_node = value_node
-        self.var_name_token = left_node
-        self.value = value_node
+    # Older names for the same children, kept as views instead of extra slots.
+    @property
+    def var_name_token(self):
+        return self.left_node
+    @property
+    def value(self):
+        return self.value_node
 
-class PrintNode:
+class PrintNode(Node):
+    __slots__ = ('value_node',)
     def __init__(self, value_node):
         self.value_node = value_node
 
-class IfNode:
+class IfNode(Node):
+    __slots__ = ('condition_node', 'true_statements', 'false_statements')
     def __init__(self, condition_node, true_statements, false_statements=None):
         self.condition_node = condition_node
         self.true_statements = true_statements
         self.false_statements = false_statements
-class UnaryOpNode:
-      def __init__(self, op_token, node):
-          self.op_token = op_token
-          self.node = node
-class WhileNode:
+class UnaryOpNode(Node):
+    __slots__ = ('op_token', 'node')
+    def __init__(self, op_token, node):
+        self.op_token = op_token
+        self.node = node
+class WhileNode(Node):
+    __slots__ = ('condition_node', 'body_node')
     def __init__(self, condition_node, body_node):
         self.condition_node = condition_node
         self.body_node = body_node
-class ArrayDeclarationNode:
+class LockNode(Node):
+    # lock name ... end: the body runs while holding the program-wide mutex name.
+    __slots__ = ('lock_name_token', 'body_nodes')
+    def __init__(self, lock_name_token, body_nodes):
+        self.lock_name_token = lock_name_token
+        self.body_nodes = body_nodes
+
+class ArrayDeclarationNode(Node):
+    __slots__ = ('var_name_token', 'sizes')
     def __init__(self, var_name_token, sizes):
         self.var_name_token = var_name_token
         self.sizes = sizes  # List of sizes for each dimension
 
-class ArrayAssignNode:
+class ArrayAssignNode(Node):
+    __slots__ = ('var_name_token', 'indexes', 'value_node')
     def __init__(self, var_name_token, indexes, value_node):
         self.var_name_token = var_name_token
         self.indexes = indexes  # Index expressions
         self.value_node = value_node
 
-class ArrayAccessNode:
+class ArrayAccessNode(Node):
+    __slots__ = ('var_name_token', 'indexes')
     def __init__(self, var_name_token, indexes):
         self.var_name_token = var_name_token
         self.indexes = indexes  # Index expressions
 
-class DynamicArrayAllocNode:
+class DynamicArrayAllocNode(Node):
+    __slots__ = ('var_name_token', 'size_expr')
     def __init__(self, var_name_token, size_expr):
         self.var_name_token = var_name_token
         self.size_expr = size_expr  # Size expression
-class DeleteNode:
+class DeleteNode(Node):
+    __slots__ = ('var_name_token',)
     def __init__(self, var_name_token):
         self.var_name_token = var_name_token
 
-class FunctionDefNode:
+class FunctionDefNode(Node):
+    __slots__ = ('func_name_token', 'param_tokens', 'body_nodes', 'threaded')
     def __init__(self, func_name_token, param_tokens, body_nodes, threaded=False):
         self.func_name_token = func_name_token
         self.param_tokens = param_tokens
         self.body_nodes = body_nodes
         self.threaded = threaded
 
-class FunctionCallNode:
+# Built-in functions; no function may take their names.
+# join(handle) waits for a threaded call and returns its value.
+JOIN = 'join'
+# Atomic read-modify-write operations and their argument counts. Each
+# changes the variable or array element it is given first and returns its
+# old value: atomic_add(v, n), atomic_sub(v, n), atomic_exchange(v, new)
+# and atomic_compare_exchange(v, expected, new), which only stores new if
+# v held expected.
+ATOMICS = {'atomic_add': 2, 'atomic_sub': 2, 'atomic_exchange': 2, 'atomic_compare_exchange': 3}
+BUILTINS = (JOIN, *ATOMICS)
+
+class FunctionCallNode(Node):
+    __slots__ = ('func_name_token', 'arg_nodes')
     def __init__(self, func_name_token, arg_nodes):
         self.func_name_token = func_name_token
         self.arg_nodes = arg_nodes
 
-class ReturnNode:
+class ReturnNode(Node):
+    __slots__ = ('value_node',)
     def __init__(self, value_node):
-        self.value_node = value_node
\ No newline at end of file
+        self.value_node = value_node
+
+def walk(node):
+    """Yields node and all of its descendants without recursing in Python."""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(iter_child_nodes(node))
+
+VARIABLE_NODES = (VarAccessNode, ArrayAccessNode, DynamicArrayAllocNode, DeleteNode)
+
+def atomic_target(node):
+    """The VarAccessNode or ArrayAccessNode an atomic operation changes; None for any other node."""
+    if not isinstance(node, FunctionCallNode) or node.func_name_token.value not in ATOMICS:
+        return None
+    name = node.func_name_token.value
+    if (len(node.arg_nodes) != ATOMICS[name]
+            or not isinstance(node.arg_nodes[0], (VarAccessNode, ArrayAccessNode))):
+        raise Exception(f"{name} takes a variable or array element and {ATOMICS[name] - 1} "
+                        f"value{'s' if ATOMICS[name] > 2 else ''}")
+    return node.arg_nodes[0]
+
+def variable_names(node):
+    """Names of the variables node and its descendants use, in order of first use."""
+    names = {}
+    for child in walk(node):
+        if isinstance(child, VARIABLE_NODES):
+            names.setdefault(child.var_name_token.value, None)
+    return list(names)
+
+def global_variables(nodes):
+    """Names the top-level statements of a program use; only these are globals.
+
+    Every other name a function uses, and every parameter, is local to the
+    function's stack frame.
+    """
+    names = {}
+    for node in nodes:
+        if not isinstance(node, FunctionDefNode):
+            names.update(dict.fromkeys(variable_names(node)))
+    return set(names)
+
+def local_variables(node, global_names):
+    """Parameters and then the other locals of a FunctionDefNode, in order of first use."""
+    params = [token.value for token in node.param_tokens]
+    names = dict.fromkeys(params)
+    for statement in node.body_nodes:
+        for name in variable_names(statement):
+            if name not in global_names:
+                names.setdefault(name, None)
+    return list(names)
+
+def unassigned_locals(node, global_names):
+    """Locals of a FunctionDefNode that it may read before assigning them.
+
+    A local is assigned on a path when every way through the statements
+    before the read assigns it: both branches of an if, not the body of a
+    while, which may not run.
+    """
+    params = {token.value for token in node.param_tokens}
+    local_names = set(local_variables(node, global_names)) - params
+    names = {}
+
+    def read(expression, assigned):
+        for child in walk(expression):
+            if isinstance(child, VARIABLE_NODES):
+                name = child.var_name_token.value
+                if name in local_names and name not in assigned:
+                    names.setdefault(name, None)
+
+    def run(statements, assigned):
+        for statement in statements or []:
+            if isinstance(statement, VarAssignNode):
+                read(statement.value_node, assigned)
+                if isinstance(statement.left_node, VarAccessNode):
+                    assigned.add(statement.left_node.var_name_token.value)
+                else:
+                    read(statement.left_node, assigned)
+            elif isinstance(statement, DynamicArrayAllocNode):
+                read(statement.size_expr, assigned)
+                assigned.add(statement.var_name_token.value)
+            elif isinstance(statement, IfNode):
+                read(statement.condition_node, assigned)
+                assigned_if_true = run(statement.true_statements, set(assigned))
+                assigned = assigned_if_true & run(statement.false_statements, set(assigned))
+            elif isinstance(statement, WhileNode):
+                read(statement.condition_node, assigned)
+                run(statement.body_node, set(assigned))
+            elif isinstance(statement, LockNode):
+                assigned = run(statement.body_nodes, assigned)
+            else:
+                read(statement, assigned)
+        return assigned
+
+    run(node.body_nodes, set())
+    return list(names)
+
+def check_locals_assigned(nodes, global_names):
+    """Raises if a function may read one of its locals before assigning it.
+
+    A frame slot holds whatever was on the stack before, so such a read is
+    rejected rather than left to depend on the backend and opt level.
+    """
+    for node in nodes:
+        if isinstance(node, FunctionDefNode):
+            names = unassigned_locals(node, global_names)
+            if names:
+                raise Exception(f"'{names[0]}' may be used before it is assigned in function "
+                                f"'{node.func_name_token.value}'")
+
+def global_uses(node, global_names):
+    """Globals a FunctionDefNode uses; a parameter hides the global of the same name."""
+    params = {token.value for token in node.param_tokens}
+    return {name for statement in node.body_nodes for name in variable_names(statement)
+            if name in global_names and name not in params}
+
+def threaded_function_variables(nodes):
+    """Globals used inside threaded function bodies; a running thread may change them at any time.
+
+    Locals live in the thread's own stack frame, so they are never shared.
+    """
+    global_names = global_variables(nodes)
+    names = set()
+    calls = False
+    for node in nodes:
+        if isinstance(node, FunctionDefNode) and node.threaded:
+            names.update(global_uses(node, global_names))
+            calls = calls or any(isinstance(child, FunctionCallNode) and child.func_name_token.value not in BUILTINS
+                                 for child in walk(node))
+    if calls:
+        # Functions called from a thread run on that thread too.
+        for node in nodes:
+            if isinstance(node, FunctionDefNode):
+                names.update(global_uses(node, global_names))
+    return names
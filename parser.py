@@ -1,25 +1,37 @@
 from token import Token
 from token_types import *
 from nodes import *
+from token_stream import TokenStream
+import tracing
+
+# Binding strength of binary operators; all of them are left-associative.
+BINARY_PRECEDENCE = {
+    TT_EE: 1, TT_NE: 1, TT_LT: 1, TT_GT: 1, TT_LTE: 1, TT_GTE: 1,
+    TT_PLUS: 2, TT_MINUS: 2,
+    TT_MUL: 3, TT_DIV: 3,
+}
+UNARY_PRECEDENCE = 4
+GROUP_PRECEDENCE = 0
+# Tokens accepted before an operand: unary +/- and an opening parenthesis.
+PREFIX_PRECEDENCE = {TT_PLUS: UNARY_PRECEDENCE, TT_MINUS: UNARY_PRECEDENCE, TT_LPAREN: GROUP_PRECEDENCE}
 
 class Parser:
     def __init__(self, tokens):
-        self.tokens = tokens
+        # Accepts a token list or any token iterator; tokens are pulled lazily.
+        self.tokens = tokens if isinstance(tokens, TokenStream) else TokenStream(tokens)
         self.token_index = -1
         self.advance()
 
     def advance(self):
         """Advances to the next token."""
         self.token_index += 1
-        if self.token_index < len(self.tokens):
-            self.current_token = self.tokens[self.token_index]
+        self.current_token = self.tokens.next()
         return self.current_token
 
     def retreat(self):
-        """Advances to the next token."""
+        """Steps back to the previous token."""
         self.token_index -= 1
-        if self.token_index < len(self.tokens):
-            self.current_token = self.tokens[self.token_index]
+        self.current_token = self.tokens.retreat()
         return self.current_token
     def parse(self):
         statements = []
@@ -29,11 +41,7 @@ class Parser:
                 statements.append(stmt)
         return statements
     def peek_token(self):
-        peek_index = self.token_index + 1
-        if peek_index < len(self.tokens):
-            return self.tokens[peek_index]
-        else:
-            return Token(TT_EOF)
+        return self.tokens.peek()
     
     def statement(self):
         if self.current_token.matches(TT_KEYWORD, 'return'):
@@ -62,6 +70,8 @@ class Parser:
             return self.delete_statement()
         elif self.current_token.matches(TT_KEYWORD, 'while'):
             return self.while_statement()
+        elif self.current_token.matches(TT_KEYWORD, 'lock'):
+            return self.lock_statement()
         else:
             return self.expression()
 
@@ -75,11 +85,13 @@ class Parser:
         self.advance()
         
         
-        print(self.current_token)
         func_name = self.current_token
-        print(func_name)
+        if tracing.enabled('parser', tracing.DEBUG):
+            tracing.emit('parser', f"function definition {func_name}")
         if func_name.type != TT_IDENTIFIER:
             raise Exception("Expected function name")
+        if func_name.value in BUILTINS:
+            raise Exception(f"'{func_name.value}' is a built-in function")
         self.advance()
         if self.current_token.type != TT_LPAREN:
             raise Exception("Expected '(' after function name")
@@ -107,12 +119,14 @@ class Parser:
 
         
         
-        print(self.current_token)
         self.advance()
         func_name = self.current_token
-        print(func_name)
+        if tracing.enabled('parser', tracing.DEBUG):
+            tracing.emit('parser', f"threaded function definition {func_name}")
         if func_name.type != TT_IDENTIFIER:
             raise Exception("Expected function name")
+        if func_name.value in BUILTINS:
+            raise Exception(f"'{func_name.value}' is a built-in function")
         self.advance()
         if self.current_token.type != TT_LPAREN:
             raise Exception("Expected '(' after function name")
@@ -252,6 +266,159 @@ class Parser:
         return ArrayAccessNode(var_name_token, indexes)
 
         return ArrayAccessNode(var_token, indexes)
+    def expression(self):
+        """Parses an expression with an explicit operator stack (precedence climbing).
+
+        Operator chains and parentheses are handled iteratively, so Python
+        stack depth does not grow with the length of the expression or the
+        depth of its parentheses. Only [index] and call arguments recurse.
+        """
+        operands = []
+        operators = []  # (precedence, token); GROUP_PRECEDENCE marks an open '('
+        push_operand = operands.append
+        push_operator = operators.append
+        # advance() is inlined on this hot path: 'token' is the current token
+        # and 'consumed' the pending token_index increment, both written back
+        # before any other parser method runs.
+        next_token = self.tokens.next
+        binary_precedence = BINARY_PRECEDENCE
+        prefix_precedence = PREFIX_PRECEDENCE
+        open_groups = 0
+        consumed = 0
+        token = self.current_token
+        while True:
+            # Prefix position: unary operators and opening parentheses.
+            while token.type in prefix_precedence:
+                if token.type == TT_LPAREN:
+                    open_groups += 1
+                push_operator((prefix_precedence[token.type], token))
+                token = next_token()
+                consumed += 1
+            # Operand: numbers and plain variables inline, the rest via identifier_suffix().
+            if token.type == TT_INT:
+                push_operand(NumberNode(token))
+                token = next_token()
+                consumed += 1
+            elif token.type == TT_IDENTIFIER:
+                name_token = token
+                token = next_token()
+                consumed += 1
+                if token.type == TT_LBRACKET or token.type == TT_LPAREN:
+                    self.current_token = token
+                    self.token_index += consumed
+                    consumed = 0
+                    push_operand(self.identifier_suffix(name_token))
+                    token = self.current_token
+                else:
+                    push_operand(VarAccessNode(name_token))
+            else:
+                self.current_token = token
+                self.token_index += consumed
+                raise Exception(f"Unexpected token {token.type}")
+            # Infix position: binary operators and closing parentheses.
+            while True:
+                precedence = binary_precedence.get(token.type)
+                if precedence is not None:
+                    while operators and operators[-1][0] >= precedence:
+                        top_precedence, op_token = operators.pop()
+                        if top_precedence == UNARY_PRECEDENCE:
+                            operands[-1] = UnaryOpNode(op_token, operands[-1])
+                        else:
+                            right = operands.pop()
+                            operands[-1] = BinOpNode(operands[-1], op_token, right)
+                    push_operator((precedence, token))
+                    token = next_token()
+                    consumed += 1
+                    break
+                if token.type == TT_RPAREN and open_groups:
+                    self.reduce(operands, operators, GROUP_PRECEDENCE + 1)
+                    operators.pop()
+                    open_groups -= 1
+                    token = next_token()
+                    consumed += 1
+                    continue
+                self.current_token = token
+                self.token_index += consumed
+                self.reduce(operands, operators, GROUP_PRECEDENCE + 1)
+                if open_groups:
+                    raise Exception("Expected ')'")
+                return operands.pop()
+
+    def reduce(self, operands, operators, min_precedence):
+        """Pops operators binding at least as tightly as min_precedence into nodes."""
+        while operators and operators[-1][0] >= min_precedence:
+            precedence, op_token = operators.pop()
+            if precedence == UNARY_PRECEDENCE:
+                operands[-1] = UnaryOpNode(op_token, operands[-1])
+            else:
+                right = operands.pop()
+                operands[-1] = BinOpNode(operands[-1], op_token, right)
+
+    def identifier_suffix(self, token):
+        """Parses the array index or call arguments following identifier 'token'."""
+        if self.current_token.type == TT_LBRACKET:
+            # Array access
+            self.advance()
+            index_expr = self.expression()
+            if self.current_token.type != TT_RBRACKET:
+                raise Exception("Expected ']'")
+            self.advance()
+            return ArrayAccessNode(token, [index_expr])
+        return self.function_call(token)
+    def function_call(self, func_name_token):
+        self.advance()  # Skip '('
+        arg_nodes = []
+        if self.current_token.type != TT_RPAREN:
+            arg_nodes.append(self.expression())
+            while self.current_token.type == TT_COMMA:
+                self.advance()
+                arg_nodes.append(self.expression())
+        if self.current_token.type != TT_RPAREN:
+            raise Exception("Expected ')' after function arguments")
+        self.advance()  # Skip ')'
+        return FunctionCallNode(func_name_token, arg_nodes)
+
+    def while_statement(self):
+        self.advance()  # Skip 'while'
+        condition = self.expression()
+        body_statements = []
+        while not (self.current_token.type == TT_KEYWORD and self.current_token.value == 'end'):
+            stmt = self.statement()
+            if stmt:
+                body_statements.append(stmt)
+        self.advance()  # Skip 'end'
+        return WhileNode(condition, body_statements)
+    def lock_statement(self):
+        self.advance()  # Skip 'lock'
+        lock_name_token = self.current_token
+        if lock_name_token.type != TT_IDENTIFIER:
+            raise Exception("Expected lock name after 'lock'")
+        self.advance()
+        body_statements = []
+        while not self.current_token.matches(TT_KEYWORD, 'end'):
+            if self.current_token.type == TT_EOF:
+                raise Exception(f"Expected 'end' to close lock '{lock_name_token.value}'")
+            stmt = self.statement()
+            if stmt:
+                body_statements.append(stmt)
+        self.advance()  # Skip 'end'
+        return LockNode(lock_name_token, body_statements)
+    def delete_statement(self):
+        self.advance()  # Skip 'delete'
+        var_name_token = self.current_token
+        if var_name_token.type != TT_IDENTIFIER:
+            raise Exception("Expected identifier after 'delete'")
+        self.advance()
+        return DeleteNode(var_name_token)
+
+
+class RecursiveDescentParser(Parser):
+    """The original expression -> arith_expr -> term -> factor grammar.
+
+    Kept as the reference implementation for tests and benchmark.py; it
+    builds the same trees as Parser.expression but uses several Python
+    frames per operand and per parenthesis.
+    """
     def expression(self):
         # Handle comparison expressions
         return self.binary_operation(self.arith_expr, (TT_EE, TT_NE, TT_LT, TT_GT, TT_LTE, TT_GTE))
@@ -306,19 +473,6 @@ class Parser:
                 raise Exception("Expected ')'")
         else:
             raise Exception(f"Unexpected token {token.type}")
-    def function_call(self, func_name_token):
-        self.advance()  # Skip '('
-        arg_nodes = []
-        if self.current_token.type != TT_RPAREN:
-            arg_nodes.append(self.expression())
-            while self.current_token.type == TT_COMMA:
-                self.advance()
-                arg_nodes.append(self.expression())
-        if self.current_token.type != TT_RPAREN:
-            raise Exception("Expected ')' after function arguments")
-        self.advance()  # Skip ')'
-        return FunctionCallNode(func_name_token, arg_nodes)
-
     def binary_operation(self, func, ops):
         left = func()
         while self.current_token.type in ops:
@@ -327,20 +481,3 @@ class Parser:
             right = func()
             left = BinOpNode(left, op_token, right)
         return left
-    def while_statement(self):
-        self.advance()  # Skip 'while'
-        condition = self.expression()
-        body_statements = []
-        while not (self.current_token.type == TT_KEYWORD and self.current_token.value == 'end'):
-            stmt = self.statement()
-            if stmt:
-                body_statements.append(stmt)
-        self.advance()  # Skip 'end'
-        return WhileNode(condition, body_statements)
-    def delete_statement(self):
-        self.advance()  # Skip 'delete'
-        var_name_token = self.current_token
-        if var_name_token.type != TT_IDENTIFIER:
-            raise Exception("Expected identifier after 'delete'")
-        self.advance()
-        return DeleteNode(var_name_token)
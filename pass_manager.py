@@ -0,0 +1,204 @@
+"""Optimization passes and the manager that schedules them by -O level.
+
+A pass runs at one stage of the pipeline: 'ast' passes rewrite the parsed
+statement list, 'ir' passes an IRModule (--backend ir only) and 'asm'
+passes the finished assembly lines. Within a stage passes run in
+registration order unless registered before another pass. Every run is
+recorded with its wall time and the size of the program before and after:
+AST nodes, IR instructions or assembly instructions.
+"""
+import time
+
+import tracing
+from constant_folding import ConstantFolder
+from dead_code import DeadCodeEliminator
+from inliner import Inliner
+from ir import simplify, tail_calls, value_numbering
+from loop_optimizer import LoopUnroller
+from nodes import walk
+from peephole import INDENT, PEEPHOLE_RULES, PeepholeOptimizer
+
+STAGES = ('ast', 'ir', 'asm')
+SIZE_UNITS = {'ast': 'nodes', 'ir': 'instructions', 'asm': 'instructions'}
+
+
+def program_size(stage, unit):
+    if stage == 'ast':
+        return sum(1 for node in unit for _ in walk(node))
+    if stage == 'ir':
+        return sum(function.instruction_count() for function in unit.functions.values())
+    return sum(1 for line in unit if line.startswith(INDENT))
+
+
+class PassContext:
+    """What passes may need to know besides the program itself."""
+    __slots__ = ('target', 'architecture', 'shared_variables', 'whole_program')
+    def __init__(self, target, shared_variables=(), whole_program=True):
+        self.target = target
+        self.architecture = 'arm64' if target == 'arm64' else 'x86_64'
+        # Variables a threaded function may change; see ConstantFolder.
+        self.shared_variables = set(shared_variables)
+        # False when the program is compiled in parts (--jobs).
+        self.whole_program = whole_program
+
+
+class Pass:
+    """run(unit, context) returns the rewritten unit; it may change unit in place."""
+    __slots__ = ('name', 'stage', 'level', 'run')
+    def __init__(self, name, stage, level, run):
+        if stage not in STAGES:
+            raise Exception(f"Unknown pass stage '{stage}' (expected one of {', '.join(STAGES)})")
+        self.name = name
+        self.stage = stage
+        self.level = level
+        self.run = run
+
+
+class PassRecord:
+    __slots__ = ('name', 'stage', 'seconds', 'before', 'after')
+    def __init__(self, name, stage, seconds, before, after):
+        self.name = name
+        self.stage = stage
+        self.seconds = seconds
+        self.before = before
+        self.after = after
+
+
+class PassManager:
+    """Runs the registered passes whose level is at most opt_level.
+
+    records holds a PassRecord for every pass run, across every program
+    this manager has compiled.
+    """
+    def __init__(self, opt_level):
+        self.opt_level = opt_level
+        self.passes = []
+        self.records = []
+
+    def register(self, name, stage, level, run, before=None):
+        new_pass = Pass(name, stage, level, run)
+        if any(existing.name == name for existing in self.passes):
+            raise Exception(f"Pass '{name}' is already registered")
+        if before is None:
+            self.passes.append(new_pass)
+        else:
+            index = [existing.name for existing in self.passes].index(before)
+            self.passes.insert(index, new_pass)
+        return new_pass
+
+    def scheduled(self, stage):
+        return [p for p in self.passes if p.stage == stage and p.level <= self.opt_level]
+
+    def run(self, stage, unit, context):
+        for scheduled_pass in self.scheduled(stage):
+            before = program_size(stage, unit)
+            start = time.perf_counter()
+            unit = scheduled_pass.run(unit, context)
+            record = PassRecord(scheduled_pass.name, stage, time.perf_counter() - start,
+                                before, program_size(stage, unit))
+            self.records.append(record)
+            if tracing.enabled('compiler', tracing.DEBUG):
+                tracing.emit('compiler', f"pass {self.format_record(record)}")
+        return unit
+
+    def format_record(self, record):
+        return (f"{record.name} ({record.stage}): {record.seconds * 1000:.2f} ms, "
+                f"{record.before} -> {record.after} {SIZE_UNITS[record.stage]}")
+
+    def format_report(self):
+        """Totals per pass, in the order the passes first ran."""
+        totals = {}
+        for record in self.records:
+            seconds, removed, runs = totals.get((record.name, record.stage), (0.0, 0, 0))
+            totals[record.name, record.stage] = (seconds + record.seconds,
+                                                 removed + record.before - record.after, runs + 1)
+        lines = [f"{'pass':<20} {'stage':<5} {'runs':>4} {'ms':>9} {'removed':>9}"]
+        for (name, stage), (seconds, removed, runs) in totals.items():
+            lines.append(f"{name:<20} {stage:<5} {runs:>4} {seconds * 1000:>9.2f} {removed:>9}")
+        return '\n'.join(lines)
+
+
+# Default passes
+
+def constant_folding(nodes, context):
+    folder = ConstantFolder(context.shared_variables, context.whole_program)
+    folder.fold(nodes)
+    if tracing.enabled('compiler', tracing.DEBUG):
+        tracing.emit('compiler', f"constant folding: {folder.folded} expressions replaced")
+    return nodes
+
+
+def inline_functions(nodes, context):
+    if not context.whole_program:
+        return nodes  # other units may call or redefine the functions
+    inliner = Inliner()
+    inliner.inline(nodes)
+    if tracing.enabled('compiler', tracing.DEBUG):
+        tracing.emit('compiler', f"inlining: {inliner.inlined} calls inlined")
+    return nodes
+
+
+def dead_code_elimination(nodes, context):
+    if not context.whole_program:
+        return nodes  # other units may call the functions or read the variables
+    eliminator = DeadCodeEliminator()
+    eliminator.eliminate(nodes)
+    if tracing.enabled('compiler', tracing.DEBUG):
+        tracing.emit('compiler', f"dead code: {eliminator.format_stats()}")
+    return nodes
+
+
+def loop_unrolling(factor):
+    def unroll_loops(nodes, context):
+        unroller = LoopUnroller(factor, context.shared_variables)
+        unroller.unroll(nodes)
+        if tracing.enabled('compiler', tracing.DEBUG):
+            tracing.emit('compiler', f"loop unrolling: {unroller.unrolled} loops unrolled by {factor}")
+        return nodes
+    return unroll_loops
+
+
+def simplify_cfg(module, context):
+    return simplify(module)
+
+
+def number_values(module, context):
+    return value_numbering(module)
+
+
+def mark_tail_calls(module, context):
+    return tail_calls(module)
+
+
+def peephole(lines, context):
+    optimizer = PeepholeOptimizer(PEEPHOLE_RULES[context.architecture])
+    lines = optimizer.optimize(lines)
+    if tracing.enabled('codegen', tracing.DEBUG):
+        tracing.emit('codegen', f"peephole: {optimizer.format_stats()}")
+    return lines
+
+
+def default_pass_manager(opt_level, unroll=1):
+    """The compiler's pipeline: -O1 simplifies and value-numbers the IR, turns calls whose value is
+    returned into tail calls and runs the peephole rules, -O2 also inlines small functions, folds
+    constants and removes dead code.
+
+    With unroll > 1 counted loops are unrolled by that factor from -O1, after
+    constant folding so folded bounds count as constants.
+
+    Register allocation, strength reduction, loop optimization, value
+    numbering and tail calls in the AST backends are choices made while
+    generating code rather than passes; they are enabled from -O1 by
+    compiler.get_code_generator.
+    """
+    manager = PassManager(opt_level)
+    manager.register('inline', 'ast', 2, inline_functions)
+    manager.register('constant-folding', 'ast', 2, constant_folding)
+    manager.register('dead-code', 'ast', 2, dead_code_elimination)
+    if unroll > 1:
+        manager.register('unroll-loops', 'ast', 1, loop_unrolling(unroll))
+    manager.register('simplify-cfg', 'ir', 1, simplify_cfg)
+    manager.register('value-numbering', 'ir', 1, number_values)
+    manager.register('tail-calls', 'ir', 1, mark_tail_calls)
+    manager.register('peephole', 'asm', 1, peephole)
+    return manager
@@ -0,0 +1,255 @@
+"""Peephole optimization of generated assembly.
+
+A rule looks at the lines starting at an index and returns (length,
+replacement) to replace that many lines, or None if it does not apply.
+Rules only match instruction lines, so a label between two instructions
+stops a pattern from matching across it.
+
+The generated code only reads flags set by cmp and test right before a
+jcc, setcc or cmov, so rules may change how other instructions set flags.
+"""
+import re
+from collections import Counter
+from functools import lru_cache
+
+X86_REGISTERS = ('rax', 'rbx', 'rcx', 'rdx', 'rsi', 'rdi', 'rbp', 'rsp',
+                 'r8', 'r9', 'r10', 'r11', 'r12', 'r13', 'r14', 'r15')
+X86_JUMPS = ('jmp', 'je', 'jne', 'jz', 'jnz', 'jl', 'jg', 'jle', 'jge')
+ARM64_JUMPS = ('b', 'b.eq', 'b.ne', 'b.lt', 'b.gt', 'b.le', 'b.ge', 'cbz', 'cbnz')
+# A variable's memory operand: a global, e.g. qword [i] or [arr], or a frame slot, e.g. qword [rbp - 8].
+VARIABLE_OPERAND = re.compile(r'(?:qword )?\[([A-Za-z_][\w.]*|rbp [-+] \d+)\]$')
+IMMEDIATE = re.compile(r'-?\d+$')
+# Instruction lines are indented; labels and directives are not.
+INDENT = '    '
+
+
+@lru_cache(maxsize=4096)
+def instruction(line):
+    """(mnemonic, operands) for an instruction line, or None for labels and directives.
+
+    Every rule parses the lines it looks at, so results are cached by line.
+    """
+    if not line.startswith(INDENT):
+        return None
+    mnemonic, _, rest = line.strip().partition(' ')
+    operands, depth, current = [], 0, ''
+    for char in rest:
+        if char == ',' and depth == 0:
+            operands.append(current.strip())
+            current = ''
+            continue
+        depth += char == '['
+        depth -= char == ']'
+        current += char
+    if current.strip():
+        operands.append(current.strip())
+    return mnemonic, tuple(operands)
+
+
+def instructions(lines, i, count):
+    """Parsed instructions lines[i:i + count], or None if any of them is not an instruction."""
+    if i + count > len(lines):
+        return None
+    window = [instruction(line) for line in lines[i:i + count]]
+    return None if None in window else window
+
+
+def x86_registers(operand):
+    """64-bit registers an x86 operand reads or writes through."""
+    return {reg for reg in re.findall(r'\b\w+\b', operand) if reg in X86_REGISTERS}
+
+
+def variable_name(operand):
+    match = VARIABLE_OPERAND.match(operand)
+    return match.group(1) if match else None
+
+
+# x86-64 rules
+
+def jump_to_next_label(lines, i):
+    """jmp L / L:  ->  L:"""
+    ins = instruction(lines[i])
+    if (ins is not None and ins[0] in X86_JUMPS and i + 1 < len(lines)
+            and lines[i + 1] == f'{ins[1][0]}:'):
+        return 1, []
+    return None
+
+
+def self_move(lines, i):
+    """mov rax, rax  ->  (nothing)"""
+    ins = instruction(lines[i])
+    if ins is not None and ins[0] == 'mov' and len(ins[1]) == 2 and ins[1][0] == ins[1][1] in X86_REGISTERS:
+        return 1, []
+    return None
+
+
+def push_pop(lines, i):
+    """push A / pop B  ->  mov B, A"""
+    window = instructions(lines, i, 2)
+    if window is None:
+        return None
+    (op1, args1), (op2, args2) = window
+    if op1 != 'push' or op2 != 'pop' or args2[0] not in X86_REGISTERS:
+        return None
+    source, target = args1[0], args2[0]
+    if source == target:
+        return 2, []
+    return 2, [f'{INDENT}mov {target}, {source}']
+
+
+def push_load_pop(lines, i):
+    """push A / mov A, Y / pop B  ->  mov B, A / mov A, Y"""
+    window = instructions(lines, i, 3)
+    if window is None:
+        return None
+    (op1, args1), (op2, args2), (op3, args3) = window
+    if op1 != 'push' or op2 != 'mov' or op3 != 'pop' or len(args2) != 2:
+        return None
+    saved, (loaded, value), (target,) = args1[0], args2, args3
+    if (saved not in X86_REGISTERS or target not in X86_REGISTERS or loaded != saved or target == saved
+            or {'rsp', target} & x86_registers(value)):
+        return None
+    return 3, [f'{INDENT}mov {target}, {saved}', f'{INDENT}mov {saved}, {value}']
+
+
+def push_load_move_pop(lines, i):
+    """push A / mov A, Y / mov B, A / pop A  ->  mov B, Y"""
+    window = instructions(lines, i, 4)
+    if window is None:
+        return None
+    (op1, args1), (op2, args2), (op3, args3), (op4, args4) = window
+    if (op1, op2, op3, op4) != ('push', 'mov', 'mov', 'pop') or len(args2) != 2 or len(args3) != 2:
+        return None
+    saved, (loaded, value), (target, moved), (restored,) = args1[0], args2, args3, args4
+    if (saved not in X86_REGISTERS or loaded != saved or moved != saved or restored != saved
+            or target not in X86_REGISTERS or target in (saved, 'rsp') or 'rsp' in x86_registers(value)):
+        return None
+    return 4, [f'{INDENT}mov {target}, {value}']
+
+
+def store_reload(lines, i):
+    """mov qword [v], A / mov B, qword [v]  ->  mov qword [v], A / mov B, A, for a global or frame slot v"""
+    window = instructions(lines, i, 2)
+    if window is None:
+        return None
+    (op1, args1), (op2, args2) = window
+    if op1 != 'mov' or op2 != 'mov' or len(args1) != 2 or len(args2) != 2:
+        return None
+    name = variable_name(args1[0])
+    stored, target = args1[1], args2[0]
+    if (name is None or variable_name(args2[1]) != name or target not in X86_REGISTERS
+            or not (stored in X86_REGISTERS or IMMEDIATE.match(stored))):
+        return None
+    if stored == target:
+        return 2, [lines[i]]
+    return 2, [lines[i], f'{INDENT}mov {target}, {stored}']
+
+
+def multiply_power_of_two(lines, i):
+    """imul rax, 8  ->  shl rax, 3"""
+    ins = instruction(lines[i])
+    if ins is None or ins[0] != 'imul':
+        return None
+    args = ins[1]
+    if len(args) == 3 and args[0] == args[1]:
+        args = args[1:]
+    if len(args) != 2 or args[0] not in X86_REGISTERS or not IMMEDIATE.match(args[1]):
+        return None
+    factor = int(args[1])
+    if factor <= 0 or factor & (factor - 1):
+        return None
+    if factor == 1:
+        return 1, []
+    return 1, [f'{INDENT}shl {args[0]}, {factor.bit_length() - 1}']
+
+
+def cancelled_stack_adjustment(lines, i):
+    """add rsp, N / sub rsp, N  ->  (nothing)"""
+    window = instructions(lines, i, 2)
+    if window is None:
+        return None
+    (op1, args1), (op2, args2) = window
+    if {op1, op2} == {'add', 'sub'} and args1 == args2 and args1[0] == 'rsp':
+        return 2, []
+    return None
+
+
+# ARM64 rules
+
+def arm64_jump_to_next_label(lines, i):
+    """b L / L:  ->  L:"""
+    ins = instruction(lines[i])
+    if (ins is not None and ins[0] in ARM64_JUMPS and i + 1 < len(lines)
+            and lines[i + 1] == f'{ins[1][-1]}:'):
+        return 1, []
+    return None
+
+
+def arm64_self_move(lines, i):
+    """mov x2, x2  ->  (nothing)"""
+    ins = instruction(lines[i])
+    if ins is not None and ins[0] == 'mov' and len(ins[1]) == 2 and ins[1][0] == ins[1][1]:
+        return 1, []
+    return None
+
+
+def arm64_store_reload(lines, i):
+    """A store to a global followed by a load of the same global reuses the stored register.
+
+    adrp x1, v / add x1, x1, :lo12:v / str x0, [x1] / adrp x1, v / add x1, x1, :lo12:v / ldr x2, [x1]
+    ->  adrp x1, v / add x1, x1, :lo12:v / str x0, [x1] / mov x2, x0
+    """
+    window = instructions(lines, i, 6)
+    if window is None:
+        return None
+    address, store, reload, load = window[0:2], window[2], window[3:5], window[5]
+    if (address != reload or address[0][0] != 'adrp' or address[1][0] != 'add'
+            or store[0] != 'str' or load[0] != 'ldr'):
+        return None
+    base = address[0][1][0]
+    if store[1][1] != f'[{base}]' or load[1][1] != f'[{base}]':
+        return None
+    stored, target = store[1][0], load[1][0]
+    if stored == target:
+        return 6, lines[i:i + 3]
+    return 6, lines[i:i + 3] + [f'{INDENT}mov {target}, {stored}']
+
+
+PEEPHOLE_RULES = {
+    'x86_64': (jump_to_next_label, self_move, push_load_move_pop, push_load_pop, push_pop,
+               store_reload, multiply_power_of_two, cancelled_stack_adjustment),
+    'arm64': (arm64_jump_to_next_label, arm64_self_move, arm64_store_reload),
+}
+# Longest pattern any rule matches; after a rewrite matching restarts this
+# far back so rewrites can enable each other.
+WINDOW = 6
+
+
+class PeepholeOptimizer:
+    """Applies a target's rules to a list of assembly lines until none applies.
+
+    stats counts how often each rule fired, by rule name, across every
+    program this optimizer has seen.
+    """
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self.stats = Counter()
+
+    def optimize(self, lines):
+        lines = list(lines)
+        i = 0
+        while i < len(lines):
+            for rule in self.rules:
+                match = rule(lines, i)
+                if match is not None:
+                    length, replacement = match
+                    lines[i:i + length] = replacement
+                    self.stats[rule.__name__] += 1
+                    i = max(i - WINDOW + 1, 0)
+                    break
+            else:
+                i += 1
+        return lines
+
+    def format_stats(self):
+        return ', '.join(f'{name} {count}' for name, count in self.stats.most_common()) or 'no rules fired'
@@ -0,0 +1,217 @@
+from nodes import (
+    ArrayAccessNode, BinOpNode, DeleteNode, DynamicArrayAllocNode, FunctionCallNode,
+    FunctionDefNode, LockNode, NumberNode, ReturnNode, UnaryOpNode, VarAccessNode, atomic_target,
+    iter_child_nodes, walk,
+)
+from token_types import TT_DIV
+
+# Registers available to expression code, per ABI. rax and rdx are left out of
+# the scratch pools because they are fixed by calls, returns and idiv.
+SCRATCH_REGISTERS = {
+    'windows': ['rcx', 'r8', 'r9', 'r10', 'r11'],
+    'linux': ['rcx', 'rsi', 'rdi', 'r8', 'r9', 'r10', 'r11'],
+}
+# Callee-saved registers hot loop variables can live in.
+CALLEE_SAVED_REGISTERS = {
+    'windows': ['rbx', 'rsi', 'rdi', 'r12', 'r13', 'r14', 'r15'],
+    'linux': ['rbx', 'r12', 'r13', 'r14', 'r15'],
+}
+ARGUMENT_REGISTERS = {
+    'windows': ['rcx', 'rdx', 'r8', 'r9'],
+    'linux': ['rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9'],
+}
+# In a fixed order, so saves around calls come out the same on every run.
+CALLER_SAVED_REGISTERS = ('rax', 'rcx', 'rdx', 'rsi', 'rdi', 'r8', 'r9', 'r10', 'r11')
+
+BYTE_REGISTERS = {
+    'rax': 'al', 'rbx': 'bl', 'rcx': 'cl', 'rdx': 'dl', 'rsi': 'sil', 'rdi': 'dil',
+    'r8': 'r8b', 'r9': 'r9b', 'r10': 'r10b', 'r11': 'r11b',
+    'r12': 'r12b', 'r13': 'r13b', 'r14': 'r14b', 'r15': 'r15b',
+}
+
+
+def contains_call(node):
+    return any(isinstance(n, FunctionCallNode) for n in walk(node))
+
+
+def is_imm32(value):
+    return -2**31 <= value < 2**31
+
+
+class RegisterAllocator:
+    """Register bookkeeping for one code generator.
+
+    Expressions are evaluated in Sethi-Ullman order: register_need() gives
+    the number of registers a subtree needs, and the needier side of a
+    binary operation is evaluated first so the other side fits in what is
+    left. Registers holding values that are still needed are tracked in
+    in_use so calls and idiv know what to preserve.
+
+    Hot scalars of a while loop are promoted to callee-saved registers for
+    the duration of the loop; promoted maps variable names to their register.
+    Other variables are memory operands: frame slots for the locals in frame,
+    .bss symbols for globals.
+    Loop-invariant array bases (array_bases, by array name) and expressions
+    (hoisted, by node id) are held in callee-saved registers the same way.
+
+    Within a run of straight-line statements, values whose keys are in
+    reusable are remembered in free scratch registers (values, by key) for
+    later statements to reuse; allocate() takes registers holding no
+    remembered value first and forgets the value of any it does take.
+    """
+    def __init__(self, abi):
+        self.abi = abi
+        self.scratch = SCRATCH_REGISTERS[abi]
+        self.callee_saved = CALLEE_SAVED_REGISTERS[abi]
+        self.argument_registers = ARGUMENT_REGISTERS[abi]
+        self.in_use = set()
+        self.promoted = {}
+        self.array_bases = {}
+        self.hoisted = {}
+        self.values = {}  # value key -> (register, names read, reads an array element)
+        self.reusable = set()
+        self.stack_bytes = 0  # bytes pushed by expression code, for call alignment
+        self.shared_variables = set()
+        self.frame = {}  # local name -> frame operand, in the function being generated
+        self._needs = {}
+        self._calls = {}
+
+    def allocate(self):
+        """Takes a free scratch register, or returns None when all are in use."""
+        reg = self.spare()
+        if reg is None:
+            free = [reg for reg in self.scratch if reg not in self.in_use]
+            if not free:
+                return None
+            reg = free[0]
+            self.forget_register(reg)
+        self.in_use.add(reg)
+        return reg
+
+    def spare(self):
+        """A free scratch register holding no remembered value, or None."""
+        held = {register for register, _, _ in self.values.values()}
+        for reg in self.scratch:
+            if reg not in self.in_use and reg not in held:
+                return reg
+        return None
+
+    def release(self, reg):
+        self.in_use.discard(reg)
+
+    def free_count(self):
+        return sum(1 for reg in self.scratch if reg not in self.in_use)
+
+    def free_callee_saved(self):
+        taken = set(self.promoted.values()) | set(self.array_bases.values()) | set(self.hoisted.values())
+        return [reg for reg in self.callee_saved if reg not in taken]
+
+    def remember(self, key, register, names, elements=False):
+        self.values[key] = (register, names, elements)
+
+    def recall(self, key):
+        entry = self.values.get(key)
+        return None if entry is None else entry[0]
+
+    def forget_register(self, register):
+        for key in [key for key, entry in self.values.items() if entry[0] == register]:
+            del self.values[key]
+
+    def forget(self, name=None, elements=False):
+        """Forgets the values that read name, and with elements=True those that read an array element."""
+        for key in [key for key, (_, names, reads) in self.values.items()
+                    if name in names or (elements and reads)]:
+            del self.values[key]
+
+    def forget_values(self):
+        self.values.clear()
+        self.reusable = set()
+
+    def operand(self, node):
+        """Memory, immediate or register operand for a leaf, or None if it needs evaluating."""
+        if id(node) in self.hoisted:
+            return self.hoisted[id(node)]
+        if isinstance(node, NumberNode) and is_imm32(node.token.value):
+            return str(node.token.value)
+        if isinstance(node, VarAccessNode):
+            name = node.var_name_token.value
+            if name in self.promoted:
+                return self.promoted[name]
+            return self.frame.get(name, f'qword [{name}]')
+        return None
+
+    def register_need(self, node):
+        """Sethi-Ullman number: scratch registers needed to evaluate node, target included."""
+        need = self._needs.get(id(node))
+        if need is not None:
+            return need
+        if id(node) in self.hoisted:
+            need = 1
+        elif isinstance(node, BinOpNode):
+            left = self.register_need(node.left_node)
+            operand = self.operand(node.right_node)
+            # idiv takes a register or memory operand, but not an immediate.
+            if operand is not None and not (node.op_token.type == TT_DIV and isinstance(node.right_node, NumberNode)):
+                need = left
+            else:
+                right = self.register_need(node.right_node)
+                need = max(left, right) if left != right else left + 1
+        elif isinstance(node, UnaryOpNode):
+            need = self.register_need(node.node)
+        elif isinstance(node, ArrayAccessNode):
+            need = max(self.register_need(node.indexes[0]), 2)
+        else:
+            need = 1
+        self._needs[id(node)] = need
+        return need
+
+    def has_call(self, node):
+        calls = self._calls.get(id(node))
+        if calls is None:
+            if isinstance(node, FunctionCallNode):
+                calls = True
+            else:
+                calls = any(self.has_call(child) for child in iter_child_nodes(node))
+            self._calls[id(node)] = calls
+        return calls
+
+    def reset_needs(self):
+        # Results are cached by node id, so the caches only live for one statement.
+        self._needs.clear()
+        self._calls.clear()
+
+    def loop_candidates(self, loop_node, variables):
+        """Scalars of a loop worth keeping in registers, most used first.
+
+        Loops that return or allocate are skipped, and in loops that call
+        HiVe functions or have lock blocks only locals are candidates.
+        Variables touched by threaded functions or changed by atomic
+        operations stay in memory.
+        """
+        counts = {}
+        excluded = set(self.shared_variables) | set(self.promoted)
+        calls = False
+        for node in walk(loop_node):
+            if isinstance(node, (ReturnNode, FunctionDefNode, DynamicArrayAllocNode)):
+                # Return and a failed allocation leave the loop without restoring the registers.
+                return []
+            if isinstance(atomic_target(node), VarAccessNode):
+                excluded.add(node.arg_nodes[0].var_name_token.value)
+            elif isinstance(node, FunctionCallNode):
+                # A callee may use the globals, but not the caller's frame, and it
+                # saves the callee-saved registers it uses.
+                calls = True
+            elif isinstance(node, LockNode):
+                # Other threads change the globals a lock guards whenever it is free.
+                calls = True
+            elif isinstance(node, VarAccessNode):
+                name = node.var_name_token.value
+                counts[name] = counts.get(name, 0) + 1
+            elif isinstance(node, (ArrayAccessNode, DynamicArrayAllocNode, DeleteNode)):
+                excluded.add(node.var_name_token.value)
+        candidates = [name for name in counts
+                      if name not in excluded and (name in self.frame or not calls)
+                      and variables.get(name, {'type': 'scalar'})['type'] == 'scalar']
+        candidates.sort(key=lambda name: -counts[name])
+        return list(zip(candidates, self.free_callee_saved()))
+
@@ -0,0 +1,207 @@
+"""Cheaper instruction sequences for multiplication and division by constants.
+
+Each function returns the instructions to emit, or None when the plain
+imul/idiv (or mul/sdiv) is as good or the constant cannot be reduced.
+"""
+from nodes import BinOpNode, NumberNode, UnaryOpNode
+from token_types import TT_MINUS, TT_PLUS
+
+INT64_MIN = -2**63
+# lea can scale an index by 2, 4 or 8 and add the base: x*3, x*5 and x*9 in one instruction.
+LEA_FACTORS = {3: 2, 5: 4, 9: 8}
+
+
+def is_power_of_two(value):
+    return value > 0 and value & (value - 1) == 0
+
+
+def signed_magic(divisor):
+    """(magic, shift) so that n / divisor == (hi64(magic * n) [+ n]) >> shift, rounded toward zero.
+
+    divisor must be at least 3 and not a power of two. A magic number of
+    2**63 or more is negative as a signed 64-bit value, and the caller has
+    to add n back after the high multiply.
+    """
+    nc = 2**63 - 1 - 2**63 % divisor
+    p = 64
+    while 2**p <= nc * (divisor - 2**p % divisor):
+        p += 1
+    return (2**p + divisor - 2**p % divisor) // divisor, p - 64
+
+
+def multiply_plan(factor):
+    """Steps computing x * factor, factor > 0: ('lea', scale) multiplies by scale + 1, ('shl', k) by 2**k."""
+    shift = (factor & -factor).bit_length() - 1
+    odd = factor >> shift
+    steps = []
+    if odd in LEA_FACTORS:
+        steps.append(('lea', LEA_FACTORS[odd]))
+    elif odd != 1:
+        for first in LEA_FACTORS:
+            if odd % first == 0 and odd // first in LEA_FACTORS:
+                steps += [('lea', LEA_FACTORS[first]), ('lea', LEA_FACTORS[odd // first])]
+                break
+        else:
+            return None
+    if shift:
+        steps.append(('shl', shift))
+    # Longer chains are no faster than a 3-cycle imul.
+    return steps if len(steps) <= 2 else None
+
+
+def multiply_by_constant(target, factor):
+    """x86-64: target *= factor with shl and lea instead of imul."""
+    if factor == 0:
+        return [f'    xor {target}, {target}']
+    plan = multiply_plan(abs(factor))
+    if plan is None or (factor < 0 and len(plan) > 1):
+        return None
+    code = []
+    for step, amount in plan:
+        if step == 'lea':
+            code.append(f'    lea {target}, [{target} + {target}*{amount}]')
+        else:
+            code.append(f'    shl {target}, {amount}')
+    if factor < 0:
+        code.append(f'    neg {target}')
+    return code
+
+
+def reducible_divisor(divisor):
+    # Division by 0 and -1 is left to idiv/sdiv so it still traps (or wraps) where it would.
+    return divisor not in (0, -1, INT64_MIN)
+
+
+def divide_by_constant(target, divisor, scratch):
+    """x86-64: target /= divisor, rounded toward zero, without idiv.
+
+    scratch is a free register other than rax and rdx. rax and rdx are
+    clobbered unless one of them is target, so the caller saves them if
+    they hold live values; powers of two only use scratch.
+    """
+    if not reducible_divisor(divisor) or scratch is None:
+        return None
+    magnitude = abs(divisor)
+    code = []
+    if magnitude == 1:
+        pass
+    elif is_power_of_two(magnitude):
+        # Negative dividends are biased by 2**k - 1 so the arithmetic shift rounds toward zero.
+        shift = magnitude.bit_length() - 1
+        code.append(f'    mov {scratch}, {target}')
+        if shift > 1:
+            code.append(f'    sar {scratch}, 63')
+        code.append(f'    shr {scratch}, {64 - shift}')
+        code.append(f'    add {target}, {scratch}')
+        code.append(f'    sar {target}, {shift}')
+    else:
+        magic, shift = signed_magic(magnitude)
+        dividend = target
+        if target in ('rax', 'rdx'):
+            code.append(f'    mov {scratch}, {target}')
+            dividend = scratch
+        code.append(f'    mov rax, {magic - 2**64 if magic >= 2**63 else magic}')
+        code.append(f'    imul {dividend}')
+        if magic >= 2**63:
+            code.append(f'    add rdx, {dividend}')
+        if shift:
+            code.append(f'    sar rdx, {shift}')
+        # Round toward zero: add one when the dividend is negative.
+        code.append(f'    mov rax, {dividend}')
+        code.append('    shr rax, 63')
+        code.append('    add rdx, rax')
+        if target != 'rdx':
+            code.append(f'    mov {target}, rdx')
+    if divisor < 0:
+        code.append(f'    neg {target}')
+    return code
+
+
+def arm64_multiply_by_constant(dest, source, factor):
+    """ARM64: dest = source * factor with shifted adds instead of mul."""
+    magnitude = abs(factor)
+    if magnitude == 0:
+        return None
+    shift = (magnitude & -magnitude).bit_length() - 1
+    odd = magnitude >> shift
+    code = []
+    if odd == 1:
+        code.append(f'    lsl {dest}, {source}, #{shift}')
+    elif is_power_of_two(odd - 1):
+        code.append(f'    add {dest}, {source}, {source}, lsl #{(odd - 1).bit_length() - 1}')
+        if shift:
+            code.append(f'    lsl {dest}, {dest}, #{shift}')
+    else:
+        return None
+    if factor < 0:
+        code.append(f'    neg {dest}, {dest}')
+    return code if len(code) <= 2 else None
+
+
+def arm64_divide_by_constant(dest, source, divisor, scratch):
+    """ARM64: dest = source / divisor, rounded toward zero, with smulh or shifts instead of sdiv."""
+    if not reducible_divisor(divisor):
+        return None
+    magnitude = abs(divisor)
+    code = []
+    if magnitude == 1:
+        code.append(f'    mov {dest}, {source}')
+    elif is_power_of_two(magnitude):
+        shift = magnitude.bit_length() - 1
+        code.append(f'    asr {scratch}, {source}, #63')
+        code.append(f'    add {scratch}, {source}, {scratch}, lsr #{64 - shift}')
+        code.append(f'    asr {dest}, {scratch}, #{shift}')
+    else:
+        magic, shift = signed_magic(magnitude)
+        code.append(f'    ldr {scratch}, ={magic - 2**64 if magic >= 2**63 else magic}')
+        code.append(f'    smulh {scratch}, {source}, {scratch}')
+        if magic >= 2**63:
+            code.append(f'    add {scratch}, {scratch}, {source}')
+        if shift:
+            code.append(f'    asr {scratch}, {scratch}, #{shift}')
+        code.append(f'    add {dest}, {scratch}, {source}, lsr #63')
+    if divisor < 0:
+        code.append(f'    neg {dest}, {dest}')
+    return code
+
+
+def constant_value(node):
+    """The value of a literal, optionally negated, or None."""
+    sign = 1
+    while isinstance(node, UnaryOpNode) and node.op_token.type in (TT_PLUS, TT_MINUS):
+        if node.op_token.type == TT_MINUS:
+            sign = -sign
+        node = node.node
+    if isinstance(node, NumberNode):
+        value = sign * node.token.value
+        return value if -2**63 <= value < 2**63 else None
+    return None
+
+
+def displacement(offset):
+    """Address suffix for the qword offset elements further on."""
+    if offset > 0:
+        return f' + {8 * offset}'
+    if offset < 0:
+        return f' - {-8 * offset}'
+    return ''
+
+
+def scaled_index(base, index, offset):
+    """Address of element index + offset of an array of qwords at base."""
+    return f'{base} + {index}*8{displacement(offset)}'
+
+
+def constant_offset(index_node):
+    """Splits an index expression into (node, constant) for index + constant.
+
+    Array accesses fold the constant into the displacement of the address,
+    e.g. a[i + 1] becomes [base + i*8 + 8].
+    """
+    if (isinstance(index_node, BinOpNode) and index_node.op_token.type in (TT_PLUS, TT_MINUS)
+            and isinstance(index_node.right_node, NumberNode)):
+        value = index_node.right_node.token.value
+        offset = -value if index_node.op_token.type == TT_MINUS else value
+        if -2**31 <= 8 * offset < 2**31:
+            return index_node.left_node, offset
+    return index_node, 0
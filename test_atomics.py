@@ -0,0 +1,107 @@
+from compiler import compile_to_asm
+from testutil import OUTPUT
+from x86_simulator import X86Simulator
+
+PROGRAM = """
+threaded function bump(n)
+    i = 0
+    while i < n
+        atomic_add(hits, 1)
+        atomic_sub(misses, 2)
+        atomic_add(slots[i - i / 4 * 4], 1)
+        i = i + 1
+    end
+    return atomic_exchange(last, n)
+end
+function local_swap()
+    x = 5
+    a = atomic_compare_exchange(x, 4, 9)
+    b = atomic_compare_exchange(x, 5, 7)
+    return a * 100 + b * 10 + x
+end
+hits = 0
+misses = 0
+last = 0
+slots = new[4]
+h1 = bump(10)
+h2 = bump(20)
+h3 = bump(30)
+print join(h1) + join(h2) + join(h3)
+print hits
+print misses
+print slots[0] + slots[1] + slots[2] + slots[3]
+print local_swap()
+print atomic_compare_exchange(hits, 60, 0)
+print hits
+c = 1
+atomic_add(c, 41)
+print c
+"""
+
+# join(h1) is 0, join(h2) 10 and join(h3) 20: each call swaps its n into last in turn.
+EXPECTED = "30\n60\n-120\n60\n557\n60\n0\n42\n"
+
+LOOP = """
+function count(n)
+    c = 0
+    i = 0
+    while i < n
+        atomic_add(c, 2)
+        i = i + 1
+    end
+    return c
+end
+print count(7)
+"""
+
+
+def test_results():
+    for target in ('linux', 'windows'):
+        for opt_level in (0, 1, 2):
+            for backend in ('ast', 'ir'):
+                asm_code = compile_to_asm(PROGRAM, OUTPUT, target, opt_level=opt_level, backend=backend)
+                assert X86Simulator(asm_code, target).run() == EXPECTED, (target, opt_level, backend)
+
+
+def test_instructions():
+    for backend in ('ast', 'ir'):
+        asm_code = compile_to_asm(PROGRAM, OUTPUT, 'linux', backend=backend)
+        assert 'lock xadd qword [hits], rax' in asm_code and 'lock xadd qword [r8 + rdx*8], rax' in asm_code
+        assert 'xchg qword [last], rax' in asm_code and 'lock cmpxchg qword [hits], rcx' in asm_code
+    arm64 = compile_to_asm(LOOP, OUTPUT, 'arm64', backend='ir')
+    assert 'ldaxr x0, [x1]' in arm64 and 'stlxr w5, x4, [x1]' in arm64 and 'lock' not in arm64
+
+
+def test_target_stays_in_memory():
+    # i goes to a register for the loop; c, which the atomic changes, stays in the frame.
+    for target in ('linux', 'windows'):
+        asm_code = compile_to_asm(LOOP, OUTPUT, target, opt_level=1)
+        body = asm_code[asm_code.index('WHILE_START_0:'):asm_code.index('WHILE_END_0:')]
+        assert 'lock xadd qword [rbp - ' in body and 'add rbx, 1' in body
+        assert X86Simulator(asm_code, target).run() == "14\n"
+
+
+def test_errors():
+    for source, message in (("atomic_add(1, 2)", "variable or array element"),
+                            ("x = 0\natomic_compare_exchange(x, 1)", "2 values"),
+                            ("function atomic_add(x)\n    return x\nend", "built-in")):
+        try:
+            compile_to_asm(source, OUTPUT, 'linux')
+        except Exception as error:
+            assert message in str(error), error
+        else:
+            raise AssertionError(source)
+    try:
+        compile_to_asm("atomic_add(x, 1)", OUTPUT, 'arm64', backend='ast')
+    except Exception as error:
+        assert 'IR backend' in str(error)
+    else:
+        raise AssertionError('arm64')
+
+
+if __name__ == '__main__':
+    test_results()
+    test_instructions()
+    test_target_stays_in_memory()
+    test_errors()
+    print("All atomics tests passed!")
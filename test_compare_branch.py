@@ -0,0 +1,99 @@
+import re
+
+from code_generator import CodeGenerator, LinuxCodeGenerator, RISCCodeGenerator
+from testutil import generate
+from x86_simulator import X86Simulator
+
+CONDITIONS = """
+i = 0
+hits = 0
+while i < 12
+    if i == 3
+        hits = hits + 1
+    end
+    if i != 4
+        hits = hits + 10
+    end
+    if i > 9
+        hits = hits + 100
+    else
+        hits = hits + 1000
+    end
+    if i <= 2
+        hits = hits + 10000
+    end
+    if i * 2 >= i + 8
+        hits = hits + 100000
+    end
+    i = i + 1
+end
+print hits
+print i == 12
+print (i < 3) + (i >= 12)
+"""
+EXPECTED = f"{1 + 11 * 10 + 2 * 100 + 10 * 1000 + 3 * 10000 + 4 * 100000}\n1\n1\n"
+
+VALUE_CONDITIONS = """
+function three()
+    return 3
+end
+n = 3
+while n
+    n = n - 1
+    print n
+end
+if three() > n
+    print 7
+end
+"""
+
+# (generator class, simulator abi, generator options)
+CONFIGURATIONS = [
+    (LinuxCodeGenerator, 'linux', {'register_allocation': False}),
+    (LinuxCodeGenerator, 'linux', {}),
+    (CodeGenerator, 'windows', {}),
+]
+
+
+def test_conditions_branch_on_flags():
+    for generator_class, abi, options in CONFIGURATIONS:
+        asm_code = generate(CONDITIONS, generator_class, **options)
+        assert X86Simulator(asm_code, abi).run() == EXPECTED, options
+        # Only the three printed comparisons materialise a boolean.
+        assert len(re.findall(r'^    set', asm_code, re.M)) == 3, options
+        assert 'cmp rax, 0' not in asm_code
+        for jump in ('jge', 'jne', 'je', 'jle', 'jg', 'jl'):
+            assert f'    {jump} ' in asm_code, (jump, options)
+
+
+def test_loop_condition_on_register():
+    asm_code = generate("j = 0\nwhile j < 1000\n    j = j + 1\nend\nprint j", LinuxCodeGenerator)
+    lines = asm_code.splitlines()
+    start = lines.index('WHILE_START_0:')
+    # The loop is rotated: guard in front, test at the bottom.
+    assert lines[start - 2:start] == ['    cmp rbx, 1000', '    jge WHILE_END_0']
+    assert lines[start + 1:start + 5] == ['    add rbx, 1', '    cmp rbx, 1000', '    jl WHILE_START_0', 'WHILE_END_0:']
+
+
+def test_value_conditions():
+    for generator_class, abi, options in CONFIGURATIONS[1:]:
+        asm_code = generate(VALUE_CONDITIONS, generator_class, **options)
+        assert X86Simulator(asm_code, abi).run() == "2\n1\n0\n7\n", options
+        assert '    test rax, rax' in asm_code
+
+
+def test_arm64():
+    asm_code = generate("a = 1\nif a < 2\n    print 3\nend\nb = 4\nprint b >= 5", RISCCodeGenerator)
+    lines = asm_code.splitlines()
+    index = lines.index('    cmp x2, x3')
+    assert lines[index + 1] == '    b.ge ENDIF_0'
+    assert '    cset x0, ge' in lines and 'a: .skip 8' in lines
+    assert not any(line.strip().startswith(('jmp', 'je ')) or 'rax' in line for line in lines)
+
+
+if __name__ == '__main__':
+    test_conditions_branch_on_flags()
+    test_loop_condition_on_register()
+    test_value_conditions()
+    test_arm64()
+    print("All compare-and-branch tests passed!")
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import time
+
+from compile_cache import CompilationCache
+
+
+def compile_with(cache, source, target='linux-x86_64', asm_name='out.asm'):
+    from compiler import compile_to_asm
+    path = os.path.join(cache.directory, '..', asm_name)
+    return compile_to_asm(source, path, target=target, cache=cache)
+
+
+def test_hit_skips_compilation():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = CompilationCache(os.path.join(tmp, 'cache'))
+        first = compile_with(cache, "a = 5\nprint a * 3")
+        second = compile_with(cache, "a = 5\nprint a * 3")
+        assert first == second
+        assert (cache.hits, cache.misses, cache.stores) == (1, 1, 1)
+        # A different source or target is a different entry.
+        compile_with(cache, "a = 6\nprint a * 3")
+        compile_with(cache, "a = 5\nprint a * 3", target='windows-x86_64')
+        assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_key_depends_on_all_inputs():
+    base = CompilationCache.key("print 1", "linux-x86_64", "1")
+    assert base == CompilationCache.key("print 1", "linux-x86_64", "1")
+    assert base != CompilationCache.key("print 2", "linux-x86_64", "1")
+    assert base != CompilationCache.key("print 1", "arm64", "1")
+    assert base != CompilationCache.key("print 1", "linux-x86_64", "2")
+
+
+def test_lru_eviction():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = CompilationCache(tmp, max_bytes=10**9)
+        for name in ('a', 'b', 'c'):
+            cache.put(name, None, 'x' * 1000)
+            time.sleep(0.01)
+        assert cache.get('a') is not None   # 'a' becomes the most recently used
+        cache.max_bytes = sum(size for _, size, _ in cache.entries()) - 1
+        cache.evict()
+        assert cache.get('b') is None
+        assert cache.get('a') is not None and cache.get('c') is not None
+        assert cache.evictions == 1
+
+
+def test_corrupt_entry_is_a_miss():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = CompilationCache(tmp)
+        cache.put('k', None, 'asm')
+        with open(cache._path('k'), 'wb') as f:
+            f.write(b'not a pickle')
+        assert cache.get('k') is None
+        assert not os.path.exists(cache._path('k'))
+
+
+if __name__ == '__main__':
+    test_hit_skips_compilation()
+    test_key_depends_on_all_inputs()
+    test_lru_eviction()
+    test_corrupt_entry_is_a_miss()
+    print("All cache tests passed!")
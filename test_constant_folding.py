@@ -0,0 +1,78 @@
+from compiler import compile_to_asm
+from constant_folding import ConstantFolder, wrap64
+from nodes import NumberNode, VarAccessNode, BinOpNode
+from testutil import OUTPUT, parse
+
+
+def fold(source, **options):
+    return ConstantFolder(**options).fold(parse(source))
+
+
+def test_literal_expressions():
+    ast = fold("print 5 * 3 - 10\nprint -(2 + 2)\nprint 7 / -2\nprint 3 < 4")
+    assert [node.value_node.token.value for node in ast] == [5, -4, -3, 1]
+
+
+def test_propagation_through_assignments():
+    ast = fold("a = 4\nb = a * 2\nprint a + b")
+    assert ast[1].value_node.token.value == 8
+    assert ast[2].value_node.token.value == 12
+
+
+def test_loop_forgets_assigned_variables():
+    ast = fold("i = 0\nn = 10\nwhile i < n\n  i = i + 1\nend\nprint i")
+    loop = ast[2]
+    assert isinstance(loop.condition_node.left_node, VarAccessNode)
+    assert loop.condition_node.right_node.token.value == 10
+    assert isinstance(ast[3].value_node, VarAccessNode)
+
+
+def test_if_merges_branches():
+    ast = fold("a = 1\nb = 2\nif x > 0\n  a = 3\nelse\n  a = 3\n  b = 5\nend\nprint a\nprint b")
+    assert ast[3].value_node.token.value == 3
+    assert isinstance(ast[4].value_node, VarAccessNode)
+    # A constant condition only takes one branch.
+    ast = fold("a = 1\nif 1\n  a = 2\nend\nprint a")
+    assert ast[2].value_node.token.value == 2
+
+
+def test_calls_forget_what_functions_assign():
+    ast = fold("function f()\n  a = 9\nend\na = 1\nb = 2\nf()\nprint a\nprint b")
+    assert isinstance(ast[4].value_node, VarAccessNode)
+    assert ast[5].value_node.token.value == 2
+    # Without the whole program any global may change.
+    ast = fold("b = 2\nf()\nprint b", whole_program=False)
+    assert isinstance(ast[2].value_node, VarAccessNode)
+
+
+def test_threaded_variables_not_propagated():
+    ast = fold("threaded function t()\n  s = 1 + 1\n  print s\nend\ns = 4\nprint s")
+    body = ast[0].body_nodes
+    assert body[0].value_node.token.value == 2
+    assert isinstance(body[1].value_node, VarAccessNode)
+    assert isinstance(ast[2].value_node, VarAccessNode)
+
+
+def test_trapping_division_kept():
+    ast = fold("print 1 / 0")
+    assert isinstance(ast[0].value_node, BinOpNode)
+    assert wrap64(2**63) == -2**63 and wrap64(-2**63 - 1) == 2**63 - 1
+
+
+def test_opt_levels():
+    source = "a = 6\nb = a * 7\nprint b"
+    assert 'mov rsi, 42' in compile_to_asm(source, OUTPUT, target='linux', opt_level=2)
+    assert 'mov rsi, 42' not in compile_to_asm(source, OUTPUT, target='linux', opt_level=1)
+    assert isinstance(fold("print 2")[0].value_node, NumberNode)
+
+
+if __name__ == '__main__':
+    test_literal_expressions()
+    test_propagation_through_assignments()
+    test_loop_forgets_assigned_variables()
+    test_if_merges_branches()
+    test_calls_forget_what_functions_assign()
+    test_threaded_variables_not_propagated()
+    test_trapping_division_kept()
+    test_opt_levels()
+    print("All constant folding tests passed!")
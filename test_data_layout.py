@@ -0,0 +1,119 @@
+from code_generator import CodeGenerator, LinuxCodeGenerator
+from compiler import compile_to_asm
+from data_layout import CACHE_LINE, arrange, thread_writers
+from testutil import OUTPUT, parse
+from x86_simulator import X86Simulator
+
+PROGRAM = """
+function bump(x)
+    hits = hits + x
+    return hits
+end
+threaded function left(n)
+    i = 0
+    while i < n
+        a = a + scale
+        i = i + 1
+    end
+    return bump(1)
+end
+threaded function right(n)
+    i = 0
+    while i < n
+        b = b + scale
+        i = i + 1
+    end
+    return 0
+end
+scale = 2
+a = 0
+b = 0
+hits = 0
+k = 5
+h1 = left(10)
+h2 = right(k)
+print join(h1) + join(h2)
+print a
+print b
+print scale + hits + k
+"""
+
+EXPECTED = "1\n20\n10\n8\n"
+
+
+def lines_of(asm_code, target, names):
+    simulator = X86Simulator(asm_code, target)
+    simulator.run()
+    return {name: simulator.symbols[name] // CACHE_LINE for name in names}
+
+
+def test_thread_writers():
+    writers = thread_writers(parse(PROGRAM))
+    # left writes hits through bump, which runs on its thread; scale is only read.
+    assert writers == {'a': {'left'}, 'hits': {'left'}, 'b': {'right'}}, writers
+
+
+def test_arrange():
+    declarations = [(name, f'{name}: resq 1') for name in 'pqrst']
+    assert arrange(declarations, {}, set(), 'alignb 64') == [line for _, line in declarations]
+    lines = arrange(declarations, {'q': {'f'}, 's': {'g'}, 't': {'f'}}, {'r'}, 'alignb 64')
+    assert lines == ['p: resq 1', 'alignb 64', 'r: resq 1', 'alignb 64', 'q: resq 1', 't: resq 1',
+                     'alignb 64', 's: resq 1', 'alignb 64']
+
+
+def test_results():
+    for target in ('linux', 'windows'):
+        for opt_level in (0, 1, 2):
+            for backend in ('ast', 'ir'):
+                asm_code = compile_to_asm(PROGRAM, OUTPUT, target, opt_level=opt_level, backend=backend)
+                assert X86Simulator(asm_code, target).run() == EXPECTED, (target, opt_level, backend)
+        asm_code = compile_to_asm(PROGRAM, OUTPUT, target, jobs=2)
+        assert X86Simulator(asm_code, target).run() == EXPECTED, target
+
+
+def test_lines():
+    names = ('a', 'b', 'hits', 'scale', 'k', 'h1', 'h2')
+    for target in ('linux', 'windows'):
+        for options in ({'backend': 'ast'}, {'backend': 'ir'}, {'jobs': 2}):
+            line = lines_of(compile_to_asm(PROGRAM, OUTPUT, target, **options), target, names)
+            # Each thread's counters, the read-mostly scale and main's own variables are on different lines.
+            assert line['a'] == line['hits'], (target, options)
+            assert len({line['a'], line['b'], line['scale'], line['k']}) == 4, (target, options)
+            assert line['k'] == line['h1'] == line['h2'], (target, options)
+
+
+def test_runtime_lines():
+    asm_code = compile_to_asm(PROGRAM.replace('a = a + scale', 'lock l\n a = a + scale\n end'), OUTPUT, 'linux')
+    simulator = X86Simulator(asm_code, 'linux')
+    simulator.run()
+    symbols = simulator.symbols
+    for name in ('hive_lock_l', 'hive_queue', 'hive_queue_head', 'hive_queue_tail', 'hive_pending'):
+        assert symbols[name] % CACHE_LINE == 0, name
+    assert symbols['hive_queue_tail'] // CACHE_LINE != symbols['hive_queue_head'] // CACHE_LINE
+
+
+def test_disabled():
+    ast = parse(PROGRAM)
+    for generator_class, abi in ((LinuxCodeGenerator, 'linux'), (CodeGenerator, 'windows')):
+        asm_code = generator_class(cache_line_layout=False).generate(ast)
+        bss = asm_code[asm_code.index('section .bss'):asm_code.index('section .text', asm_code.index('section .bss'))]
+        assert 'alignb' not in bss
+        assert X86Simulator(asm_code, abi).run() == EXPECTED, abi
+        assert 'alignb 64' in generator_class().generate(ast)
+
+
+def test_arm64():
+    arm64 = compile_to_asm("threaded function f()\n    c = c + 1\nend\nc = 0\nk = 1\nf()\n", OUTPUT, 'arm64',
+                           backend='ir')
+    assert 'k: .skip 8\n.balign 64\nc: .skip 8\n.balign 64' in arm64
+
+
+if __name__ == '__main__':
+    test_thread_writers()
+    test_arrange()
+    test_results()
+    test_lines()
+    test_runtime_lines()
+    test_disabled()
+    test_arm64()
+    print("All data layout tests passed!")
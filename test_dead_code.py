@@ -0,0 +1,124 @@
+from code_generator import LinuxCodeGenerator
+from compiler import compile_to_asm
+from dead_code import DeadCodeEliminator, live_functions, read_variables
+from test_peephole import CORPUS
+from testutil import OUTPUT, parse
+from x86_simulator import X86Simulator
+
+LIBRARY = """
+function square(x)
+    return x * x
+end
+function cube(x)
+    return x * square(x)
+end
+function unused(x)
+    return cube(x) + 1
+end
+function bump()
+    calls = calls + 1
+    return calls
+end
+threaded function worker()
+    done = 1
+end
+threaded function idle()
+    done = 2
+end
+function early(n)
+    if n > 0
+        return n
+        print 99
+    end
+    return 0
+    n = n + 1
+    print n
+end
+"""
+
+PROGRAM = LIBRARY + """
+calls = 0
+done = 0
+tmp = 3
+s = 0
+k = 0
+while k < 4
+    s = s + k
+    k = k + 1
+end
+ignored = bump() + 1
+if 0
+    print 1000
+else
+    print cube(3)
+end
+while 0
+    print 2000
+end
+worker()
+print early(5)
+print calls
+print done
+"""
+
+
+def eliminate(source):
+    eliminator = DeadCodeEliminator()
+    return eliminator, eliminator.eliminate(parse(source))
+
+
+def test_functions():
+    nodes = parse(PROGRAM)
+    # unused calls cube, but nothing calls unused; idle is never started.
+    assert live_functions(nodes) == {'square', 'cube', 'bump', 'worker', 'early'}
+    eliminator, nodes = eliminate(PROGRAM)
+    names = [node.func_name_token.value for node in nodes if type(node).__name__ == 'FunctionDefNode']
+    assert names == ['square', 'cube', 'bump', 'worker', 'early']
+    assert eliminator.removed_functions == 2
+    asm_code = LinuxCodeGenerator().generate(nodes)
+    assert 'FUNC_unused' not in asm_code and 'FUNC_idle' not in asm_code
+
+
+def test_statements_and_stores():
+    eliminator, nodes = eliminate(PROGRAM)
+    early = next(node for node in nodes if type(node).__name__ == 'FunctionDefNode'
+                 and node.func_name_token.value == 'early')
+    # print 99 after the first return; n = n + 1 and print n after the second.
+    assert [type(node).__name__ for node in early.body_nodes] == ['IfNode', 'ReturnNode']
+    assert len(early.body_nodes[0].true_statements) == 1
+    # tmp, s (only read by s = s + k) and ignored; the call in bump() + 1 still runs.
+    assert eliminator.removed_stores == 4
+    assert eliminator.removed_statements == 5
+    assert eliminator.format_stats() == "2 functions, 5 unreachable statements and 4 stores removed"
+    asm_code = LinuxCodeGenerator().generate(nodes)
+    # Less the thread pool's queue and counters.
+    bss = {line.split(':')[0] for line in asm_code.splitlines() if 'resq' in line and not line.startswith('hive_')}
+    assert bss == {'calls', 'done', 'k'}
+    assert X86Simulator(asm_code, 'linux').run() == "27\n5\n1\n1\n"
+    assert read_variables(parse("a = 1\nb = a\nc = c + b\nl = new[2]\nl[0] = 1")) == {'a', 'b', 'l'}
+
+
+def test_output_unchanged():
+    for source in CORPUS + [PROGRAM]:
+        expected = X86Simulator(compile_to_asm(source, OUTPUT, 'linux', opt_level=1), 'linux').run()
+        for target in ('linux', 'windows'):
+            for backend in ('ast', 'ir'):
+                asm_code = compile_to_asm(source, OUTPUT, target, opt_level=2, backend=backend)
+                assert X86Simulator(asm_code, target).run() == expected, (target, backend, source)
+
+
+def test_compiler_levels():
+    assert 'FUNC_unused' in compile_to_asm(PROGRAM, OUTPUT, 'linux', opt_level=1)
+    asm_code = compile_to_asm(PROGRAM, OUTPUT, 'linux', opt_level=2)
+    assert 'FUNC_unused' not in asm_code and 'tmp: resq 1' not in asm_code
+    # Compiled in parts, a unit cannot know who calls its functions.
+    asm_code = compile_to_asm(PROGRAM, OUTPUT, 'linux', opt_level=2, jobs=2)
+    assert 'FUNC_unused:' in asm_code and 'FUNC_idle:' in asm_code
+
+
+if __name__ == '__main__':
+    test_functions()
+    test_statements_and_stores()
+    test_output_unchanged()
+    test_compiler_levels()
+    print("All dead code tests passed!")
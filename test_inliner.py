@@ -0,0 +1,174 @@
+from code_generator import CodeGenerator, LinuxCodeGenerator
+from compiler import compile_to_asm
+from inliner import Inliner, recursive_functions, returns_at_end
+from test_peephole import CORPUS
+from testutil import OUTPUT, parse
+from x86_simulator import X86Simulator
+
+FUNCTIONS = """
+function add(a, b)
+    return a + b
+end
+function clamp(x)
+    if x > 10
+        return 10
+    else
+        return x
+    end
+end
+function reset()
+    i = 9
+end
+function fact(n)
+    if n < 2
+        return 1
+    else
+        return n * fact(n - 1)
+    end
+end
+function first_over(limit)
+    k = 0
+    while k < 100
+        if k * k > limit
+            return k
+        end
+        k = k + 1
+    end
+    return 0
+end
+"""
+
+PROGRAMS = [
+    FUNCTIONS + """
+i = 0
+j = 0
+while j < 5
+    i = i + 1
+    j = j + 1
+    reset()
+    print i
+end
+n = 0
+while n < 15
+    print clamp(add(n, 1))
+    n = n + 4
+end
+print fact(5)
+print first_over(50)
+a = 3
+b = add(a, a * 2)
+print b
+c = add(2, 3) * 2
+print c
+""",
+    """
+function twice(v)
+    return v * 2
+end
+function quad(w)
+    return twice(twice(w))
+end
+function show(s)
+    print s
+end
+show(quad(3))
+threaded function later()
+    t = 1
+end
+later()
+t = 0
+print t + quad(1)
+""",
+]
+
+
+def calls(nodes, name):
+    return sum(1 for line in LinuxCodeGenerator().generate(nodes).splitlines() if line == f'    call FUNC_{name}')
+
+
+def test_output_unchanged():
+    for source in CORPUS + PROGRAMS:
+        expected = X86Simulator(compile_to_asm(source, OUTPUT, 'linux', opt_level=1), 'linux').run()
+        for backend in ('ast', 'ir'):
+            asm_code = compile_to_asm(source, OUTPUT, 'linux', opt_level=2, backend=backend)
+            assert X86Simulator(asm_code, 'linux').run() == expected, (backend, source)
+        asm_code = compile_to_asm(source, OUTPUT, 'windows', opt_level=2)
+        assert X86Simulator(asm_code, 'windows').run() == expected, source
+
+
+def test_calls_inlined():
+    inliner = Inliner()
+    nodes = inliner.inline(parse(PROGRAMS[0]))
+    for name in ('reset', 'clamp'):
+        assert calls(nodes, name) == 0, name
+    # Recursive, and returning from inside a loop.
+    assert calls(nodes, 'fact') == 2
+    assert calls(nodes, 'first_over') == 1
+    assert calls(nodes, 'add') == 1  # add(2, 3) inside a larger expression
+    nodes = Inliner().inline(parse(PROGRAMS[1]))
+    # quad(1) inside t + quad(1) keeps its call; the threaded call still starts a thread.
+    assert calls(nodes, 'twice') == 0 and calls(nodes, 'quad') == 1
+    assert 'CreateThread' in CodeGenerator().generate(nodes)
+
+
+def test_loop_without_call_keeps_registers():
+    source = FUNCTIONS + "i = 0\nj = 0\nwhile j < 1000\n    i = i + 1\n    j = j + 1\n    reset()\nend\nprint i"
+    plain = LinuxCodeGenerator().generate(parse(source))
+    inlined = LinuxCodeGenerator().generate(Inliner().inline(parse(source)))
+    assert '    call FUNC_reset' in plain and '    call FUNC_reset' not in inlined
+    # With the call gone the loop variables live in callee-saved registers.
+    assert 'add rbx, 1' not in plain and 'add rbx, 1' in inlined
+
+
+def test_parameters_renamed():
+    source = FUNCTIONS + "a = 3\nb = add(a, a * 2)\nprint b\nprint a"
+    nodes = Inliner().inline(parse(source))
+    assert calls(nodes, 'add') == 0
+    # add's a and b become add.0.a and add.0.b, so a = a; b = a * 2 cannot clobber the caller's a.
+    asm_code = LinuxCodeGenerator().generate(nodes)
+    assert 'add.0.a: resq 1' in asm_code
+    assert X86Simulator(asm_code, 'linux').run() == "9\n3\n"
+    # Inlined into a function, the callee's variables are locals of the caller's frame.
+    source = FUNCTIONS + "function g(a)\n    s = add(a, 1)\n    return s * a\nend\nprint g(4) + 1"
+    asm_code = LinuxCodeGenerator().generate(Inliner().inline(parse(source)))
+    assert '    call FUNC_add' not in asm_code and 'resq' not in asm_code
+    assert X86Simulator(asm_code, 'linux').run() == "21\n"
+
+
+def test_size_limit():
+    body = "\n".join(f"    s = s + {k}" for k in range(8))
+    source = f"function big()\n{body}\nend\ns = 0\nbig()\nk = 0\nwhile k < 2\n    big()\n    k = k + 1\nend\nprint s"
+    inliner = Inliner(max_nodes=30)
+    nodes = inliner.inline(parse(source))
+    # 40 nodes: too big for a straight call, small enough inside a loop.
+    assert inliner.inlined == 1 and calls(nodes, 'big') == 1
+    assert X86Simulator(LinuxCodeGenerator().generate(nodes), 'linux').run() == "84\n"
+
+
+def test_analysis():
+    definitions = {node.func_name_token.value: node for node in parse(FUNCTIONS + PROGRAMS[1])
+                   if type(node).__name__ == 'FunctionDefNode'}
+    assert recursive_functions(definitions) == {'fact'}
+    assert returns_at_end(definitions['clamp'].body_nodes)
+    assert returns_at_end(definitions['fact'].body_nodes)
+    assert not returns_at_end(definitions['first_over'].body_nodes)
+    assert not returns_at_end(definitions['reset'].body_nodes)
+
+
+def test_parallel_units_not_inlined():
+    expected = X86Simulator(compile_to_asm(PROGRAMS[1], OUTPUT, 'linux', opt_level=0), 'linux').run()
+    asm_code = compile_to_asm(PROGRAMS[1], OUTPUT, 'linux', opt_level=2, jobs=2)
+    assert X86Simulator(asm_code, 'linux').run() == expected
+    # Each unit only sees its own functions, so nothing is inlined; the outer twice is a tail call.
+    assert asm_code.count('    call FUNC_twice') == 1 and asm_code.count('    jmp FUNC_twice') == 1
+
+
+if __name__ == '__main__':
+    test_output_unchanged()
+    test_calls_inlined()
+    test_loop_without_call_keeps_registers()
+    test_parameters_renamed()
+    test_size_limit()
+    test_analysis()
+    test_parallel_units_not_inlined()
+    print("All inliner tests passed!")
@@ -0,0 +1,141 @@
+from code_generator import CodeGenerator, LinuxCodeGenerator
+from compiler import compile_to_asm, default_backend
+from instruction_selection import get_selector
+from ir import Temp, fold_constant_branches, lower, merge_blocks, remove_unreachable_blocks, simplify
+from test_peephole import CORPUS
+from testutil import OUTPUT, generate, parse
+from x86_simulator import X86Simulator
+
+
+def lower_source(source):
+    return lower(parse(source))
+
+
+def test_dump():
+    module = lower_source("a = 2\nb = a * -3\nprint b")
+    assert module.dump() == (
+        "global @a : scalar\n"
+        "global @b : scalar\n"
+        "\n"
+        "function main():\n"
+        "  B0:\n"
+        "    store @a, 2\n"
+        "    %0 = load @a\n"
+        "    %1 = neg 3\n"
+        "    %2 = mul %0, %1\n"
+        "    store @b, %2\n"
+        "    %3 = load @b\n"
+        "    print %3\n"
+        "    ret 0\n")
+
+
+def test_control_flow_graph():
+    module = lower_source("""
+function sign(x)
+    if x < 0
+        return -1
+    else
+        return 1
+    end
+end
+i = 0
+while i < 3
+    print sign(i - 1)
+    i = i + 1
+end
+""")
+    sign = module.functions['sign']
+    assert sign.params == ['x']
+    assert [block.label for block in sign.blocks] == ['B0', 'THEN1', 'ELSE2', 'ENDIF3']
+    assert sign.blocks[0].successors() == ['THEN1', 'ELSE2']
+    # Both branches return, so nothing reaches ENDIF.
+    assert sign.predecessors()['ENDIF3'] == []
+    main = module.functions['main']
+    assert list(module.functions) == ['sign', 'main']
+    assert main.predecessors()['WHILE1'] == ['B0', 'BODY2']
+    for function in module.functions.values():
+        for block in function.blocks:
+            assert block.terminator is not None, (function.name, block.label)
+            for instruction in block.instructions[:-1]:
+                assert instruction.op not in ('jump', 'branch', 'ret')
+
+
+def test_passes():
+    module = lower_source("""
+function f()
+    return 1
+    print 2
+end
+if 1
+    print f()
+else
+    print 3
+end
+""")
+    f, main = module.functions['f'], module.functions['main']
+    assert remove_unreachable_blocks(f)
+    assert all(instruction.op != 'print' for block in f.blocks for instruction in block.instructions)
+    assert fold_constant_branches(main)
+    assert main.blocks[0].terminator.args == ('THEN1',)
+    assert remove_unreachable_blocks(main)
+    assert merge_blocks(main)
+    assert len(main.blocks) == 1
+    assert not any([fold_constant_branches(main), remove_unreachable_blocks(main), merge_blocks(main)])
+    assert isinstance(main.blocks[0].instructions[0].dest, Temp)
+
+
+def test_selected_code_matches_ast_backends():
+    for target, abi, generator_class in (('linux-x86_64', 'linux', LinuxCodeGenerator),
+                                         ('windows-x86_64', 'windows', CodeGenerator)):
+        for source in CORPUS:
+            expected = X86Simulator(generate(source, generator_class), abi).run()
+            for peephole in (False, True):
+                module = lower_source(source)
+                if peephole:
+                    simplify(module)
+                asm_code = get_selector(target, peephole).select(module)
+                assert X86Simulator(asm_code, abi).run() == expected, (target, peephole, source)
+
+
+def test_arm64_selection():
+    asm_code = get_selector('arm64').select(simplify(lower_source(CORPUS[3])))
+    lines = asm_code.splitlines()
+    assert 'FUNC_add:' in lines and 'main:' in lines
+    assert '    bl FUNC_clamp' in lines and '    bl printf' in lines
+    # Globals are addressed through adrp/:lo12:, never as x86 memory operands.
+    assert not any('qword' in line or 'rax' in line for line in lines)
+    assert lines.count('    stp x29, x30, [sp, #-16]!') == 3
+
+
+def test_compiler_backend_flag():
+    source = "a = 5\nb = a / 2\nprint b + 1"
+    asm_code = compile_to_asm(source, OUTPUT, 'linux', backend='ir')
+    assert 'IR_main_B0:' in asm_code
+    assert X86Simulator(asm_code, 'linux').run() == '3\n'
+    assert 'IR_main_B0:' not in compile_to_asm(source, OUTPUT, 'linux')
+
+
+def test_arm64_default_backend():
+    # ARM64 goes through the IR unless the AST generator is asked for, which only handles straight-line code.
+    source = "function f(x)\n    return x + 1\nend\na = 5\nprint f(a)"
+    assert default_backend('arm64') == 'ir' and default_backend('linux-x86_64') == 'ast'
+    assert 'bl FUNC_f' in compile_to_asm(source, OUTPUT, 'arm64')
+    try:
+        compile_to_asm(source, OUTPUT, 'arm64', backend='ast')
+    except Exception as error:
+        assert 'IR backend' in str(error)
+    else:
+        raise AssertionError('functions on the ARM64 AST generator')
+    straight = compile_to_asm("a = 5\nprint a * 3", OUTPUT, 'arm64', backend='ast', opt_level=0).splitlines()
+    assert 'a: .skip 8' in straight and not any('rax' in line for line in straight)
+
+
+if __name__ == '__main__':
+    test_dump()
+    test_control_flow_graph()
+    test_passes()
+    test_selected_code_matches_ast_backends()
+    test_arm64_selection()
+    test_compiler_backend_flag()
+    test_arm64_default_backend()
+    print("All IR tests passed!")
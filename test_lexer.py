@@ -0,0 +1,95 @@
+import contextlib
+import io
+
+from lexer import Lexer, RegexLexer
+from parser import Parser
+from token_stream import TokenStream
+from token_types import TT_EOF, TT_EQ, TT_IDENTIFIER, TT_INT
+
+SOURCES = [
+    "print 5 * 3 - 10",
+    "a = 5\nb = 3\nc = a + b\nprint c\n",
+    """
+li = new[9]
+i = 10
+while i < 18
+ li[i-11] = i   # comment
+ print li[i-11]
+ i = i+1
+end
+delete li
+threaded function reset_i()
+   i = 9
+end
+function add(a, b)
+    return a + b
+end
+if add(i, 2) >= 2
+  print i == 3
+else
+  print (i != 4) <= 1
+end
+x = {1, 2}
+""",
+    "x = 1 $ y = 2",   # lexing stops at the first illegal character
+]
+
+
+def legacy_tokens(source):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Lexer(source).tokenize()
+
+
+def test_regex_lexer_matches_lexer():
+    """RegexLexer must produce exactly the Lexer token stream"""
+    for source in SOURCES:
+        expected = legacy_tokens(source)
+        result = RegexLexer(source).tokenize()
+        assert repr(result) == repr(expected), f"Failed: {source!r}"
+
+
+def test_invalid_bang():
+    for lexer_class in (Lexer, RegexLexer):
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                lexer_class("a ! b").tokenize()
+        except Exception as e:
+            assert "Invalid character '!'" in str(e)
+        else:
+            raise AssertionError(f"{lexer_class.__name__} accepted a lone '!'")
+
+
+def test_token_stream_lookahead():
+    stream = TokenStream(RegexLexer("a = 1").iter_tokens())
+    assert stream.next().type == TT_IDENTIFIER
+    assert stream.peek().type == TT_EQ
+    assert stream.peek(2).type == TT_INT
+    assert stream.next().type == TT_EQ
+    assert stream.retreat().type == TT_IDENTIFIER
+    assert stream.next().type == TT_EQ
+    stream.next()
+    assert stream.next().type == TT_EOF
+    assert stream.next().type == TT_EOF   # stays on EOF once drained
+    assert stream.peek(3).type == TT_EOF
+
+
+def test_parser_accepts_list_and_stream():
+    source = SOURCES[2].replace("x = {1, 2}", "")   # braces do not parse
+    with contextlib.redirect_stdout(io.StringIO()):
+        from_list = Parser(RegexLexer(source).tokenize()).parse()
+        from_stream = Parser(RegexLexer(source).iter_tokens()).parse()
+    assert [type(n).__name__ for n in from_list] == [type(n).__name__ for n in from_stream]
+
+
+def test_token_spans():
+    tokens = RegexLexer("a = 1\n  # note\n\nprint  a").tokenize()
+    assert [(t.line, t.col) for t in tokens] == [(1, 1), (1, 3), (1, 5), (4, 1), (4, 8), (4, 9)]
+
+
+if __name__ == '__main__':
+    test_regex_lexer_matches_lexer()
+    test_invalid_bang()
+    test_token_stream_lookahead()
+    test_parser_accepts_list_and_stream()
+    test_token_spans()
+    print("All lexer tests passed!")
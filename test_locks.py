@@ -0,0 +1,186 @@
+from code_generator import CodeGenerator, LinuxCodeGenerator
+from compiler import compile_to_asm
+from nodes import LockNode
+from testutil import OUTPUT, parse
+from x86_simulator import X86Simulator
+
+PROGRAM = """
+threaded function deposit(n)
+    i = 0
+    while i < n
+        lock bank
+            balance = balance + 1
+            moves = moves + 1
+        end
+        i = i + 1
+    end
+    return n
+end
+function raise_best(x)
+    lock best_lock
+        if x > best
+            best = x
+            return 1
+        end
+    end
+    return 0
+end
+balance = 0
+moves = 0
+best = 0
+h1 = deposit(10)
+h2 = deposit(20)
+print join(h1) + join(h2)
+print balance
+print moves
+print raise_best(5) + raise_best(3) + raise_best(7)
+print best
+lock bank
+    balance = balance * 2
+end
+print balance
+"""
+
+# raise_best returns from inside its lock block; a lock it kept would hang the next call.
+EXPECTED = "30\n30\n30\n2\n7\n60\n"
+STATS = "lock bank: 31 acquisitions, 0 contended\nlock best_lock: 3 acquisitions, 0 contended\n"
+
+# main holds total while add(5) starts, so the task has to wait for it.
+CONTENDED = """
+threaded function add(n)
+    lock total
+        sum = sum + n
+    end
+    return 0
+end
+sum = 0
+lock total
+    h = add(5)
+    sum = 10
+end
+x = join(h)
+print sum
+"""
+
+
+def test_parse():
+    node, = parse("lock totals\n    a = 1\n    lock inner\n        b = 2\n    end\nend")
+    assert isinstance(node, LockNode) and node.lock_name_token.value == 'totals'
+    assert len(node.body_nodes) == 2 and isinstance(node.body_nodes[1], LockNode)
+    for source, message in (("lock 3\nend", "lock name"), ("lock a\n    x = 1\n", "'end'")):
+        try:
+            parse(source)
+        except Exception as error:
+            assert message in str(error), error
+        else:
+            raise AssertionError(source)
+
+
+def test_results():
+    for target in ('linux', 'windows'):
+        for opt_level in (0, 1, 2):
+            for backend in ('ast', 'ir'):
+                asm_code = compile_to_asm(PROGRAM, OUTPUT, target, opt_level=opt_level, backend=backend)
+                simulator = X86Simulator(asm_code, target)
+                assert simulator.run() == EXPECTED, (target, opt_level, backend)
+                # Every lock was released again.
+                assert simulator.memory[simulator.symbols['hive_lock_bank']] == 0
+                assert simulator.memory[simulator.symbols['hive_lock_best_lock']] == 0
+        asm_code = compile_to_asm(PROGRAM, OUTPUT, target, jobs=2)
+        assert X86Simulator(asm_code, target).run() == EXPECTED, target
+
+
+def test_stats():
+    for target in ('linux', 'windows'):
+        for backend in ('ast', 'ir'):
+            asm_code = compile_to_asm(PROGRAM, OUTPUT, target, backend=backend, lock_stats=True)
+            assert X86Simulator(asm_code, target).run() == EXPECTED + STATS, (target, backend)
+        asm_code = compile_to_asm(PROGRAM, OUTPUT, target, jobs=2, lock_stats=True)
+        assert X86Simulator(asm_code, target).run() == EXPECTED + STATS, target
+    assert 'acquisitions' not in compile_to_asm(PROGRAM, OUTPUT, 'linux')
+
+
+def test_contended():
+    expected = "15\nlock total: 2 acquisitions, 1 contended\n"
+    for target in ('linux', 'windows'):
+        for backend in ('ast', 'ir'):
+            asm_code = compile_to_asm(CONTENDED, OUTPUT, target, backend=backend, lock_stats=True)
+            assert X86Simulator(asm_code, target).run() == expected, (target, backend)
+    # The task sleeps until main releases the lock.
+    for generator_class, abi in ((LinuxCodeGenerator, 'linux'), (CodeGenerator, 'windows')):
+        asm_code = generator_class(thread_pool=False, lock_stats=True).generate(parse(CONTENDED))
+        assert X86Simulator(asm_code, abi).run() == expected, abi
+
+
+def test_instructions():
+    linux = compile_to_asm(PROGRAM, OUTPUT, 'linux')
+    assert 'lock cmpxchg qword [rdi + 0], rcx' in linux and 'pause' in linux
+    assert 'xchg qword [rbx + 0], rax' in linux and 'call syscall' in linux
+    assert linux.count('    call hive_lock') == 3 and 'hive_lock_bank: resq 8' in linux
+    windows = compile_to_asm(PROGRAM, OUTPUT, 'windows')
+    assert 'call AcquireSRWLockExclusive' in windows and 'call ReleaseSRWLockExclusive' in windows
+    assert 'call TryAcquireSRWLockExclusive' not in windows and 'syscall' not in windows
+    assert 'call TryAcquireSRWLockExclusive' in compile_to_asm(PROGRAM, OUTPUT, 'windows', lock_stats=True)
+    assert 'hive_lock' not in compile_to_asm("print 1", OUTPUT, 'linux')
+
+
+def test_no_tail_call_inside_lock():
+    source = """
+function g(x)
+    return x + 1
+end
+function f(x)
+    lock l
+        return g(x)
+    end
+end
+print f(1)
+"""
+    for target in ('linux', 'windows'):
+        asm_code = compile_to_asm(source, OUTPUT, target, opt_level=1)
+        body = asm_code[asm_code.index('FUNC_f:'):]
+        assert 'jmp FUNC_g' not in body and 'call FUNC_g' in body
+        assert body.index('call FUNC_g') < body.index('call hive_unlock')
+        assert X86Simulator(asm_code, target).run() == "2\n"
+
+
+def test_globals_stay_in_memory():
+    # Another thread may change total while the loop does not hold the lock.
+    source = """
+total = 0
+i = 0
+while i < 10
+    lock l
+        total = total + i
+    end
+    i = i + 1
+end
+print total
+"""
+    for target in ('linux', 'windows'):
+        asm_code = compile_to_asm(source, OUTPUT, target, opt_level=1)
+        body = asm_code[asm_code.index('WHILE_START_0:'):asm_code.index('WHILE_END_0:')]
+        assert '[total]' in body
+        assert X86Simulator(asm_code, target).run() == "45\n"
+
+
+def test_arm64():
+    for backend in ('ast', 'ir'):
+        try:
+            compile_to_asm("lock l\n    x = 1\nend", OUTPUT, 'arm64', backend=backend)
+        except Exception as error:
+            assert 'not yet supported on ARM64' in str(error)
+        else:
+            raise AssertionError(backend)
+
+
+if __name__ == '__main__':
+    test_parse()
+    test_results()
+    test_stats()
+    test_contended()
+    test_instructions()
+    test_no_tail_call_inside_lock()
+    test_globals_stay_in_memory()
+    test_arm64()
+    print("All lock tests passed!")
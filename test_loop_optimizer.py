@@ -0,0 +1,141 @@
+from code_generator import CodeGenerator, LinuxCodeGenerator, RISCCodeGenerator
+from compiler import compile_to_asm
+from loop_optimizer import LoopUnroller, counted_loop, invariant_expressions, unroll_loop
+from test_peephole import CORPUS
+from testutil import OUTPUT, parse
+from x86_simulator import X86Simulator
+
+INVARIANTS = """
+a = new[8]
+n = 5
+s = 0
+i = 0
+while i < 8
+    a[i] = n * n + i
+    s = s + a[i] + (n + 3) * 2 - n / 2
+    i = i + 1
+end
+print s
+delete a
+"""
+
+LOOPS = [
+    INVARIANTS,
+    "i = 0\nwhile i < 0\n    print i\n    i = i + 1\nend\nprint i",
+    "i = 5\ns = 0\nwhile i <= 23\n    s = s + i\n    i = i + 3\nend\nprint s\nprint i",
+    """
+total = 0
+i = 0
+while i < 7
+    j = 0
+    while j < i
+        total = total + i * j
+        j = j + 1
+    end
+    i = i + 1
+end
+print total
+""",
+]
+
+
+def loop_lines(asm_code, number=0):
+    lines = asm_code.splitlines()
+    start = lines.index(f'WHILE_START_{number}:')
+    return lines[:start], lines[start:lines.index(f'WHILE_END_{number}:')]
+
+
+def test_rotation():
+    asm_code = LinuxCodeGenerator().generate(parse(LOOPS[2]))
+    before, loop = loop_lines(asm_code)
+    assert before[-1] == '    jg WHILE_END_0'
+    assert loop[-1] == '    jle WHILE_START_0'
+    assert '    jmp WHILE_START_0' not in asm_code
+    top_tested = LinuxCodeGenerator(loop_optimization=False).generate(parse(LOOPS[2]))
+    assert '    jmp WHILE_START_0' in top_tested
+
+
+def test_invariants_hoisted():
+    expected = X86Simulator(LinuxCodeGenerator(loop_optimization=False).generate(parse(INVARIANTS)), 'linux').run()
+    for generator_class, abi in ((LinuxCodeGenerator, 'linux'), (CodeGenerator, 'windows')):
+        asm_code = generator_class().generate(parse(INVARIANTS))
+        before, loop = loop_lines(asm_code)
+        assert any(line.endswith(', qword [a]') for line in before), abi
+        assert not any('qword [a]' in line for line in loop), abi
+        assert X86Simulator(asm_code, abi).run() == expected, abi
+    # Windows has callee-saved registers left for all three invariant expressions:
+    # n * n, (n + 3) * 2 and n / 2 are each computed once, in front of the loop.
+    assert not any(line.split()[0] in ('imul', 'shl', 'sar') or 'qword [n]' in line for line in loop)
+    assert len(loop) == 12
+
+
+def test_nothing_hoisted():
+    sources = [
+        # A call may assign n.
+        "function f()\n    return 1\nend\nn = 2\ni = 0\nwhile i < 3\n    i = i + n * n + f()\nend\nprint i",
+        # n is written by a threaded function.
+        "threaded function g()\n    n = 1\nend\nn = 2\ni = 0\nwhile i < 3\n    i = i + n * n\nend\nprint i",
+        # Division by a variable could trap where the loop would not run it.
+        "n = 0\ni = 0\nwhile i < 0\n    i = i + 7 / n\nend\nprint i",
+    ]
+    for source in sources:
+        loop = next(node for node in parse(source) if type(node).__name__ == 'WhileNode')
+        shared = {'n'} if 'threaded' in source else ()
+        assert invariant_expressions(loop, shared) == [], source
+    assert X86Simulator(LinuxCodeGenerator().generate(parse(sources[2])), 'linux').run() == "0\n"
+
+
+def test_counted_loops():
+    loops = [next(node for node in parse(source) if type(node).__name__ == 'WhileNode') for source in LOOPS]
+    assert counted_loop(loops[0]) == ('i', 1)
+    assert counted_loop(loops[2]) == ('i', 3)
+    assert counted_loop(loops[3]) is None  # has a nested loop
+    assert counted_loop(loops[0], {'i'}) is None
+    unrolled, remainder = unroll_loop(loops[2], 4, 3)
+    assert unrolled.condition_node.right_node.token.value == 23 - 9
+    assert len(unrolled.body_node) == 4 * len(loops[2].body_node)
+    assert remainder is loops[2]
+    # A bound near INT64_MIN, as constant folding leaves it, cannot be lowered by (factor - 1) * step.
+    loops[2].condition_node.right_node.token.value = -2**63 + 5
+    assert unroll_loop(loops[2], 2, 3) is not None
+    assert unroll_loop(loops[2], 3, 3) is None
+
+
+def test_unrolled_output():
+    for source in CORPUS + LOOPS:
+        expected = X86Simulator(LinuxCodeGenerator(loop_optimization=False).generate(parse(source)), 'linux').run()
+        for factor in (2, 3, 4, 5):
+            for generator_class, abi in ((LinuxCodeGenerator, 'linux'), (CodeGenerator, 'windows')):
+                unroller = LoopUnroller(factor)
+                asm_code = generator_class().generate(unroller.unroll(parse(source)))
+                assert X86Simulator(asm_code, abi).run() == expected, (factor, abi, source)
+    unroller = LoopUnroller(4)
+    unroller.unroll(parse(LOOPS[2] + LOOPS[3]))
+    # The outer loop of LOOPS[3] has a nested loop, and the inner one a variable bound.
+    assert unroller.unrolled == 1
+
+
+def test_compiler_flag():
+    for backend in ('ast', 'ir'):
+        asm_code = compile_to_asm(LOOPS[2], OUTPUT, 'linux', backend=backend, unroll=2)
+        assert X86Simulator(asm_code, 'linux').run() == "98\n26\n"
+    assert compile_to_asm(LOOPS[2], OUTPUT, 'linux', unroll=2).count('WHILE_START_') == 4
+
+
+def test_arm64():
+    asm_code = RISCCodeGenerator().generate(parse("n = 1\nwhile n > 2\n    print n\nend"))
+    before, loop = loop_lines(asm_code)
+    assert before[-1] == '    b.le WHILE_END_0'
+    assert loop[-1] == '    b.gt WHILE_START_0'
+    assert not any(line.strip() == 'b WHILE_START_0' or 'rax' in line for line in loop)
+
+
+if __name__ == '__main__':
+    test_rotation()
+    test_invariants_hoisted()
+    test_nothing_hoisted()
+    test_counted_loops()
+    test_unrolled_output()
+    test_compiler_flag()
+    test_arm64()
+    print("All loop optimizer tests passed!")
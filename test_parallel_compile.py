@@ -0,0 +1,77 @@
+import os
+import tempfile
+
+from compiler import compile_to_asm, split_top_level_functions
+
+SOURCE = """
+total = 0
+function clamp(x)
+    if x > 10
+        return 10
+    end
+    return x
+end
+threaded function worker()
+    n = 0
+    while n < 3
+        n = n + 1
+    end
+end
+i = 0
+while i < 20
+    total = total + clamp(i)
+    i = i + 1
+end
+worker()
+function twice(x) return x * 2 end print twice(total)
+"""
+
+
+def compile_source(source, jobs, target='linux'):
+    with tempfile.TemporaryDirectory() as tmp:
+        return compile_to_asm(source, os.path.join(tmp, 'out.asm'), target=target, jobs=jobs)
+
+
+def test_split_keeps_positions():
+    main_source, units = split_top_level_functions(SOURCE)
+    assert [(name, threaded) for name, threaded, _ in units] == [
+        ('clamp', False), ('worker', True), ('twice', False)]
+    assert main_source.count('\n') == SOURCE.count('\n')
+    assert 'function' not in main_source and 'print twice(total)' in main_source
+    # Each unit starts on its original line and column.
+    lines = SOURCE.split('\n')
+    for name, _, unit_source in units:
+        unit_lines = unit_source.split('\n')
+        row = len(unit_lines) - len(unit_source.lstrip('\n').split('\n'))
+        assert lines[row].startswith(unit_lines[row])
+    # The trailing statement keeps its column.
+    assert main_source.split('\n')[-2].index('print') == lines[-2].index('print')
+
+
+def test_parallel_matches_serial():
+    for target in ('linux', 'windows'):
+        serial = compile_source(SOURCE, 1, target)
+        parallel = compile_source(SOURCE, 3, target)
+        assert parallel == compile_source(SOURCE, 2, target)   # deterministic
+        assert len(parallel.splitlines()) == len(serial.splitlines())
+        assert 'F0_ENDIF_0:' in parallel and 'F1_WHILE_START_0:' in parallel
+        for line in ('FUNC_clamp:', 'FUNC_worker:', 'FUNC_twice:', 'total: resq 1', 'i: resq 1'):
+            assert line in parallel, line
+        # Parameters and the thread's counter live in the functions' frames.
+        assert 'n: resq 1' not in parallel and 'x: resq 1' not in parallel
+
+
+def test_worker_errors_propagate():
+    try:
+        compile_source("function f()\n    x = (1 +\nend\nprint 1\n", 2)
+    except Exception as e:
+        assert 'Unexpected token' in str(e) or 'Expected' in str(e), str(e)
+    else:
+        raise AssertionError("syntax error in a function unit was not reported")
+
+
+if __name__ == '__main__':
+    test_split_keeps_positions()
+    test_parallel_matches_serial()
+    test_worker_errors_propagate()
+    print("All parallel compilation tests passed!")
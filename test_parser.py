@@ -0,0 +1,80 @@
+import random
+
+from lexer import RegexLexer
+from nodes import (
+    ArrayAccessNode, BinOpNode, FunctionCallNode, NumberNode, UnaryOpNode, VarAccessNode,
+)
+from parser import Parser, RecursiveDescentParser
+
+OPERATORS = ['+', '-', '*', '/', '==', '!=', '<', '>', '<=', '>=']
+
+
+def shape(node):
+    """Nested tuples describing an expression tree."""
+    if isinstance(node, NumberNode):
+        return node.token.value
+    if isinstance(node, VarAccessNode):
+        return node.var_name_token.value
+    if isinstance(node, UnaryOpNode):
+        return (node.op_token.type, shape(node.node))
+    if isinstance(node, BinOpNode):
+        return (shape(node.left_node), node.op_token.type, shape(node.right_node))
+    if isinstance(node, ArrayAccessNode):
+        return ('index', node.var_name_token.value, [shape(i) for i in node.indexes])
+    if isinstance(node, FunctionCallNode):
+        return ('call', node.func_name_token.value, [shape(a) for a in node.arg_nodes])
+    raise AssertionError(f"unexpected node {node!r}")
+
+
+def parse_expression(parser_class, source):
+    return parser_class(RegexLexer(source).iter_tokens()).expression()
+
+
+def random_expression(rng, depth):
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice(['1', '42', 'a', 'b', 'li[i - 1]', 'f(a, 2)'])
+    roll = rng.random()
+    if roll < 0.15:
+        return rng.choice(['-', '+']) + random_expression(rng, depth - 1)
+    if roll < 0.3:
+        return '(' + random_expression(rng, depth - 1) + ')'
+    return (random_expression(rng, depth - 1) + ' ' + rng.choice(OPERATORS) + ' '
+            + random_expression(rng, depth - 1))
+
+
+def test_matches_recursive_descent():
+    """The precedence-climbing parser builds the same trees as the old grammar"""
+    rng = random.Random(1234)
+    sources = ["a - b - c", "a * -b + c", "-a * b", "- - 3", "1 < 2 < 3", "-(a + b) / 2",
+               "a + b * c == d - e / f", "f() + g(1, (2))"]
+    sources += [random_expression(rng, 6) for _ in range(300)]
+    for source in sources:
+        expected = shape(parse_expression(RecursiveDescentParser, source))
+        assert shape(parse_expression(Parser, source)) == expected, f"Failed: {source}"
+
+
+def test_deep_and_wide_expressions():
+    depth = 20000
+    node = parse_expression(Parser, '(' * depth + '1' + ')' * depth)
+    assert isinstance(node, NumberNode)
+    node = parse_expression(Parser, '-' * depth + '1')
+    assert isinstance(node, UnaryOpNode)
+    node = parse_expression(Parser, ' + '.join(['a'] * depth))
+    assert isinstance(node, BinOpNode) and isinstance(node.right_node, VarAccessNode)
+
+
+def test_errors():
+    for source, message in (("(1 + 2", "Expected ')'"), ("1 + )", "Unexpected token RPAREN")):
+        try:
+            parse_expression(Parser, source)
+        except Exception as e:
+            assert message in str(e), str(e)
+        else:
+            raise AssertionError(f"{source!r} parsed")
+
+
+if __name__ == '__main__':
+    test_matches_recursive_descent()
+    test_deep_and_wide_expressions()
+    test_errors()
+    print("All parser tests passed!")
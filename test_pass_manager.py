@@ -0,0 +1,77 @@
+from compiler import compile_to_asm
+from pass_manager import PassContext, PassManager, default_pass_manager, program_size
+from test_peephole import CORPUS
+from testutil import OUTPUT
+from x86_simulator import X86Simulator
+
+
+def test_levels():
+    for opt_level, expected in ((0, []), (1, ['peephole']), (2, ['inline', 'constant-folding', 'dead-code', 'peephole'])):
+        manager = default_pass_manager(opt_level)
+        compile_to_asm(CORPUS[1], OUTPUT, 'linux', opt_level=opt_level, passes=manager)
+        assert [record.name for record in manager.records] == expected, opt_level
+    manager = default_pass_manager(1)
+    compile_to_asm(CORPUS[1], OUTPUT, 'linux', passes=manager, backend='ir')
+    assert [record.name for record in manager.records] == ['simplify-cfg', 'value-numbering', 'tail-calls', 'peephole']
+
+
+def test_records():
+    manager = default_pass_manager(2)
+    compile_to_asm("a = 2 * 3\nb = a + 4\nprint b", OUTPUT, 'linux', opt_level=2, passes=manager)
+    inline, folding, dead_code, peephole = manager.records
+    assert inline.before == inline.after
+    # With a propagated into b = a + 4, nothing reads a any more.
+    assert dead_code.after < dead_code.before
+    assert (folding.stage, peephole.stage) == ('ast', 'asm')
+    assert folding.after < folding.before
+    assert peephole.after <= peephole.before
+    assert folding.seconds >= 0 and peephole.seconds >= 0
+    report = manager.format_report().splitlines()
+    assert report[0].split() == ['pass', 'stage', 'runs', 'ms', 'removed']
+    assert report[2].split()[:3] == ['constant-folding', 'ast', '1']
+
+
+def test_output_unchanged_at_every_level():
+    for source in CORPUS:
+        expected = X86Simulator(compile_to_asm(source, OUTPUT, 'linux', opt_level=0), 'linux').run()
+        for opt_level in (1, 2):
+            for backend in ('ast', 'ir'):
+                asm_code = compile_to_asm(source, OUTPUT, 'linux', opt_level=opt_level, backend=backend)
+                assert X86Simulator(asm_code, 'linux').run() == expected, (opt_level, backend, source)
+
+
+def test_registration_order():
+    calls = []
+    def record(name):
+        def run(lines, context):
+            calls.append(name)
+            return lines[1:]
+        return run
+    manager = PassManager(1)
+    manager.register('first', 'asm', 1, record('first'))
+    manager.register('last', 'asm', 1, record('last'))
+    manager.register('second', 'asm', 1, record('second'), before='last')
+    manager.register('expensive', 'asm', 2, record('expensive'))
+    lines = manager.run('asm', ['    nop'] * 5, PassContext('linux-x86_64'))
+    assert calls == ['first', 'second', 'last']
+    assert len(lines) == 2
+    assert [(r.before, r.after) for r in manager.records] == [(5, 4), (4, 3), (3, 2)]
+    try:
+        manager.register('first', 'ast', 1, record('first'))
+    except Exception as e:
+        assert 'already registered' in str(e)
+    else:
+        assert False, "duplicate pass names must be rejected"
+
+
+def test_program_size():
+    assert program_size('asm', ['main:', '    mov rax, 1', 'section .bss', '    ret']) == 2
+
+
+if __name__ == '__main__':
+    test_levels()
+    test_records()
+    test_output_unchanged_at_every_level()
+    test_registration_order()
+    test_program_size()
+    print("All pass manager tests passed!")
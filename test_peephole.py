@@ -0,0 +1,132 @@
+from code_generator import CodeGenerator, LinuxCodeGenerator, RISCCodeGenerator
+from peephole import PEEPHOLE_RULES, PeepholeOptimizer, jump_to_next_label
+from testutil import generate
+from x86_simulator import X86Simulator
+
+# Programs whose printed output must not change when the peephole rules run.
+CORPUS = [
+    "print 5 * 3 - 10\nprint 7 / -2\nprint -(4 + 4) * 8\nprint 3 <= 3\nprint 2 != 2",
+    "a = 6\nb = a * 4\nc = b / a - 1\nprint c\nprint a * 16 + b * 2",
+    """
+li = new[9]
+i = 10
+while i < 18
+ li[i-10] = i * 8
+ print li[i-10]
+ i = i + 1
+end
+delete li
+""",
+    """
+function add(a, b)
+    return a + b
+end
+function clamp(x)
+    if x > 10
+        return 10
+    else
+        return x
+    end
+end
+n = 0
+while n < 15
+    print clamp(add(n, 1))
+    n = n + 2
+end
+""",
+    """
+i = 0
+j = 1
+threaded function reset_i()
+   i = 9
+end
+while j < 5
+    i = i + 1
+    j = j + 1
+    reset_i()
+    print i
+end
+""",
+    """
+total = 0
+i = 0
+while i < 20
+    j = 0
+    while j < 4
+        if (i + j) / 2 > j
+            total = total + i - j
+        else
+            total = total + 1
+        end
+        j = j + 1
+    end
+    i = i + 1
+end
+print total
+""",
+]
+
+# (generator class, simulator abi, generator options)
+CONFIGURATIONS = [
+    (LinuxCodeGenerator, 'linux', {'register_allocation': False}),
+    (LinuxCodeGenerator, 'linux', {'register_allocation': True}),
+    (CodeGenerator, 'windows', {'register_allocation': True}),
+]
+
+
+def instruction_count(asm_code):
+    return sum(1 for line in asm_code.splitlines() if line.startswith('    '))
+
+
+def test_corpus_output_unchanged():
+    for generator_class, abi, options in CONFIGURATIONS:
+        before = after = 0
+        for source in CORPUS:
+            plain = generate(source, generator_class, peephole=False, **options)
+            optimized = generate(source, generator_class, **options)
+            expected = X86Simulator(plain, abi).run()
+            assert expected, source
+            assert X86Simulator(optimized, abi).run() == expected, (abi, options, source)
+            before += instruction_count(plain)
+            after += instruction_count(optimized)
+        assert after < before, (abi, options, before, after)
+
+
+def test_stack_machine_patterns():
+    optimizer = PeepholeOptimizer(PEEPHOLE_RULES['x86_64'])
+    lines = ['    mov rax, 5', '    push rax', '    mov rax, qword [b]', '    mov rbx, rax', '    pop rax',
+             '    mov qword [v], rax', '    mov rax, qword [v]',
+             '    imul rax, 8',
+             '    jmp END', 'END:']
+    assert optimizer.optimize(lines) == [
+        '    mov rax, 5', '    mov rbx, qword [b]',
+        '    mov qword [v], rax',
+        '    shl rax, 3',
+        'END:']
+    assert optimizer.stats == {'push_load_move_pop': 1, 'store_reload': 1,
+                               'multiply_power_of_two': 1, 'jump_to_next_label': 1}
+    # Labels stop patterns from matching across them.
+    lines = ['    push rax', 'L:', '    pop rax']
+    assert optimizer.optimize(lines) == lines
+
+
+def test_arm64_rules():
+    store = ['    adrp x1, a', '    add x1, x1, :lo12:a', '    str x0, [x1]']
+    load = ['    adrp x1, a', '    add x1, x1, :lo12:a', '    ldr x2, [x1]']
+    optimizer = PeepholeOptimizer(PEEPHOLE_RULES['arm64'])
+    assert optimizer.optimize(store + load + ['    mov x3, x3', '    b L', 'L:']) == store + ['    mov x2, x0', 'L:']
+    assert RISCCodeGenerator().peephole.rules == PEEPHOLE_RULES['arm64']
+
+
+def test_custom_rule_set():
+    optimizer = PeepholeOptimizer([jump_to_next_label])
+    assert optimizer.optimize(['    push rax', '    pop rax', '    jmp L', 'L:']) == ['    push rax', '    pop rax', 'L:']
+    assert optimizer.format_stats() == 'jump_to_next_label 1'
+
+
+if __name__ == '__main__':
+    test_corpus_output_unchanged()
+    test_stack_machine_patterns()
+    test_arm64_rules()
+    test_custom_rule_set()
+    print("All peephole tests passed!")
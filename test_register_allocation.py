@@ -0,0 +1,69 @@
+from code_generator import CodeGenerator, LinuxCodeGenerator
+from testutil import generate
+
+LOOP = """
+s = 0
+i = 0
+while i < 100
+    s = s + i * i
+    i = i + 1
+end
+print s
+"""
+
+
+def main_body(asm_code):
+    # Less the thread-pool runtime that follows main.
+    return [line.strip() for line in asm_code[asm_code.index('main:'):].split('hive_spawn:')[0].splitlines()]
+
+
+def test_expressions_stay_in_registers():
+    body = main_body(generate("a = 2\nb = 3\nprint (a + b) * (a - b) / (b + 1) < 7"))
+    expression = body[body.index('mov qword [b], 3'):body.index('call printf')]
+    assert not any(line.startswith(('push', 'pop')) for line in expression), expression
+    # Evaluated straight into printf's argument register.
+    assert 'cmp rsi, 7' in expression and 'setl sil' in expression
+    # Leaves are used as memory and immediate operands.
+    assert 'add rsi, qword [b]' in expression and 'add rcx, 1' in expression
+
+
+def test_stack_machine_still_available():
+    body = main_body(generate("a = 2\nprint a + 1", register_allocation=False, peephole=False))
+    assert 'push rax' in body and 'pop rax' in body
+
+
+def test_division_saves_live_rax():
+    body = main_body(generate("a = 7\nb = 2\nc = a - a / b"))
+    assert body.index('push rax') < body.index('cqo') < body.index('pop rax')
+
+
+def test_loop_variables_promoted():
+    for generator_class, registers in ((LinuxCodeGenerator, ('rbx', 'r12')), (CodeGenerator, ('rbx', 'rsi'))):
+        body = main_body(generate(LOOP, generator_class))
+        for register in registers:
+            assert f'push {register}' in body and f'pop {register}' in body
+        assert 'add rbx, 1' in body                      # i = i + 1 in place
+        start = body.index('WHILE_START_0:')
+        end = body.index('WHILE_END_0:')
+        assert not any('qword [i]' in line or 'qword [s]' in line for line in body[start:end])
+        # Written back before the print that follows the loop.
+        assert 'mov qword [s], ' + registers[1] in body[end:]
+
+
+def test_loops_with_calls_or_threads_not_promoted():
+    with_call = "function f()\n  s = 1\nend\n" + LOOP.replace("i = i + 1", "i = i + 1\n    f()")
+    assert 'push rbx' not in generate(with_call)
+    with_thread = "threaded function t()\n  s = 0\nend\n" + LOOP
+    body = main_body(generate(with_thread))
+    # s is used by the threaded function, so only i moves to a register.
+    assert 'mov rbx, qword [i]' in body and 'push r12' not in body
+    assert 'mov qword [s], rax' in body
+
+
+if __name__ == '__main__':
+    test_expressions_stay_in_registers()
+    test_stack_machine_still_available()
+    test_division_saves_live_rax()
+    test_loop_variables_promoted()
+    test_loops_with_calls_or_threads_not_promoted()
+    print("All register allocation tests passed!")
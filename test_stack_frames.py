@@ -0,0 +1,234 @@
+from code_generator import CodeGenerator, LinuxCodeGenerator
+from compiler import compile_to_asm
+from ir import lower
+from nodes import global_variables, local_variables, threaded_function_variables, unassigned_locals
+from testutil import OUTPUT, parse, simulate
+from x86_simulator import X86Simulator
+
+RECURSIVE = """
+function fact(n)
+    if n < 2
+        return 1
+    end
+    return n * fact(n - 1)
+end
+function fib(n)
+    if n < 2
+        return n
+    end
+    a = fib(n - 1)
+    b = fib(n - 2)
+    return a + b
+end
+n = 4
+print fact(10)
+print fib(12)
+print fact(n) + n
+"""
+
+SCOPES = """
+function bump(a)
+    a = a + 1
+    i = i + a
+    return a
+end
+threaded function worker()
+    k = 0
+    s = 0
+    while k < 10
+        s = s + k
+        k = k + 1
+    end
+    total = s
+end
+a = 5
+i = 0
+total = 0
+print bump(1)
+print a
+print i
+worker()
+print total
+"""
+
+STACK_PARAMETERS = """
+function sum7(a, b, c, d, e, f, g)
+    return a + b * 2 + c * 3 + d * 4 + e * 5 + f * 6 + g * 7
+end
+print sum7(1, 2, 3, 4, 5, 6, 7)
+"""
+
+CALL_IN_LOOP = """
+function sq(x)
+    return x * x
+end
+function sum_squares(limit)
+    k = 0
+    s = 0
+    while k < limit
+        s = s + sq(k)
+        k = k + 1
+    end
+    return s
+end
+print sum_squares(10)
+"""
+
+HEAP_IN_FUNCTION = """
+function make(n)
+    a = 5
+    b = 6
+    c = 7
+    d = 8
+    arr = new[n]
+    arr[0] = a + b + c + d
+    r = arr[0]
+    delete arr
+    return r + a + b + c + d
+end
+print make(3)
+"""
+
+SHARED_COUNTER = """
+function init()
+    counter = 10
+    return 0
+end
+function get()
+    return counter
+end
+x = init()
+print get()
+"""
+
+BRANCHES = """
+function f(n)
+    if n > 0
+        a = 1
+        b = 1
+    else
+        a = 2
+    end
+    while n > 0
+        c = n
+        n = n - 1
+    end
+    lock l
+        d = a
+    end
+    return a + b + c + d
+end
+"""
+
+
+def test_recursion():
+    for target in ('linux', 'windows'):
+        for opt_level in (0, 1, 2):
+            for backend in ('ast', 'ir'):
+                output, _ = simulate(RECURSIVE, target, opt_level=opt_level, backend=backend)
+                assert output == "3628800\n144\n28\n", (target, opt_level, backend)
+
+
+def test_scopes():
+    nodes = parse(SCOPES)
+    assert global_variables(nodes) == {'a', 'i', 'total'}
+    bump, worker = nodes[0], nodes[1]
+    # The parameter a hides the global a; i is the global.
+    assert local_variables(bump, global_variables(nodes)) == ['a']
+    assert local_variables(worker, global_variables(nodes)) == ['k', 's']
+    assert threaded_function_variables(nodes) == {'total'}
+    for target in ('linux', 'windows'):
+        for opt_level in (0, 1, 2):
+            for backend in ('ast', 'ir'):
+                output, _ = simulate(SCOPES, target, opt_level=opt_level, backend=backend)
+                assert output == "2\n5\n2\n45\n", (target, opt_level, backend)
+
+
+def test_only_globals_in_bss():
+    for generator_class in (LinuxCodeGenerator, CodeGenerator):
+        asm_code = generator_class().generate(parse(SCOPES))
+        bss = {line.split(':')[0] for line in asm_code.splitlines() if 'resq' in line and not line.startswith('hive_')}
+        assert bss - {'heap_handle'} == {'a', 'i', 'total'}
+        assert 'qword [rbp - 8]' in asm_code
+    assert set(lower(parse(SCOPES)).globals) == {'a', 'i', 'total'}
+
+
+def test_stack_parameters():
+    # The seventh argument is passed on the stack and read where the caller pushed it.
+    for opt_level in (0, 1):
+        for backend in ('ast', 'ir'):
+            output, _ = simulate(STACK_PARAMETERS, 'linux', opt_level=opt_level, backend=backend)
+            assert output == "140\n", (opt_level, backend)
+    asm_code = LinuxCodeGenerator().generate(parse(STACK_PARAMETERS))
+    assert 'qword [rbp + 16]' in asm_code
+
+
+def test_locals_in_registers():
+    asm_code = LinuxCodeGenerator().generate(parse(SCOPES))
+    lines = asm_code.splitlines()
+    worker = lines[lines.index('FUNC_worker:'):lines.index('FUNC_worker_END:')]
+    loop = worker[worker.index('WHILE_START_0:'):]
+    # The thread's counters are its own, so they stay in registers for the whole loop.
+    assert not any('[' in line for line in loop[:loop.index('WHILE_END_0:')])
+    # A call does not stop locals from living in registers across a loop.
+    lines = LinuxCodeGenerator().generate(parse(CALL_IN_LOOP)).splitlines()
+    start = lines.index('WHILE_START_0:')
+    loop = lines[start:lines.index('WHILE_END_0:')]
+    assert '    call FUNC_sq' in loop and not any('qword [rbp' in line for line in loop)
+
+
+def test_parallel_units():
+    expected, _ = simulate(RECURSIVE + CALL_IN_LOOP, 'linux', opt_level=1, backend='ast')
+    asm_code = compile_to_asm(RECURSIVE + CALL_IN_LOOP, OUTPUT, 'linux', jobs=2)
+    assert X86Simulator(asm_code, 'linux').run() == expected
+    assert 'k: resq 1' not in asm_code and 'n: resq 1' in asm_code
+
+
+def test_ir_locals():
+    module = lower(parse(SCOPES))
+    dump = module.dump()
+    assert "function bump(a):\n  local %a : scalar\n" in dump
+    assert 'store %a, ' in dump and 'load @i' in dump
+    assert list(module.functions['worker'].locals) == ['k', 's']
+
+
+def test_shadow_space():
+    # HeapAlloc and HeapFree may overwrite the 32 bytes above rsp, which must not be make's locals.
+    for opt_level in (0, 1, 2):
+        for backend in ('ast', 'ir'):
+            output, _ = simulate(HEAP_IN_FUNCTION, 'windows', opt_level=opt_level, backend=backend)
+            assert output == "52\n", (opt_level, backend)
+
+
+def test_unassigned_locals():
+    nodes = parse(BRANCHES)
+    # b is only assigned on one branch and c in a loop that may not run.
+    assert set(unassigned_locals(nodes[0], global_variables(nodes))) == {'b', 'c'}
+    nodes = parse(SHARED_COUNTER)
+    assert unassigned_locals(nodes[1], global_variables(nodes)) == ['counter']
+    for target in ('linux', 'windows', 'arm64'):
+        for options in ({'opt_level': 0}, {'opt_level': 2}, {'backend': 'ir'}, {'jobs': 2}):
+            try:
+                compile_to_asm(SHARED_COUNTER, OUTPUT, target, **options)
+            except Exception as e:
+                assert str(e) == "'counter' may be used before it is assigned in function 'get'", (target, options)
+            else:
+                raise AssertionError((target, options))
+    # Used by the main program too, counter is a global both functions share.
+    for target in ('linux', 'windows'):
+        for backend in ('ast', 'ir'):
+            output, _ = simulate('counter = 0\n' + SHARED_COUNTER, target, backend=backend)
+            assert output == "10\n", (target, backend)
+
+
+if __name__ == '__main__':
+    test_recursion()
+    test_scopes()
+    test_only_globals_in_bss()
+    test_stack_parameters()
+    test_locals_in_registers()
+    test_parallel_units()
+    test_ir_locals()
+    test_shadow_space()
+    test_unassigned_locals()
+    print("All stack frame tests passed!")
@@ -0,0 +1,87 @@
+import re
+
+from code_generator import CodeGenerator, LinuxCodeGenerator, RISCCodeGenerator
+from constant_folding import truncating_division, wrap64
+from strength_reduction import divide_by_constant, multiply_by_constant
+from testutil import generate
+from x86_simulator import X86Simulator
+
+DIVIDENDS = [0, 1, -1, 7, -7, 100, -100, 12345678901, -98765432109, 2**63 - 1, -2**63, -2**63 + 1]
+DIVISORS = list(range(-20, 21)) + [1000, -641, 3 * 2**40, 2**62, 2**63 - 1]
+
+PROGRAM = """
+n = 0
+a = new[12]
+while n < 10
+    a[n + 1] = n * 10 - 37
+    print a[n + 1] / 7
+    print a[n + 1] / -4
+    print (n - 5) * 9
+    print 3 * n * 24
+    n = n + 1
+end
+print a[1 - 1]
+delete a
+"""
+
+
+def run_sequence(code, target, values):
+    """Prints target after running code on each value."""
+    lines = ['main:', '    sub rsp, 8']
+    for value in values:
+        lines += [f'    mov {target}, {value}'] + code + [f'    mov rsi, {target}', '    call printf']
+    return X86Simulator('\n'.join(lines + ['    add rsp, 8', '    ret'])).run().split()
+
+
+def test_division_sequences():
+    for target, scratch in (('rcx', 'r8'), ('rax', 'rcx'), ('rdx', 'r9')):
+        for divisor in DIVISORS:
+            code = divide_by_constant(target, divisor, scratch)
+            if divisor in (0, -1):
+                assert code is None
+                continue
+            assert not any('idiv' in line for line in code)
+            expected = [str(wrap64(truncating_division(n, divisor))) for n in DIVIDENDS]
+            assert run_sequence(code, target, DIVIDENDS) == expected, (target, divisor, code)
+
+
+def test_multiplication_sequences():
+    for factor in range(-10, 50):
+        code = multiply_by_constant('rcx', factor)
+        if code is None:
+            continue
+        assert len(code) <= 2 and not any('imul' in line for line in code)
+        assert run_sequence(code, 'rcx', DIVIDENDS) == [str(wrap64(n * factor)) for n in DIVIDENDS], factor
+    assert multiply_by_constant('rax', 8) == ['    shl rax, 3']
+    assert multiply_by_constant('rax', 10) == ['    lea rax, [rax + rax*4]', '    shl rax, 1']
+    assert multiply_by_constant('rax', 7) is None
+
+
+def test_generated_code():
+    for generator_class, abi in ((LinuxCodeGenerator, 'linux'), (CodeGenerator, 'windows')):
+        for options in ({'register_allocation': True}, {'register_allocation': False}):
+            plain = generate(PROGRAM, generator_class, strength_reduction=False, peephole=False, **options)
+            reduced = generate(PROGRAM, generator_class, **options)
+            # Only the one-operand imul of the magic-number division is left.
+            assert 'idiv' not in reduced and not re.search(r'imul \w+, ', reduced)
+            if abi == 'windows' and not options['register_allocation']:
+                continue  # the Windows stack machine does not print expressions
+            assert X86Simulator(reduced, abi).run() == X86Simulator(plain, abi).run()
+    body = generate(PROGRAM)
+    # Index scaling and the constant offset are folded into the address.
+    assert '*8 + 8]' in body and 'lea rdi, [rax*8]' in body
+
+
+def test_arm64():
+    body = generate("a = 5\nprint a * 8\nprint a * 9\nb = 100\nprint b / 7\nprint b / 16", RISCCodeGenerator)
+    assert 'lsl x0, x2, #3' in body and 'add x0, x2, x2, lsl #3' in body
+    assert 'smulh x3, x2, x3' in body and 'asr x0, x3, #4' in body
+    assert 'sdiv' not in body and '    mul' not in body
+
+
+if __name__ == '__main__':
+    test_division_sequences()
+    test_multiplication_sequences()
+    test_generated_code()
+    test_arm64()
+    print("All strength reduction tests passed!")
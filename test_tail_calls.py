@@ -0,0 +1,147 @@
+from code_generator import CodeGenerator, LinuxCodeGenerator
+from compiler import compile_to_asm
+from ir import lower, mark_tail_calls, simplify
+from test_peephole import CORPUS
+from testutil import OUTPUT, parse, simulate
+from x86_simulator import X86Simulator
+
+ACCUMULATE = """
+function sum_to(n, acc)
+    if n == 0
+        return acc
+    end
+    return sum_to(n - 1, acc + n)
+end
+"""
+
+MUTUAL = """
+function is_even(n)
+    if n == 0
+        return 1
+    end
+    return is_odd(n - 1)
+end
+function is_odd(n)
+    if n == 0
+        return 0
+    end
+    return is_even(n - 1)
+end
+"""
+
+# The seventh argument is passed on the stack.
+STACK_ARGUMENTS = """
+function last7(a, b, c, d, e, f, g)
+    if a == 0
+        return g
+    end
+    return last7(a - 1, b, c, d, e, f, g + a)
+end
+function relay(a, b, c, d, e, f, g)
+    return last7(a, b, c, d, e, f, g * 2)
+end
+function more(a)
+    return last7(a, 0, 0, 0, 0, 0, 1)
+end
+print relay(3, 0, 0, 0, 0, 0, 1)
+print more(4)
+"""
+
+NOT_TAIL = """
+function fact(n)
+    if n < 2
+        return 1
+    end
+    return n * fact(n - 1)
+end
+threaded function worker()
+    done = 1
+end
+function start()
+    return worker()
+end
+done = 0
+print fact(10)
+x = start()
+print done
+"""
+
+
+def test_constant_stack():
+    for target in ('linux', 'windows'):
+        for backend in ('ast', 'ir'):
+            for depth in (100, 1000):
+                source = ACCUMULATE + MUTUAL + f"print sum_to({depth}, 0)\nprint is_even({depth + 1})"
+                expected = f"{depth * (depth + 1) // 2}\n0\n"
+                output, simulator = simulate(source, target, opt_level=0, backend=backend)
+                assert output == expected and simulator.stack_bytes >= 32 * depth, (target, backend)
+                output, simulator = simulate(source, target, opt_level=1, backend=backend)
+                # A self call reuses its frame and a sibling call the caller's.
+                assert output == expected and simulator.stack_bytes < 512, (target, backend, simulator.stack_bytes)
+
+
+def test_jumps():
+    lines = LinuxCodeGenerator().generate(parse(ACCUMULATE + MUTUAL)).splitlines()
+    assert 'call FUNC_sum_to' not in '\n'.join(lines)
+    body = lines.index('FUNC_sum_to_BODY:')
+    assert lines[body - 1] == '    sub rsp, 16' and lines[body + 1] == '    mov qword [rbp - 8], rdi'
+    assert '    jmp FUNC_sum_to_BODY' in lines
+    end = lines.index('FUNC_is_even_END:')
+    assert lines[end - 3:end] == ['    mov rsp, rbp', '    pop rbp', '    jmp FUNC_is_odd']
+    windows = CodeGenerator().generate(parse(ACCUMULATE + MUTUAL))
+    assert 'call FUNC_' not in windows and '    jmp FUNC_is_even' in windows
+    disabled = LinuxCodeGenerator(tail_calls=False).generate(parse(ACCUMULATE))
+    assert '    call FUNC_sum_to' in disabled and 'jmp FUNC_sum_to_BODY' not in disabled
+
+
+def test_stack_arguments():
+    for backend in ('ast', 'ir'):
+        for opt_level in (0, 1, 2):
+            output, _ = simulate(STACK_ARGUMENTS, 'linux', opt_level=opt_level, backend=backend)
+            assert output == "8\n11\n", (backend, opt_level)
+    asm_code = LinuxCodeGenerator().generate(parse(STACK_ARGUMENTS))
+    # relay was passed a stack argument and can hand one on; more was not and calls.
+    assert '    jmp FUNC_last7' in asm_code and '    call FUNC_last7' in asm_code
+    assert '    mov qword [rbp + 16], rax' in asm_code
+
+
+def test_not_tail_calls():
+    for target in ('linux', 'windows'):
+        for backend in ('ast', 'ir'):
+            output, _ = simulate(NOT_TAIL, target, opt_level=1, backend=backend)
+            assert output == "3628800\n1\n", (target, backend)
+    asm_code = LinuxCodeGenerator().generate(parse(NOT_TAIL))
+    # The multiplication follows the call, and a threaded call starts a thread.
+    assert '    call FUNC_fact' in asm_code and 'pthread_create' in asm_code
+
+
+def test_output_unchanged():
+    for source in CORPUS:
+        expected = X86Simulator(LinuxCodeGenerator(tail_calls=False).generate(parse(source)), 'linux').run()
+        for generator_class, abi in ((LinuxCodeGenerator, 'linux'), (CodeGenerator, 'windows')):
+            asm_code = generator_class().generate(parse(source))
+            assert X86Simulator(asm_code, abi).run() == expected, (abi, source)
+
+
+def test_ir():
+    module = simplify(lower(parse(ACCUMULATE + MUTUAL + NOT_TAIL)))
+    for function in module.functions.values():
+        mark_tail_calls(function)
+    ops = {name: [instruction.op for block in function.blocks for instruction in block.instructions]
+           for name, function in module.functions.items()}
+    assert ops['sum_to'].count('tailcall') == 1 and 'call' not in ops['sum_to']
+    assert ops['is_even'].count('tailcall') == 1
+    assert 'tailcall' not in ops['fact'] and 'tailcall' not in ops['start'] and 'tailcall' not in ops['main']
+    assert 'tailcall sum_to, ' in module.dump()
+    arm64 = compile_to_asm(ACCUMULATE + MUTUAL + "print sum_to(3, 0)", OUTPUT, 'arm64', backend='ir')
+    assert '    b IR_sum_to_B0' in arm64 and 'bl FUNC_sum_to' in arm64 and 'bl FUNC_is_odd' not in arm64
+
+
+if __name__ == '__main__':
+    test_constant_stack()
+    test_jumps()
+    test_stack_arguments()
+    test_not_tail_calls()
+    test_output_unchanged()
+    test_ir()
+    print("All tail call tests passed!")
@@ -0,0 +1,130 @@
+from code_generator import CodeGenerator, LinuxCodeGenerator
+from compiler import compile_to_asm
+from test_peephole import CORPUS
+from testutil import OUTPUT, parse
+from thread_pool import QUEUE_SIZE
+from x86_simulator import SIMULATED_CPUS, X86Simulator
+
+SPAWN_LOOP = """
+threaded function tick()
+    ticks = ticks + 1
+end
+ticks = 0
+n = 0
+while n < 600
+    tick()
+    n = n + 1
+end
+print ticks
+"""
+
+# Each task starts the next, so later ones are queued while every worker is busy.
+CHAIN = ''.join(f"""
+threaded function step{n}()
+    steps = steps + 1
+    step{n + 1}()
+end
+""" for n in range(SIMULATED_CPUS + 2)) + f"""
+threaded function step{SIMULATED_CPUS + 2}()
+    steps = steps * 10
+end
+steps = 0
+step0()
+print steps
+"""
+
+
+def simulate(asm_code, abi):
+    simulator = X86Simulator(asm_code, abi)
+    return simulator, simulator.run()
+
+
+def test_spawn_enqueues():
+    for generator_class, register in ((LinuxCodeGenerator, 'rdi'), (CodeGenerator, 'rcx')):
+        lines = generator_class().generate(parse(SPAWN_LOOP)).splitlines()
+        assert lines[lines.index('main:') + 1:].count('    call hive_pool_start') == 1
+        assert f'    lea {register}, [rel FUNC_tick]' in lines and '    call hive_spawn' in lines
+        # Threads are only created when the pool starts.
+        create = [i for i, line in enumerate(lines) if line in ('    call pthread_create', '    call CreateThread')]
+        assert len(create) == 1 and lines.index('hive_pool_start:') < create[0] < lines.index('hive_worker:')
+        # Without the pool hive_spawn creates the threads.
+        per_call = generator_class(thread_pool=False).generate(parse(SPAWN_LOOP)).splitlines()
+        assert 'hive_pool_start:' not in per_call and 'hive_queue' not in '\n'.join(per_call)
+        create = [i for i, line in enumerate(per_call) if line in ('    call pthread_create', '    call CreateThread')]
+        assert len(create) == 1 and per_call.index('hive_spawn:') < create[0]
+    assert 'hive_' not in LinuxCodeGenerator().generate(parse("x = 1\nprint x"))
+
+
+def test_workers():
+    for target in ('linux', 'windows'):
+        for backend in ('ast', 'ir'):
+            simulator, output = simulate(compile_to_asm(SPAWN_LOOP, OUTPUT, target, backend=backend), target)
+            assert output == "600\n", (target, backend)
+            # One worker per CPU, all asleep again; the queue has wrapped around twice.
+            assert simulator.threads == SIMULATED_CPUS and len(simulator.parked) == SIMULATED_CPUS
+            symbols, memory = simulator.symbols, simulator.memory
+            assert memory[symbols['hive_queue_head']] == memory[symbols['hive_queue_tail']] == 600 > 2 * QUEUE_SIZE
+            assert memory[symbols['hive_pending']] == 0 and memory[symbols['hive_idle']] == SIMULATED_CPUS
+
+
+def test_busy_workers():
+    for target in ('linux', 'windows'):
+        for opt_level in (0, 1):
+            simulator, output = simulate(compile_to_asm(CHAIN, OUTPUT, target, opt_level=opt_level), target)
+            assert output == f"{(SIMULATED_CPUS + 2) * 10}\n", (target, opt_level)
+
+
+def test_output_unchanged():
+    threaded = [source for source in CORPUS if 'threaded' in source] + [SPAWN_LOOP, CHAIN]
+    for source in threaded:
+        expected = X86Simulator(LinuxCodeGenerator(thread_pool=False).generate(parse(source)), 'linux').run()
+        for target in ('linux', 'windows'):
+            for opt_level in (0, 2):
+                for backend in ('ast', 'ir'):
+                    asm_code = compile_to_asm(source, OUTPUT, target, opt_level=opt_level, backend=backend)
+                    assert X86Simulator(asm_code, target).run() == expected, (target, opt_level, backend, source)
+        asm_code = compile_to_asm(source, OUTPUT, 'linux', jobs=2)
+        assert asm_code.count('hive_worker:') == 1 and X86Simulator(asm_code, 'linux').run() == expected
+
+
+def test_arm64():
+    # No runtime for ARM64 yet: every threaded call still creates a thread.
+    asm_code = compile_to_asm(SPAWN_LOOP, OUTPUT, 'arm64', backend='ir')
+    assert 'bl pthread_create' in asm_code and 'hive_' not in asm_code
+
+
+def test_locked_instructions():
+    simulator = X86Simulator('\n'.join([
+        'section .bss',
+        'word: resq 1',
+        'main:',
+        '    sub rsp, 8',
+        '    mov qword [rel word], 5',
+        '    mov rax, 4',
+        '    mov rcx, 9',
+        '    lock cmpxchg qword [rel word], rcx',  # fails: rax = 5
+        '    jne main_retry',
+        '    ret',
+        'main_retry:',
+        '    lock cmpxchg qword [rel word], rcx',  # succeeds: word = 9
+        '    jne main_retry',
+        '    mov rdx, 3',
+        '    lock xadd qword [rel word], rdx',
+        '    mov rsi, rdx',
+        '    call printf',
+        '    mov rsi, qword [rel word]',
+        '    call printf',
+        '    add rsp, 8',
+        '    ret',
+    ]), 'linux')
+    assert simulator.run() == "9\n12\n"
+
+
+if __name__ == '__main__':
+    test_spawn_enqueues()
+    test_workers()
+    test_busy_workers()
+    test_output_unchanged()
+    test_arm64()
+    test_locked_instructions()
+    print("All thread pool tests passed!")
@@ -0,0 +1,126 @@
+from code_generator import CodeGenerator, LinuxCodeGenerator
+from compiler import compile_to_asm
+from ir import lower, number_values, shared_globals, simplify
+from test_peephole import CORPUS
+from testutil import OUTPUT, parse
+from value_numbering import repeated_values, straight_line_run
+from x86_simulator import X86Simulator
+
+README_STORE = """
+li = new[9]
+i = 12
+li[i-11] = i
+print li[i-11]
+delete li
+"""
+
+PROGRAMS = [
+    README_STORE,
+    # A store to a variable an expression reads.
+    "x = 3\ny = 4\na = x * y + 1\nx = 2\nb = x * y + 1\nprint a\nprint b",
+    # A store through another name for the same array.
+    "p = new[4]\nq = p\np[1] = 5\nx = p[1] + p[1]\nq[1] = 7\ny = p[1] + p[1]\nprint x\nprint y\ndelete p",
+    # A call between two statements.
+    """
+function bump()
+    n = n + 1
+    return 0
+end
+n = 5
+a = n * 3 + 1
+z = bump()
+b = n * 3 + 1
+print a
+print b
+""",
+    # Values used inside a loop body and across an if.
+    """
+a = new[10]
+k = 0
+t = 0
+while k < 10
+    a[k] = k * k + 2
+    t = t + a[k] * 2 + (k * k + 2)
+    if a[k] > 20
+        t = t - a[k]
+    else
+        t = t + a[k] * 2
+    end
+    k = k + 1
+end
+print t
+delete a
+""",
+]
+
+
+def lower_source(source):
+    return lower(parse(source))
+
+
+def test_store_then_load():
+    asm_code = LinuxCodeGenerator().generate(parse(README_STORE))
+    lines = asm_code.splitlines()
+    start = lines.index('    mov qword [i], 12')
+    run = lines[start:lines.index('    call printf')]
+    # The base pointer is loaded once and the printed element comes from the stored register.
+    assert sum(1 for line in run if 'qword [li]' in line) == 1
+    assert not any(', qword [r' in line for line in run)
+    plain = LinuxCodeGenerator(value_numbering=False).generate(parse(README_STORE))
+    assert plain.count('qword [li]') == 4  # the new pointer's store, two base loads and the delete
+
+
+def test_output_unchanged():
+    for source in CORPUS + PROGRAMS:
+        expected = X86Simulator(LinuxCodeGenerator(value_numbering=False).generate(parse(source)), 'linux').run()
+        for generator_class, abi in ((LinuxCodeGenerator, 'linux'), (CodeGenerator, 'windows')):
+            asm_code = generator_class().generate(parse(source))
+            assert X86Simulator(asm_code, abi).run() == expected, (abi, source)
+        for opt_level in (1, 2):
+            asm_code = compile_to_asm(source, OUTPUT, 'linux', opt_level=opt_level, backend='ir')
+            assert X86Simulator(asm_code, 'linux').run() == expected, (opt_level, source)
+    assert X86Simulator(LinuxCodeGenerator().generate(parse(PROGRAMS[2])), 'linux').run() == "10\n14\n"
+
+
+def test_repeated_values():
+    statements = parse("a = x * y + 1\nb = x * y + 1\nc = x * y\nprint z[a] + z[b]")
+    assert straight_line_run(statements, 0) == 4
+    keys = repeated_values(statements)
+    assert ('base', 'z') in keys
+    # x * y is evaluated by the first x * y + 1 and by c; the second x * y + 1 is reused whole.
+    assert len([key for key in keys if key[0] != 'base']) == 2
+    assert repeated_values(statements, {'x'}) == {('base', 'z')}
+    calls = parse("a = n * 2\nb = f()\nc = n * 2")
+    assert straight_line_run(calls, 0) == 1
+
+
+def test_threaded_globals_reloaded():
+    source = "threaded function t()\n    n = 3\nend\nt()\nn = 1\na = n * n\nb = n * n\nprint a + b"
+    asm_code = LinuxCodeGenerator().generate(parse(source))
+    assert asm_code.count('imul') == 2
+    module = lower_source(source)
+    assert 'n' in shared_globals(module)
+    main = module.functions['main']
+    number_values(main, shared_globals(module))
+    loads = [instruction for instruction in main.blocks[0].instructions if instruction.op == 'load']
+    assert len(loads) == 4
+
+
+def test_ir_numbering():
+    function = simplify(lower_source("i = 12\na = i - 11\nb = i - 11\nprint a + b")).functions['main']
+    assert number_values(function)
+    ops = [instruction.op for instruction in function.blocks[0].instructions]
+    # Loads after a store get the stored value, and 12 - 11 is computed once.
+    assert ops == ['store', 'sub', 'store', 'store', 'add', 'print', 'ret']
+    function = lower_source("n = 2\na = n * 3\nz = f()\nb = n * 3").functions['main']
+    number_values(function)
+    assert [instruction.op for instruction in function.blocks[0].instructions].count('mul') == 2
+
+
+if __name__ == '__main__':
+    test_store_then_load()
+    test_output_unchanged()
+    test_repeated_values()
+    test_threaded_globals_reloaded()
+    test_ir_numbering()
+    print("All value numbering tests passed!")
@@ -0,0 +1,32 @@
+"""Helpers shared by the test scripts."""
+import atexit
+import os
+import shutil
+import tempfile
+
+from code_generator import LinuxCodeGenerator
+from compiler import compile_to_asm
+from lexer import RegexLexer
+from parser import Parser
+from x86_simulator import X86Simulator
+
+# compile_to_asm always writes the assembly out; each test process gets a
+# directory of its own for it, removed when the process exits.
+_directory = tempfile.mkdtemp(prefix='hive_test_')
+atexit.register(shutil.rmtree, _directory, ignore_errors=True)
+OUTPUT = os.path.join(_directory, 'output.asm')
+
+
+def parse(source):
+    return Parser(RegexLexer(source).iter_tokens()).parse()
+
+
+def generate(source, generator_class=LinuxCodeGenerator, **options):
+    """The assembly generator_class(**options) generates for source."""
+    return generator_class(**options).generate(parse(source))
+
+
+def simulate(source, target, **options):
+    """Runs what compile_to_asm(source, target=target, **options) generates; the output and the simulator."""
+    simulator = X86Simulator(compile_to_asm(source, OUTPUT, target, **options), target)
+    return simulator.run(), simulator
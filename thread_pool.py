@@ -0,0 +1,442 @@
+"""Thread-pool runtime for threaded functions.
+
+Programs with threaded functions get a small runtime emitted along with
+their code. At program start hive_pool_start creates one worker thread
+per CPU. After that, a threaded call does not create a thread: hive_spawn
+puts a task on a bounded lock-free queue and wakes a sleeping worker if
+there is one.
+
+A task is a heap frame holding the function, its arguments and, once it
+has run, its return value. The call's value is the frame, a handle that
+the built-in join(handle) waits on; join returns the function's value
+and frees the frame. A threaded call whose value is not used is
+detached: its frame is freed as soon as it has run.
+
+The queue is a ring of QUEUE_SIZE cells, each holding a sequence number
+and a task (Vyukov's bounded MPMC queue). A producer claims position p
+when its cell's sequence is p, stores the task and sets the sequence to
+p + 1. A consumer takes it when the sequence is p + 1 and frees the cell
+for position p + QUEUE_SIZE. Positions are claimed with lock cmpxchg.
+Sequences are stored minus the cell's index, so the zeroed .bss is an
+empty queue. hive_spawn spins while the queue is full.
+
+Workers with nothing to do sleep on hive_pending, the number of queued
+tasks, using futex(2) on Linux and WaitOnAddress on Windows, and join
+sleeps on the task's state the same way. hive_spawn only makes the
+wake-up call while hive_idle says some worker may be asleep. Both
+counters change with locked instructions, which are full barriers, so a
+worker cannot miss a task published just as it goes to sleep.
+
+Without the pool (thread_pool=False) hive_spawn creates a thread for
+each task instead; frames, arguments and join work the same.
+"""
+from data_layout import CACHE_LINE
+from nodes import FunctionDefNode
+from register_allocator import ARGUMENT_REGISTERS
+
+QUEUE_SIZE = 256  # a power of two
+
+# Library functions the runtime needs besides the ones every program declares.
+EXTERNS = {
+    'linux': ('sysconf', 'syscall'),
+    'windows': ('GetSystemInfo', 'WaitOnAddress', 'WakeByAddressSingle', 'WakeByAddressAll'),
+}
+SYS_FUTEX = 202
+FUTEX_WAIT_PRIVATE = 128
+FUTEX_WAKE_PRIVATE = 129
+SC_NPROCESSORS_ONLN = 84
+
+# A task frame: the function, its state, its return value, whether it is
+# detached, then one qword per argument register of the ABI.
+TASK_FUNCTION = 0
+TASK_STATE = 8  # RUNNING, JOINING (join is waiting) or DONE
+TASK_RESULT = 16
+TASK_DETACHED = 24
+TASK_ARGUMENTS = 32
+RUNNING, DONE, JOINING = 0, 1, 2
+
+
+def uses_threads(nodes, functions=None):
+    """True if the program has threaded functions.
+
+    functions maps the names of separately compiled functions to
+    {'threaded': ...}, as in CodeGenerator.functions.
+    """
+    return (any(isinstance(node, FunctionDefNode) and node.threaded for node in nodes)
+            or any(info.get('threaded', False) for info in (functions or {}).values()))
+
+
+def frame_size(abi):
+    return TASK_ARGUMENTS + 8 * len(ARGUMENT_REGISTERS[abi])
+
+
+def spawn(abi, label, arguments, detached):
+    """Lines that start the function at label; the caller has pushed its arguments, first to last.
+
+    Leaves the handle in rax.
+    """
+    registers = ARGUMENT_REGISTERS[abi]
+    return [f'    lea {registers[0]}, [rel {label}]',
+            f'    mov {registers[1]}, {arguments}',
+            f'    mov {registers[2]}, {int(detached)}',
+            '    call hive_spawn']
+
+
+def join(abi):
+    """Lines that wait for the task whose handle is in rax and leave its value in rax."""
+    return [f'    mov {ARGUMENT_REGISTERS[abi][0]}, rax',
+            '    call hive_join']
+
+
+def start():
+    """Lines that start the workers; they go in main's prologue."""
+    return ['    call hive_pool_start']
+
+
+def runtime(abi, pool=True):
+    """The runtime's declarations and code."""
+    lines = [f'extern {name}' for name in EXTERNS[abi]]
+    lines.append('section .bss')
+    if pool:
+        # Workers take from the head while callers add at the tail, so each
+        # index, and the counters both update, get a cache line of their own.
+        align = f'alignb {CACHE_LINE}'
+        lines += [
+            align,
+            f'hive_queue: resq {2 * QUEUE_SIZE}',  # (sequence, task) cells
+            align,
+            'hive_queue_head: resq 1',
+            align,
+            'hive_queue_tail: resq 1',
+            align,
+            'hive_pending: resq 1',
+            'hive_idle: resq 1',
+        ]
+        if abi == 'windows':
+            lines.append('hive_empty: resq 1')  # what hive_pending is compared with before sleeping
+        lines.append(align)
+    lines.append('section .text')
+    lines += spawn_task(abi, pool) + run_task(abi) + join_task(abi)
+    if pool:
+        lines += pool_start(abi) + worker(abi)
+    return lines
+
+
+def wait(abi, address, value, compare):
+    """Sleeps while the qword at address holds value; WaitOnAddress reads value from compare."""
+    if abi == 'windows':
+        return [f'    lea rcx, [{address}]',
+                f'    lea rdx, [{compare}]',
+                '    mov r8d, 8',
+                '    mov r9d, -1',  # INFINITE
+                '    call WaitOnAddress']
+    return [f'    mov edi, {SYS_FUTEX}',
+            f'    lea rsi, [{address}]',
+            f'    mov edx, {FUTEX_WAIT_PRIVATE}',
+            f'    mov ecx, {value}',
+            '    xor r8d, r8d',  # no timeout
+            '    xor eax, eax',
+            '    call syscall']
+
+
+def wake(abi, address, everyone):
+    """Wakes one or every thread sleeping on address."""
+    if abi == 'windows':
+        return [f'    lea rcx, [{address}]',
+                f'    call {"WakeByAddressAll" if everyone else "WakeByAddressSingle"}']
+    return [f'    mov edi, {SYS_FUTEX}',
+            f'    lea rsi, [{address}]',
+            f'    mov edx, {FUTEX_WAKE_PRIVATE}',
+            f'    mov ecx, {0x7fffffff if everyone else 1}',
+            '    xor eax, eax',
+            '    call syscall']
+
+
+def allocate(abi, size):
+    """Lines that leave size bytes of heap in rax."""
+    if abi == 'windows':
+        return ['    mov rcx, [rel heap_handle]',
+                '    xor edx, edx',
+                f'    mov r8, {size}',
+                '    call HeapAlloc']
+    return [f'    mov edi, {size}',
+            '    call malloc']
+
+
+def release(abi, register):
+    """Lines that free the heap block register points to."""
+    if abi == 'windows':
+        return ['    mov rcx, [rel heap_handle]',
+                '    xor edx, edx',
+                f'    mov r8, {register}',
+                '    call HeapFree']
+    return [f'    mov rdi, {register}',
+            '    call free']
+
+
+def spawn_task(abi, pool):
+    """hive_spawn(function, argument count, detached): starts a task; callable with any stack alignment.
+
+    The arguments are on the caller's stack, the last one nearest the
+    return address.
+    """
+    registers = ARGUMENT_REGISTERS[abi]
+    lines = [
+        'hive_spawn:',
+        '    push rbp',
+        '    mov rbp, rsp',
+        '    push rbx',
+        '    push r12',
+        '    push r13',
+        '    and rsp, -16',
+        # Shadow space and CreateThread's stack arguments, or a pthread_t.
+        f'    sub rsp, {48 if abi == "windows" else 16}',
+        f'    mov rbx, {registers[0]}',
+        f'    mov r12, {registers[1]}',
+        f'    mov r13, {registers[2]}',
+    ]
+    lines += allocate(abi, frame_size(abi))
+    lines += [
+        f'    mov qword [rax + {TASK_FUNCTION}], rbx',
+        f'    mov qword [rax + {TASK_STATE}], {RUNNING}',
+        f'    mov qword [rax + {TASK_DETACHED}], r13',
+        '    lea rdx, [rbp + 16]',  # the last argument
+        'hive_spawn_argument:',
+        '    cmp r12, 0',
+        '    je hive_spawn_start',
+        '    sub r12, 1',
+        '    mov rcx, qword [rdx]',
+        f'    mov qword [rax + r12*8 + {TASK_ARGUMENTS}], rcx',
+        '    add rdx, 8',
+        '    jmp hive_spawn_argument',
+        'hive_spawn_start:',
+        '    mov rbx, rax',
+    ]
+    if pool:
+        lines += [
+            '    lea r8, [rel hive_queue]',
+            'hive_spawn_claim:',
+            '    mov rax, qword [rel hive_queue_tail]',
+            '    mov r9, rax',
+            f'    and r9, {QUEUE_SIZE - 1}',
+            '    shl r9, 4',
+            '    mov r10, rax',
+            f'    and r10, {-QUEUE_SIZE}',  # p minus the cell's index
+            '    cmp qword [r8 + r9], r10',
+            '    jne hive_spawn_busy',  # full, or another producer claimed the position
+            '    lea rdx, [rax + 1]',
+            '    lock cmpxchg qword [rel hive_queue_tail], rdx',
+            '    jne hive_spawn_claim',
+            '    mov qword [r8 + r9 + 8], rbx',
+            '    add r10, 1',
+            '    mov qword [r8 + r9], r10',  # x86 stores are not reordered, so the task is visible first
+            '    lock add qword [rel hive_pending], 1',
+            '    cmp qword [rel hive_idle], 0',
+            '    je hive_spawn_done',
+        ]
+        lines += wake(abi, 'rel hive_pending', everyone=False)
+    elif abi == 'windows':
+        lines += [
+            '    xor ecx, ecx',
+            '    xor edx, edx',
+            '    lea r8, [rel hive_run]',
+            '    mov r9, rbx',
+            '    mov qword [rsp + 32], 0',
+            '    mov qword [rsp + 40], 0',
+            '    call CreateThread',
+            '    mov rcx, rax',
+            '    call CloseHandle',
+        ]
+    else:
+        lines += [
+            '    mov rdi, rsp',
+            '    xor esi, esi',
+            '    lea rdx, [rel hive_run]',
+            '    mov rcx, rbx',
+            '    call pthread_create',
+        ]
+    lines += [
+        'hive_spawn_done:',
+        '    mov rax, rbx',
+        '    lea rsp, [rbp - 24]',
+        '    pop r13',
+        '    pop r12',
+        '    pop rbx',
+        '    pop rbp',
+        '    ret',
+    ]
+    if pool:
+        lines += [
+            'hive_spawn_busy:',
+            '    pause',
+            '    jmp hive_spawn_claim',
+        ]
+    return lines
+
+
+def run_task(abi):
+    """hive_run(task): calls the task's function, then records its value or frees a detached task."""
+    registers = ARGUMENT_REGISTERS[abi]
+    # Past the shadow space: the task, as the function need not preserve rbx.
+    task = 'rsp + 32' if abi == 'windows' else 'rsp'
+    lines = [
+        'hive_run:',
+        '    push rbx',
+        f'    sub rsp, {48 if abi == "windows" else 16}',
+        f'    mov qword [{task}], {registers[0]}',
+        f'    mov rbx, {registers[0]}',
+    ]
+    lines += [f'    mov {register}, qword [rbx + {TASK_ARGUMENTS + 8 * index}]'
+              for index, register in enumerate(registers)]
+    lines += [
+        f'    call qword [rbx + {TASK_FUNCTION}]',
+        f'    mov rbx, qword [{task}]',
+        f'    cmp qword [rbx + {TASK_DETACHED}], 0',
+        '    jne hive_run_detached',
+        f'    mov qword [rbx + {TASK_RESULT}], rax',
+        f'    mov eax, {DONE}',
+        f'    xchg qword [rbx + {TASK_STATE}], rax',  # locked, so the result is visible first
+        f'    cmp rax, {JOINING}',
+        '    jne hive_run_done',
+    ]
+    lines += wake(abi, f'rbx + {TASK_STATE}', everyone=True)
+    lines += [
+        '    jmp hive_run_done',
+        'hive_run_detached:',
+    ]
+    lines += release(abi, 'rbx')
+    lines += [
+        'hive_run_done:',
+        f'    add rsp, {48 if abi == "windows" else 16}',
+        '    pop rbx',
+        '    ret',
+    ]
+    return lines
+
+
+def join_task(abi):
+    """hive_join(task): waits for the task to finish, frees it and returns its value; callable with any stack alignment."""
+    registers = ARGUMENT_REGISTERS[abi]
+    # Past the shadow space: the value WaitOnAddress compares with, then the result.
+    compare = 'rsp + 32' if abi == 'windows' else 'rsp'
+    result = 'rsp + 40' if abi == 'windows' else 'rsp + 8'
+    lines = [
+        'hive_join:',
+        '    push rbp',
+        '    mov rbp, rsp',
+        '    push rbx',
+        '    and rsp, -16',
+        f'    sub rsp, {48 if abi == "windows" else 16}',
+        f'    mov rbx, {registers[0]}',
+        f'    mov qword [{compare}], {JOINING}',
+        'hive_join_check:',
+        f'    mov eax, {RUNNING}',
+        f'    mov ecx, {JOINING}',
+        f'    lock cmpxchg qword [rbx + {TASK_STATE}], rcx',
+        f'    cmp rax, {DONE}',
+        '    je hive_join_done',
+    ]
+    lines += wait(abi, f'rbx + {TASK_STATE}', JOINING, compare)
+    lines += [
+        '    jmp hive_join_check',
+        'hive_join_done:',
+        f'    mov rax, qword [rbx + {TASK_RESULT}]',
+        f'    mov qword [{result}], rax',
+    ]
+    lines += release(abi, 'rbx')
+    lines += [
+        f'    mov rax, qword [{result}]',
+        '    lea rsp, [rbp - 8]',
+        '    pop rbx',
+        '    pop rbp',
+        '    ret',
+    ]
+    return lines
+
+
+def pool_start(abi):
+    lines = ['hive_pool_start:',
+             '    push rbx']
+    if abi == 'windows':
+        # Shadow space, CreateThread's stack arguments and a SYSTEM_INFO.
+        lines += ['    sub rsp, 96',
+                  '    lea rcx, [rsp + 48]',
+                  '    call GetSystemInfo',
+                  '    mov ebx, dword [rsp + 80]']  # dwNumberOfProcessors
+    else:
+        lines += ['    sub rsp, 16',  # a pthread_t
+                  f'    mov edi, {SC_NPROCESSORS_ONLN}',
+                  '    call sysconf',
+                  '    mov rbx, rax']
+    lines += [
+        '    cmp rbx, 1',
+        '    jge hive_pool_start_worker',
+        '    mov ebx, 1',
+        'hive_pool_start_worker:',
+    ]
+    if abi == 'windows':
+        lines += [
+            '    xor ecx, ecx',
+            '    xor edx, edx',
+            '    lea r8, [rel hive_worker]',
+            '    xor r9d, r9d',
+            '    mov qword [rsp + 32], 0',
+            '    mov qword [rsp + 40], 0',
+            '    call CreateThread',
+            '    mov rcx, rax',
+            '    call CloseHandle',
+        ]
+    else:
+        lines += [
+            '    mov rdi, rsp',
+            '    xor esi, esi',
+            '    lea rdx, [rel hive_worker]',
+            '    xor ecx, ecx',
+            '    call pthread_create',
+        ]
+    lines += [
+        '    sub rbx, 1',
+        '    jnz hive_pool_start_worker',
+        f'    add rsp, {96 if abi == "windows" else 16}',
+        '    pop rbx',
+        '    ret',
+    ]
+    return lines
+
+
+def worker(abi):
+    """The workers' thread function: runs queued tasks, sleeping while there are none."""
+    lines = [
+        'hive_worker:',
+        f'    sub rsp, {40 if abi == "windows" else 8}',
+        'hive_worker_take:',
+        '    lea r10, [rel hive_queue]',
+        '    mov rax, qword [rel hive_queue_head]',
+        '    mov rcx, rax',
+        f'    and rcx, {QUEUE_SIZE - 1}',
+        '    shl rcx, 4',
+        '    mov rdx, rax',
+        f'    and rdx, {-QUEUE_SIZE}',
+        '    lea r8, [rdx + 1]',
+        '    cmp qword [r10 + rcx], r8',
+        '    jne hive_worker_sleep',  # empty, or another worker took the task
+        '    lea r9, [rax + 1]',
+        '    lock cmpxchg qword [rel hive_queue_head], r9',
+        '    jne hive_worker_take',
+        '    mov r11, qword [r10 + rcx + 8]',
+        f'    add rdx, {QUEUE_SIZE}',
+        '    mov qword [r10 + rcx], rdx',
+        '    lock sub qword [rel hive_pending], 1',
+        f'    mov {ARGUMENT_REGISTERS[abi][0]}, r11',
+        '    call hive_run',
+        '    jmp hive_worker_take',
+        'hive_worker_sleep:',
+        '    lock add qword [rel hive_idle], 1',
+    ]
+    # Returns at once if a task was queued since hive_pending was 0.
+    lines += wait(abi, 'rel hive_pending', 0, 'rel hive_empty')
+    lines += [
+        '    lock sub qword [rel hive_idle], 1',
+        '    jmp hive_worker_take',
+    ]
+    return lines
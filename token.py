@@ -1,24 +1,37 @@
+from token_types import TT_PLUS, TT_MINUS, TT_MUL, TT_DIV, TT_DELETE, TT_LPAREN, TT_RPAREN
+
+# Token types whose value is implied by the type.
+DEFAULT_VALUES = {
+    TT_PLUS: '+',
+    TT_MINUS: '-',
+    TT_MUL: '*',
+    TT_DIV: '/',
+    TT_DELETE: 'delete',
+    TT_LPAREN: '(',
+    TT_RPAREN: ')',
+}
+
+SPAN_COLUMN_BITS = 24
+SPAN_COLUMN_MASK = (1 << SPAN_COLUMN_BITS) - 1
+
 class Token:
-    def __init__(self, type_, value=None):
+    # type is one of the shared token_types strings, so tokens only hold a
+    # reference to it; line and column are packed into a single int.
+    __slots__ = ('type', 'value', 'span')
+
+    def __init__(self, type_, value=None, line=0, col=0):
         self.type = type_
-        self.value = value
-        if self.type == 'PLUS':
-           self.value = '+'
-        if self.type == 'MINUS':
-           self.value = '-'
-        if self.type == 'MUL':
-           self.value = '*'
-        if self.type == 'DIV':
-           self.value = '/'
-        if self.type == 'TT_DELETE':
-           self.value = 'delete'   
-        if self.type == 'LPAREN':
-           self.value = '('
-        if self.type == 'RPAREN':
-           self.value = ')'
+        self.value = DEFAULT_VALUES.get(type_, value)
+        self.span = (line << SPAN_COLUMN_BITS) | col
+    @property
+    def line(self):
+        return self.span >> SPAN_COLUMN_BITS
+    @property
+    def col(self):
+        return self.span & SPAN_COLUMN_MASK
     def __repr__(self):
         return f'Token({self.type}, {repr(self.value)})'
     def matches(self, type_, value):
         
         #print(self.type == type_ and self.value == value)
-        return self.type == type_ and self.value == value
\ No newline at end of file
+        return self.type == type_ and self.value == value
@@ -0,0 +1,59 @@
+from collections import deque
+
+from token import Token
+from token_types import TT_EOF
+
+
+class TokenStream:
+    """Pulls tokens on demand from a list or a generator such as RegexLexer.iter_tokens().
+
+    Only the tokens the parser can still look at are kept: a small lookahead
+    buffer filled by peek() and the previous token for a one-step retreat().
+    Memory therefore depends on the lookahead depth, not on the size of the
+    source.
+    """
+    def __init__(self, tokens):
+        self._source = iter(tokens)
+        self._lookahead = deque()
+        self.previous_token = None
+        self.current_token = None
+        self.exhausted = False
+
+    def _fill(self, count):
+        """Makes sure 'count' tokens are buffered, if the source has them."""
+        lookahead = self._lookahead
+        while len(lookahead) < count and not self.exhausted:
+            token = next(self._source, None)
+            if token is None:
+                self.exhausted = True
+            else:
+                lookahead.append(token)
+        return len(lookahead) >= count
+
+    def next(self):
+        """Moves to the next token; stays on the last one (EOF) once the source is drained."""
+        if self._lookahead:
+            token = self._lookahead.popleft()
+        else:
+            token = next(self._source, None)
+            if token is None:
+                self.exhausted = True
+                return self.current_token
+        self.previous_token = self.current_token
+        self.current_token = token
+        return token
+
+    def peek(self, distance=1):
+        """Returns the token 'distance' positions ahead without consuming it."""
+        if self._fill(distance):
+            return self._lookahead[distance - 1]
+        return Token(TT_EOF)
+
+    def retreat(self):
+        """Steps back one token; only the previous token is remembered."""
+        if self.previous_token is None:
+            raise Exception("Cannot retreat more than one token")
+        self._lookahead.appendleft(self.current_token)
+        self.current_token = self.previous_token
+        self.previous_token = None
+        return self.current_token
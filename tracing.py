@@ -0,0 +1,51 @@
+import sys
+
+# Verbosity levels, from quiet to chatty.
+OFF, INFO, DEBUG, TRACE = 0, 1, 2, 3
+LEVELS = {'off': OFF, 'info': INFO, 'debug': DEBUG, 'trace': TRACE}
+
+# One category per compiler phase.
+CATEGORIES = ('lexer', 'parser', 'codegen', 'compiler')
+
+levels = dict.fromkeys(CATEGORIES, OFF)
+stream = None  # None writes to sys.stderr at emit time
+
+
+def configure(spec='', output=None):
+    """Sets trace levels from a spec such as 'lexer=debug,codegen' or 'all=trace'.
+
+    A category without '=level' is traced at INFO. Categories that are not
+    named are switched off.
+    """
+    global stream
+    for category in CATEGORIES:
+        levels[category] = OFF
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        category, _, level_name = item.partition('=')
+        level_name = level_name.lower() or 'info'
+        if level_name not in LEVELS:
+            raise Exception(f"Unknown trace level '{level_name}' (expected one of {', '.join(LEVELS)})")
+        if category == 'all':
+            targets = CATEGORIES
+        elif category in levels:
+            targets = (category,)
+        else:
+            raise Exception(f"Unknown trace category '{category}' (expected all or one of {', '.join(CATEGORIES)})")
+        for target in targets:
+            levels[target] = LEVELS[level_name]
+    stream = output
+
+
+def enabled(category, level=DEBUG):
+    """True when 'category' is traced at 'level' or above.
+
+    Call sites test this before formatting a message, so disabled tracing
+    costs a dictionary lookup and never builds strings or performs I/O.
+    """
+    return levels[category] >= level
+
+
+def emit(category, message):
+    """Writes one trace line; callers check enabled() first."""
+    out = stream if stream is not None else sys.stderr
+    out.write(f'[{category}] {message}\n')
@@ -0,0 +1,84 @@
+"""Local value numbering over straight-line statements.
+
+A run is a sequence of assignments without calls, optionally ending in a
+print: nothing in it jumps, and nothing but its own stores changes a
+global. Within a run, an expression or array base pointer computed once
+can be reused from a register until a store to one of the variables it
+reads, or to any array element if it reads one, invalidates it.
+Variables used by threaded functions are never reused.
+"""
+from loop_optimizer import HOISTABLE_OPERATORS, expression_key
+from nodes import *
+
+
+def is_straight_line(node):
+    return isinstance(node, (VarAssignNode, PrintNode)) and not any(
+        isinstance(child, FunctionCallNode) for child in walk(node))
+
+
+def straight_line_run(nodes, start):
+    """End index of the run starting at nodes[start]; a print ends a run, since printf is a call."""
+    end = start
+    while end < len(nodes) and is_straight_line(nodes[end]):
+        end += 1
+        if isinstance(nodes[end - 1], PrintNode):
+            break
+    return end
+
+
+def value_names(node):
+    """(variables node reads, whether it reads an array element)."""
+    names, elements = set(), False
+    for child in walk(node):
+        if isinstance(child, (VarAccessNode, ArrayAccessNode)):
+            names.add(child.var_name_token.value)
+            elements = elements or isinstance(child, ArrayAccessNode)
+    return names, elements
+
+
+def value_key(node):
+    """Key under which node's value is remembered, or None for values not worth keeping."""
+    if isinstance(node, BinOpNode) and node.op_token.type in HOISTABLE_OPERATORS:
+        return expression_key(node)
+    if isinstance(node, ArrayAccessNode) and len(node.indexes) == 1:
+        return expression_key(node)
+    return None
+
+
+def base_key(var_name):
+    return ('base', var_name)
+
+
+def value_keys(node, shared_variables):
+    """Keys node's value and array base are remembered under, skipping those reading shared variables."""
+    keys = []
+    if isinstance(node, ArrayAccessNode) and node.var_name_token.value not in shared_variables:
+        keys.append(base_key(node.var_name_token.value))
+    key = value_key(node)
+    if key is not None and not value_names(node)[0] & shared_variables:
+        keys.append(key)
+    return keys
+
+
+def count_values(statements, shared_variables, reused=frozenset()):
+    """Occurrences of each key; repeats of a reused key are not looked into, their parts are not evaluated."""
+    counts = {}
+    stack = list(reversed(statements))
+    while stack:
+        node = stack.pop()
+        keys = value_keys(node, shared_variables)
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+        if keys and keys[-1] in reused and counts[keys[-1]] > 1:
+            continue
+        stack.extend(reversed(list(iter_child_nodes(node))))
+    return counts
+
+
+def repeated_values(statements, shared_variables=()):
+    """Keys of the values and array bases that are evaluated more than once in statements."""
+    shared_variables = set(shared_variables)
+    counts = count_values(statements, shared_variables)
+    reused = {key for key, count in counts.items() if count > 1}
+    counts = count_values(statements, shared_variables, reused)
+    return {key for key, count in counts.items() if count > 1}
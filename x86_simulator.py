@@ -0,0 +1,404 @@
+"""Runs generated x86-64 assembly in Python.
+
+Only the instructions and library calls the code generators emit are
+supported. Tests use it to check that optimizations leave program output
+unchanged on machines without nasm; threaded calls run the thread to
+completion before returning, which is one valid interleaving.
+
+Threads are cooperative: each runs on its own stack until it returns or
+waits on an address with futex(2), WaitOnAddress or a held SRWLOCK. A
+waiting thread is parked, and its creator continues. Waking the address
+runs the parked thread until it returns or waits again, then the waker
+continues. Locked instructions are atomic because only one thread runs
+at a time.
+"""
+import re
+
+MASK = 2**64 - 1
+REGISTERS = ('rax', 'rbx', 'rcx', 'rdx', 'rsi', 'rdi', 'rbp', 'rsp',
+             'r8', 'r9', 'r10', 'r11', 'r12', 'r13', 'r14', 'r15')
+DWORD_REGISTERS = {'eax': 'rax', 'ebx': 'rbx', 'ecx': 'rcx', 'edx': 'rdx', 'esi': 'rsi', 'edi': 'rdi',
+                   **{f'r{n}d': f'r{n}' for n in range(8, 16)}}
+BYTE_REGISTERS = {'al': 'rax', 'bl': 'rbx', 'cl': 'rcx', 'dl': 'rdx', 'sil': 'rsi', 'dil': 'rdi',
+                  **{f'r{n}b': f'r{n}' for n in range(8, 16)}}
+CONDITIONS = {
+    'e': lambda a, b: a == b, 'z': lambda a, b: a == b,
+    'ne': lambda a, b: a != b, 'nz': lambda a, b: a != b,
+    'l': lambda a, b: a < b, 'g': lambda a, b: a > b,
+    'le': lambda a, b: a <= b, 'ge': lambda a, b: a >= b,
+}
+GLOBALS_BASE = 0x1000
+HEAP_BASE = 0x10000000
+STACK_TOP = 0x7fff0000
+THREAD_STACKS = 0x70000000  # thread n's stack grows down from THREAD_STACKS - n * THREAD_STACK_SIZE
+THREAD_STACK_SIZE = 0x100000
+RETURN_TO_HOST = -1
+SHADOW_JUNK = 0x5ADD0C5ADD0C  # what a Windows library function leaves in its caller's shadow space
+SIMULATED_CPUS = 4  # what sysconf and GetSystemInfo report
+FUTEX_WAIT = 0
+# printf's format string and values, in argument order.
+PRINTF_REGISTERS = {'windows': ('rcx', 'rdx', 'r8', 'r9'), 'linux': ('rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9')}
+
+
+def signed(value):
+    value &= MASK
+    return value - 2**64 if value >= 2**63 else value
+
+
+def c_format(text, values):
+    """printf's output for a format string using only %lld conversions."""
+    return text.replace('%lld', '%d') % tuple(values[:text.count('%lld')])
+
+
+def split_operands(text):
+    """Splits an operand list on commas outside brackets."""
+    operands, depth, current = [], 0, ''
+    for char in text:
+        if char == ',' and depth == 0:
+            operands.append(current.strip())
+            current = ''
+            continue
+        depth += char == '['
+        depth -= char == ']'
+        current += char
+    if current.strip():
+        operands.append(current.strip())
+    return operands
+
+
+class SimulationError(Exception):
+    pass
+
+
+class X86Simulator:
+    """Executes a program from a code generator; abi selects the library calls.
+
+    run() returns everything printf printed.
+    """
+    def __init__(self, asm_code, abi='linux', max_steps=10_000_000):
+        self.abi = abi
+        self.max_steps = max_steps
+        self.instructions = []
+        self.labels = {}
+        self.symbols = {}
+        self.constants = {}
+        self.strings = {}  # address -> text of the db strings
+        self.memory = {}
+        self.registers = dict.fromkeys(REGISTERS, 0)
+        self.flags = (0, 0)
+        self.heap = HEAP_BASE
+        self.allocated = set()  # addresses of the heap blocks not freed yet
+        self.output = []
+        self.steps = 0  # instructions executed so far, threads included
+        self.stack_top = STACK_TOP  # of the running thread
+        self.stack_bytes = 0  # deepest any thread's stack has grown below its top, in bytes
+        self.threads = 0  # threads created so far
+        self.library_calls = {}  # name -> calls made to that library function
+        self.parked = []  # (address, context) of waiting threads, oldest first
+        self.load(asm_code)
+
+    def load(self, asm_code):
+        address = GLOBALS_BASE
+        for line in asm_code.splitlines():
+            line = line.split(';')[0].rstrip()
+            if not line.strip():
+                continue
+            if line.startswith((' ', '\t')):
+                mnemonic, _, operands = line.strip().partition(' ')
+                if mnemonic == 'lock':
+                    mnemonic, _, operands = operands.partition(' ')
+                self.instructions.append((mnemonic, split_operands(operands)))
+                continue
+            match = re.match(r'([\w.]+):?\s+resq\s+(\d+)$', line)
+            if match:
+                self.symbols[match.group(1)] = address
+                address += 8 * int(match.group(2))
+                continue
+            match = re.match(r'alignb\s+(\d+)$', line)
+            if match:
+                address = -(-address // int(match.group(1))) * int(match.group(1))
+                continue
+            match = re.match(r'(\w+)\s+equ\s+(\S+)$', line)
+            if match:
+                self.constants[match.group(1)] = int(match.group(2), 0)
+                continue
+            match = re.match(r'(\w+):?\s+db\b(.*)$', line)
+            if match:
+                self.symbols[match.group(1)] = address
+                parts = re.findall(r'"([^"]*)"|(\d+)', match.group(2))
+                self.strings[address] = ''.join(text or chr(int(code)) for text, code in parts).rstrip('\0')
+                address += 8
+                continue
+            if line.endswith(':'):
+                self.labels[line[:-1]] = len(self.instructions)
+
+    # Operands
+
+    def address(self, operand):
+        expression = operand[operand.index('[') + 1:operand.rindex(']')].replace('rel ', '')
+        total = 0
+        for sign, term in re.findall(r'([+-]?)\s*([^+-]+)', expression):
+            term = term.strip()
+            if '*' in term:
+                register, scale = term.split('*')
+                value = self.registers[register.strip()] * int(scale)
+            elif term in self.registers:
+                value = self.registers[term]
+            elif term in self.symbols:
+                value = self.symbols[term]
+            else:
+                value = int(term, 0)
+            total += -value if sign == '-' else value
+        return total & MASK
+
+    def read(self, operand):
+        if operand in self.registers:
+            return self.registers[operand]
+        if operand in DWORD_REGISTERS:
+            return self.registers[DWORD_REGISTERS[operand]] & 0xffffffff
+        if operand in BYTE_REGISTERS:
+            return self.registers[BYTE_REGISTERS[operand]] & 0xff
+        if '[' in operand:
+            return self.memory.get(self.address(operand), 0)
+        if operand in self.constants:
+            return self.constants[operand]
+        return signed(int(operand, 0))
+
+    def write(self, operand, value):
+        if operand in self.registers:
+            self.registers[operand] = signed(value)
+        elif operand in DWORD_REGISTERS:
+            self.registers[DWORD_REGISTERS[operand]] = value & 0xffffffff
+        elif operand in BYTE_REGISTERS:
+            register = BYTE_REGISTERS[operand]
+            self.registers[register] = signed((self.registers[register] & ~0xff) | (value & 0xff))
+        elif '[' in operand:
+            self.memory[self.address(operand)] = signed(value)
+        else:
+            raise SimulationError(f"cannot write to {operand}")
+
+    def push(self, value):
+        self.registers['rsp'] -= 8
+        self.memory[self.registers['rsp'] & MASK] = signed(value)
+        self.stack_bytes = max(self.stack_bytes, self.stack_top - self.registers['rsp'])
+
+    def pop(self):
+        value = self.memory[self.registers['rsp'] & MASK]
+        self.registers['rsp'] += 8
+        return value
+
+    # Execution
+
+    def run(self):
+        self.registers['rsp'] = STACK_TOP
+        self.call(self.labels['main'])
+        return ''.join(self.output)
+
+    def call(self, pc):
+        """Runs from pc until the matching ret, like a call from the host."""
+        self.push(RETURN_TO_HOST)
+        self.execute(pc)
+
+    def execute(self, pc):
+        """Runs the current thread from pc until it returns to the host or waits."""
+        while pc is not None:
+            self.steps += 1
+            if self.steps > self.max_steps:
+                raise SimulationError("step limit exceeded")
+            mnemonic, operands = self.instructions[pc]
+            pc = self.step(mnemonic, operands, pc + 1)
+
+    def step(self, op, args, next_pc):
+        r = self.registers
+        if op == 'mov':
+            self.write(args[0], self.read(args[1]))
+        elif op == 'movzx':
+            self.write(args[0], self.read(args[1]))
+        elif op == 'lea':
+            target = args[1][args[1].index('[') + 1:-1].replace('rel ', '').strip()
+            self.write(args[0], self.labels[target] if target in self.labels else self.address(args[1]))
+        elif op == 'xchg':
+            first, second = self.read(args[0]), self.read(args[1])
+            self.write(args[0], second)
+            self.write(args[1], first)
+        elif op == 'push':
+            self.push(self.read(args[0]))
+        elif op == 'pop':
+            self.write(args[0], self.pop())
+        elif op in ('add', 'sub', 'and', 'or', 'xor', 'shl', 'sar', 'shr'):
+            a, b = signed(self.read(args[0])), signed(self.read(args[1]))
+            result = {
+                'add': lambda: a + b, 'sub': lambda: a - b, 'and': lambda: a & b,
+                'or': lambda: a | b, 'xor': lambda: a ^ b, 'shl': lambda: a << (b & 63),
+                'sar': lambda: a >> (b & 63), 'shr': lambda: (a & MASK) >> (b & 63),
+            }[op]()
+            self.write(args[0], result)
+            self.flags = (signed(result), 0)
+            if args[0] == 'rsp':
+                self.stack_bytes = max(self.stack_bytes, self.stack_top - r['rsp'])
+        elif op == 'imul':
+            if len(args) == 1:
+                product = signed(r['rax']) * signed(self.read(args[0]))
+                r['rax'], r['rdx'] = signed(product), signed(product >> 64)
+                return next_pc
+            if len(args) == 3:
+                result = signed(self.read(args[1])) * signed(self.read(args[2]))
+            else:
+                result = signed(self.read(args[0])) * signed(self.read(args[1]))
+            self.write(args[0], result)
+            self.flags = (signed(result), 0)
+        elif op == 'cmpxchg':
+            current = signed(self.read(args[0]))
+            self.flags = (current, signed(r['rax']))
+            if current == signed(r['rax']):
+                self.write(args[0], self.read(args[1]))
+            else:
+                r['rax'] = current
+        elif op == 'xadd':
+            current, total = signed(self.read(args[0])), signed(self.read(args[0]) + self.read(args[1]))
+            self.write(args[0], total)
+            self.write(args[1], current)
+            self.flags = (total, 0)
+        elif op in ('inc', 'dec', 'neg', 'not'):
+            value = signed(self.read(args[0]))
+            result = {'inc': value + 1, 'dec': value - 1, 'neg': -value, 'not': ~value}[op]
+            self.write(args[0], result)
+            self.flags = (signed(result), 0)
+        elif op == 'cqo':
+            r['rdx'] = -1 if r['rax'] < 0 else 0
+        elif op == 'idiv':
+            divisor = signed(self.read(args[0]))
+            if divisor == 0:
+                raise SimulationError("division by zero")
+            dividend = (r['rdx'] << 64) | (r['rax'] & MASK)
+            quotient = abs(dividend) // abs(divisor)
+            if (dividend < 0) != (divisor < 0):
+                quotient = -quotient
+            r['rax'], r['rdx'] = signed(quotient), signed(dividend - quotient * divisor)
+        elif op == 'cmp':
+            self.flags = (signed(self.read(args[0])), signed(self.read(args[1])))
+        elif op == 'test':
+            self.flags = (signed(self.read(args[0]) & self.read(args[1])), 0)
+        elif op.startswith('set'):
+            self.write(args[0], int(CONDITIONS[op[3:]](*self.flags)))
+        elif op.startswith('cmov'):
+            if CONDITIONS[op[4:]](*self.flags):
+                self.write(args[0], self.read(args[1]))
+        elif op == 'jmp':
+            return self.labels[args[0]]
+        elif op.startswith('j'):
+            return self.labels[args[0]] if CONDITIONS[op[1:]](*self.flags) else next_pc
+        elif op == 'call':
+            return self.call_function(args[0], next_pc)
+        elif op == 'ret':
+            target = self.pop()
+            return None if target == RETURN_TO_HOST else target
+        elif op in ('nop', 'mfence', 'pause'):
+            pass
+        else:
+            raise SimulationError(f"unsupported instruction {op} {', '.join(args)}")
+        return next_pc
+
+    def call_function(self, name, next_pc):
+        r = self.registers
+        if name in self.labels or name in self.registers or '[' in name:
+            target = self.labels[name] if name in self.labels else self.read(name)
+            self.push(next_pc)
+            return target
+        if r['rsp'] % 16:
+            raise SimulationError(f"{name} called with rsp not 16-byte aligned")
+        self.library_calls[name] = self.library_calls.get(name, 0) + 1
+        if self.abi == 'windows':
+            # The callee may use the 32 bytes of shadow space at its caller's rsp.
+            for offset in range(0, 32, 8):
+                self.memory[r['rsp'] + offset] = SHADOW_JUNK
+        if name == 'printf':
+            registers = PRINTF_REGISTERS[self.abi]
+            text = self.strings.get(r[registers[0]], '%lld\n')  # as the generators' format, if not a db string
+            self.output.append(c_format(text, [r[register] for register in registers[1:]]))
+        elif name in ('malloc', 'HeapAlloc'):
+            size = r['r8'] if name == 'HeapAlloc' else r['rdi']
+            r['rax'] = self.heap
+            self.allocated.add(self.heap)
+            for offset in range(0, size, 8):
+                self.memory[self.heap + offset] = 0
+            self.heap += max(size, 8)
+        elif name in ('pthread_create', 'CreateThread'):
+            start, argument = (r['r8'], r['r9']) if name == 'CreateThread' else (r['rdx'], r['rcx'])
+            saved = self.context(next_pc)
+            r['rcx' if self.abi == 'windows' else 'rdi'] = argument
+            self.stack_top = r['rsp'] = THREAD_STACKS - self.threads * THREAD_STACK_SIZE
+            self.threads += 1
+            self.call(start)
+            self.restore(saved)
+            r['rax'] = 1 if name == 'CreateThread' else 0
+        elif name == 'syscall':  # futex(2), the only system call the runtime makes
+            if r['rdx'] & 127 == FUTEX_WAIT:
+                if self.memory.get(r['rsi'], 0) == signed(r['rcx']):
+                    return self.park(r['rsi'], next_pc)
+                r['rax'] = -1
+            else:
+                r['rax'] = self.wake(r['rsi'], r['rcx'])
+        elif name == 'WaitOnAddress':
+            if self.memory.get(r['rcx'], 0) == self.memory.get(r['rdx'], 0):
+                return self.park(r['rcx'], next_pc)
+            r['rax'] = 1
+        elif name in ('WakeByAddressSingle', 'WakeByAddressAll'):
+            self.wake(r['rcx'], 1 if name == 'WakeByAddressSingle' else len(self.parked))
+        elif name in ('AcquireSRWLockExclusive', 'TryAcquireSRWLockExclusive'):
+            # Held locks are 1 here; a parked AcquireSRWLockExclusive is called again when woken.
+            if self.memory.get(r['rcx'], 0) == 0:
+                self.memory[r['rcx']] = 1
+                r['rax'] = 1
+            elif name == 'AcquireSRWLockExclusive':
+                return self.park(r['rcx'], next_pc - 1)
+            else:
+                r['rax'] = 0
+        elif name == 'ReleaseSRWLockExclusive':
+            self.memory[r['rcx']] = 0
+            self.wake(r['rcx'], 1)
+        elif name == 'sysconf':
+            r['rax'] = SIMULATED_CPUS
+        elif name == 'GetSystemInfo':
+            self.memory[r['rcx'] + 32] = SIMULATED_CPUS  # dwNumberOfProcessors
+        elif name == 'ExitProcess':
+            return None
+        elif name in ('free', 'HeapFree'):
+            self.allocated.discard(r['r8'] if name == 'HeapFree' else r['rdi'])
+            r['rax'] = 0
+        elif name in ('CloseHandle', 'GetProcessHeap', 'pthread_join'):
+            r['rax'] = 0
+        else:
+            raise SimulationError(f"unknown function {name}")
+        return next_pc
+
+    # Threads
+
+    def context(self, pc):
+        return dict(self.registers), self.flags, self.stack_top, pc
+
+    def restore(self, context):
+        registers, self.flags, self.stack_top, pc = context
+        self.registers.update(registers)
+        return pc
+
+    def park(self, address, next_pc):
+        """Suspends the running thread until address is woken; its creator or waker continues."""
+        self.parked.append((address, self.context(next_pc)))
+        return None
+
+    def wake(self, address, count):
+        """Runs up to count threads waiting on address in turn; returns how many there were."""
+        woken = 0
+        while woken < count:
+            waiting = next((entry for entry in self.parked if entry[0] == address), None)
+            if waiting is None:
+                break
+            self.parked.remove(waiting)
+            woken += 1
+            saved = self.context(None)
+            pc = self.restore(waiting[1])
+            self.registers['rax'] = 1 if self.abi == 'windows' else 0
+            self.execute(pc)
+            self.restore(saved)
+        return woken